@@ -19,6 +19,7 @@ Requires: coreutils
 Requires: grep
 Requires: python3-lxml
 Requires: python3-PyYAML
+Recommends: python3-numpy
 Requires: sed
 Requires: tar
 Requires: util-linux
@@ -78,7 +79,10 @@ fi
 %config(noreplace) %{_sysconfdir}/%{name}.conf
 %{_bindir}/mkova.sh
 %{_bindir}/ova-compose
+%{_prefix}/lib/%{name}
 %{_bindir}/vmdk-convert
+%{_prefix}/lib/libvmdk.so*
+%{_includedir}/libvmdk.h
 %{_datadir}/%{name}/*
 
 %files -n ovfenv
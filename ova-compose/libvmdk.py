@@ -0,0 +1,168 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the “License”); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+ctypes binding of libvmdk.so.1, the library with the disk formats of
+vmdk-convert. The GIL is released while the library runs, so several disks
+can be converted at once from threads of one process.
+"""
+
+import ctypes
+import json
+import os
+
+
+LIBRARY = "libvmdk.so.1"
+
+# void (*)(uint64_t done, uint64_t total, void *data)
+PROGRESS_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_uint64, ctypes.c_uint64, ctypes.c_void_p)
+
+_lib = None
+_path = None
+
+
+def load(path=None):
+    """
+    Loads libvmdk from path, or by its soname if path is None. Raises
+    OSError if the library cannot be loaded.
+    """
+    global _lib, _path
+    if _lib is not None and path is None:
+        return _lib
+
+    lib = ctypes.CDLL(path or LIBRARY, use_errno=True)
+
+    lib.Vmdk_Open.argtypes = [ctypes.c_char_p]
+    lib.Vmdk_Open.restype = ctypes.c_void_p
+    lib.Vmdk_GetCapacity.argtypes = [ctypes.c_void_p]
+    lib.Vmdk_GetCapacity.restype = ctypes.c_uint64
+    lib.Vmdk_Info.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.Vmdk_Info.restype = ctypes.c_void_p
+    lib.Vmdk_Convert.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int,
+                                 ctypes.c_int, PROGRESS_FUNC, ctypes.c_void_p]
+    lib.Vmdk_Convert.restype = ctypes.c_int
+    lib.Vmdk_ConvertAt.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64, ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_int, PROGRESS_FUNC, ctypes.c_void_p]
+    lib.Vmdk_ConvertAt.restype = ctypes.c_int
+    lib.Vmdk_Cancel.argtypes = [ctypes.c_void_p]
+    lib.Vmdk_Cancel.restype = None
+    lib.Vmdk_Close.argtypes = [ctypes.c_void_p]
+    lib.Vmdk_Close.restype = None
+    lib.Vmdk_Free.argtypes = [ctypes.c_void_p]
+    lib.Vmdk_Free.restype = None
+
+    _lib = lib
+    _path = path
+    return lib
+
+
+def library_path():
+    """
+    The file of the loaded library, to tell versions apart. None if no
+    library is loaded or its file is not known.
+    """
+    if _lib is None:
+        return None
+    if _path is not None:
+        return os.path.abspath(_path)
+    try:
+        with open("/proc/self/maps", "rt") as f:
+            for line in f:
+                fields = line.split(maxsplit=5)
+                if len(fields) == 6 and os.path.basename(fields[5].strip()).startswith("libvmdk.so"):
+                    return fields[5].strip()
+    except OSError:
+        pass
+    return None
+
+
+def _error(filename):
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err), filename)
+
+
+class Disk(object):
+
+    def __init__(self, path, library=None):
+        """
+        Opens a sparse VMDK, qcow2, VHD or VHDX, or a raw image. Raises
+        OSError if it cannot be opened.
+        """
+        self._lib = load(library)
+        self.path = path
+        self._handle = self._lib.Vmdk_Open(os.fsencode(path))
+        if not self._handle:
+            raise _error(path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def capacity(self):
+        return self._lib.Vmdk_GetCapacity(self._handle)
+
+
+    def info(self, detailed=True):
+        """The output of vmdk-convert -i [--detailed] as a dict."""
+        result = self._lib.Vmdk_Info(self._handle, int(detailed))
+        if not result:
+            raise _error(self.path)
+        try:
+            return json.loads(ctypes.string_at(result).decode("UTF-8"))
+        finally:
+            self._lib.Vmdk_Free(result)
+
+
+    def convert(self, path, format=None, compression_level=0, num_threads=0, sector_size=0, progress=None):
+        """
+        Converts the disk to path, like vmdk-convert. format is picked by
+        the extension of path if it is None. progress is called with the
+        bytes read so far and the capacity. Raises OSError on failure, with
+        errno ECANCELED if the conversion was cancelled.
+        """
+        callback = PROGRESS_FUNC(lambda done, total, data: progress(done, total)) if progress else PROGRESS_FUNC()
+        ret = self._lib.Vmdk_Convert(self._handle, os.fsencode(path), format.encode() if format else None,
+                                     compression_level, num_threads, sector_size or 0, callback, None)
+        if ret != 0:
+            raise _error(path)
+
+
+    def convert_at(self, path, offset, compression_level=0, num_threads=0, sector_size=0, progress=None):
+        """
+        Converts the disk to a streamOptimized VMDK written into the
+        existing file path at offset, a multiple of 512. On failure path is
+        truncated to offset.
+        """
+        callback = PROGRESS_FUNC(lambda done, total, data: progress(done, total)) if progress else PROGRESS_FUNC()
+        ret = self._lib.Vmdk_ConvertAt(self._handle, os.fsencode(path), offset,
+                                       compression_level, num_threads, sector_size or 0, callback, None)
+        if ret != 0:
+            raise _error(path)
+
+
+    def cancel(self):
+        """Cancels the running conversion. Can be called from any thread."""
+        if self._handle:
+            self._lib.Vmdk_Cancel(self._handle)
+
+
+    def close(self):
+        if self._handle:
+            self._lib.Vmdk_Close(self._handle)
+            self._handle = None
@@ -17,19 +17,51 @@ import sys
 import os
 import subprocess
 import getopt
+import itertools
 import datetime
+import fcntl
+import functools
 import yaml
 import json
 from lxml import etree as ET
 import hashlib
 import tempfile
 import shutil
-from concurrent.futures import ProcessPoolExecutor
+import select
+import stat
+import tarfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# vmdkinfo and libvmdk are installed to <prefix>/lib/open-vmdk, vmdkinfo needs numpy
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib", "open-vmdk"))
+try:
+    import vmdkinfo
+except ImportError:
+    vmdkinfo = None
+try:
+    import libvmdk
+except ImportError:
+    libvmdk = None
 
 APP_NAME = "ova-compose"
 
 VMDK_CONVERT = "vmdk-convert"
 
+# the JobBudget limiting conversion threads and hashing, None for no limit
+JOB_BUDGET = None
+
+# the directory of the caches, set with --cache-dir
+CACHE_DIR = None
+
+# FileCaches of digests and disk info, from earlier builds unless --no-cache is set
+DIGEST_CACHE = None
+DISK_INFO_CACHE = None
+
+# the ConversionCache of VMDKs converted by earlier builds, only with --cache-dir or --cache-size
+CONVERSION_CACHE = None
+
 NS_CIM = "http://schemas.dmtf.org/wbem/wscim/1/common"
 NS_OVF = "http://schemas.dmtf.org/ovf/envelope/1"
 NS_RASD = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData"
@@ -88,6 +120,485 @@ class ValidationError(Exception):
     pass
 
 
+class BuildGraph(object):
+    """
+    Runs the steps of a build on a pool of threads, each as soon as the
+    steps it depends on are done. Conversions run in vmdk-convert or in
+    libvmdk, and hashlib releases the GIL, so the threads run in parallel.
+    """
+
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.tasks = {}
+
+
+    def add(self, name, func, deps=[]):
+        """
+        Runs func once the tasks named in deps are done, and returns a future
+        for its result. If a dependency fails, the task fails with the same
+        exception without running.
+        """
+        future = Future()
+        dep_futures = [self.tasks[dep] for dep in deps]
+        remaining = len(dep_futures)
+        self.tasks[name] = future
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func())
+                except BaseException as e:
+                    future.set_exception(e)
+
+        def dep_done(dep):
+            nonlocal remaining
+            with self.lock:
+                remaining -= 1
+                if remaining > 0:
+                    return
+            errors = [f.exception() for f in dep_futures if f.exception() is not None]
+            if errors:
+                future.set_exception(errors[0])
+            else:
+                self.executor.submit(run)
+
+        if dep_futures:
+            for dep in dep_futures:
+                dep.add_done_callback(dep_done)
+        else:
+            self.executor.submit(run)
+        return future
+
+
+    def get(self, name):
+        return self.tasks.get(name)
+
+
+    def result(self, name):
+        return self.tasks[name].result()
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class JobBudget(object):
+    """
+    Limits the threads of a build to --jobs, or to the tokens of the GNU
+    make jobserver when running from make -j. Like every job of make,
+    ova-compose holds one token without asking. Tasks take tokens before
+    they run and return them afterwards: a hash needs one, a conversion
+    runs with as many threads as tokens it can get.
+    """
+
+    def __init__(self, jobs=None, read_fd=None, write_fd=None):
+        self.cond = threading.Condition()
+        self.jobs = jobs
+        self.held = 0
+        self.tokens = []
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.free = jobs if read_fd is None else 1
+        # without --jobs, a conversion takes at most one token per CPU
+        self.max_per_task = jobs if jobs is not None else os.cpu_count()
+
+
+    @classmethod
+    def from_environment(cls, jobs=None):
+        """The budget for --jobs and the jobserver in MAKEFLAGS, None if there is neither."""
+        read_fd, write_fd = cls._jobserver(os.environ.get("MAKEFLAGS", ""))
+        if read_fd is None and jobs is None:
+            return None
+        return cls(jobs, read_fd, write_fd)
+
+
+    @staticmethod
+    def _jobserver(makeflags):
+        """The file descriptors of the jobserver in MAKEFLAGS, or (None, None)."""
+        auth = None
+        for flag in makeflags.split():
+            for prefix in ["--jobserver-auth=", "--jobserver-fds="]:
+                if flag.startswith(prefix):
+                    auth = flag[len(prefix):]
+        if auth is None:
+            return None, None
+        try:
+            if auth.startswith("fifo:"):
+                fd = os.open(auth[5:], os.O_RDWR | os.O_NONBLOCK)
+                return fd, fd
+            read_fd, write_fd = [int(fd) for fd in auth.split(",")]
+            # make closes the pipe for commands not marked as recursive
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except (OSError, ValueError):
+            print(f"warning: jobserver {auth} is not available, add '+' to the make rule")
+            return None, None
+        # Another job can take the token between select() and read(). The
+        # inherited pipe is shared with make and blocking, reopening it
+        # gives a non-blocking descriptor of our own. Without /proc, read()
+        # waits for the next token.
+        try:
+            read_fd = os.open(f"/proc/self/fd/{read_fd}", os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            pass
+        return read_fd, write_fd
+
+
+    def _take(self, block):
+        while True:
+            with self.cond:
+                if self.jobs is not None and self.held >= self.jobs:
+                    if not block:
+                        return False
+                    self.cond.wait()
+                    continue
+                if self.free > 0:
+                    self.free -= 1
+                    self.held += 1
+                    return True
+                if self.read_fd is None:
+                    if not block:
+                        return False
+                    self.cond.wait()
+                    continue
+                # reserved while reading from the jobserver
+                self.held += 1
+
+            # wake up now and then for tokens returned by other threads
+            token = b""
+            if select.select([self.read_fd], [], [], 0.1 if block else 0)[0]:
+                try:
+                    token = os.read(self.read_fd, 1)
+                except BlockingIOError:
+                    # taken by another job
+                    pass
+            with self.cond:
+                if token:
+                    self.tokens.append(token)
+                    return True
+                self.held -= 1
+                self.cond.notify()
+            if not block:
+                return False
+
+
+    def acquire(self, max_tokens=1):
+        """Waits for one token, takes up to max_tokens if available and returns the number taken."""
+        count = 0
+        while count == 0:
+            count += self._take(True)
+        while count < max_tokens and self._take(False):
+            count += 1
+        return count
+
+
+    def release(self, count=1):
+        with self.cond:
+            for i in range(count):
+                # tokens of the jobserver go back first, for other jobs of make
+                if self.tokens:
+                    os.write(self.write_fd, self.tokens.pop())
+                else:
+                    self.free += 1
+                self.held -= 1
+            self.cond.notify_all()
+
+
+def cache_dir():
+    if CACHE_DIR is not None:
+        return CACHE_DIR
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "open-vmdk")
+
+
+def file_key(st):
+    """Identifies the content of a file by its stat result, until it is changed or replaced."""
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}"
+
+
+class FileCache(object):
+    """
+    Values computed from files, like their digests, keyed by the identity
+    of the file. A file that was changed or replaced has another key, so
+    its value is computed again.
+
+    The cache is a JSON file in the cache directory, shared by all builds
+    of the user. Entries are merged into the file under a lock when it is
+    saved, so concurrent builds do not lose each other's entries. Beyond
+    max_entries, the least recently used entries are dropped. The cache is
+    only an optimization, so errors reading or writing it are ignored.
+    """
+
+    # file systems with a coarse time stamp could not tell a file written
+    # right after it was read, so only older files are cached
+    RACY_SECONDS = 2
+
+    def __init__(self, name, persistent=True, max_entries=10000):
+        self.path = os.path.join(cache_dir(), name)
+        self.persistent = persistent
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key: [value, time last used]
+        self.entries = self._read() if persistent else {}
+        self.changed = {}
+        # values only kept for this process
+        self.local = {}
+
+
+    def _read(self):
+        try:
+            with open(self.path, "rt") as f:
+                entries = json.load(f)
+            assert isinstance(entries, dict)
+            return entries
+        except (OSError, ValueError, AssertionError):
+            return {}
+
+
+    def get(self, key):
+        with self.lock:
+            if key in self.local:
+                return self.local[key]
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry[1] = time.time()
+            self.changed[key] = entry
+            return entry[0]
+
+
+    def put(self, key, value, persistent=True):
+        with self.lock:
+            if not persistent:
+                self.local[key] = value
+                return
+            entry = [value, time.time()]
+            self.entries[key] = entry
+            self.changed[key] = entry
+
+
+    def lookup(self, st, kind):
+        """The value of type kind for the file with the stat result st, or None."""
+        return self.get(f"{file_key(st)}:{kind}")
+
+
+    def store(self, path, st, kind, value, started):
+        """
+        Caches the value of type kind for path, read since the time started
+        with the stat result st, if the file did not change meanwhile. A
+        value of a file changed just before is only kept for this process.
+        """
+        try:
+            if file_key(os.stat(path)) != file_key(st):
+                return
+        except OSError:
+            return
+        self.put(f"{file_key(st)}:{kind}", value,
+                 persistent=max(st.st_mtime, st.st_ctime) <= started - FileCache.RACY_SECONDS)
+
+
+    def save(self):
+        with self.lock:
+            if not self.persistent or not self.changed:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(f"{self.path}.lock", "a") as lock:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                    entries = self._read()
+                    entries.update(self.changed)
+                    if len(entries) > self.max_entries:
+                        keys = sorted(entries, key=lambda k: entries[k][1], reverse=True)[:self.max_entries]
+                        entries = {k: entries[k] for k in keys}
+                    data = json.dumps(entries)
+                    tmp_file = f"{self.path}.{os.getpid()}.tmp"
+                    with open(tmp_file, "wt") as f:
+                        f.write(data)
+                    os.replace(tmp_file, self.path)
+                self.changed = {}
+            except (OSError, TypeError, ValueError) as e:
+                print(f"warning: could not save {self.path}: {e}")
+
+class ConversionCache(object):
+    """
+    VMDKs converted by earlier builds, named by the digest of the raw image,
+    the conversion options and the converter, so identical inputs are only
+    converted once, even if the raw image was touched or copied. The
+    directory can be shared by the builds on a host, or between hosts. A
+    VMDK is a reflink to its cache entry where the file system supports
+    it, otherwise a copy, so writing to the VMDK does not change the entry.
+    Entries are read-only. Beyond max_size bytes, the least recently used
+    entries are removed.
+    """
+
+    # from linux/fs.h
+    FICLONE = 0x40049409
+
+    def __init__(self, directory, max_size, quiet=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.converter = None
+
+
+    def _converter(self):
+        """Tells converters apart by the digest of the program or library."""
+        with self.lock:
+            if self.converter is None:
+                if OVF._use_libvmdk():
+                    path = libvmdk.library_path()
+                else:
+                    path = shutil.which(VMDK_CONVERT)
+                self.converter = OVF._get_hash((path, "sha256")) if path is not None else VMDK_CONVERT
+            return self.converter
+
+
+    def key(self, raw_image, sector_size):
+        options = {
+            'raw_image': OVF._get_hash((raw_image, "sha256")),
+            'sector_size': sector_size,
+            'converter': self._converter(),
+        }
+        return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+    def _entry(self, key):
+        return os.path.join(self.directory, f"{key}.vmdk")
+
+
+    @staticmethod
+    def _place(src, dst, read_only=False):
+        # a temporary name first, so dst is never partially written
+        tmp_file = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            try:
+                # shares the blocks copy-on-write, on btrfs or xfs
+                with open(src, "rb") as fsrc, open(tmp_file, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), ConversionCache.FICLONE, fsrc.fileno())
+            except OSError:
+                shutil.copyfile(src, tmp_file)
+            if read_only:
+                os.chmod(tmp_file, 0o444)
+            os.replace(tmp_file, dst)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+    def get(self, key, path):
+        """
+        Makes path the VMDK of key if it is cached, returns False if it is
+        not.
+        """
+        entry = self._entry(key)
+        if not os.path.exists(entry):
+            return False
+        try:
+            # used now, for the eviction
+            with open(f"{entry}.used", "a"):
+                pass
+            os.utime(f"{entry}.used")
+            if os.path.exists(path):
+                if os.path.getsize(path) == os.path.getsize(entry) and \
+                   OVF._get_hash((path, "sha256")) == OVF._get_hash((entry, "sha256")):
+                    return True
+            ConversionCache._place(entry, path)
+        except OSError:
+            # removed by another build meanwhile
+            return False
+        if not self.quiet:
+            print(f"using cached {path}")
+        return True
+
+
+    def put(self, key, path):
+        """
+        Adds the VMDK path for key, and removes entries beyond the size of
+        the cache.
+        """
+        entry = self._entry(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            ConversionCache._place(path, entry, read_only=True)
+            with open(f"{entry}.used", "a"):
+                pass
+            os.utime(f"{entry}.used")
+            self._evict()
+        except OSError as e:
+            print(f"warning: could not add {path} to {self.directory}: {e}")
+
+
+    def _evict(self):
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".vmdk"):
+                    continue
+                entry = os.path.join(self.directory, name)
+                try:
+                    size = os.path.getsize(entry)
+                    used = os.path.getmtime(f"{entry}.used") if os.path.exists(f"{entry}.used") else os.path.getmtime(entry)
+                except OSError:
+                    continue
+                entries.append((used, size, entry))
+            total = sum(size for used, size, entry in entries)
+            for used, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for name in [entry, f"{entry}.used"]:
+                    if os.path.exists(name):
+                        os.remove(name)
+                total -= size
+
+
+class DirectDisks(object):
+    """
+    The direct disks converted by the builds of a batch, so each raw image
+    is converted once. A disk is kept as a range of a file: the member of
+    the first OVA it was converted into, or a VMDK in a temporary directory
+    of the batch if it could not be converted into the OVA. Later builds
+    copy the range.
+    """
+
+    def __init__(self):
+        # builds change to their own temporary directories
+        self.parent = os.getcwd()
+        self.directory = None
+        self.disks = {}
+
+
+    @staticmethod
+    def _key(disk):
+        return (disk.raw_image, disk.convert_sector_size)
+
+
+    def get(self, disk):
+        """Returns (path, offset, size, used, hash) for disk, or None."""
+        return self.disks.get(DirectDisks._key(disk))
+
+
+    def add(self, disk, path, offset, size, hash=None):
+        """hash is a digest, a Future of one, or None if unknown."""
+        self.disks[DirectDisks._key(disk)] = (path, offset, size, disk.used, hash)
+
+
+    def vmdk_path(self, disk):
+        """Returns a path for the VMDK of disk that is kept until close()."""
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="direct-", dir=self.parent)
+        directory = os.path.join(self.directory, str(len(os.listdir(self.directory))))
+        os.mkdir(directory)
+        return os.path.join(directory, os.path.basename(disk.path))
+
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+            self.directory = None
+
+
 class VirtualHardware(object):
     pass
 
@@ -565,14 +1076,21 @@ class OVFNetwork(object):
 class OVFFile(object):
     next_id = 0
 
-    def __init__(self, path, file_id=None):
+    def __init__(self, path, file_id=None, size=None):
         self.path = os.path.abspath(path)
         if file_id is None:
-            self.id = f"file{OVFFile.next_id}"
-            OVFFile.next_id += 1
+            self.id = OVFFile.new_id()
         else:
             self.id = file_id
-        self.size = os.path.getsize(self.path)
+        # the size of a file that is not written yet is set later
+        self.size = size if size is not None else os.path.getsize(self.path)
+
+
+    @staticmethod
+    def new_id():
+        file_id = f"file{OVFFile.next_id}"
+        OVFFile.next_id += 1
+        return file_id
 
 
     def host_resource(self):
@@ -606,7 +1124,8 @@ class OVFDisk(object):
             'byte * 2^40' : 2 ** 40,
     }
 
-    def __init__(self, path, units=None, disk_id=None, file_id=None, raw_image=None, sector_size=None):
+    def __init__(self, path, units=None, disk_id=None, file_id=None, raw_image=None, sector_size=None, graph=None,
+                 direct=False):
         if disk_id is None:
             self.id = f"vmdisk{OVFDisk.next_id}"
             OVFDisk.next_id += 1
@@ -627,21 +1146,113 @@ class OVFDisk(object):
         self.units = units
 
         self.sector_size = int(sector_size) if sector_size is not None else None
+        self.path = path
+        self.raw_image = raw_image
+        # the file is created with the disk, but its id is taken in config order
+        self.file_id = file_id if file_id is not None else OVFFile.new_id()
+        self.file = None
+        # a direct disk is converted when it is written to the OVA
+        self.direct = direct and raw_image is not None and os.path.exists(raw_image)
+        if self.direct:
+            # the OVA is written from a temporary directory
+            self.raw_image = os.path.abspath(raw_image)
+            self.convert_sector_size = self.sector_size
+
+        if self.direct:
+            if graph is None:
+                self._load_raw_info()
+            else:
+                graph.add(f"convert:{self.id}", lambda: None)
+                graph.add(f"info:{self.id}", self._load_raw_info)
+        elif graph is None:
+            self._convert_raw_image()
+            self._load_info()
+        else:
+            # the disk can be used once the info task is done
+            graph.add(f"convert:{self.id}", self._convert_raw_image)
+            graph.add(f"info:{self.id}", self._load_info, [f"convert:{self.id}"])
 
+
+    def _convert_raw_image(self):
+        raw_image, path, sector_size = self.raw_image, self.path, self.sector_size
         if raw_image is not None:
             if os.path.exists(raw_image):
+                if CONVERSION_CACHE is not None:
+                    # the vmdk is taken from the cache, or converted and added to it.
+                    # An existing vmdk is not added as it is, because nothing tells
+                    # which raw image and converter it was written from.
+                    key = CONVERSION_CACHE.key(raw_image, sector_size)
+                    if not CONVERSION_CACHE.get(key, path):
+                        OVFDisk._replace(raw_image, path, sector_size)
+                        CONVERSION_CACHE.put(key, path)
                 # check if the vmdk exists, and if it does if it's newer than the raw image
-                # if not, create vmdk from raw image
-                if not os.path.exists(path) or os.path.getctime(raw_image) > os.path.getctime(path):
-                    command = [VMDK_CONVERT, raw_image, path]
-                    if sector_size is not None:
-                        command += ["--sector-size", str(sector_size)]
-                    subprocess.check_call(command)
+                elif not os.path.exists(path) or os.path.getctime(raw_image) > os.path.getctime(path):
+                    # if not, create vmdk from raw image
+                    OVFDisk._replace(raw_image, path, sector_size)
             else:
                 print(f"warning: raw image file {raw_image} does not exist, using {path}")
 
-        self.file = OVFFile(path, file_id=file_id)
-        disk_info = OVF._disk_info(path)
+
+    @staticmethod
+    def _replace(raw_image, path, sector_size):
+        # the vmdk may be a hard link, for example to a cache entry of an older
+        # version, which must not be overwritten
+        if os.path.lexists(path):
+            os.remove(path)
+        OVFDisk._run_conversion(raw_image, path, sector_size)
+
+
+    @staticmethod
+    def _run_conversion(raw_image, path, sector_size, offset=None):
+        num_threads = JOB_BUDGET.acquire(JOB_BUDGET.max_per_task) if JOB_BUDGET is not None else None
+        try:
+            if OVF._use_libvmdk():
+                OVFDisk._convert(raw_image, path, sector_size, num_threads, offset)
+            else:
+                command = [VMDK_CONVERT, raw_image, path]
+                if sector_size is not None:
+                    command += ["--sector-size", str(sector_size)]
+                if num_threads is not None:
+                    command += ["-n", str(num_threads)]
+                if offset is not None:
+                    command += ["--offset", str(offset)]
+                subprocess.check_call(command)
+        finally:
+            if num_threads is not None:
+                JOB_BUDGET.release(num_threads)
+
+
+    def _load_info(self):
+        self.file = OVFFile(self.path, file_id=self.file_id)
+        disk_info = OVF._disk_info(self.path)
+        self._set_info(disk_info)
+
+
+    def _load_raw_info(self):
+        # the size of the VMDK is set once it is written
+        self.file = OVFFile(self.path, file_id=self.file_id, size=0)
+        self._set_info(OVF._disk_info(self.raw_image))
+        self.used = 0
+
+
+    def write_direct(self, path, offset=None):
+        """
+        Converts the raw image of a direct disk to path, or into the
+        existing file path at offset. The size is set with set_size().
+        """
+        OVFDisk._run_conversion(self.raw_image, path, self.convert_sector_size, offset)
+        if offset is None:
+            self.path = path
+            self.file.path = os.path.abspath(path)
+            self.set_size(os.path.getsize(path), OVF._disk_info(path)['used'])
+
+
+    def set_size(self, size, used):
+        self.file.size = size
+        self.used = used
+
+
+    def _set_info(self, disk_info):
         self.capacity = int(disk_info['capacity'] / self.allocation_factors[self.units])
         self.used = disk_info['used']
 
@@ -655,6 +1266,25 @@ class OVFDisk(object):
             self.sector_size = 512
 
 
+    @staticmethod
+    def _convert(raw_image, path, sector_size, num_threads, offset=None):
+        print(f"Converting {raw_image} {'into' if offset is not None else 'to'} {path}")
+        percent = 0
+
+        # other disks may be converted at the same time, so one line per step
+        def progress(done, total):
+            nonlocal percent
+            if total > 0 and sys.stdout.isatty() and done * 100 // total >= percent + 10:
+                percent = done * 100 // total
+                print(f"{raw_image}: {percent}%", flush=True)
+
+        with libvmdk.Disk(raw_image) as disk:
+            if offset is not None:
+                disk.convert_at(path, offset, sector_size=sector_size, num_threads=num_threads or 0, progress=progress)
+            else:
+                disk.convert(path, sector_size=sector_size, num_threads=num_threads or 0, progress=progress)
+
+
     def host_resource(self):
         return f"ovf:/disk/{self.id}"
 
@@ -683,6 +1313,7 @@ class OVFEmptyDisk(OVFDisk):
             units = self.allocation_units_map[units]
         self.units = units
         self.sector_size = None
+        self.direct = False
 
     def xml_item(self):
         return ET.Element('{%s}Disk' % NS_OVF, {
@@ -1005,6 +1636,7 @@ class OVF(object):
         self.annotation = annotation
         self.eula = eula
         self.configurations = configurations
+        self.graph = None
 
         if 'default_configuration' in system:
             dflt_cfg = system['default_configuration']
@@ -1014,7 +1646,13 @@ class OVF(object):
 
 
     @classmethod
-    def from_dict(cls, config):
+    def from_dict(cls, config, graph=None, hash_type=None, direct=False):
+        """
+        With a graph, raw images are converted in parallel, and if hash_type
+        is set files are hashed for the manifest as soon as they are ready.
+        With direct, raw images are only converted when the OVA is written.
+        Returns once the metadata of all disks is known.
+        """
 
         # search for files and disks in hardware config:
         files = []
@@ -1034,6 +1672,8 @@ class OVF(object):
                                    file_id=hw.get('file_id', None))
                     files.append(file)
                     hw['image'] = file
+                    if graph is not None and hash_type is not None:
+                        OVF._add_hash(graph, file.path, hash_type)
                 elif 'disk_image' in hw or 'raw_image' in hw:
                     if 'disk_image' not in hw:
                         # if vmdk file is unset, use the raw image name and replace the extension
@@ -1043,16 +1683,27 @@ class OVF(object):
                                    raw_image=hw.get('raw_image', None),
                                    disk_id=hw.get('disk_id', None),
                                    file_id=hw.get('file_id', None),
-                                   sector_size=hw.get('sector_size', None))
+                                   sector_size=hw.get('sector_size', None),
+                                   graph=graph,
+                                   direct=direct)
                     disks.append(disk)
-                    files.append(disk.file)
+                    # replaced by disk.file once the disk is ready
+                    files.append(disk)
                     hw['disk'] = disk
+                    if graph is not None and hash_type is not None and not disk.direct:
+                        OVF._add_hash(graph, os.path.abspath(disk.path), hash_type, [f"convert:{disk.id}"])
                 elif 'disk_capacity' in hw:
                     disk = OVFEmptyDisk(hw['disk_capacity'],
                                         disk_id=hw.get('disk_id', None))
                     disks.append(disk)
                     hw['disk'] = disk
 
+        if graph is not None:
+            for file in files:
+                if isinstance(file, OVFDisk):
+                    graph.result(f"info:{file.id}")
+        files = [file.file if isinstance(file, OVFDisk) else file for file in files]
+
         hardware_config = hardware.get('config', {})
 
         networks = {}
@@ -1103,6 +1754,7 @@ class OVF(object):
                   networks, vssd_system, rasd_items, extra_configs,
                   products, annotation, eula,
                   configurations)
+        ovf.graph = graph
 
         return ovf
 
@@ -1151,8 +1803,43 @@ class OVF(object):
             rasd_item.connect(self)
 
 
+    @staticmethod
+    def _use_libvmdk():
+        # --vmdk-convert selects the binary to run
+        if libvmdk is None or VMDK_CONVERT != "vmdk-convert":
+            return False
+        try:
+            libvmdk.load()
+        except OSError:
+            return False
+        return True
+
+
     @staticmethod
     def _disk_info(filename):
+        started = time.time()
+        st = os.stat(filename)
+        if DISK_INFO_CACHE is not None:
+            disk_info = DISK_INFO_CACHE.lookup(st, "detailed")
+            if disk_info is not None:
+                return disk_info
+        disk_info = OVF._read_disk_info(filename)
+        if DISK_INFO_CACHE is not None:
+            DISK_INFO_CACHE.store(filename, st, "detailed", disk_info, started)
+        return disk_info
+
+
+    @staticmethod
+    def _read_disk_info(filename):
+        if vmdkinfo is not None:
+            try:
+                return vmdkinfo.disk_info(filename)
+            except ValueError:
+                # not a sparse VMDK, vmdk-convert knows other formats
+                pass
+        if OVF._use_libvmdk():
+            with libvmdk.Disk(filename) as disk:
+                return disk.info()
         out = subprocess.check_output([VMDK_CONVERT, "-i", "--detailed", filename]).decode("UTF-8")
         return json.loads(out)
 
@@ -1266,29 +1953,58 @@ class OVF(object):
     @staticmethod
     def _get_hash(args):
         filename, hash_type = args
+        started = time.time()
+        st = os.stat(filename)
+        if DIGEST_CACHE is not None:
+            digest = DIGEST_CACHE.lookup(st, hash_type)
+            if digest is not None:
+                return digest
+
         blocksz = 1024 * 1024
         hash = hashlib.new(hash_type)
-        with open(filename, "rb") as f:
-            while True:
-                buf = f.read(blocksz)
-                if not buf:
-                    break
-                hash.update(buf)
+        if JOB_BUDGET is not None:
+            JOB_BUDGET.acquire()
+        try:
+            with open(filename, "rb") as f:
+                while True:
+                    buf = f.read(blocksz)
+                    if not buf:
+                        break
+                    hash.update(buf)
+        finally:
+            if JOB_BUDGET is not None:
+                JOB_BUDGET.release()
+        if DIGEST_CACHE is not None:
+            DIGEST_CACHE.store(filename, st, hash_type, hash.hexdigest(), started)
         return hash.hexdigest()
 
 
-    def write_manifest(self, ovf_file=None, mf_file=None, hash_type="sha512"):
+    @staticmethod
+    def _add_hash(graph, path, hash_type, deps=[]):
+        return graph.add(f"hash:{path}:{hash_type}", lambda: OVF._get_hash((path, hash_type)), deps)
+
+
+    def write_manifest(self, ovf_file=None, mf_file=None, hash_type="sha512", hash_results=None):
+        """
+        Writes the manifest. hash_results is a list of (file name, hash) of
+        the OVF and all files, if they are already hashed.
+        """
         if ovf_file == None:
             ovf_file = f"{self.name}.ovf"
         if mf_file == None:
             mf_file = f"{self.name}.mf"
-        filenames = [ovf_file]
 
-        for file in self.files:
-            filenames.append(file.path)
+        if hash_results is None:
+            graph = self.graph if self.graph is not None else BuildGraph()
 
-        with ProcessPoolExecutor() as executor:
-            hash_results = list(zip(filenames, executor.map(OVF._get_hash, [(fname, hash_type) for fname in filenames])))
+            # files may already be hashed while the disks were converted
+            futures = [OVF._add_hash(graph, os.path.abspath(ovf_file), hash_type)]
+            for file in self.files:
+                futures.append(graph.get(f"hash:{file.path}:{hash_type}") or OVF._add_hash(graph, file.path, hash_type))
+            filenames = [ovf_file] + [file.path for file in self.files]
+            hash_results = [(fname, future.result()) for fname, future in zip(filenames, futures)]
+            if graph is not self.graph:
+                graph.shutdown()
 
         with open(mf_file, "wt") as f:
             for fname, hash in hash_results:
@@ -1332,25 +2048,229 @@ class OVF(object):
         assert os.path.getsize(cert_file) > 0, f"certificate file {cert_file} is empty"
 
 
+class OVAWriter(object):
+    """
+    Writes an OVA in one pass. Each member is hashed while it is copied
+    into the archive, so the manifest can be added at the end without
+    reading the files again. Members look like from
+    tar -h --owner=0 --group=0 --mode=0644.
+
+    The archive is written as a stream without seeking, so it can also go
+    to a pipe, a FIFO or stdout. Only if it is a regular file, members can
+    be reserved and filled in later, or written by another program.
+    """
+
+    TAR_FORMATS = {
+        'gnu': tarfile.GNU_FORMAT,
+        'posix': tarfile.PAX_FORMAT,
+        'pax': tarfile.PAX_FORMAT,
+        'ustar': tarfile.USTAR_FORMAT,
+    }
+
+    BUFSIZE = 1024 * 1024
+
+    def __init__(self, ova_file, tar_format="gnu", fileobj=None):
+        """
+        Writes to the file ova_file, or to fileobj if set. ova_file is only
+        removed on failure if it is a regular file.
+        """
+        self.ova_file = ova_file
+        self.format = OVAWriter.TAR_FORMATS[tar_format]
+        self.fileobj = fileobj if fileobj is not None else open(ova_file, "wb")
+        self.seekable = fileobj is None and stat.S_ISREG(os.fstat(self.fileobj.fileno()).st_mode)
+        self.offset = 0
+        self.pending = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.close()
+        finally:
+            self.fileobj.close()
+            if exc_type is not None and self.seekable:
+                os.remove(self.ova_file)
+
+
+    def close(self):
+        # two empty blocks end the archive, which is padded to a record like tar does
+        self._write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        self._write(tarfile.NUL * (-self.offset % tarfile.RECORDSIZE))
+        self.fileobj.flush()
+
+
+    def _write(self, buf):
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+
+    def _pad(self):
+        self._write(tarfile.NUL * (-self.offset % tarfile.BLOCKSIZE))
+
+
+    def _header(self, name, size, mtime, fixed_size=False):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        if fixed_size and self.format == tarfile.PAX_FORMAT:
+            # always a pax header, so the header does not grow with the size
+            info.pax_headers = {'size': str(size)}
+        return info.tobuf(self.format, tarfile.ENCODING, "surrogateescape")
+
+
+    def hash_range(self, offset, size, hash_type):
+        """
+        Hashes size bytes of the OVA at offset, for a member written by
+        someone else. This reads the member once more: a VMDK begins with
+        its grain tables, written after the grains, so it cannot be hashed
+        in the order it is written.
+        """
+        hash = hashlib.new(hash_type)
+        end = offset + size
+        with open(self.ova_file, "rb") as f:
+            while offset < end:
+                buf = os.pread(f.fileno(), min(OVAWriter.BUFSIZE, end - offset), offset)
+                assert len(buf) > 0, f"{self.ova_file} is truncated"
+                hash.update(buf)
+                offset += len(buf)
+        return hash.hexdigest()
+
+
+    def add(self, path, hash_type=None):
+        """
+        Adds path as a member named by its base name. Returns its hash if
+        hash_type is set.
+        """
+        st = os.stat(path)
+        self._write(self._header(os.path.basename(path), st.st_size, st.st_mtime))
+        hash = hashlib.new(hash_type) if hash_type is not None else None
+        with open(path, "rb") as f:
+            remaining = st.st_size
+            while remaining > 0:
+                buf = f.read(min(OVAWriter.BUFSIZE, remaining))
+                assert len(buf) > 0, f"{path} was truncated while it was added"
+                if hash is not None:
+                    hash.update(buf)
+                self._write(buf)
+                remaining -= len(buf)
+        self._pad()
+        return hash.hexdigest() if hash is not None else None
+
+
+    def add_range(self, name, path, offset, size, hash_type=None):
+        """
+        Adds size bytes of path at offset as a member name, like a member
+        of another OVA. Returns its hash if hash_type is set.
+        """
+        self._write(self._header(name, size, time.time()))
+        hash = hashlib.new(hash_type) if hash_type is not None else None
+        end = offset + size
+        with open(path, "rb") as f:
+            while offset < end:
+                buf = os.pread(f.fileno(), min(OVAWriter.BUFSIZE, end - offset), offset)
+                assert len(buf) > 0, f"{path} is truncated"
+                if hash is not None:
+                    hash.update(buf)
+                self._write(buf)
+                offset += len(buf)
+        self._pad()
+        return hash.hexdigest() if hash is not None else None
+
+
+    def reserve(self, name, size):
+        """
+        Adds a member of size bytes, to be filled in later with fill().
+        """
+        assert self.seekable, f"{self.ova_file} is not seekable"
+        self._write(self._header(name, size, time.time()))
+        member = (self.offset, size)
+        self._write(tarfile.NUL * size)
+        self._pad()
+        return member
+
+
+    def fill(self, member, path, hash_type=None):
+        """
+        Writes the content of path to a reserved member, padded with newlines
+        to its size. Returns the hash of the member if hash_type is set.
+        """
+        offset, size = member
+        with open(path, "rb") as f:
+            data = f.read()
+        assert len(data) <= size, f"{path} does not fit into {size} bytes"
+        data += b"\n" * (size - len(data))
+        self.fileobj.flush()
+        os.pwrite(self.fileobj.fileno(), data, offset)
+        return hashlib.new(hash_type, data).hexdigest() if hash_type is not None else None
+
+
+    def begin(self, name):
+        """
+        Starts a member that is written by someone else at the returned
+        offset, at the end of the OVA. Finish it with end().
+        """
+        assert self.seekable, f"{self.ova_file} is not seekable"
+        assert self.pending is None, "a member is already being written"
+        mtime = time.time()
+        header = self._header(name, 0, mtime, fixed_size=True)
+        self.pending = (name, self.offset, mtime, len(header))
+        self._write(header)
+        self.fileobj.flush()
+        return self.offset
+
+
+    def end(self):
+        """
+        Finishes the member started with begin(), with everything written
+        after its offset. Returns its size.
+        """
+        name, header_offset, mtime, header_size = self.pending
+        self.pending = None
+        offset = header_offset + header_size
+        end = os.fstat(self.fileobj.fileno()).st_size
+        size = end - offset
+
+        header = self._header(name, size, mtime, fixed_size=True)
+        assert len(header) == header_size, f"the header of {name} changed its size"
+        os.pwrite(self.fileobj.fileno(), header, header_offset)
+        self.fileobj.seek(end)
+        self.offset = end
+        self._pad()
+        return size
+
+
 def usage():
     print(f"Usage: {sys.argv[0]} -i|--input-file <input file> -o|--output-file <output file> [--format ova|ovf|dir] [-q] [-h]")
     print("")
     print("Options:")
     print("  -i, --input-file <file>     input file")
-    print("  -o, --output-file <file>    output file or directory name")
+    print("  -o, --output-file <file>    output file or directory name. Use '-' to write an ova to stdout")
     print("  -f, --format ova|ovf|dir    output format")
+    print("  --batch <file>              build several outputs with different params, set in file, sharing disks and digests")
     print("  -m, --manifest              create manifest file along with ovf (default true for output formats ova and dir)")
     print("  --checksum-type sha1|sha256|sha512  set the checksum type for the manifest. Must be sha1, sha256 or sha512.")
     print("  --sign <keyfile>            sign the manifest file with the given keyfile")
     print("  --sign-alg sha1|sha256|sha512  set the signature algorithm for the manifest. Must be sha1, sha256 or sha512. Default is the same as the checksum-type.")
     print("  --sign-script <script>      sign the manifest file with the given script")
-    print("  --tar-format gnu|posix      set the tar format for the ova file. Must be gnu or posix. Default is gnu.")
+    print("  --tar-format gnu|posix      set the tar format for the ova file. Must be gnu, posix (pax) or ustar. Default is gnu.")
     print("  --vmdk-convert <path>       set the path to the vmdk-convert tool (optional)")
+    print("  --direct                    convert raw images straight into the ova, without writing vmdk files")
+    print("  -j, --jobs <n>              limit conversion threads and hashing to n jobs. Under make -j, the jobserver of make is used")
+    print("  --no-cache                  do not use or update the cached vmdks, digests and disk info of earlier builds")
+    print("  --cache-dir <dir>           the directory of the caches, also caches converted vmdks. Default is ~/.cache/open-vmdk")
+    print("  --cache-size <MB>           cache converted vmdks up to this size, least recently used ones are removed. Default is 10240")
     print("  -q                          quiet mode")
     print("  -h                          print help")
     print("")
     print("Output formats:")
-    print("  ova: create an OVA file")
+    print("  ova: create an OVA file, with the OVF first and the manifest (and certificate) last")
     print("  ovf: create OVF file only")
     print("  dir: create a directory with the OVF file, the manifest and symlinks to the referenced files (hard disk(s) and iso image(s))")
     print("")
@@ -1393,11 +2313,207 @@ def yaml_param(loader, node):
     return value
 
 
+def batch_builds(batch, params, output_format=None):
+    """
+    Returns (params, output file, output format) for each build of a batch:
+    one for each combination of the values in 'matrix', named by 'output',
+    and one for each entry of 'builds'. Output names can use the params as
+    in "photon-{cpus}.ova". params are the defaults for all builds.
+    """
+    assert isinstance(batch, dict), "the batch file must be a dictionary"
+    builds = []
+
+    if 'matrix' in batch:
+        assert 'output' in batch, "a batch with a 'matrix' needs an 'output'"
+        keys = list(batch['matrix'].keys())
+        values = [v if isinstance(v, list) else [v] for v in batch['matrix'].values()]
+        for combination in itertools.product(*values):
+            build_params = dict(params)
+            build_params.update(zip(keys, combination))
+            builds.append((build_params, batch['output'].format(**build_params),
+                           batch.get('format', output_format)))
+
+    for b in batch.get('builds', []):
+        assert 'output' in b, "each entry of 'builds' needs an 'output'"
+        build_params = dict(params)
+        build_params.update(b.get('params', {}))
+        builds.append((build_params, b['output'].format(**build_params),
+                       b.get('format', batch.get('format', output_format))))
+
+    assert len(builds) > 0, "the batch has no builds"
+    outputs = [output_file for build_params, output_file, build_format in builds]
+    assert len(set(outputs)) == len(outputs), "the outputs of the batch are not unique"
+    return builds
+
+
+def build(config, config_file, output_file, output_format, checksum_type="sha256",
+          do_manifest=False, do_direct=False, do_quiet=False,
+          sign_keyfile=None, sign_alg=None, sign_script=None,
+          tar_format="gnu", ova_stream=None, direct_disks=None):
+    """
+    Builds output_file in output_format from config, loaded from
+    config_file. With direct_disks, direct disks converted by an earlier
+    build of a batch are copied instead of converted again.
+    """
+    if direct_disks is None:
+        direct_disks = DirectDisks()
+
+    # the ids of files, disks and items start over in each OVF of a batch
+    OVFFile.next_id = 0
+    OVFDisk.next_id = 0
+    RasdItem.last_instance_id = 0
+
+    # disks are converted and files hashed in parallel while building,
+    # files of an OVA are hashed while they are written to it
+    graph = BuildGraph()
+    ovf = OVF.from_dict(config, graph=graph,
+                        hash_type=checksum_type if output_format == "dir" or do_manifest and output_format == "ovf" else None,
+                        direct=do_direct)
+
+    if not do_quiet:
+        print (f"creating '{output_file}' with format '{output_format}' from '{config_file}'")
+
+    if ova_stream is not None:
+        basename = ovf.name
+    elif output_format != "dir":
+        basename = os.path.basename(output_file)[:-4]
+    else:
+        basename = os.path.basename(output_file)
+    mf_file = f"{basename}.mf"
+
+    if output_format == "ovf":
+        ovf_file = output_file
+        ovf.write_xml(ovf_file=ovf_file)
+        if do_manifest:
+            ovf.write_manifest(ovf_file=ovf_file, mf_file=mf_file, hash_type=checksum_type)
+            if sign_keyfile is not None or sign_script is not None:
+                if sign_script is None:
+                    ovf.sign_manifest(sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
+                else:
+                    ovf.sign_manifest_external(sign_script, sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
+    elif output_format == "ova" or output_format == "dir":
+        pwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp(prefix=f"{basename}-", dir=pwd)
+        try:
+            os.chdir(tmpdir)
+            ovf_file = f"{basename}.ovf"
+            cert_file = os.path.splitext(ovf_file)[0] + ".cert"
+
+            def sign():
+                if sign_keyfile is not None or sign_script is not None:
+                    if sign_script is None:
+                        ovf.sign_manifest(sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
+                    else:
+                        ovf.sign_manifest_external(sign_script, sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
+                    return True
+                return False
+
+            if output_format == "ova":
+                # the OVF first, the manifest and certificate at the end
+                with OVAWriter(os.path.join(pwd, output_file), tar_format, fileobj=ova_stream) as ova:
+                    direct = {disk.file.path: disk for disk in ovf.disks if disk.direct}
+                    # disks converted by an earlier build of the batch are copied from there
+                    copied = {}
+                    for path, disk in list(direct.items()):
+                        source = direct_disks.get(disk)
+                        if source is not None:
+                            src_path, src_offset, size, used, hash = source
+                            disk.set_size(size, used)
+                            copied[path] = (src_path, src_offset, size, hash)
+                            del direct[path]
+
+                    if direct and (not ova.seekable or vmdkinfo is None):
+                        # the size of a member is written before it, so for a pipe
+                        # the disks are converted to a temporary directory first
+                        for disk in direct.values():
+                            graph.add(f"direct:{disk.id}",
+                                      functools.partial(disk.write_direct, direct_disks.vmdk_path(disk)))
+                        for disk in direct.values():
+                            graph.result(f"direct:{disk.id}")
+                            direct_disks.add(disk, disk.file.path, 0, disk.file.size)
+                        direct = {}
+
+                    if direct:
+                        # the OVF has the sizes of the disks, which are known once they are
+                        # written, so space for the OVF with the largest sizes is reserved
+                        for disk in direct.values():
+                            disk.set_size(2 ** 64 - 1, 2 ** 64 - 1)
+                        ovf.write_xml(ovf_file=ovf_file)
+                        ovf_member = ova.reserve(ovf_file, os.path.getsize(ovf_file))
+                        hash_results = [None]
+                    else:
+                        ovf.write_xml(ovf_file=ovf_file)
+                        hash_results = [(ovf_file, ova.add(ovf_file, hash_type=checksum_type))]
+
+                    for file in ovf.files:
+                        if file.path in direct:
+                            # each disk starts where the one before ends, so they are
+                            # converted one at a time, each hashed while the next one
+                            # is converted
+                            disk = direct[file.path]
+                            offset = ova.begin(os.path.basename(file.path))
+                            graph.add(f"direct:{disk.id}", functools.partial(disk.write_direct, ova.ova_file, offset))
+                            graph.result(f"direct:{disk.id}")
+                            size = ova.end()
+                            disk.set_size(size, vmdkinfo.disk_info(ova.ova_file, detailed=False,
+                                                                   offset=offset, size=size)['used'])
+                            hash = graph.add(f"member:{disk.id}",
+                                             functools.partial(ova.hash_range, offset, size, checksum_type))
+                            direct_disks.add(disk, ova.ova_file, offset, size, hash)
+                        elif file.path in copied:
+                            src_path, src_offset, size, hash = copied[file.path]
+                            if hash is None:
+                                hash = ova.add_range(os.path.basename(file.path), src_path, src_offset, size,
+                                                     hash_type=checksum_type)
+                            else:
+                                ova.add_range(os.path.basename(file.path), src_path, src_offset, size)
+                        else:
+                            # a file from an earlier build is copied without hashing it
+                            started = time.time()
+                            st = os.stat(file.path)
+                            hash = DIGEST_CACHE.lookup(st, checksum_type) if DIGEST_CACHE is not None else None
+                            if hash is not None:
+                                ova.add(file.path)
+                            else:
+                                hash = ova.add(file.path, hash_type=checksum_type)
+                                if DIGEST_CACHE is not None:
+                                    DIGEST_CACHE.store(file.path, st, checksum_type, hash, started)
+                        hash_results.append((file.path, hash))
+
+                    if direct:
+                        ovf.write_xml(ovf_file=ovf_file)
+                        hash_results[0] = (ovf_file, ova.fill(ovf_member, ovf_file, hash_type=checksum_type))
+                    hash_results = [(path, hash.result() if isinstance(hash, Future) else hash)
+                                    for path, hash in hash_results]
+                    ovf.write_manifest(ovf_file=ovf_file, mf_file=mf_file, hash_type=checksum_type,
+                                       hash_results=hash_results)
+                    ova.add(mf_file)
+                    if sign():
+                        ova.add(cert_file)
+                os.chdir(pwd)
+                shutil.rmtree(tmpdir)
+            else:
+                ovf.write_xml(ovf_file=ovf_file)
+                for file in ovf.files:
+                    os.symlink(os.path.join(pwd, file.path), os.path.basename(file.path))
+                ovf.write_manifest(ovf_file=ovf_file, mf_file=mf_file, hash_type=checksum_type)
+                sign()
+                os.chdir(pwd)
+                shutil.move(tmpdir, output_file)
+        except Exception as e:
+            os.chdir(pwd)
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir)
+            raise e
+
+    graph.shutdown()
+
+
 def main():
     config_file = None
     output_file = None
     output_format = None
-    basename = None
+    batch_file = None
     do_quiet = False
     do_manifest = False
     params = {}
@@ -1406,11 +2522,15 @@ def main():
     sign_alg = None
     sign_script = None
     tar_format = "gnu"
+    jobs = None
+    do_direct = False
+    do_cache = True
+    cache_size = None
 
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-            'f:hi:mo:q',
-            longopts=['format=', 'input-file=', 'manifest', 'output-file=', 'param=', 'checksum-type=', 'sign=', 'sign-alg=', 'sign-script=', 'tar-format=', 'vmdk-convert='])
+            'f:hi:j:mo:q',
+            longopts=['batch=', 'cache-dir=', 'cache-size=', 'direct', 'format=', 'input-file=', 'jobs=', 'manifest', 'no-cache', 'output-file=', 'param=', 'checksum-type=', 'sign=', 'sign-alg=', 'sign-script=', 'tar-format=', 'vmdk-convert='])
     except:
         print ("invalid option")
         sys.exit(2)
@@ -1422,8 +2542,23 @@ def main():
             output_file = a
         elif o in ['-f', '--format']:
             output_format = a
+        elif o in ['--batch']:
+            batch_file = a
+        elif o in ['--cache-dir']:
+            global CACHE_DIR
+            CACHE_DIR = os.path.abspath(a)
+        elif o in ['--cache-size']:
+            assert a.isdigit(), f"invalid cache size '{a}'"
+            cache_size = int(a)
+        elif o in ['--direct']:
+            do_direct = True
+        elif o in ['-j', '--jobs']:
+            assert a.isdigit() and int(a) > 0, f"invalid number of jobs '{a}'"
+            jobs = int(a)
         elif o in ['-m', '--manifest']:
             do_manifest = True
+        elif o in ['--no-cache']:
+            do_cache = False
         elif o in ['--checksum-type']:
             checksum_type = a
         elif o in ['--param']:
@@ -1449,101 +2584,85 @@ def main():
             assert False, f"unhandled option {o}"
 
     assert config_file != None, "no input file specified"
-    assert output_file != None, "no output file/directory specified"
+    assert output_file != None or batch_file != None, "no output file/directory specified"
+    assert output_file == None or batch_file == None, "the output files of a batch are set in the batch file"
 
     assert checksum_type in ["sha1", "sha512", "sha256"], f"checksum-type '{checksum_type}' is invalid"
     if sign_alg is None:
         sign_alg = checksum_type
     assert sign_alg in ["sha1", "sha512", "sha256"], f"checksum-type '{sign_alg}' is invalid"
+    assert tar_format in OVAWriter.TAR_FORMATS, f"tar format '{tar_format}' is invalid"
 
     if sign_keyfile is not None:
         sign_keyfile = os.path.abspath(sign_keyfile)
 
-    if config_file != None:
-        f = open(config_file, 'r')
+    # the config is loaded again with the params of each build
+    with open(config_file, 'r') as f:
+        config_text = f.read()
 
     yaml_loader = yaml.SafeLoader
-    yaml_loader.app_params = params
     yaml.add_constructor("!param", yaml_param, Loader=yaml_loader)
 
-    config = yaml.load(f, Loader=yaml_loader)
-    if f != sys.stdin:
-        f.close()
-
-    ovf = OVF.from_dict(config)
-
-    if output_format is None:
-        if output_file.endswith(".ova"):
-            # create an ova file
-            output_format = "ova"
-        elif output_file.endswith(".ovf"):
-            # create just ovf (and maybe mf) file
-            output_format = "ovf"
-
-    assert output_format != None, "no output format specified"
-    assert output_format in ['ova', 'ovf', 'dir'], f"invalid output_format '{output_format}'"
-
-    if not do_quiet:
-        print (f"creating '{output_file}' with format '{output_format}' from '{config_file}'")
-
-    if output_format != "dir":
-        basename = os.path.basename(output_file)[:-4]
+    if batch_file is not None:
+        with open(batch_file, 'r') as f:
+            builds = batch_builds(yaml.safe_load(f), params, output_format)
     else:
-        basename = os.path.basename(output_file)
-    mf_file = f"{basename}.mf"
-
-    if output_format == "ovf":
-        ovf_file = output_file
-        ovf.write_xml(ovf_file=ovf_file)
-        if do_manifest:
-            ovf.write_manifest(ovf_file=ovf_file, mf_file=mf_file, hash_type=checksum_type)
-            if sign_keyfile is not None or sign_script is not None:
-                if sign_script is None:
-                    ovf.sign_manifest(sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
-                else:
-                    ovf.sign_manifest_external(sign_script, sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
-    elif output_format == "ova" or output_format == "dir":
-        pwd = os.getcwd()
-        tmpdir = tempfile.mkdtemp(prefix=f"{basename}-", dir=pwd)
-        try:
-            os.chdir(tmpdir)
-            ovf_file = f"{basename}.ovf"
-            ovf.write_xml(ovf_file=ovf_file)
-
-            all_files = [ovf_file, mf_file]
-            for file in ovf.files:
-                dst = os.path.basename(file.path)
-                os.symlink(os.path.join(pwd, file.path), dst)
-                all_files.append(dst)
-
-            ovf.write_manifest(ovf_file=ovf_file, mf_file=mf_file, hash_type=checksum_type)
-            if sign_keyfile is not None or sign_script is not None:
-                if sign_script is None:
-                    ovf.sign_manifest(sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
-                else:
-                    ovf.sign_manifest_external(sign_script, sign_keyfile, ovf_file=ovf_file, mf_file=mf_file, sign_alg=sign_alg)
-                cert_file = os.path.splitext(ovf_file)[0] + ".cert"
-                all_files.append(cert_file)
-
-            if output_format == "ova":
-                ret = subprocess.check_call(["tar", f"--format={tar_format}", "-h",
-                                             "--owner=0", "--group=0", "--mode=0644",
-                                             "-cf",
-                                             os.path.join(pwd, output_file)] + all_files)
-                os.chdir(pwd)
-                shutil.rmtree(tmpdir)
-            else:
-                os.chdir(pwd)
-                shutil.move(tmpdir, output_file)
-        except Exception as e:
-            os.chdir(pwd)
-            if os.path.isdir(tmpdir):
-                shutil.rmtree(tmpdir)
-            raise e
+        builds = [(params, output_file, output_format)]
+
+    for i, (build_params, build_file, build_format) in enumerate(builds):
+        if build_format is None:
+            if build_file.endswith(".ova"):
+                # create an ova file
+                build_format = "ova"
+            elif build_file.endswith(".ovf"):
+                # create just ovf (and maybe mf) file
+                build_format = "ovf"
+
+        assert build_format != None, f"no output format specified for '{build_file}'"
+        assert build_format in ['ova', 'ovf', 'dir'], f"invalid output_format '{build_format}'"
+        assert not do_direct or build_format == "ova", "--direct can only be used for the ova format"
+        builds[i] = (build_params, build_file, build_format)
+
+    ova_stream = None
+    if output_file == "-":
+        assert builds[0][2] == "ova", "only the ova format can be written to stdout"
+        # the OVA goes to stdout, messages and tools print to stderr
+        sys.stdout.flush()
+        ova_stream = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    global JOB_BUDGET
+    JOB_BUDGET = JobBudget.from_environment(jobs)
+    # without --no-cache, the caches are also kept for later builds. Builds
+    # of a batch share them in any case.
+    global DIGEST_CACHE, DISK_INFO_CACHE, CONVERSION_CACHE
+    DIGEST_CACHE = FileCache("digests.json", persistent=do_cache)
+    DISK_INFO_CACHE = FileCache("diskinfo.json", persistent=do_cache)
+    # VMDKs are large, so they are only cached when asked for
+    if do_cache and (CACHE_DIR is not None or cache_size is not None):
+        if cache_size is None:
+            cache_size = 10240
+        CONVERSION_CACHE = ConversionCache(os.path.join(cache_dir(), "vmdks"), cache_size * 1024 * 1024,
+                                           quiet=do_quiet)
+
+    # direct disks are converted once for all builds of a batch
+    direct_disks = DirectDisks()
+    try:
+        for build_params, build_file, build_format in builds:
+            yaml_loader.app_params = build_params
+            config = yaml.load(config_text, Loader=yaml_loader)
+            build(config, config_file, build_file, build_format, checksum_type=checksum_type,
+                  do_manifest=do_manifest, do_direct=do_direct, do_quiet=do_quiet,
+                  sign_keyfile=sign_keyfile, sign_alg=sign_alg, sign_script=sign_script,
+                  tar_format=tar_format, ova_stream=ova_stream, direct_disks=direct_disks)
+    finally:
+        direct_disks.close()
+
+    DIGEST_CACHE.save()
+    DISK_INFO_CACHE.save()
 
     if not do_quiet:
         print ("done.")
 
-
 if __name__ == "__main__":
     main()
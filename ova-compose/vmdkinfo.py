@@ -0,0 +1,290 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the “License”); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Reads the metadata of sparse VMDK files (streamOptimized and monolithicSparse)
+without running vmdk-convert. The grain directory and grain tables are mapped
+with numpy.memmap when they are first used, and the statistics are computed
+on the whole grain table at once.
+
+disk_info(path) returns the same as "vmdk-convert -i --detailed path".
+"""
+
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+
+SECTOR_SIZE = 512
+
+SPARSE_MAGICNUMBER = 0x564d444b
+SPARSE_VERSION_INCOMPAT_FLAGS = 3
+SPARSE_GD_AT_END = 0xFFFFFFFFFFFFFFFF
+
+SPARSEFLAG_VALID_NEWLINE_DETECTOR = 1 << 0
+SPARSEFLAG_USE_REDUNDANT = 1 << 1
+SPARSEFLAG_INCOMPAT_FLAGS = 0xFFFF0000
+SPARSEFLAG_COMPRESSED = 1 << 16
+SPARSEFLAG_EMBEDDED_LBA = 1 << 17
+
+SPARSE_COMPRESSALGORITHM_NONE = 0
+SPARSE_COMPRESSALGORITHM_DEFLATE = 1
+
+GRAIN_MARKER_FOOTER = 3
+
+# SparseExtentHeaderOnDisk, without the padding
+HEADER_FORMAT = "<IIIQQQQIQQQB4sH"
+# SparseMetaDataMarkerOnDisk, without the padding
+MARKER_FORMAT = "<QII"
+
+
+def _parse_header(data):
+    (magic, version, flags, capacity, grain_size, descriptor_offset, descriptor_size, num_gtes_per_gt,
+     rgd_offset, gd_offset, over_head, unclean_shutdown, newline_chars,
+     compress_algorithm) = struct.unpack_from(HEADER_FORMAT, data)
+
+    if magic != SPARSE_MAGICNUMBER:
+        return None
+    if version > SPARSE_VERSION_INCOMPAT_FLAGS:
+        raise ValueError(f"unsupported sparse extent version {version}")
+    if flags & SPARSEFLAG_INCOMPAT_FLAGS & ~SPARSEFLAG_COMPRESSED & ~SPARSEFLAG_EMBEDDED_LBA:
+        raise ValueError(f"unsupported sparse extent flags 0x{flags:x}")
+    if flags & SPARSEFLAG_VALID_NEWLINE_DETECTOR and newline_chars != b"\n \r\n":
+        raise ValueError("corrupted newline detector")
+    if flags & SPARSEFLAG_EMBEDDED_LBA and not flags & SPARSEFLAG_COMPRESSED:
+        raise ValueError("embedded LBA without compression")
+
+    return {
+        'version': version,
+        'flags': flags,
+        'capacity': capacity,
+        'grainSize': grain_size,
+        'descriptorOffset': descriptor_offset,
+        'descriptorSize': descriptor_size,
+        'numGTEsPerGT': num_gtes_per_gt,
+        'rgdOffset': rgd_offset,
+        'gdOffset': gd_offset,
+        'overHead': over_head,
+        'uncleanShutdown': unclean_shutdown,
+        'compressAlgorithm': compress_algorithm,
+    }
+
+
+def _is_pow2(value):
+    return value & (value - 1) == 0
+
+
+def parse_descriptor(text):
+    """
+    Returns the key/value pairs of a descriptor, with quotes removed from the
+    values, like vmdk-convert does.
+    """
+    values = {}
+    for line in text.split("\n"):
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        key = key.strip()
+        value = value.strip()
+        if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        if key:
+            values[key] = value
+    return values
+
+
+class SparseVmdk(object):
+
+    def __init__(self, path, offset=0, size=None):
+        """
+        Reads the header, footer and descriptor of path. Raises ValueError
+        if path is not a sparse VMDK. A VMDK embedded in another file, like
+        a member of an OVA, is read from its offset and size in path.
+        """
+        self.path = path
+        self.offset = offset
+        self.file_size = size if size is not None else os.path.getsize(path) - offset
+        self._gd = None
+        self._gt = None
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            header = _parse_header(f.read(SECTOR_SIZE).ljust(SECTOR_SIZE, b"\0"))
+            if header is None:
+                raise ValueError(f"{path} is not a sparse VMDK")
+
+            # a footer, preceded by a footer marker, overrides the header
+            self.has_footer = False
+            if self.file_size >= 3 * SECTOR_SIZE:
+                f.seek(self.offset + ((self.file_size - 3 * SECTOR_SIZE) & ~(SECTOR_SIZE - 1)))
+                _, size, marker_type = struct.unpack_from(MARKER_FORMAT, f.read(SECTOR_SIZE))
+                if size == 0 and marker_type == GRAIN_MARKER_FOOTER:
+                    footer = _parse_header(f.read(SECTOR_SIZE).ljust(SECTOR_SIZE, b"\0"))
+                    if footer is not None:
+                        header = footer
+                        self.has_footer = True
+
+            self.descriptor = None
+            if header['descriptorOffset'] != 0 and header['descriptorSize'] != 0:
+                f.seek(self.offset + header['descriptorOffset'] * SECTOR_SIZE)
+                data = f.read(header['descriptorSize'] * SECTOR_SIZE)
+                self.descriptor = data.split(b"\0", 1)[0].decode("UTF-8", errors="replace")
+
+        grain_size = header['grainSize']
+        if grain_size < 1 or grain_size > 128 or not _is_pow2(grain_size):
+            raise ValueError(f"invalid grain size {grain_size}")
+        if header['numGTEsPerGT'] < SECTOR_SIZE // 4 or not _is_pow2(header['numGTEsPerGT']):
+            raise ValueError(f"invalid number of GTEs per GT {header['numGTEsPerGT']}")
+        if header['gdOffset'] == SPARSE_GD_AT_END:
+            raise ValueError("grain directory at the end, but no footer")
+
+        self.header = header
+        self.grain_bytes = grain_size * SECTOR_SIZE
+        self.capacity = header['capacity'] * SECTOR_SIZE
+        self.num_grains = -(-header['capacity'] // grain_size)
+        self.num_gts = -(-self.num_grains // header['numGTEsPerGT'])
+
+
+    @property
+    def descriptor_values(self):
+        return parse_descriptor(self.descriptor) if self.descriptor is not None else {}
+
+
+    @property
+    def gd(self):
+        """The grain directory, mapped from the file."""
+        if self._gd is None:
+            self._gd = np.memmap(self.path, dtype="<u4", mode="r",
+                                 offset=self.offset + self.header['gdOffset'] * SECTOR_SIZE, shape=(self.num_gts,))
+        return self._gd
+
+
+    @property
+    def gt(self):
+        """
+        All grain tables as one array with an entry per grain. Grain tables
+        are read from a mapping of the file, missing ones are all zero.
+        """
+        if self._gt is None:
+            per_gt = self.header['numGTEsPerGT']
+            gt = np.zeros(self.num_gts * per_gt, dtype=np.uint32)
+            if self.num_gts > 0:
+                words = np.memmap(self.path, dtype="<u4", mode="r", offset=self.offset,
+                                  shape=(self.file_size // 4,))
+                for i in np.flatnonzero(self.gd):
+                    start = int(self.gd[i]) * (SECTOR_SIZE // 4)
+                    if start + per_gt > words.shape[0]:
+                        raise ValueError(f"grain table {i} is beyond the end of the file")
+                    gt[i * per_gt:(i + 1) * per_gt] = words[start:start + per_gt]
+            self._gt = gt[:self.num_grains]
+        return self._gt
+
+
+    def used(self):
+        """Bytes in grains with data or marked as zero, like vmdk-convert -i."""
+        allocated = self.gt != 0
+        used = int(np.count_nonzero(allocated)) * self.grain_bytes
+        last_size = self.capacity - (self.num_grains - 1) * self.grain_bytes
+        if self.num_grains > 0 and allocated[-1]:
+            used -= self.grain_bytes - last_size
+        return used
+
+
+    def grains_ordered(self):
+        """True if the grains with data are stored in LBA order."""
+        sectors = self.gt[self.gt > 1]
+        return bool(np.all(sectors[1:] >= sectors[:-1]))
+
+
+    def stats(self):
+        """Grain counts, and how fragmented the data is in LBA and file order."""
+        gt = self.gt
+        data = np.flatnonzero(gt > 1)
+        sectors = gt[data]
+        return {
+            'grains': int(self.num_grains),
+            'allocatedGrains': int(data.shape[0]),
+            'zeroGrains': int(np.count_nonzero(gt == 1)),
+            # runs of consecutive grains with data
+            'extents': int(np.count_nonzero(np.diff(data) != 1)) + 1 if data.shape[0] else 0,
+            # grains stored before the previous grain in LBA order
+            'outOfOrder': int(np.count_nonzero(sectors[1:] < sectors[:-1])),
+            'firstDataSector': int(sectors.min()) if sectors.shape[0] else None,
+            'lastDataSector': int(sectors.max()) if sectors.shape[0] else None,
+        }
+
+
+    def info(self, detailed=True):
+        """The output of vmdk-convert -i [--detailed] as a dict."""
+        info = {'capacity': self.capacity, 'used': self.used()}
+        if not detailed:
+            return info
+
+        h = self.header
+        info['sparseHeader'] = {
+            'version': h['version'],
+            'flags': h['flags'],
+            'flagsDecoded': {
+                'validNewlineDetector': bool(h['flags'] & SPARSEFLAG_VALID_NEWLINE_DETECTOR),
+                'useRedundant': bool(h['flags'] & SPARSEFLAG_USE_REDUNDANT),
+                'compressed': bool(h['flags'] & SPARSEFLAG_COMPRESSED),
+                'embeddedLBA': bool(h['flags'] & SPARSEFLAG_EMBEDDED_LBA),
+            },
+            'numGTEsPerGT': h['numGTEsPerGT'],
+            'compressAlgorithm': h['compressAlgorithm'],
+            'compressAlgorithmName': {SPARSE_COMPRESSALGORITHM_NONE: "none",
+                                      SPARSE_COMPRESSALGORITHM_DEFLATE: "deflate"}.get(h['compressAlgorithm'],
+                                                                                       "unknown"),
+            'uncleanShutdown': h['uncleanShutdown'],
+            'grainSize': h['grainSize'],
+            'grainSizeBytes': self.grain_bytes,
+            'descriptorOffset': h['descriptorOffset'],
+            'descriptorSize': h['descriptorSize'],
+            'rgdOffset': h['rgdOffset'],
+            'gdOffset': h['gdOffset'],
+            'overHead': h['overHead'],
+            'grainsOrdered': self.grains_ordered(),
+            'hasFooter': self.has_footer,
+        }
+        if self.descriptor is not None:
+            values = self.descriptor_values
+            if 'ddb.contentDigest' in values:
+                info['contentDigest'] = values['ddb.contentDigest']
+            info['descriptorFile'] = values
+        return info
+
+
+def disk_info(path, detailed=True, offset=0, size=None):
+    """
+    Returns the same as "vmdk-convert -i [--detailed] path" for a sparse
+    VMDK, which can be embedded in path at offset. Raises ValueError for
+    other files.
+    """
+    return SparseVmdk(path, offset=offset, size=size).info(detailed=detailed)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"usage: {sys.argv[0]} file.vmdk", file=sys.stderr)
+        sys.exit(1)
+    vmdk = SparseVmdk(sys.argv[1])
+    info = vmdk.info()
+    info['stats'] = vmdk.stats()
+    print(json.dumps(info, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import json
+import os
+import pytest
+import shutil
+import struct
+import subprocess
+import uuid
+import zlib
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-analyze")
+
+MB = 1024 * 1024
+DISK_SIZE = 16 * MB
+
+LINUX_FS = uuid.UUID("0FC63DAF-8483-4772-8E79-3D69D8477DE4")
+EFI_SYSTEM = uuid.UUID("C12A7328-F81F-11D2-BA4B-00A0C93EC93B")
+
+
+def write_gpt(image, partitions):
+    """
+    Write a protective MBR, and a GPT with 128 entries at LBA 2.
+    partitions is a list of (type uuid, name, first LBA, last LBA).
+    """
+    mbr = bytearray(512)
+    mbr[446:462] = struct.pack("<B3sB3sII", 0, b"\0\0\2", 0xee, b"\xff\xff\xff", 1, len(image) // 512 - 1)
+    mbr[510:512] = b"\x55\xaa"
+    image[0:512] = mbr
+
+    entries = bytearray(128 * 128)
+    for i, (type_guid, name, first, last) in enumerate(partitions):
+        entries[i * 128:(i + 1) * 128] = struct.pack("<16s16sQQQ72s", type_guid.bytes_le, uuid.uuid4().bytes_le,
+                                                     first, last, 0, name.encode("utf-16-le"))
+    header = struct.pack("<8sIIIIQQQQ16sQIII", b"EFI PART", 0x10000, 92, 0, 0, 1, len(image) // 512 - 1,
+                         34, len(image) // 512 - 34, uuid.uuid4().bytes_le, 2, 128, 128, zlib.crc32(entries))
+    header = header[:16] + struct.pack("<I", zlib.crc32(header)) + header[20:]
+    image[512:512 + len(header)] = header
+    image[1024:1024 + len(entries)] = entries
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    # 1-5 MB compresses well, 8-12 MB does not
+    image = bytearray(DISK_SIZE)
+    write_gpt(image, [(EFI_SYSTEM, "efi", 2048, 5 * 2048 - 1),
+                      (LINUX_FS, "root", 8 * 2048, 12 * 2048 - 1)])
+    image[1 * MB:5 * MB] = (b"compressible " * (4 * MB))[:4 * MB]
+    image[8 * MB:12 * MB] = os.urandom(4 * MB)
+    with open(os.path.join(WORK_DIR, "gpt.img"), "wb") as f:
+        f.write(image)
+
+    image = bytearray(DISK_SIZE)
+    image[446:462] = struct.pack("<B3sB3sII", 0x80, b"\0\0\0", 0x83, b"\0\0\0", 2048, 4 * 2048)
+    image[510:512] = b"\x55\xaa"
+    image[2 * MB:3 * MB] = os.urandom(MB)
+    with open(os.path.join(WORK_DIR, "mbr.img"), "wb") as f:
+        f.write(image)
+
+    for name in ["gpt", "mbr"]:
+        process = subprocess.run([VMDK_CONVERT, f"{name}.img", f"{name}.vmdk"], cwd=WORK_DIR)
+        assert process.returncode == 0
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def analyze(filename):
+    process = subprocess.run([VMDK_CONVERT, "--analyze", filename], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    return json.loads(process.stdout)
+
+
+def test_analyze_gpt(setup_test):
+    report = analyze("gpt.vmdk")
+    assert report["capacity"] == DISK_SIZE
+    assert report["partitionTable"] == "gpt"
+
+    efi, root = report["partitions"]
+    assert (efi["number"], efi["type"], efi["name"], efi["start"], efi["length"]) == \
+        (1, "EFI System", "efi", MB, 4 * MB)
+    assert (root["number"], root["type"], root["name"]) == (2, "Linux filesystem", "root")
+    assert efi["allocatedBytes"] == root["allocatedBytes"] == 4 * MB
+    # the random data takes most of the file
+    assert root["storedBytes"] > 4 * MB > 10 * efi["storedBytes"]
+    # the partition table
+    assert report["unpartitioned"]["allocatedBytes"] == 64 * 1024
+
+    assert report["storedBytes"] == sum(p["storedBytes"] for p in report["partitions"]) + \
+        report["unpartitioned"]["storedBytes"]
+    assert report["storedBytes"] == sum(r["storedBytes"] for r in report["regions"])
+    assert len(report["regions"]) * report["regionSize"] >= DISK_SIZE
+
+
+def test_analyze_mbr(setup_test):
+    report = analyze("mbr.vmdk")
+    assert report["partitionTable"] == "mbr"
+    assert [(p["number"], p["type"], p["start"], p["length"]) for p in report["partitions"]] == \
+        [(1, "Linux", MB, 4 * MB)]
+    assert report["partitions"][0]["allocatedBytes"] == MB
+
+
+def test_heatmap(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--analyze", "--heatmap", "gpt-map", "gpt.vmdk"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+
+    with open(os.path.join(WORK_DIR, "gpt-map.json")) as f:
+        assert json.load(f) == json.loads(process.stdout)
+    with open(os.path.join(WORK_DIR, "gpt-map.html")) as f:
+        html = f.read()
+    assert html.count("<svg") == 2
+    assert "Linux filesystem" in html
+
+
+def test_heatmap_conversion(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--heatmap", "converted", "gpt.img", "converted.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    with open(os.path.join(WORK_DIR, "converted.json")) as f:
+        assert json.load(f) == analyze("converted.vmdk")
+    assert os.path.exists(os.path.join(WORK_DIR, "converted.html"))
+
+
+def test_heatmap_raw_target_rejected(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--heatmap", "raw", "gpt.vmdk", "out.img"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 1
+
+
+def test_analyze_raw_rejected(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--analyze", "gpt.img"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
@@ -0,0 +1,107 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-batch")
+
+MB = 1024 * 1024
+DISKS = {"disk1": 8, "disk2": 1, "disk3": 3}
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def check_roundtrip(name, converted):
+    process = subprocess.run([VMDK_CONVERT, converted, name + "-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, name + "-back.img")) == get_hash(os.path.join(WORK_DIR, name + ".img"))
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    for name, size in DISKS.items():
+        with open(os.path.join(WORK_DIR, name + ".img"), "wb") as f:
+            for i in range(size):
+                f.write(os.urandom(MB // 4) + f"{name} ".encode() * (MB // 8) + b"\0" * (MB // 4))
+    yield
+
+
+def test_batch_pairs(setup_test):
+    args = []
+    for name in DISKS:
+        args += [name + ".img", name + ".vmdk"]
+    process = subprocess.run([VMDK_CONVERT, "-n", "3", "--batch"] + args,
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    for name in DISKS:
+        assert f"Success: {name}.img -> {name}.vmdk" in process.stdout
+        check_roundtrip(name, name + ".vmdk")
+
+
+def test_batch_job_file(setup_test):
+    jobs = [
+        {"src": "disk1.img", "dst": "job1.vmdk"},
+        {"src": "disk2.img", "dst": "job2.qcow2"},
+        {"src": "disk3.img", "dst": "job3.disk", "format": "streamOptimized"},
+    ]
+    with open(os.path.join(WORK_DIR, "jobs.json"), "wt") as f:
+        json.dump(jobs, f)
+
+    process = subprocess.run([VMDK_CONVERT, "--job-file", "jobs.json"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    check_roundtrip("disk1", "job1.vmdk")
+    check_roundtrip("disk2", "job2.qcow2")
+    check_roundtrip("disk3", "job3.disk")
+    with open(os.path.join(WORK_DIR, "job3.disk"), "rb") as f:
+        assert f.read(4) == b"KDMV"
+
+
+def test_batch_partial_failure(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--batch", "disk2.img", "ok.vmdk", "missing.img", "missing.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
+
+    assert "Success: disk2.img -> ok.vmdk" in process.stdout
+    assert "Failure: missing.img -> missing.vmdk" in process.stdout
+    check_roundtrip("disk2", "ok.vmdk")
+
+
+@pytest.mark.parametrize("content", ['{"src": "a", "dst": "b"}', '[{"src": "a"}]', '[{"src": "a", "dst": "b", "foo": "c"}]'])
+def test_batch_invalid_job_file(setup_test, content):
+    with open(os.path.join(WORK_DIR, "bad.json"), "wt") as f:
+        f.write(content)
+
+    process = subprocess.run([VMDK_CONVERT, "--job-file", "bad.json"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
+
+
+def test_batch_odd_arguments(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--batch", "disk1.img"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
@@ -0,0 +1,105 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import time
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-build-graph")
+
+NUM_DISKS = 3
+DELAY = 2
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def write_config(filename, images):
+    hardware = {
+        'cpus': 1,
+        'memory': {'type': "memory", 'size': 1024},
+        'sata1': {'type': "sata_controller"},
+    }
+    for i, image in enumerate(images):
+        hardware[f"disk{i}"] = {'type': "hard_disk", 'parent': "sata1", 'raw_image': image}
+    config = {
+        'system': {'name': "graph", 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+        'networks': {'vm_network': {'name': "None", 'description': "The None network"}},
+        'hardware': hardware,
+    }
+    with open(os.path.join(WORK_DIR, filename), "wt") as f:
+        yaml.dump(config, f)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    for i in range(NUM_DISKS):
+        with open(os.path.join(WORK_DIR, f"disk{i}.img"), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+
+    # a vmdk-convert that takes DELAY seconds per conversion
+    with open(os.path.join(WORK_DIR, "slow-convert"), "wt") as f:
+        f.write(f"#!/bin/sh\n[ \"$1\" = \"-i\" ] || sleep {DELAY}\nexec {VMDK_CONVERT} \"$@\"\n")
+    os.chmod(os.path.join(WORK_DIR, "slow-convert"), 0o755)
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def test_parallel_conversions(setup_test):
+    write_config("graph.yaml", [f"disk{i}.img" for i in range(NUM_DISKS)])
+
+    start = time.monotonic()
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "graph.yaml", "-o", "graph", "--format", "dir",
+                              "--vmdk-convert", os.path.join(WORK_DIR, "slow-convert")], cwd=WORK_DIR)
+    assert process.returncode == 0
+    # the conversions ran at the same time
+    assert time.monotonic() - start < DELAY * NUM_DISKS - 1
+
+    with open(os.path.join(WORK_DIR, "graph", "graph.mf")) as f:
+        manifest = f.read()
+    for i in range(NUM_DISKS):
+        assert f"SHA256(disk{i}.vmdk)= {get_hash(os.path.join(WORK_DIR, f'disk{i}.vmdk'))}" in manifest
+    assert f"SHA256(graph.ovf)= {get_hash(os.path.join(WORK_DIR, 'graph', 'graph.ovf'))}" in manifest
+
+    # disks keep their order in the OVF
+    with open(os.path.join(WORK_DIR, "graph", "graph.ovf")) as f:
+        ovf = f.read()
+    positions = [ovf.index(f'ovf:href="disk{i}.vmdk"') for i in range(NUM_DISKS)]
+    assert positions == sorted(positions)
+
+
+def test_failed_conversion(setup_test):
+    write_config("broken.yaml", ["disk0.img", "broken.img"])
+    # a directory cannot be converted
+    os.makedirs(os.path.join(WORK_DIR, "broken.img"), exist_ok=True)
+
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "broken.yaml", "-o", "broken.ova",
+                              "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR)
+    assert process.returncode != 0
+    assert not os.path.exists(os.path.join(WORK_DIR, "broken.ova"))
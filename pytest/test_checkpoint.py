@@ -0,0 +1,136 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import time
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-checkpoint")
+
+MB = 1024 * 1024
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def content_digest(filename):
+    process = subprocess.run([VMDK_CONVERT, "-i", "--detailed", filename], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+    return json.loads(process.stdout)["contentDigest"]
+
+
+def interrupted_conversion(src, dst):
+    """
+    Start a conversion with checkpoints and kill it hard once the first
+    checkpoint has been written.
+    """
+    checkpoint = os.path.join(WORK_DIR, dst + ".checkpoint")
+    process = subprocess.Popen([VMDK_CONVERT, "-n", "1", "--checkpoint", "4", src, dst], cwd=WORK_DIR)
+    while not os.path.exists(checkpoint):
+        if process.poll() is not None:
+            pytest.skip("conversion finished before the first checkpoint")
+        time.sleep(0.01)
+    process.kill()
+    process.wait()
+    return checkpoint
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    # random data compresses slowly, leaving time to interrupt
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        for i in range(48):
+            f.write(os.urandom(MB // 2) + b"\0" * (MB // 2))
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def test_checkpoint_removed_on_success(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--checkpoint", "8", "test.img", "full.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert not os.path.exists(os.path.join(WORK_DIR, "full.vmdk.checkpoint"))
+
+
+def test_resume(setup_test):
+    checkpoint = interrupted_conversion("test.img", "resume.vmdk")
+
+    process = subprocess.run([VMDK_CONVERT, "--resume", "--content-digest", "test.img", "resume.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    assert "Resuming conversion at" in process.stdout
+    assert not os.path.exists(checkpoint)
+
+    process = subprocess.run([VMDK_CONVERT, "resume.vmdk", "resume.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "resume.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+    # the content converted before the interruption is part of the digest
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "test.img", "direct.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert content_digest("resume.vmdk") == content_digest("direct.vmdk")
+
+
+def test_resume_truncates_stale_data(setup_test):
+    interrupted_conversion("test.img", "stale.vmdk")
+
+    # leave more data behind than the finished stream will cover
+    with open(os.path.join(WORK_DIR, "stale.vmdk"), "ab") as f:
+        f.write(os.urandom(64 * MB))
+
+    process = subprocess.run([VMDK_CONVERT, "--resume", "test.img", "stale.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "test.img", "fresh.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert os.path.getsize(os.path.join(WORK_DIR, "stale.vmdk")) == os.path.getsize(os.path.join(WORK_DIR, "fresh.vmdk"))
+
+
+def test_resume_changed_source(setup_test):
+    interrupted_conversion("test.img", "changed.vmdk")
+
+    os.utime(os.path.join(WORK_DIR, "test.img"))
+    process = subprocess.run([VMDK_CONVERT, "--resume", "test.img", "changed.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
+    assert "Source disk has changed" in process.stderr
+
+
+def test_resume_without_checkpoint(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "test.img", "nockpt.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "--resume", "test.img", "nockpt.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
+    assert "Cannot open checkpoint" in process.stderr
+
+
+def test_checkpoint_raw_rejected(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--checkpoint", "8", "test.img", "out.img"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
@@ -0,0 +1,228 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import glob
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import time
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-conversion-cache")
+CACHE_DIR = os.path.join(WORK_DIR, "cache")
+
+KB = 1024
+
+
+def write_config(name, raw_image, sector_size=None, disk_image=None):
+    disk = {'type': "hard_disk", 'parent': "sata1", 'raw_image': raw_image}
+    if sector_size is not None:
+        disk['sector_size'] = sector_size
+    if disk_image is not None:
+        disk['disk_image'] = disk_image
+    config = {
+        'system': {'name': name, 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+        'hardware': {
+            'cpus': 1,
+            'memory': {'type': "memory", 'size': 1024},
+            'sata1': {'type': "sata_controller"},
+            'disk0': disk,
+        },
+    }
+    with open(os.path.join(WORK_DIR, f"{name}.yaml"), "wt") as f:
+        yaml.dump(config, f)
+
+
+def write_converter(name, comment=""):
+    # logs each conversion
+    with open(os.path.join(WORK_DIR, name), "wt") as f:
+        f.write("#!/bin/sh\n"
+                f"# {comment}\n"
+                f"[ \"$1\" = \"-i\" ] || echo \"$@\" >> {WORK_DIR}/convert.log\n"
+                f"exec {VMDK_CONVERT} \"$@\"\n")
+    os.chmod(os.path.join(WORK_DIR, name), 0o755)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    for name in ["a", "b", "c"]:
+        # about 400 KB as a VMDK
+        with open(os.path.join(WORK_DIR, f"{name}.img"), "wb") as f:
+            f.write(os.urandom(384 * KB) + b"\0" * (640 * KB))
+        write_config(name, f"{name}.img")
+    write_converter("logged-convert")
+    write_converter("other-convert", "another version")
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def conversions():
+    if not os.path.exists(os.path.join(WORK_DIR, "convert.log")):
+        return 0
+    with open(os.path.join(WORK_DIR, "convert.log")) as f:
+        return len(f.read().splitlines())
+
+
+def run(name, converter="logged-convert", options=[], output=None):
+    before = conversions()
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", f"{name}.yaml", "-o", f"{name}.ovf",
+                              "--cache-dir", CACHE_DIR, "--vmdk-convert", os.path.join(WORK_DIR, converter)] + options,
+                             cwd=WORK_DIR, capture_output=output is not None, text=True)
+    assert process.returncode == 0
+    if output is not None:
+        output.append(process.stdout)
+    return conversions() - before
+
+
+def remove_vmdks():
+    for name in glob.glob(os.path.join(WORK_DIR, "*.vmdk")):
+        os.remove(name)
+
+
+def cached_vmdks():
+    return glob.glob(os.path.join(CACHE_DIR, "vmdks", "*.vmdk"))
+
+
+def test_convert_once(setup_test):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    assert run("a") == 1
+    assert run("a") == 0
+
+    # a removed VMDK is taken from the cache
+    os.remove(os.path.join(WORK_DIR, "a.vmdk"))
+    assert run("a") == 0
+    cached = cached_vmdks()
+    assert len(cached) == 1
+    assert not os.path.samefile(cached[0], os.path.join(WORK_DIR, "a.vmdk"))
+    assert os.stat(cached[0]).st_mode & 0o777 == 0o444
+
+    # writing to the VMDK does not change the cached one
+    with open(os.path.join(WORK_DIR, "a.vmdk"), "rb") as f:
+        vmdk = f.read()
+    with open(os.path.join(WORK_DIR, "a.vmdk"), "r+b") as f:
+        f.write(os.urandom(KB))
+    assert run("a") == 0
+    with open(os.path.join(WORK_DIR, "a.vmdk"), "rb") as f:
+        assert f.read() == vmdk
+
+    # the content counts, not the time stamps or the name
+    os.utime(os.path.join(WORK_DIR, "a.img"))
+    assert run("a") == 0
+    shutil.copy(os.path.join(WORK_DIR, "a.img"), os.path.join(WORK_DIR, "copy.img"))
+    write_config("copy", "copy.img")
+    assert run("copy") == 0
+    with open(os.path.join(WORK_DIR, "a.vmdk"), "rb") as f1, open(os.path.join(WORK_DIR, "copy.vmdk"), "rb") as f2:
+        assert f1.read() == f2.read()
+
+    # a changed raw image is converted again, without changing the cached VMDK
+    with open(os.path.join(WORK_DIR, "a.img"), "r+b") as f:
+        f.write(os.urandom(KB))
+    assert run("a") == 1
+    assert len(cached_vmdks()) == 2
+    assert run("copy") == 0
+
+
+def test_opt_in(setup_test):
+    # without --cache-dir or --cache-size, no VMDKs are cached
+    remove_vmdks()
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(WORK_DIR, "home-cache"))
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "a.yaml", "-o", "a.ovf",
+                              "--vmdk-convert", os.path.join(WORK_DIR, "logged-convert")], cwd=WORK_DIR, env=env)
+    assert process.returncode == 0
+    assert os.path.exists(os.path.join(WORK_DIR, "a.vmdk"))
+    assert not os.path.exists(os.path.join(WORK_DIR, "home-cache", "open-vmdk", "vmdks"))
+
+
+def test_options(setup_test):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    assert run("b") == 1
+    # another sector size or converter needs another conversion
+    write_config("b4k", "b.img", sector_size=4096)
+    assert run("b4k") == 1
+    assert run("b", converter="other-convert") == 1
+    assert run("b4k") == 0
+
+    # --no-cache falls back to the time stamps
+    assert run("b", options=["--no-cache"]) == 0
+    os.utime(os.path.join(WORK_DIR, "b.img"))
+    assert run("b", options=["--no-cache"]) == 1
+    # which does not overwrite the cached VMDK
+    assert run("b4k") == 0
+    process = subprocess.run([VMDK_CONVERT, "-i", "--detailed", "b.vmdk"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert '"ddb.logicalSectorSize": "4096"' in process.stdout
+
+
+def test_existing_vmdk(setup_test):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    remove_vmdks()
+    # older than c.vmdk, but not what it was converted from
+    with open(os.path.join(WORK_DIR, "other.img"), "wb") as f:
+        f.write(os.urandom(384 * KB) + b"\0" * (640 * KB))
+    assert run("c", options=["--no-cache"]) == 1
+
+    # a VMDK that is not cached is converted again, not added as it is
+    write_config("other", "other.img", disk_image="c.vmdk")
+    assert run("other") == 1
+    assert run("other") == 0
+    process = subprocess.run([VMDK_CONVERT, "other.img", "expected.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    process = subprocess.run([VMDK_CONVERT, "--diff", "c.vmdk", "expected.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert len(cached_vmdks()) == 1
+
+    assert run("c") == 1
+    assert len(cached_vmdks()) == 2
+
+
+def test_quiet(setup_test):
+    run("c")
+    remove_vmdks()
+    output = []
+    assert run("c", output=output) == 0
+    assert "using cached" in output[0]
+    os.remove(os.path.join(WORK_DIR, "c.vmdk"))
+    output = []
+    assert run("c", options=["-q"], output=output) == 0
+    assert "using cached" not in output[0]
+
+
+def test_eviction(setup_test):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    remove_vmdks()
+    # room for two VMDKs
+    options = ["--cache-size", "1"]
+    assert run("a", options=options) == 1
+    time.sleep(0.1)
+    assert run("b", options=options) == 1
+    time.sleep(0.1)
+    os.remove(os.path.join(WORK_DIR, "a.vmdk"))
+    assert run("a", options=options) == 0
+    time.sleep(0.1)
+
+    # b was used least recently
+    assert run("c", options=options) == 1
+    assert len(cached_vmdks()) == 2
+    os.remove(os.path.join(WORK_DIR, "a.vmdk"))
+    assert run("a", options=options) == 0
+    os.remove(os.path.join(WORK_DIR, "b.vmdk"))
+    assert run("b", options=options) == 1
@@ -0,0 +1,122 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import json
+import os
+import pytest
+import shutil
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-diff")
+
+GRAIN_SIZE = 64 * 1024
+NUM_GRAINS = 64
+
+
+def write_image(filename, data):
+    with open(os.path.join(WORK_DIR, filename), "wb") as f:
+        f.write(data)
+
+
+def convert(src, dst, options=[]):
+    process = subprocess.run([VMDK_CONVERT] + options + [src, dst], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+
+def diff(a, b, options=[]):
+    process = subprocess.run([VMDK_CONVERT, "--diff"] + options + [a, b], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    report = json.loads(process.stdout)
+    assert process.returncode == (0 if report["identical"] else 1)
+    return report
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    base = bytearray()
+    for i in range(NUM_GRAINS):
+        if i % 2:
+            base += b"\0" * GRAIN_SIZE
+        else:
+            base += (f"grain {i} ".encode() * GRAIN_SIZE)[:GRAIN_SIZE]
+    write_image("base.img", base)
+    convert("base.img", "base.vmdk")
+
+    changed = bytearray(base)
+    # inside one grain, across two grains, and in a zero grain
+    changed[10:20] = b"x" * 10
+    changed[8 * GRAIN_SIZE - 5:8 * GRAIN_SIZE + 5] = b"y" * 10
+    changed[21 * GRAIN_SIZE + 100] = 1
+    write_image("changed.img", changed)
+    convert("changed.img", "changed.vmdk")
+
+    write_image("bigger.img", base + os.urandom(2 * GRAIN_SIZE))
+    convert("bigger.img", "bigger.vmdk")
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def test_diff_identical(setup_test):
+    report = diff("base.vmdk", "base.vmdk")
+    assert report["identical"]
+    assert report["sameByTable"] == NUM_GRAINS // 2
+    assert report["sameByPayload"] == NUM_GRAINS // 2
+    assert report["extents"] == []
+
+
+@pytest.mark.parametrize("threads", ["1", "4"])
+def test_diff_other_level(setup_test, threads):
+    convert("base.img", "level1.vmdk", ["-c", "1"])
+
+    # different compressed data, same content
+    report = diff("base.vmdk", "level1.vmdk", ["-n", threads])
+    assert report["identical"]
+    assert report["sameByContent"] == NUM_GRAINS // 2
+
+
+def test_diff_changed(setup_test):
+    report = diff("base.vmdk", "changed.vmdk")
+    assert not report["identical"]
+    assert report["changedGrains"] == 4
+    assert report["changedBytes"] == 4 * GRAIN_SIZE
+    assert [(e["start"], e["length"]) for e in report["extents"]] == \
+        [(0, GRAIN_SIZE), (7 * GRAIN_SIZE, 2 * GRAIN_SIZE), (21 * GRAIN_SIZE, GRAIN_SIZE)]
+    # the zero grain is not in the first file
+    assert report["extents"][2]["size"][0] == 0
+    assert report["extents"][2]["size"][1] > 0
+    assert report["size"][1] > report["size"][0]
+
+
+def test_diff_capacity(setup_test):
+    report = diff("base.vmdk", "bigger.vmdk")
+    assert report["capacity"] == [NUM_GRAINS * GRAIN_SIZE, (NUM_GRAINS + 2) * GRAIN_SIZE]
+    assert [(e["start"], e["length"]) for e in report["extents"]] == [(NUM_GRAINS * GRAIN_SIZE, 2 * GRAIN_SIZE)]
+
+
+def test_diff_raw_rejected(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--diff", "base.vmdk", "base.img"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 1
+    assert "only works with sparse VMDK" in process.stderr
+
+
+def test_diff_one_disk(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--diff", "base.vmdk"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 1
@@ -0,0 +1,96 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import struct
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-digest")
+
+MB = 1024 * 1024
+LEAF_SIZE = 64 * 1024
+FANOUT = 512
+
+
+def tree_digest(data):
+    leaves = [hashlib.sha256(data[i:i + LEAF_SIZE]).digest() for i in range(0, len(data), LEAF_SIZE)]
+    nodes = [hashlib.sha256(b"".join(leaves[i:i + FANOUT])).digest() for i in range(0, len(leaves), FANOUT)]
+    return "sha256-tree:" + hashlib.sha256(struct.pack("<Q", len(data)) + b"".join(nodes)).hexdigest()
+
+
+def content_digest(filename):
+    process = subprocess.run([VMDK_CONVERT, "-i", "--detailed", filename], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+    data = json.loads(process.stdout)
+    assert data["descriptorFile"]["ddb.contentDigest"] == data["contentDigest"]
+    return data["contentDigest"]
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    # more than one node, the last one partial
+    data = os.urandom(3 * MB) + b"\0" * (34 * MB) + os.urandom(MB)
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        f.write(data)
+    yield data
+
+
+@pytest.mark.parametrize("threads", ["1", "4"])
+def test_digest(setup_test, threads):
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "-n", threads, "test.img", "test.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert content_digest("test.vmdk") == tree_digest(setup_test)
+
+
+def test_no_digest_by_default(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "test.img", "plain.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "-i", "--detailed", "plain.vmdk"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+    data = json.loads(process.stdout)
+    assert "contentDigest" not in data
+    assert "ddb.contentDigest" not in data["descriptorFile"]
+
+
+def test_digest_same_content(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "test.img", "test.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "-c", "1", "test.vmdk", "copy.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert content_digest("copy.vmdk") == content_digest("test.vmdk")
+
+
+def test_digest_changed_content(setup_test):
+    data = bytearray(setup_test)
+    data[20 * MB] = 1
+    with open(os.path.join(WORK_DIR, "changed.img"), "wb") as f:
+        f.write(data)
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "changed.img", "changed.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert content_digest("changed.vmdk") == tree_digest(data)
+    assert content_digest("changed.vmdk") != tree_digest(setup_test)
@@ -0,0 +1,152 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-digest-cache")
+CACHE_FILE = os.path.join(WORK_DIR, "cache", "open-vmdk", "digests.json")
+
+# files changed in the last seconds are not cached
+RACY_SECONDS = 2
+
+FAKE_DIGEST = "0" * 64
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def file_key(filename):
+    st = os.stat(filename)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}:sha256"
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    with open(os.path.join(WORK_DIR, "disk.img"), "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+    with open(os.path.join(WORK_DIR, "cd.iso"), "wb") as f:
+        f.write(os.urandom(64 * 1024))
+
+    config = {
+        'system': {'name': "cached", 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+        'hardware': {
+            'cpus': 1,
+            'memory': {'type': "memory", 'size': 1024},
+            'sata1': {'type': "sata_controller"},
+            'disk0': {'type': "hard_disk", 'parent': "sata1", 'raw_image': "disk.img"},
+            'cdrom1': {'type': "cd_drive", 'parent': "sata1", 'image': "cd.iso"},
+        },
+    }
+    with open(os.path.join(WORK_DIR, "cached.yaml"), "wt") as f:
+        yaml.dump(config, f)
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def ova_compose(output_file, output_format):
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(WORK_DIR, "cache"))
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "cached.yaml", "-o", output_file,
+                              "--format", output_format, "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR, env=env)
+    assert process.returncode == 0
+
+
+def read_manifest(output_file, output_format):
+    mf_file = os.path.splitext(output_file)[0] + ".mf"
+    if output_format == "dir":
+        with open(os.path.join(WORK_DIR, output_file, mf_file)) as f:
+            lines = f.read().splitlines()
+    else:
+        with tarfile.open(os.path.join(WORK_DIR, output_file)) as tar:
+            lines = tar.extractfile(mf_file).read().decode().splitlines()
+    manifest = {}
+    for line in lines:
+        left, digest = line.split("= ")
+        manifest[left[len("SHA256("):-1]] = digest
+    return manifest
+
+
+def remove(output_file):
+    path = os.path.join(WORK_DIR, output_file)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def set_cached_digest(filename, digest):
+    with open(CACHE_FILE) as f:
+        entries = json.load(f)
+    entries[file_key(filename)][0] = digest
+    with open(CACHE_FILE, "wt") as f:
+        json.dump(entries, f)
+
+
+@pytest.mark.parametrize("output_format, output_file", [("dir", "cached"), ("ova", "cached.ova")])
+def test_digest_cache(setup_test, output_format, output_file):
+    if os.path.exists(CACHE_FILE):
+        os.remove(CACHE_FILE)
+    ova_compose("first", "dir")
+    remove("first")
+    time.sleep(RACY_SECONDS + 1)
+
+    # the files are hashed once more and cached, the OVF is not cached
+    remove(output_file)
+    ova_compose(output_file, output_format)
+    with open(CACHE_FILE) as f:
+        entries = json.load(f)
+    assert len(entries) == 2
+    for name in ["disk.vmdk", "cd.iso"]:
+        assert entries[file_key(os.path.join(WORK_DIR, name))][0] == get_hash(os.path.join(WORK_DIR, name))
+
+    # the cached digests are used instead of hashing the files
+    set_cached_digest(os.path.join(WORK_DIR, "cd.iso"), FAKE_DIGEST)
+    remove(output_file)
+    ova_compose(output_file, output_format)
+    manifest = read_manifest(output_file, output_format)
+    assert manifest["cd.iso"] == FAKE_DIGEST
+    assert manifest["disk.vmdk"] == get_hash(os.path.join(WORK_DIR, "disk.vmdk"))
+
+    # a changed file is hashed again
+    os.utime(os.path.join(WORK_DIR, "cd.iso"))
+    remove(output_file)
+    ova_compose(output_file, output_format)
+    assert read_manifest(output_file, output_format)["cd.iso"] == get_hash(os.path.join(WORK_DIR, "cd.iso"))
+
+
+def test_invalid_cache(setup_test):
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    with open(CACHE_FILE, "wt") as f:
+        f.write("not json")
+    ova_compose("invalid", "dir")
+    manifest = read_manifest("invalid", "dir")
+    assert manifest["cd.iso"] == get_hash(os.path.join(WORK_DIR, "cd.iso"))
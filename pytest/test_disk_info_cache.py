@@ -0,0 +1,120 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import time
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-disk-info-cache")
+CACHE_FILE = os.path.join(WORK_DIR, "cache", "open-vmdk", "diskinfo.json")
+
+NUM_DISKS = 4
+
+# files changed in the last seconds are not cached
+RACY_SECONDS = 2
+
+MB = 1024 * 1024
+
+
+def file_key(filename):
+    st = os.stat(filename)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}:detailed"
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    for i in range(NUM_DISKS):
+        with open(os.path.join(WORK_DIR, f"disk{i}.img"), "wb") as f:
+            f.write(os.urandom(MB))
+        config = {
+            'system': {'name': f"info{i}", 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+            'hardware': {
+                'cpus': 1,
+                'memory': {'type': "memory", 'size': 1024},
+                'sata1': {'type': "sata_controller"},
+                'disk0': {'type': "hard_disk", 'parent': "sata1", 'raw_image': f"disk{i}.img"},
+            },
+        }
+        with open(os.path.join(WORK_DIR, f"info{i}.yaml"), "wt") as f:
+            yaml.dump(config, f)
+
+        process = subprocess.run([VMDK_CONVERT, f"disk{i}.img", f"disk{i}.vmdk"], cwd=WORK_DIR)
+        assert process.returncode == 0
+    time.sleep(RACY_SECONDS + 1)
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def ova_compose(index, options=[]):
+    return [sys.executable, OVA_COMPOSE, "-i", f"info{index}.yaml", "-o", f"info{index}.ovf",
+            "--vmdk-convert", VMDK_CONVERT] + options
+
+
+def run(index, options=[]):
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(WORK_DIR, "cache"))
+    process = subprocess.run(ova_compose(index, options), cwd=WORK_DIR, env=env)
+    assert process.returncode == 0
+    with open(os.path.join(WORK_DIR, f"info{index}.ovf")) as f:
+        return f.read()
+
+
+def read_cache():
+    with open(CACHE_FILE) as f:
+        return json.load(f)
+
+
+def test_disk_info_cache(setup_test):
+    ovf = run(0)
+    assert 'ovf:capacity="1048576"' in ovf
+    entries = read_cache()
+    assert entries[file_key(os.path.join(WORK_DIR, "disk0.vmdk"))][0]["capacity"] == MB
+
+    # the cached info is used instead of reading the disk
+    entries[file_key(os.path.join(WORK_DIR, "disk0.vmdk"))][0]["capacity"] = 2 * MB
+    with open(CACHE_FILE, "wt") as f:
+        json.dump(entries, f)
+    assert 'ovf:capacity="2097152"' in run(0)
+
+    # but not with --no-cache, which does not change the cache either
+    entries = read_cache()
+    assert 'ovf:capacity="1048576"' in run(0, ["--no-cache"])
+    assert read_cache() == entries
+
+    # a changed disk is read again
+    os.utime(os.path.join(WORK_DIR, "disk0.vmdk"))
+    assert 'ovf:capacity="1048576"' in run(0)
+
+
+def test_concurrent_builds(setup_test):
+    os.remove(CACHE_FILE)
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(WORK_DIR, "cache"))
+    processes = [subprocess.Popen(ova_compose(i), cwd=WORK_DIR, env=env) for i in range(1, NUM_DISKS)]
+    for process in processes:
+        assert process.wait() == 0
+
+    # no build lost the entries of the others
+    entries = read_cache()
+    for i in range(1, NUM_DISKS):
+        assert file_key(os.path.join(WORK_DIR, f"disk{i}.vmdk")) in entries
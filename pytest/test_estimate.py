@@ -0,0 +1,87 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import json
+import os
+import pytest
+import random
+import shutil
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-estimate")
+
+GRAIN_SIZE = 64 * 1024
+NUM_GRAINS = 1024
+
+
+def estimate(filename, *options):
+    process = subprocess.run([VMDK_CONVERT, "--estimate"] + list(options) + [filename],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    return json.loads(process.stdout)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    # grains compressing to very different sizes, the second half is a hole
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        for i in range(NUM_GRAINS // 2):
+            kind = random.randrange(3)
+            if kind == 0:
+                f.write(os.urandom(GRAIN_SIZE))
+            elif kind == 1:
+                f.write(os.urandom(GRAIN_SIZE // 4) + b"\0" * (GRAIN_SIZE * 3 // 4))
+            else:
+                f.write(f"grain {i} ".encode() * (GRAIN_SIZE // 16) + b"\0" * (GRAIN_SIZE - GRAIN_SIZE // 16 * len(f"grain {i} ")))
+        f.truncate(NUM_GRAINS * GRAIN_SIZE)
+    process = subprocess.run([VMDK_CONVERT, "test.img", "test.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("source", ["test.img", "test.vmdk"])
+def test_estimate_all_grains(setup_test, source):
+    # with every grain sampled the estimate is exact
+    report = estimate(source, "--samples", str(NUM_GRAINS))
+    size = os.path.getsize(os.path.join(WORK_DIR, "test.vmdk"))
+    assert report["sampledGrains"] == NUM_GRAINS // 2
+    assert report["projectedSize"]["value"] == size
+    assert report["projectedSize"]["low"] == report["projectedSize"]["high"] == size
+
+
+def test_estimate_sample(setup_test):
+    report = estimate("test.img", "--samples", "100", "-n", "2")
+    size = os.path.getsize(os.path.join(WORK_DIR, "test.vmdk"))
+    assert report["capacity"] == NUM_GRAINS * GRAIN_SIZE
+    assert report["populatedGrains"] == NUM_GRAINS // 2
+    assert report["sampledGrains"] == 100
+    projected = report["projectedSize"]
+    assert projected["low"] < projected["value"] < projected["high"]
+    assert abs(projected["value"] - size) < 0.25 * size
+    ratio = report["compressionRatio"]
+    assert ratio["low"] <= ratio["value"] <= ratio["high"]
+    threads = [t["threads"] for t in report["wallTime"]]
+    assert threads == sorted(threads) and 1 in threads and 2 in threads
+
+
+def test_estimate_level(setup_test):
+    fast = estimate("test.img", "-c", "1", "--samples", str(NUM_GRAINS))
+    best = estimate("test.img", "-c", "9", "--samples", str(NUM_GRAINS))
+    assert fast["projectedSize"]["value"] >= best["projectedSize"]["value"]
@@ -0,0 +1,173 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import re
+import shutil
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-grain-cache")
+
+MB = 1024 * 1024
+GRAIN_SIZE = 64 * 1024
+NUM_GRAINS = 128
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def cache_stats(output):
+    m = re.search(r"Grain cache: (\d+) hits, (\d+) misses, (\d+) grains stored", output)
+    assert m is not None
+    return tuple(int(x) for x in m.groups())
+
+
+def cache_entries(cache_dir):
+    return [os.path.join(root, name) for root, dirs, files in os.walk(cache_dir) for name in files
+            if root != cache_dir]
+
+
+def entry_size(path):
+    st = os.stat(path)
+    return -(-st.st_size // st.st_blksize) * st.st_blksize
+
+
+def cache_size(cache_dir):
+    return sum(entry_size(path) for path in cache_entries(cache_dir))
+
+
+def recorded_size(cache_dir):
+    with open(os.path.join(cache_dir, "size")) as f:
+        return int(f.read())
+
+
+def convert(options, src, dst):
+    process = subprocess.run([VMDK_CONVERT] + options + [src, dst], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+    return cache_stats(process.stdout)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        for i in range(NUM_GRAINS):
+            if i % 4 == 3:
+                f.write(b"\0" * GRAIN_SIZE)
+            else:
+                f.write((f"grain {i} ".encode() * GRAIN_SIZE)[:GRAIN_SIZE])
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def test_grain_cache_hits(setup_test):
+    cache = os.path.join(WORK_DIR, "cache-hits")
+    data_grains = NUM_GRAINS * 3 // 4
+
+    assert convert(["--grain-cache", cache], "test.img", "first.vmdk") == (0, data_grains, data_grains)
+    assert convert(["--grain-cache", cache], "test.img", "second.vmdk") == (data_grains, 0, 0)
+
+    # the compressed grains are the same, only the descriptor differs (CID)
+    process = subprocess.run([VMDK_CONVERT, "--verify", "second.vmdk"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert json.loads(process.stdout)["valid"]
+    assert os.path.getsize(os.path.join(WORK_DIR, "first.vmdk")) == \
+        os.path.getsize(os.path.join(WORK_DIR, "second.vmdk"))
+
+    process = subprocess.run([VMDK_CONVERT, "second.vmdk", "second.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "second.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_grain_cache_level(setup_test):
+    cache = os.path.join(WORK_DIR, "cache-level")
+    data_grains = NUM_GRAINS * 3 // 4
+
+    convert(["--grain-cache", cache], "test.img", "level9.vmdk")
+    # grains compressed at another level are not reused
+    assert convert(["--grain-cache", cache, "-c", "1"], "test.img", "level1.vmdk") == (0, data_grains, data_grains)
+
+
+def test_grain_cache_damaged(setup_test):
+    cache = os.path.join(WORK_DIR, "cache-damaged")
+    data_grains = NUM_GRAINS * 3 // 4
+
+    convert(["--grain-cache", cache], "test.img", "damaged1.vmdk")
+    entries = cache_entries(cache)
+    with open(entries[0], "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    hits, misses, stored = convert(["--grain-cache", cache], "test.img", "damaged2.vmdk")
+    assert misses >= 1 and hits + misses == data_grains
+
+    process = subprocess.run([VMDK_CONVERT, "damaged2.vmdk", "damaged2.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "damaged2.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_grain_cache_budget(setup_test):
+    cache = os.path.join(WORK_DIR, "cache-budget")
+
+    with open(os.path.join(WORK_DIR, "random.img"), "wb") as f:
+        f.write(os.urandom(4 * MB))
+
+    convert(["--grain-cache", cache, "--grain-cache-size", "1"], "random.img", "random.vmdk")
+    assert cache_size(cache) <= MB
+    assert recorded_size(cache) == cache_size(cache)
+    # files next to the cache directory are not entries
+    assert os.path.exists(os.path.join(WORK_DIR, "test.img"))
+    assert os.path.exists(os.path.join(WORK_DIR, "random.img"))
+
+
+def test_grain_cache_size_index(setup_test):
+    cache = os.path.join(WORK_DIR, "cache-index")
+
+    convert(["--grain-cache", cache], "test.img", "index1.vmdk")
+    assert recorded_size(cache) == cache_size(cache)
+
+    # a conversion that only hits the cache leaves the index alone
+    index = os.path.join(cache, "size")
+    os.utime(index, (0, 0))
+    convert(["--grain-cache", cache], "test.img", "index2.vmdk")
+    assert os.stat(index).st_mtime == 0
+
+    # the recorded size is trusted, entries are only listed when it is over the budget
+    with open(os.path.join(WORK_DIR, "index.img"), "wb") as f:
+        f.write(os.urandom(MB))
+    with open(index, "w") as f:
+        f.write(f"{2 * MB}\n")
+    convert(["--grain-cache", cache, "--grain-cache-size", "1"], "index.img", "index3.vmdk")
+    assert cache_size(cache) <= MB
+    assert recorded_size(cache) == cache_size(cache)
+
+
+def test_grain_cache_invalid_size(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--grain-cache", "cache", "--grain-cache-size", "0",
+                              "test.img", "out.vmdk"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
@@ -0,0 +1,142 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import time
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-jobs")
+
+NUM_DISKS = 3
+DELAY = 1
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    hardware = {
+        'cpus': 1,
+        'memory': {'type': "memory", 'size': 1024},
+        'sata1': {'type': "sata_controller"},
+    }
+    for i in range(NUM_DISKS):
+        with open(os.path.join(WORK_DIR, f"disk{i}.img"), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+        hardware[f"disk{i}"] = {'type': "hard_disk", 'parent': "sata1", 'raw_image': f"disk{i}.img"}
+    config = {
+        'system': {'name': "jobs", 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+        'hardware': hardware,
+    }
+    with open(os.path.join(WORK_DIR, "jobs.yaml"), "wt") as f:
+        yaml.dump(config, f)
+
+    # logs the options of each conversion
+    with open(os.path.join(WORK_DIR, "logged-convert"), "wt") as f:
+        f.write("#!/bin/sh\n"
+                f"[ \"$1\" = \"-i\" ] || {{ echo \"$@\" >> {WORK_DIR}/convert.log; sleep {DELAY}; }}\n"
+                f"exec {VMDK_CONVERT} \"$@\"\n")
+    os.chmod(os.path.join(WORK_DIR, "logged-convert"), 0o755)
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def clean():
+    for name in [f"disk{i}.vmdk" for i in range(NUM_DISKS)] + ["convert.log"]:
+        if os.path.exists(os.path.join(WORK_DIR, name)):
+            os.remove(os.path.join(WORK_DIR, name))
+
+
+def conversion_threads():
+    with open(os.path.join(WORK_DIR, "convert.log")) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == NUM_DISKS
+    return [int(line.split()[line.split().index("-n") + 1]) for line in lines]
+
+
+def ova_compose(options):
+    # every build converts the disks
+    return [sys.executable, OVA_COMPOSE, "-i", "jobs.yaml", "-o", "jobs.ova", "--no-cache",
+            "--vmdk-convert", os.path.join(WORK_DIR, "logged-convert")] + options
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_jobs(setup_test, jobs):
+    clean()
+    env = dict(os.environ)
+    env.pop("MAKEFLAGS", None)
+
+    start = time.monotonic()
+    process = subprocess.run(ova_compose(["--jobs", str(jobs)]), cwd=WORK_DIR, env=env)
+    assert process.returncode == 0
+
+    threads = conversion_threads()
+    assert max(threads) <= jobs
+    if jobs == 1:
+        # one conversion at a time
+        assert threads == [1] * NUM_DISKS
+        assert time.monotonic() - start >= DELAY * NUM_DISKS
+    else:
+        assert max(threads) > 1
+
+
+def test_make_jobserver(setup_test):
+    clean()
+    command = " ".join(ova_compose([]))
+    with open(os.path.join(WORK_DIR, "Makefile"), "wt") as f:
+        f.write(f"all:\n\t+{command}\n")
+
+    env = dict(os.environ)
+    env.pop("MAKEFLAGS", None)
+    process = subprocess.run(["make", "-j2"], cwd=WORK_DIR, env=env, capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    # tokens were given back
+    assert "jobserver" not in process.stderr
+
+    # the token of ova-compose and one from make
+    assert 1 <= max(conversion_threads()) <= 2
+
+
+def test_fifo_jobserver(setup_test):
+    clean()
+    fifo = os.path.join(WORK_DIR, "jobserver")
+    os.mkfifo(fifo)
+    fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        os.write(fd, b"+")
+        env = dict(os.environ)
+        env["MAKEFLAGS"] = f" -j2 --jobserver-auth=fifo:{fifo}"
+        process = subprocess.run(ova_compose([]), cwd=WORK_DIR, env=env, timeout=60)
+        assert process.returncode == 0
+
+        assert 1 <= max(conversion_threads()) <= 2
+        # the token was given back
+        assert os.read(fd, 16) == b"+"
+    finally:
+        os.close(fd)
+        os.remove(fifo)
+
+
+@pytest.mark.parametrize("jobs", ["0", "x"])
+def test_invalid_jobs(setup_test, jobs):
+    process = subprocess.run(ova_compose(["--jobs", jobs]), cwd=WORK_DIR)
+    assert process.returncode != 0
@@ -0,0 +1,201 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import errno
+import hashlib
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import threading
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+LIBVMDK = os.path.join(THIS_DIR, "..", "build", "vmdk", "libvmdk.so.1")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+CONFIG_DIR = os.path.join(THIS_DIR, "configs")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-libvmdk")
+
+sys.path.insert(0, os.path.join(THIS_DIR, "..", "ova-compose"))
+import libvmdk   # noqa: E402
+
+MB = 1024 * 1024
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def vmdk_convert_info(filename, detailed=True):
+    process = subprocess.run([VMDK_CONVERT, "-i"] + (["--detailed"] if detailed else []) + [filename],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    return json.loads(process.stdout)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+    libvmdk.load(LIBVMDK)
+
+    for name in ["a.img", "b.img"]:
+        with open(os.path.join(WORK_DIR, name), "wb") as f:
+            f.write(os.urandom(2 * MB) + b"\0" * (4 * MB) + os.urandom(2 * MB))
+
+    process = subprocess.run([VMDK_CONVERT, "a.img", "a.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("name", ["a.vmdk", "a.img"])
+@pytest.mark.parametrize("detailed", [True, False])
+def test_info(setup_test, name, detailed):
+    with libvmdk.Disk(os.path.join(WORK_DIR, name)) as disk:
+        assert disk.capacity == 8 * MB
+        assert disk.info(detailed) == vmdk_convert_info(name, detailed)
+
+
+@pytest.mark.parametrize("dst, fmt", [("out.vmdk", None), ("out.qcow2", None), ("out.raw", "monolithicSparse")])
+def test_convert(setup_test, dst, fmt):
+    progress = []
+    with libvmdk.Disk(os.path.join(WORK_DIR, "a.img")) as disk:
+        disk.convert(os.path.join(WORK_DIR, dst), format=fmt, num_threads=2,
+                     progress=lambda done, total: progress.append((done, total)))
+
+    assert progress[-1] == (8 * MB, 8 * MB)
+    assert [p[0] for p in progress] == sorted(p[0] for p in progress)
+
+    process = subprocess.run([VMDK_CONVERT, dst, "back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "back.img")) == get_hash(os.path.join(WORK_DIR, "a.img"))
+
+
+@pytest.mark.parametrize("use_library", [True, False])
+def test_convert_at(setup_test, use_library):
+    # a VMDK written into another file, after a prefix that is kept
+    prefix = os.urandom(3 * 512)
+    host = os.path.join(WORK_DIR, "host.bin")
+    with open(host, "wb") as f:
+        f.write(prefix)
+    if use_library:
+        with libvmdk.Disk(os.path.join(WORK_DIR, "a.img")) as disk:
+            disk.convert_at(host, len(prefix), num_threads=4)
+    else:
+        process = subprocess.run([VMDK_CONVERT, "--offset", str(len(prefix)), "-n", "4", "a.img", "host.bin"],
+                                 cwd=WORK_DIR, capture_output=True, text=True)
+        assert process.returncode == 0
+        # the grains are committed in order, not reordered afterwards
+        assert "reordering grains" not in process.stdout
+
+    with open(host, "rb") as f:
+        assert f.read(len(prefix)) == prefix
+        with open(os.path.join(WORK_DIR, "embedded.vmdk"), "wb") as out:
+            out.write(f.read())
+    process = subprocess.run([VMDK_CONVERT, "--verify", "embedded.vmdk"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert json.loads(process.stdout)["grainsOrdered"]
+    process = subprocess.run([VMDK_CONVERT, "embedded.vmdk", "back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "back.img")) == get_hash(os.path.join(WORK_DIR, "a.img"))
+
+
+def test_convert_at_invalid(setup_test):
+    with open(os.path.join(WORK_DIR, "host.bin"), "wb") as f:
+        f.write(b"\0" * 1024)
+    with libvmdk.Disk(os.path.join(WORK_DIR, "a.img")) as disk:
+        with pytest.raises(OSError) as e:
+            disk.convert_at(os.path.join(WORK_DIR, "host.bin"), 100)
+        assert e.value.errno == errno.EINVAL
+    process = subprocess.run([VMDK_CONVERT, "--offset", "512", "--format", "qcow2", "a.img", "host.bin"],
+                             cwd=WORK_DIR)
+    assert process.returncode != 0
+
+
+def test_convert_same_as_vmdk_convert(setup_test):
+    with libvmdk.Disk(os.path.join(WORK_DIR, "a.img")) as disk:
+        disk.convert(os.path.join(WORK_DIR, "lib.vmdk"), sector_size=4096)
+
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "--sector-size", "4096", "a.img", "cli.vmdk"],
+                             cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    lib_info = vmdk_convert_info("lib.vmdk")
+    cli_info = vmdk_convert_info("cli.vmdk")
+    assert lib_info["descriptorFile"]["ddb.logicalSectorSize"] == "4096"
+
+    process = subprocess.run([VMDK_CONVERT, "--verify", "--digest", cli_info["contentDigest"], "lib.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    assert json.loads(process.stdout)["contentDigest"]["match"]
+
+
+def test_concurrent(setup_test):
+    errors = []
+
+    def convert(name):
+        try:
+            with libvmdk.Disk(os.path.join(WORK_DIR, f"{name}.img")) as disk:
+                disk.convert(os.path.join(WORK_DIR, f"{name}-thread.vmdk"), num_threads=2)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=convert, args=(name,)) for name in ["a", "b"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+    for name in ["a", "b"]:
+        process = subprocess.run([VMDK_CONVERT, f"{name}-thread.vmdk", f"{name}-back.img"], cwd=WORK_DIR)
+        assert process.returncode == 0
+        assert get_hash(os.path.join(WORK_DIR, f"{name}-back.img")) == \
+            get_hash(os.path.join(WORK_DIR, f"{name}.img"))
+
+
+def test_cancel(setup_test):
+    dst = os.path.join(WORK_DIR, "cancelled.vmdk")
+    with libvmdk.Disk(os.path.join(WORK_DIR, "a.img")) as disk:
+        with pytest.raises(OSError) as e:
+            disk.convert(dst, num_threads=1, progress=lambda done, total: disk.cancel())
+    assert e.value.errno == errno.ECANCELED
+    assert not os.path.exists(dst)
+
+
+def test_errors(setup_test):
+    with pytest.raises(OSError) as e:
+        libvmdk.Disk(os.path.join(WORK_DIR, "missing.img"))
+    assert e.value.errno == errno.ENOENT
+
+    with libvmdk.Disk(os.path.join(WORK_DIR, "a.img")) as disk:
+        with pytest.raises(OSError) as e:
+            disk.convert(os.path.join(WORK_DIR, "x.vmdk"), format="vdi")
+        assert e.value.errno == errno.EINVAL
+
+
+def test_ova_compose(setup_test):
+    # no vmdk-convert in PATH, ova-compose converts in process
+    env = dict(os.environ, LD_LIBRARY_PATH=os.path.dirname(LIBVMDK), PATH="/usr/bin:/bin")
+    shutil.copy(os.path.join(WORK_DIR, "a.img"), os.path.join(WORK_DIR, "dummy.img"))
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", os.path.join(CONFIG_DIR, "raw-image.yaml"),
+                              "-o", "raw-image.ova"], cwd=WORK_DIR, env=env)
+    assert process.returncode == 0
+    assert vmdk_convert_info("dummy.vmdk")["capacity"] == 8 * MB
@@ -0,0 +1,99 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-monolithic")
+
+MB = 1024 * 1024
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    # 16MB disk with 3MB of data, the last part not grain aligned
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        f.truncate(16 * MB)
+        f.write(os.urandom(2 * MB))
+        f.seek(10 * MB + 12345)
+        f.write(os.urandom(MB - 12345))
+
+    process = subprocess.run([VMDK_CONVERT, "--format", "monolithicSparse", "test.img", "test.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    yield
+
+
+def test_monolithic_sparse_roundtrip(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "test.vmdk", "test-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert get_hash(os.path.join(WORK_DIR, "test-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_monolithic_sparse_info(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "-i", "--detailed", "test.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    data = json.loads(process.stdout.strip())
+    assert data["capacity"] == 16 * MB
+    assert data["used"] == 3 * MB
+
+    header = data["sparseHeader"]
+    assert header["version"] == 1
+    assert header["flagsDecoded"]["compressed"] is False
+    assert header["flagsDecoded"]["useRedundant"] is True
+    assert header["compressAlgorithmName"] == "none"
+    assert header["rgdOffset"] != 0
+    # grains start grain aligned
+    assert header["overHead"] % header["grainSize"] == 0
+
+    assert data["descriptorFile"]["createType"] == "monolithicSparse"
+
+    # only populated grains take space
+    assert os.path.getsize(os.path.join(WORK_DIR, "test.vmdk")) == header["overHead"] * 512 + 3 * MB
+
+
+def test_monolithic_sparse_extent(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--get-descriptor", "test.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    # the extent is the file itself
+    assert 'RW 32768 SPARSE "test.vmdk"' in process.stdout
+
+
+def test_monolithic_sparse_to_stream_optimized(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "test.vmdk", "stream.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "stream.vmdk", "stream-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert get_hash(os.path.join(WORK_DIR, "stream-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
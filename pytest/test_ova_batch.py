@@ -0,0 +1,179 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import tarfile
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-ova-batch")
+
+CONFIG = """
+system:
+    name: batch
+    type: vmx-14
+    os_vmw: vmwarePhoton64Guest
+hardware:
+    cpus: !param cpus
+    memory:
+        type: memory
+        size: !param memory=1024
+    sata1:
+        type: sata_controller
+    cdrom1:
+        type: cd_drive
+        parent: sata1
+        image: cd.iso
+    disk0:
+        type: hard_disk
+        parent: sata1
+        raw_image: disk.img
+"""
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    with open(os.path.join(WORK_DIR, "disk.img"), "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+    with open(os.path.join(WORK_DIR, "cd.iso"), "wb") as f:
+        f.write(os.urandom(64 * 1024))
+    with open(os.path.join(WORK_DIR, "batch.yaml"), "wt") as f:
+        f.write(CONFIG)
+
+    # logs each conversion
+    with open(os.path.join(WORK_DIR, "logged-convert"), "wt") as f:
+        f.write("#!/bin/sh\n"
+                f"[ \"$1\" = \"-i\" ] || echo \"$@\" >> {WORK_DIR}/convert.log\n"
+                f"exec {VMDK_CONVERT} \"$@\"\n")
+    os.chmod(os.path.join(WORK_DIR, "logged-convert"), 0o755)
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+def ova_compose(options):
+    return subprocess.run([sys.executable, OVA_COMPOSE, "-i", "batch.yaml",
+                           "--cache-dir", os.path.join(WORK_DIR, "cache"),
+                           "--vmdk-convert", os.path.join(WORK_DIR, "logged-convert")] + options, cwd=WORK_DIR)
+
+
+def write_batch(batch):
+    with open(os.path.join(WORK_DIR, "builds.yaml"), "wt") as f:
+        yaml.dump(batch, f)
+
+
+def read_ova(ova_file):
+    with tarfile.open(os.path.join(WORK_DIR, ova_file)) as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+
+
+def strip_comment(ovf):
+    # the OVF has the time it was generated
+    return [line for line in ovf.decode().splitlines() if not line.startswith("<!-- Generated by")]
+
+
+@pytest.mark.parametrize("no_cache", [False, True])
+def test_batch(setup_test, no_cache):
+    for name in ["disk.vmdk", "convert.log"]:
+        if os.path.exists(os.path.join(WORK_DIR, name)):
+            os.remove(os.path.join(WORK_DIR, name))
+    shutil.rmtree(os.path.join(WORK_DIR, "cache"), ignore_errors=True)
+    shutil.rmtree(os.path.join(WORK_DIR, "large"), ignore_errors=True)
+
+    write_batch({
+        'matrix': {'cpus': [1, 2], 'memory': [1024, 2048]},
+        'output': "batch-{cpus}-{memory}.ova",
+        'builds': [{'output': "large", 'format': "dir", 'params': {'cpus': 8, 'memory': 8192}}],
+    })
+    process = ova_compose(["--batch", "builds.yaml"] + (["--no-cache"] if no_cache else []))
+    assert process.returncode == 0
+
+    # the disk is converted once for all builds
+    with open(os.path.join(WORK_DIR, "convert.log")) as f:
+        assert len(f.read().splitlines()) == 1
+
+    for cpus in [1, 2]:
+        for memory in [1024, 2048]:
+            basename = f"batch-{cpus}-{memory}"
+            data = read_ova(f"{basename}.ova")
+            assert set(data) == {f"{basename}.ovf", f"{basename}.mf", "disk.vmdk", "cd.iso"}
+            ovf = data[f"{basename}.ovf"].decode()
+            assert f"<rasd:VirtualQuantity>{cpus}</rasd:VirtualQuantity>" in ovf
+            assert f"<rasd:VirtualQuantity>{memory}</rasd:VirtualQuantity>" in ovf
+            for line in data[f"{basename}.mf"].decode().splitlines():
+                left, digest = line.split("= ")
+                assert hashlib.sha256(data[left[len("SHA256("):-1]]).hexdigest() == digest
+
+    with open(os.path.join(WORK_DIR, "large", "large.ovf")) as f:
+        assert "<rasd:VirtualQuantity>8192</rasd:VirtualQuantity>" in f.read()
+    assert os.path.exists(os.path.join(WORK_DIR, "large", "large.mf"))
+
+    # the same as building one at a time
+    process = ova_compose(["-o", "single.ova", "--param", "cpus=2", "--param", "memory=2048"])
+    assert process.returncode == 0
+    assert strip_comment(read_ova("single.ova")["single.ovf"]) == \
+        strip_comment(read_ova("batch-2-2048.ova")["batch-2-2048.ovf"])
+
+
+@pytest.mark.parametrize("batch, options", [
+    ({'matrix': {'cpus': [1, 2]}}, []),
+    ({'matrix': {'cpus': [1, 2]}, 'output': "same.ova"}, []),
+    ({'builds': [{'output': "a.ova", 'params': {'cpus': 1}}]}, ["-o", "b.ova"]),
+    ({'builds': [{'output': "a.img", 'params': {'cpus': 1}}]}, []),
+    ({'builds': []}, []),
+])
+def test_invalid_batch(setup_test, batch, options):
+    write_batch(batch)
+    process = ova_compose(["--batch", "builds.yaml"] + options)
+    assert process.returncode != 0
+
+
+def test_batch_direct(setup_test):
+    if os.path.exists(os.path.join(WORK_DIR, "convert.log")):
+        os.remove(os.path.join(WORK_DIR, "convert.log"))
+
+    write_batch({
+        'matrix': {'cpus': [1, 2, 4]},
+        'output': "direct-{cpus}.ova",
+    })
+    process = ova_compose(["--batch", "builds.yaml", "--direct", "--no-cache"])
+    assert process.returncode == 0
+
+    # the disk is converted into the first OVA and copied into the others
+    with open(os.path.join(WORK_DIR, "convert.log")) as f:
+        assert len(f.read().splitlines()) == 1
+
+    disks = set()
+    for cpus in [1, 2, 4]:
+        basename = f"direct-{cpus}"
+        data = read_ova(f"{basename}.ova")
+        assert set(data) == {f"{basename}.ovf", f"{basename}.mf", "disk.vmdk", "cd.iso"}
+        assert f'ovf:size="{len(data["disk.vmdk"])}"' in data[f"{basename}.ovf"].decode()
+        for line in data[f"{basename}.mf"].decode().splitlines():
+            left, digest = line.split("= ")
+            assert hashlib.sha256(data[left[len("SHA256("):-1]]).hexdigest() == digest
+        disks.add(data["disk.vmdk"])
+    assert len(disks) == 1
+
+    # the temporary directories are removed
+    assert not [name for name in os.listdir(WORK_DIR) if name.startswith("direct-") and not name.endswith(".ova")]
@@ -0,0 +1,253 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import yaml
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+OVA_COMPOSE = os.path.join(THIS_DIR, "..", "ova-compose", "ova-compose.py")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-ova-writer")
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    for name in ["disk0.img", "disk1.img"]:
+        with open(os.path.join(WORK_DIR, name), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+    with open(os.path.join(WORK_DIR, "cd.iso"), "wb") as f:
+        f.write(os.urandom(64 * 1024))
+    os.chmod(os.path.join(WORK_DIR, "cd.iso"), 0o600)
+
+    config = {
+        'system': {'name': "writer", 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+        'hardware': {
+            'cpus': 1,
+            'memory': {'type': "memory", 'size': 1024},
+            'sata1': {'type': "sata_controller"},
+            'disk0': {'type': "hard_disk", 'parent': "sata1", 'raw_image': "disk0.img"},
+            'disk1': {'type': "hard_disk", 'parent': "sata1", 'raw_image': "disk1.img"},
+            'cdrom1': {'type': "cd_drive", 'parent': "sata1", 'image': "cd.iso"},
+        },
+    }
+    with open(os.path.join(WORK_DIR, "writer.yaml"), "wt") as f:
+        yaml.dump(config, f)
+
+    subprocess.run(["openssl", "req", "-x509", "-nodes", "-sha256", "-days", "365",
+                    "-newkey", "rsa:2048", "-keyout", "key.pem", "-out", "key.pem",
+                    "-subj", "/CN=Test Certificate"], check=True, cwd=WORK_DIR)
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("tar_format, expected", [("gnu", tarfile.GNU_FORMAT), ("posix", tarfile.PAX_FORMAT)])
+@pytest.mark.parametrize("sign", [False, True])
+def test_ova_writer(setup_test, tar_format, expected, sign):
+    out_ova = f"writer-{tar_format}.ova"
+    args = [sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", out_ova,
+            "--tar-format", tar_format, "--vmdk-convert", VMDK_CONVERT]
+    if sign:
+        args += ["--sign", "key.pem"]
+    process = subprocess.run(args, cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    basename = f"writer-{tar_format}"
+    with tarfile.open(os.path.join(WORK_DIR, out_ova)) as tar:
+        members = tar.getmembers()
+        names = [m.name for m in members]
+
+        # the OVF first, the manifest and certificate last
+        trailer = [f"{basename}.mf"] + ([f"{basename}.cert"] if sign else [])
+        assert names[0] == f"{basename}.ovf"
+        assert sorted(names[1:-len(trailer)]) == ["cd.iso", "disk0.vmdk", "disk1.vmdk"]
+        assert names[-len(trailer):] == trailer
+
+        for m in members:
+            assert m.isfile()
+            assert m.uid == 0 and m.gid == 0
+            assert m.uname == "root" and m.gname == "root"
+            assert m.mode == 0o644
+
+        data = {m.name: tar.extractfile(m).read() for m in members}
+
+    # posix archives have the ustar magic, gnu archives the old gnu magic
+    with open(os.path.join(WORK_DIR, out_ova), "rb") as f:
+        assert (b"ustar\x0000" in f.read(512)) == (expected == tarfile.PAX_FORMAT)
+
+    manifest = data[f"{basename}.mf"].decode().splitlines()
+    assert len(manifest) == len(names) - len(trailer)
+    for line in manifest:
+        left, digest = line.split("= ")
+        name = left[len("SHA256("):-1]
+        assert hashlib.sha256(data[name]).hexdigest() == digest
+
+    for name in ["disk0.vmdk", "disk1.vmdk", "cd.iso"]:
+        with open(os.path.join(WORK_DIR, name), "rb") as f:
+            assert f.read() == data[name]
+
+    # readable by tar(1)
+    process = subprocess.run(["tar", "tf", out_ova], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    assert process.stdout.splitlines() == names
+
+
+def check_stream(ova_file, name):
+    with tarfile.open(ova_file, "r|") as tar:
+        names = [m.name for m in tar]
+    assert names[0] == f"{name}.ovf"
+    assert names[-1] == f"{name}.mf"
+    assert sorted(names[1:-1]) == ["cd.iso", "disk0.vmdk", "disk1.vmdk"]
+
+
+def test_stdout(setup_test):
+    # the OVA is piped to another process, which stores it
+    with open(os.path.join(WORK_DIR, "piped.ova"), "wb") as out:
+        compose = subprocess.Popen([sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", "-", "--format", "ova",
+                                    "--vmdk-convert", VMDK_CONVERT],
+                                   cwd=WORK_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cat = subprocess.Popen(["cat"], stdin=compose.stdout, stdout=out)
+        compose.stdout.close()
+        stderr = compose.stderr.read().decode()
+        assert compose.wait() == 0
+        assert cat.wait() == 0
+
+    # messages go to stderr
+    assert "done." in stderr
+    check_stream(os.path.join(WORK_DIR, "piped.ova"), "writer")
+
+
+def test_fifo(setup_test):
+    fifo = os.path.join(WORK_DIR, "fifo.ova")
+    os.mkfifo(fifo)
+
+    received = []
+
+    def read():
+        with open(fifo, "rb") as f:
+            received.append(f.read())
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", "fifo.ova",
+                              "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR)
+    reader.join()
+    assert process.returncode == 0
+
+    with open(os.path.join(WORK_DIR, "received.ova"), "wb") as f:
+        f.write(received[0])
+    check_stream(os.path.join(WORK_DIR, "received.ova"), "fifo")
+
+
+def test_stdout_needs_ova(setup_test):
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", "-", "--format", "ovf",
+                              "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR, capture_output=True)
+    assert process.returncode != 0
+    assert process.stdout == b""
+
+
+def convert_back(name, raw_image):
+    process = subprocess.run([VMDK_CONVERT, name, "back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    with open(os.path.join(WORK_DIR, "back.img"), "rb") as f1, open(os.path.join(WORK_DIR, raw_image), "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+@pytest.mark.parametrize("tar_format", ["gnu", "posix"])
+def test_direct(setup_test, tar_format):
+    for name in ["disk0.vmdk", "disk1.vmdk"]:
+        if os.path.exists(os.path.join(WORK_DIR, name)):
+            os.remove(os.path.join(WORK_DIR, name))
+
+    out_ova = f"direct-{tar_format}.ova"
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", out_ova, "--direct", "-j", "4",
+                              "--tar-format", tar_format, "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    # the grains are written in order, not reordered through a temporary file
+    assert "reordering grains" not in process.stdout
+    # the disks are only written into the OVA
+    assert not os.path.exists(os.path.join(WORK_DIR, "disk0.vmdk"))
+    assert not os.path.exists(os.path.join(WORK_DIR, "disk1.vmdk"))
+
+    extract_dir = os.path.join(WORK_DIR, f"direct-{tar_format}")
+    os.makedirs(extract_dir, exist_ok=True)
+    with tarfile.open(os.path.join(WORK_DIR, out_ova)) as tar:
+        names = [m.name for m in tar.getmembers()]
+        for m in tar.getmembers():
+            assert m.uid == 0 and m.mode == 0o644
+        tar.extractall(extract_dir)
+    basename = f"direct-{tar_format}"
+    assert names[0] == f"{basename}.ovf"
+    assert names[-1] == f"{basename}.mf"
+
+    with open(os.path.join(extract_dir, f"{basename}.mf")) as f:
+        for line in f:
+            left, digest = line.strip().split("= ")
+            name = left[len("SHA256("):-1]
+            with open(os.path.join(extract_dir, name), "rb") as g:
+                assert hashlib.sha256(g.read()).hexdigest() == digest
+
+    # the OVF has the sizes of the disks in the OVA
+    with open(os.path.join(extract_dir, f"{basename}.ovf")) as f:
+        ovf = f.read()
+    for i in range(2):
+        size = os.path.getsize(os.path.join(extract_dir, f"disk{i}.vmdk"))
+        assert f'ovf:href="disk{i}.vmdk" ovf:id="file' in ovf
+        assert f'ovf:size="{size}"' in ovf
+        convert_back(os.path.join(extract_dir, f"disk{i}.vmdk"), f"disk{i}.img")
+    assert 'ovf:populatedSize="1048576"' in ovf
+
+
+def test_direct_stdout(setup_test):
+    with open(os.path.join(WORK_DIR, "direct-piped.ova"), "wb") as out:
+        process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", "-", "--format", "ova",
+                                  "--direct", "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR, stdout=out)
+    assert process.returncode == 0
+    assert not os.path.exists(os.path.join(WORK_DIR, "disk0.vmdk"))
+    check_stream(os.path.join(WORK_DIR, "direct-piped.ova"), "writer")
+
+
+def test_direct_failure(setup_test):
+    with open(os.path.join(WORK_DIR, "broken.yaml"), "wt") as f:
+        yaml.dump({
+            'system': {'name': "broken", 'type': "vmx-14", 'os_vmw': "vmwarePhoton64Guest"},
+            'hardware': {
+                'sata1': {'type': "sata_controller"},
+                'disk0': {'type': "hard_disk", 'parent': "sata1", 'raw_image': "broken.img"},
+            },
+        }, f)
+    # a directory cannot be converted
+    os.makedirs(os.path.join(WORK_DIR, "broken.img"), exist_ok=True)
+
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "broken.yaml", "-o", "broken.ova", "--direct",
+                              "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR)
+    assert process.returncode != 0
+    assert not os.path.exists(os.path.join(WORK_DIR, "broken.ova"))
+
+
+def test_invalid_tar_format(setup_test):
+    process = subprocess.run([sys.executable, OVA_COMPOSE, "-i", "writer.yaml", "-o", "invalid.ova",
+                              "--tar-format", "v7", "--vmdk-convert", VMDK_CONVERT], cwd=WORK_DIR)
+    assert process.returncode != 0
+    assert not os.path.exists(os.path.join(WORK_DIR, "invalid.ova"))
@@ -0,0 +1,231 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import struct
+import subprocess
+import zlib
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-qcow2")
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+NUM_CLUSTERS = 64
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def write_qcow2(qcow2_path, raw_path, cluster_bits=CLUSTER_BITS, num_clusters=NUM_CLUSTERS,
+                plain=[0, 5, 6, 40], zero=[10], compressed=[20, 21, 63]):
+    """
+    Write a minimal qcow2 v3 image with one L2 table, containing plain,
+    unallocated, zero and compressed clusters, and the equivalent raw image.
+    """
+    cluster_size = 1 << cluster_bits
+    raw = bytearray(num_clusters * cluster_size)
+    l2 = [0] * (cluster_size // 8)
+    data = bytearray()
+    data_start = 3 * cluster_size   # header, L1, L2
+
+    # plain data clusters
+    for nr in plain:
+        buf = os.urandom(cluster_size)
+        raw[nr * cluster_size:(nr + 1) * cluster_size] = buf
+        l2[nr] = (data_start + len(data)) | (1 << 63)
+        data += buf
+
+    # zero cluster, pointing nowhere
+    for nr in zero:
+        l2[nr] = 1
+
+    # compressed clusters, packed unaligned after the plain ones
+    x = 62 - (cluster_bits - 8)
+    for nr in compressed:
+        buf = b"".join(f"cluster {nr} line {i}\n".encode() for i in range(cluster_size // 16))[:cluster_size]
+        raw[nr * cluster_size:(nr + 1) * cluster_size] = buf
+        c = zlib.compressobj(9, zlib.DEFLATED, -12)
+        cbuf = c.compress(buf) + c.flush()
+        offset = data_start + len(data)
+        sectors = (offset + len(cbuf) - 1) // 512 - offset // 512 + 1
+        l2[nr] = (1 << 62) | ((sectors - 1) << x) | offset
+        data += cbuf
+
+    header = struct.pack(">IIQIIQIIQQIIQQQQII",
+                         0x514649fb, 3, 0, 0, cluster_bits, len(raw), 0,
+                         1, cluster_size, 0, 0, 0, 0,
+                         0, 0, 0, 4, 104)
+    header += b"\0" * 8  # end of header extensions
+
+    with open(qcow2_path, "wb") as f:
+        f.write(header.ljust(cluster_size, b"\0"))
+        f.write(struct.pack(">Q", 2 * cluster_size | (1 << 63)).ljust(cluster_size, b"\0"))
+        f.write(struct.pack(f">{len(l2)}Q", *l2))
+        f.write(data)
+
+    with open(raw_path, "wb") as f:
+        f.write(raw)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+    write_qcow2(os.path.join(WORK_DIR, "test.qcow2"), os.path.join(WORK_DIR, "test.img"))
+    yield
+
+
+def test_qcow2_to_raw(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "test.qcow2", "test-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert get_hash(os.path.join(WORK_DIR, "test-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_qcow2_to_vmdk(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "test.qcow2", "test.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "test.vmdk", "test-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert get_hash(os.path.join(WORK_DIR, "test-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_qcow2_large_clusters(setup_test):
+    # each 2 MB compressed cluster is read by several grains from several threads
+    write_qcow2(os.path.join(WORK_DIR, "large.qcow2"), os.path.join(WORK_DIR, "large.img"),
+                cluster_bits=21, num_clusters=8, plain=[0], zero=[3], compressed=[1, 2, 5, 7])
+    process = subprocess.run([VMDK_CONVERT, "-n", "4", "large.qcow2", "large.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "large.vmdk", "large-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert get_hash(os.path.join(WORK_DIR, "large-back.img")) == get_hash(os.path.join(WORK_DIR, "large.img"))
+
+
+def test_qcow2_info(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "-i", "test.qcow2"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    data = json.loads(process.stdout.strip())
+    assert data["capacity"] == NUM_CLUSTERS * CLUSTER_SIZE
+    # zero and unallocated clusters are not reported as data
+    assert data["used"] == 7 * CLUSTER_SIZE
+
+
+def test_qcow2_backing_file_rejected(setup_test):
+    with open(os.path.join(WORK_DIR, "test.qcow2"), "rb") as f:
+        image = bytearray(f.read())
+    image[8:16] = struct.pack(">Q", 512)
+    with open(os.path.join(WORK_DIR, "backing.qcow2"), "wb") as f:
+        f.write(image)
+
+    process = subprocess.run([VMDK_CONVERT, "-i", "backing.qcow2"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
+    assert "backing file" in process.stderr
+
+
+def check_refcounts(path):
+    """
+    Recompute the refcount of every host cluster from the L1/L2 tables of
+    a qcow2 image and compare with the stored refcounts.
+    """
+    with open(path, "rb") as f:
+        image = f.read()
+    (magic, version, _, _, cluster_bits, size, _, l1_size, l1_offset,
+     rc_offset, rc_clusters) = struct.unpack(">IIQIIQIIQQI", image[:60])
+    refcount_order = struct.unpack(">I", image[96:100])[0]
+    assert magic == 0x514649fb and version == 3 and refcount_order == 4
+    cluster_size = 1 << cluster_bits
+    assert len(image) % cluster_size == 0
+
+    expected = [0] * (len(image) // cluster_size)
+
+    def ref(offset, length):
+        for nr in range(offset // cluster_size, (offset + length - 1) // cluster_size + 1):
+            expected[nr] += 1
+
+    ref(0, cluster_size)
+    ref(l1_offset, l1_size * 8)
+    ref(rc_offset, rc_clusters * cluster_size)
+    x = 62 - (cluster_bits - 8)
+    for l1e in struct.unpack(f">{l1_size}Q", image[l1_offset:l1_offset + l1_size * 8]):
+        l2_offset = l1e & 0x00fffffffffffe00
+        if l2_offset == 0:
+            continue
+        ref(l2_offset, cluster_size)
+        for entry in struct.unpack(f">{cluster_size // 8}Q", image[l2_offset:l2_offset + cluster_size]):
+            if entry & (1 << 62):
+                offset = entry & ((1 << x) - 1)
+                sectors = ((entry >> x) & ((1 << (cluster_bits - 8)) - 1)) + 1
+                ref(offset, sectors * 512 - offset % 512)
+            elif entry & 0x00fffffffffffe00:
+                ref(entry & 0x00fffffffffffe00, cluster_size)
+
+    rc_table = struct.unpack(f">{rc_clusters * cluster_size // 8}Q",
+                             image[rc_offset:rc_offset + rc_clusters * cluster_size])
+    for block in rc_table:
+        if block != 0:
+            ref(block, cluster_size)
+
+    per_block = cluster_size // 2
+    for nr, count in enumerate(expected):
+        block = rc_table[nr // per_block]
+        assert block != 0
+        stored = struct.unpack(">H", image[block + (nr % per_block) * 2:block + (nr % per_block) * 2 + 2])[0]
+        assert stored == count, f"cluster {nr}"
+
+
+@pytest.mark.parametrize("options", [[], ["--compress"], ["--compress", "-c", "1", "-n", "1"]])
+def test_raw_to_qcow2(setup_test, options):
+    process = subprocess.run([VMDK_CONVERT] + options + ["test.img", "out.qcow2"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    check_refcounts(os.path.join(WORK_DIR, "out.qcow2"))
+
+    process = subprocess.run([VMDK_CONVERT, "out.qcow2", "out-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "out-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+    process = subprocess.run([VMDK_CONVERT, "-i", "out.qcow2"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+    # zero clusters are not written
+    assert json.loads(process.stdout.strip())["used"] == 7 * CLUSTER_SIZE
+
+    if "--compress" in options:
+        process = subprocess.run([VMDK_CONVERT, "test.img", "plain.qcow2"], cwd=WORK_DIR)
+        assert process.returncode == 0
+        assert os.path.getsize(os.path.join(WORK_DIR, "out.qcow2")) < os.path.getsize(os.path.join(WORK_DIR, "plain.qcow2"))
+
+
+def test_qcow2_format_option(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--format", "qcow2", "test.img", "out.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    with open(os.path.join(WORK_DIR, "out.img"), "rb") as f:
+        assert f.read(4) == b"QFI\xfb"
+
+    process = subprocess.run([VMDK_CONVERT, "--format", "qcow3", "test.img", "out.img"], cwd=WORK_DIR)
+    assert process.returncode == 1
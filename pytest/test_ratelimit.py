@@ -0,0 +1,116 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import os
+import pytest
+import shutil
+import signal
+import subprocess
+import time
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-ratelimit")
+
+MB = 1024 * 1024
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def timed_convert(options, src, dst):
+    start = time.monotonic()
+    process = subprocess.run([VMDK_CONVERT] + options + [src, dst], cwd=WORK_DIR)
+    assert process.returncode == 0
+    return time.monotonic() - start
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        f.write(os.urandom(4 * MB))
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("option", ["--read-limit", "--write-limit"])
+def test_bandwidth_limit(setup_test, option):
+    # 4 MB at 2 MB/s, less the initial burst
+    assert timed_convert([option, "2"], "test.img", "out.img") >= 1.5
+    assert get_hash(os.path.join(WORK_DIR, "out.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_write_limit_vmdk(setup_test):
+    assert timed_convert(["--write-limit", "2"], "test.img", "out.vmdk") >= 1.5
+
+    process = subprocess.run([VMDK_CONVERT, "out.vmdk", "out-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "out-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_cpu_share(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--cpu-share", "50", "-n", "2", "test.img", "cpu.vmdk"],
+                             cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, "cpu.vmdk", "cpu-back.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "cpu-back.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_limit_file_reload(setup_test):
+    limit_file = os.path.join(WORK_DIR, "limits")
+    with open(limit_file, "w") as f:
+        f.write("# throttled\nread-limit=1\n")
+
+    start = time.monotonic()
+    process = subprocess.Popen([VMDK_CONVERT, "--limit-file", "limits", "test.img", "reload.img"],
+                               cwd=WORK_DIR, stdout=subprocess.PIPE, text=True)
+    time.sleep(0.5)
+    with open(limit_file, "w") as f:
+        f.write("read-limit=0\n")
+    process.send_signal(signal.SIGHUP)
+    stdout, _ = process.communicate()
+    assert process.returncode == 0
+
+    # 4 MB at 1 MB/s would take 4 seconds
+    assert time.monotonic() - start < 3
+    assert "read-limit unlimited" in stdout
+    assert get_hash(os.path.join(WORK_DIR, "reload.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+@pytest.mark.parametrize("options", [["--read-limit", "0"], ["--write-limit", "x"], ["--cpu-share", "-5"],
+                                     ["--limit-file", "missing"]])
+def test_invalid_limits(setup_test, options):
+    process = subprocess.run([VMDK_CONVERT] + options + ["test.img", "invalid.img"], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 1
+
+
+def test_invalid_limit_file(setup_test):
+    with open(os.path.join(WORK_DIR, "bad-limits"), "w") as f:
+        f.write("read-limit=fast\n")
+
+    process = subprocess.run([VMDK_CONVERT, "--limit-file", "bad-limits", "test.img", "invalid.img"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
+    assert "Invalid line 1" in process.stderr
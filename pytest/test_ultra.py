@@ -0,0 +1,98 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import os
+import pytest
+import random
+import re
+import shutil
+import struct
+import subprocess
+import zlib
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-ultra")
+
+MB = 1024 * 1024
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    # text like data, where the encoder settings make a difference
+    words = ["".join(random.choice("abcdefghij") for _ in range(random.randint(2, 9))) for _ in range(2000)]
+    text = " ".join(random.choice(words) for _ in range(400000)).encode()
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        f.write(text[:2 * MB] + b"\0" * MB + os.urandom(MB))
+
+    process = subprocess.run([VMDK_CONVERT, "-c", "9", "test.img", "level9.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("threads", ["1", "4"])
+def test_ultra(setup_test, threads):
+    process = subprocess.run([VMDK_CONVERT, "--ultra", "-n", threads, "test.img", "ultra.vmdk"],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    m = re.search(r"Ultra compression: (\d+) of (\d+) grains smaller than with level 9, (\d+) instead of (\d+) bytes",
+                  process.stdout)
+    assert m is not None
+    improved, grains, ultra_bytes, level9_bytes = map(int, m.groups())
+    assert grains == 48   # the zero grains are not compressed
+    assert improved > 0
+    assert ultra_bytes < level9_bytes
+
+    ultra_size = os.path.getsize(os.path.join(WORK_DIR, "ultra.vmdk"))
+    assert ultra_size < os.path.getsize(os.path.join(WORK_DIR, "level9.vmdk"))
+
+    process = subprocess.run([VMDK_CONVERT, "ultra.vmdk", "ultra.img"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    assert get_hash(os.path.join(WORK_DIR, "ultra.img")) == get_hash(os.path.join(WORK_DIR, "test.img"))
+
+
+def test_ultra_standard_inflate(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--ultra", "test.img", "ultra.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    # every grain is a plain zlib stream
+    with open(os.path.join(WORK_DIR, "ultra.vmdk"), "rb") as f:
+        image = f.read()
+    overhead = struct.unpack("<Q", image[64:72])[0]
+    pos = overhead * 512
+    grains = 0
+    while True:
+        lba, size = struct.unpack("<QI", image[pos:pos + 12])
+        if size == 0:
+            break
+        data = zlib.decompress(image[pos + 12:pos + 12 + size])
+        with open(os.path.join(WORK_DIR, "test.img"), "rb") as f:
+            f.seek(lba * 512)
+            assert data == f.read(len(data))
+        grains += 1
+        pos += (12 + size + 511) // 512 * 512
+    assert grains == 48
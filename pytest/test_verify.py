@@ -0,0 +1,153 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import json
+import os
+import pytest
+import shutil
+import struct
+import subprocess
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-verify")
+
+MB = 1024 * 1024
+
+
+def verify(filename, *options):
+    process = subprocess.run([VMDK_CONVERT, "--verify"] + list(options) + [filename],
+                             cwd=WORK_DIR, capture_output=True, text=True)
+    return process.returncode, json.loads(process.stdout)
+
+
+def grain_sectors(filename):
+    """
+    Return the sectors of the allocated grains of a streamOptimized VMDK,
+    indexed by grain number.
+    """
+    with open(os.path.join(WORK_DIR, filename), "rb") as f:
+        image = f.read()
+    num_gtes, gd_offset = struct.unpack("<IxxxxxxxxQ", image[44:64])
+    capacity, grain_size = struct.unpack("<QQ", image[12:28])
+    num_grains = (capacity + grain_size - 1) // grain_size
+    num_gts = (num_grains + num_gtes - 1) // num_gtes
+    grains = {}
+    gd = struct.unpack(f"<{num_gts}I", image[gd_offset * 512:gd_offset * 512 + num_gts * 4])
+    for i, gt_sect in enumerate(gd):
+        gt = struct.unpack(f"<{num_gtes}I", image[gt_sect * 512:gt_sect * 512 + num_gtes * 4])
+        for j, sect in enumerate(gt):
+            if sect > 1:
+                grains[i * num_gtes + j] = sect
+    return grains
+
+
+def corrupt(filename, offset, data):
+    with open(os.path.join(WORK_DIR, filename), "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        f.write(os.urandom(2 * MB) + b"\0" * (4 * MB) + os.urandom(2 * MB))
+    process = subprocess.run([VMDK_CONVERT, "--content-digest", "test.img", "test.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("threads", ["1", "4"])
+def test_verify(setup_test, threads):
+    ret, report = verify("test.vmdk", "-n", threads)
+    assert ret == 0
+    assert report["valid"]
+    assert report["errors"] == []
+    assert report["capacity"] == 8 * MB
+    assert report["allocatedGrains"] == 64
+    assert report["hasEOS"] and report["grainsOrdered"]
+    assert report["contentDigest"]["match"]
+
+
+def test_verify_wrong_digest(setup_test):
+    ret, report = verify("test.vmdk", "--digest", "sha256-tree:0")
+    assert ret == 1
+    assert not report["valid"]
+    assert not report["contentDigest"]["match"]
+    assert report["errors"] == []
+
+
+def test_verify_wrong_lba(setup_test):
+    shutil.copy(os.path.join(WORK_DIR, "test.vmdk"), os.path.join(WORK_DIR, "lba.vmdk"))
+    sect = grain_sectors("lba.vmdk")[5]
+    corrupt("lba.vmdk", sect * 512, struct.pack("<Q", 7 * 128))
+
+    ret, report = verify("lba.vmdk")
+    assert ret == 1
+    assert report["numErrors"] == 1
+    assert "grain 5 " in report["errors"][0] and "LBA 896" in report["errors"][0]
+
+
+def test_verify_bad_cmpsize(setup_test):
+    shutil.copy(os.path.join(WORK_DIR, "test.vmdk"), os.path.join(WORK_DIR, "cmpsize.vmdk"))
+    sect = grain_sectors("cmpsize.vmdk")[3]
+    corrupt("cmpsize.vmdk", sect * 512 + 8, struct.pack("<I", 0x7fffffff))
+
+    ret, report = verify("cmpsize.vmdk")
+    assert ret == 1
+    assert "grain 3 " in report["errors"][0] and "cmpSize" in report["errors"][0]
+
+
+def test_verify_corrupt_data(setup_test):
+    shutil.copy(os.path.join(WORK_DIR, "test.vmdk"), os.path.join(WORK_DIR, "data.vmdk"))
+    grains = grain_sectors("data.vmdk")
+    for nr in [0, 100]:
+        corrupt("data.vmdk", grains[nr] * 512 + 12, b"\xff" * 64)
+
+    ret, report = verify("data.vmdk", "-n", "2")
+    assert ret == 1
+    assert report["numErrors"] >= 2
+    # the content is not the one recorded any more
+    assert not report["contentDigest"]["match"]
+
+
+def test_verify_missing_eos(setup_test):
+    shutil.copy(os.path.join(WORK_DIR, "test.vmdk"), os.path.join(WORK_DIR, "eos.vmdk"))
+    corrupt("eos.vmdk", os.path.getsize(os.path.join(WORK_DIR, "eos.vmdk")) - 512 + 12, struct.pack("<I", 4))
+
+    ret, report = verify("eos.vmdk")
+    assert ret == 1
+    assert not report["hasEOS"]
+
+
+def test_verify_unordered(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--noreorder", "-n", "4", "test.img", "unordered.vmdk"], cwd=WORK_DIR)
+    assert process.returncode == 0
+    grains = grain_sectors("unordered.vmdk")
+    if sorted(grains.values()) == [grains[nr] for nr in sorted(grains)]:
+        pytest.skip("grains were written in order")
+
+    ret, report = verify("unordered.vmdk")
+    assert ret == 1
+    assert not report["grainsOrdered"]
+    assert "grains are not in ascending order" in report["errors"]
+
+
+def test_verify_raw_rejected(setup_test):
+    process = subprocess.run([VMDK_CONVERT, "--verify", "test.img"], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 1
@@ -0,0 +1,194 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import hashlib
+import json
+import os
+import pytest
+import struct
+import subprocess
+import uuid
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-vhd")
+
+MB = 1024 * 1024
+DISK_SIZE = 8 * MB
+
+
+def get_hash(filename, hash_type="sha256"):
+    hash = hashlib.new(hash_type)
+    with open(filename, "rb") as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+    return crc ^ 0xFFFFFFFF
+
+
+def vhd_checksum(data):
+    return ~sum(data) & 0xFFFFFFFF
+
+
+def vhd_footer(disk_type, data_offset):
+    fmt = ">8sIIQI4sIIQQIII16sB427x"
+    fields = [b"conectix", 2, 0x00010000, data_offset, 0, b"test", 0, 0,
+              DISK_SIZE, DISK_SIZE, 0, disk_type, 0, uuid.uuid4().bytes, 0]
+    fields[12] = vhd_checksum(struct.pack(fmt, *fields))
+    return struct.pack(fmt, *fields)
+
+
+def write_vhd_fixed(path, raw):
+    with open(path, "wb") as f:
+        f.write(raw)
+        f.write(vhd_footer(2, 0xFFFFFFFFFFFFFFFF))
+
+
+def write_vhd_dynamic(path):
+    block_size = 2 * MB
+    raw = bytearray(DISK_SIZE)
+    footer = vhd_footer(3, 512)
+
+    fmt = ">8sQQIIII16sII512s192s256s"
+    fields = [b"cxsparse", 0xFFFFFFFFFFFFFFFF, 1536, 0x00010000, DISK_SIZE // block_size,
+              block_size, 0, b"\0" * 16, 0, 0, b"", b"", b""]
+    fields[6] = vhd_checksum(struct.pack(fmt, *fields))
+    dyn_header = struct.pack(fmt, *fields)
+
+    bat = [0xFFFFFFFF] * (DISK_SIZE // block_size)
+    blocks = bytearray()
+    data_sector = 4   # footer copy, dynamic header (2 sectors), BAT
+    for nr, cleared in [(1, []), (3, [0, 7, 4095])]:
+        data = bytearray(os.urandom(block_size))
+        bitmap = bytearray(b"\xff" * 512)
+        for sect in cleared:
+            bitmap[sect // 8] &= ~(0x80 >> (sect % 8))
+        raw_data = bytearray(data)
+        for sect in cleared:
+            raw_data[sect * 512:(sect + 1) * 512] = b"\0" * 512
+        raw[nr * block_size:(nr + 1) * block_size] = raw_data
+        bat[nr] = data_sector + len(blocks) // 512
+        blocks += bitmap + data
+
+    with open(path, "wb") as f:
+        f.write(footer)
+        f.write(dyn_header)
+        f.write(struct.pack(f">{len(bat)}I", *bat).ljust(512, b"\xff"))
+        f.write(blocks)
+        f.write(footer)
+    return raw
+
+
+def write_vhdx(path):
+    block_size = MB
+    raw = bytearray(DISK_SIZE)
+    image = bytearray(6 * MB)
+
+    image[0:8] = b"vhdxfile"
+
+    header = bytearray(struct.pack("<4sIQ16s16s16sHHIQ", b"head", 0, 1, uuid.uuid4().bytes,
+                                   uuid.uuid4().bytes, b"\0" * 16, 0, 1, MB, MB).ljust(4096, b"\0"))
+    header[4:8] = struct.pack("<I", crc32c(header))
+    image[64 * 1024:64 * 1024 + 4096] = header
+
+    bat_guid = uuid.UUID("2DC27766-F623-4200-9D64-115E9BFD4A08").bytes_le
+    meta_guid = uuid.UUID("8B7CA206-4790-4B9A-B8FE-575F050F886E").bytes_le
+    regions = bytearray(struct.pack("<4sIII", b"regi", 0, 2, 0) +
+                        struct.pack("<16sQII", bat_guid, 2 * MB, MB, 1) +
+                        struct.pack("<16sQII", meta_guid, 3 * MB, MB, 1)).ljust(64 * 1024, b"\0")
+    regions[4:8] = struct.pack("<I", crc32c(regions))
+    image[192 * 1024:256 * 1024] = regions
+    image[256 * 1024:320 * 1024] = regions
+
+    meta = 3 * MB
+    items = [
+        ("CAA16737-FA36-4D43-B3B6-33F0AA44E76B", struct.pack("<II", block_size, 0)),
+        ("2FA54224-CD1B-4876-B211-5DBED83BF4B8", struct.pack("<Q", DISK_SIZE)),
+        ("8141BF1D-A96F-4709-BA47-F233A8FAAB5F", struct.pack("<I", 512)),
+    ]
+    table = struct.pack("<8sHH20x", b"metadata", 0, len(items))
+    item_offset = 64 * 1024
+    for guid, data in items:
+        table += struct.pack("<16sIIII", uuid.UUID(guid).bytes_le, item_offset, len(data), 4, 0)
+        image[meta + item_offset:meta + item_offset + len(data)] = data
+        item_offset += len(data)
+    image[meta:meta + len(table)] = table
+
+    # block 0 and 5 present, block 2 explicitly zero, others not present
+    bat = [0] * (DISK_SIZE // block_size)
+    bat[2] = 2
+    for nr, file_mb in [(0, 4), (5, 5)]:
+        data = os.urandom(block_size)
+        raw[nr * block_size:(nr + 1) * block_size] = data
+        image[file_mb * MB:(file_mb + 1) * MB] = data
+        bat[nr] = 6 | (file_mb << 20)
+    image[2 * MB:2 * MB + 8 * len(bat)] = struct.pack(f"<{len(bat)}Q", *bat)
+
+    with open(path, "wb") as f:
+        f.write(image)
+    return raw
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    raw = os.urandom(DISK_SIZE // 2) + b"\0" * (DISK_SIZE // 2)
+    with open(os.path.join(WORK_DIR, "fixed.img"), "wb") as f:
+        f.write(raw)
+    write_vhd_fixed(os.path.join(WORK_DIR, "fixed.vhd"), raw)
+
+    raw = write_vhd_dynamic(os.path.join(WORK_DIR, "dynamic.vhd"))
+    with open(os.path.join(WORK_DIR, "dynamic.img"), "wb") as f:
+        f.write(raw)
+
+    raw = write_vhdx(os.path.join(WORK_DIR, "test.vhdx"))
+    with open(os.path.join(WORK_DIR, "vhdx.img"), "wb") as f:
+        f.write(raw)
+    yield
+
+
+@pytest.mark.parametrize("image,raw_image", [("fixed.vhd", "fixed.img"),
+                                             ("dynamic.vhd", "dynamic.img"),
+                                             ("test.vhdx", "vhdx.img")])
+def test_vhd_to_vmdk(setup_test, image, raw_image):
+    vmdk = image.replace(".", "-") + ".vmdk"
+    back = image.replace(".", "-") + "-back.img"
+
+    process = subprocess.run([VMDK_CONVERT, image, vmdk], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    process = subprocess.run([VMDK_CONVERT, vmdk, back], cwd=WORK_DIR)
+    assert process.returncode == 0
+
+    assert get_hash(os.path.join(WORK_DIR, back)) == get_hash(os.path.join(WORK_DIR, raw_image))
+
+
+@pytest.mark.parametrize("image,used", [("dynamic.vhd", 4 * MB), ("test.vhdx", 2 * MB)])
+def test_vhd_info(setup_test, image, used):
+    process = subprocess.run([VMDK_CONVERT, "-i", image], cwd=WORK_DIR, capture_output=True, text=True)
+    assert process.returncode == 0
+
+    data = json.loads(process.stdout.strip())
+    assert data["capacity"] == DISK_SIZE
+    # only allocated blocks are reported
+    assert data["used"] == used
@@ -0,0 +1,90 @@
+# Copyright (c) 2025 Broadcom.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+VMDK_CONVERT = os.path.join(THIS_DIR, "..", "build", "vmdk", "vmdk-convert")
+WORK_DIR = os.path.join(os.getcwd(), "pytest-vmdkinfo")
+
+pytest.importorskip("numpy")
+sys.path.insert(0, os.path.join(THIS_DIR, "..", "ova-compose"))
+import vmdkinfo   # noqa: E402
+
+GRAIN_SIZE = 64 * 1024
+NUM_GRAINS = 1100   # more than two grain tables
+
+
+def vmdk_convert_info(filename):
+    process = subprocess.run([VMDK_CONVERT, "-i", "--detailed", filename], cwd=WORK_DIR,
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+    return json.loads(process.stdout)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_test():
+    os.makedirs(WORK_DIR, exist_ok=True)
+
+    with open(os.path.join(WORK_DIR, "test.img"), "wb") as f:
+        for i in range(NUM_GRAINS):
+            if i % 3 == 0 or 600 <= i < 700:
+                f.write(b"\0" * GRAIN_SIZE)
+            else:
+                f.write((f"grain {i} ".encode() * GRAIN_SIZE)[:GRAIN_SIZE])
+
+    for options, name in [(["--content-digest"], "stream.vmdk"),
+                          (["--noreorder", "-n", "4"], "noreorder.vmdk"),
+                          (["--format", "monolithicSparse"], "sparse.vmdk")]:
+        process = subprocess.run([VMDK_CONVERT] + options + ["test.img", name], cwd=WORK_DIR)
+        assert process.returncode == 0
+    yield
+    shutil.rmtree(WORK_DIR)
+
+
+@pytest.mark.parametrize("name", ["stream.vmdk", "noreorder.vmdk", "sparse.vmdk"])
+def test_same_as_vmdk_convert(setup_test, name):
+    path = os.path.join(WORK_DIR, name)
+    assert vmdkinfo.disk_info(path) == vmdk_convert_info(path)
+
+
+def test_stats(setup_test):
+    vmdk = vmdkinfo.SparseVmdk(os.path.join(WORK_DIR, "stream.vmdk"))
+    stats = vmdk.stats()
+
+    data_grains = sum(1 for i in range(NUM_GRAINS) if not (i % 3 == 0 or 600 <= i < 700))
+    assert stats['grains'] == NUM_GRAINS
+    assert stats['allocatedGrains'] == data_grains
+    assert stats['outOfOrder'] == 0
+    # every third grain is zero, so runs of two grains
+    assert stats['extents'] == -(-data_grains // 2)
+    assert vmdk.gt.shape == (NUM_GRAINS,)
+    assert vmdk.grains_ordered()
+
+
+def test_descriptor(setup_test):
+    vmdk = vmdkinfo.SparseVmdk(os.path.join(WORK_DIR, "stream.vmdk"))
+    assert vmdk.descriptor_values['createType'] == "streamOptimized"
+    assert vmdk.descriptor_values['ddb.contentDigest'].startswith("sha256-tree:")
+
+
+def test_not_sparse(setup_test):
+    with pytest.raises(ValueError):
+        vmdkinfo.SparseVmdk(os.path.join(WORK_DIR, "test.img"))
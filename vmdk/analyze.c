@@ -0,0 +1,532 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+/*
+ * Attributes the bytes a sparse disk takes in its file to regions of the
+ * disk and to the partitions found in its GPT or MBR, to find out which
+ * part of a disk makes an image big.  A grain is attributed to the
+ * partition its first byte belongs to.  Logical partitions inside an MBR
+ * extended partition are not listed, their grains count for the extended
+ * partition.
+ */
+
+#include "analyze.h"
+
+#include <endian.h>
+#include <errno.h>
+#include <math.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define CEILING(x, y) (((x) + (y) - 1) / (y))
+
+#define MBR_SIGNATURE_OFFSET    510
+#define MBR_TABLE_OFFSET        446
+#define MBR_TYPE_GPT            0xee
+#define GPT_SIGNATURE           "EFI PART"
+#define GPT_MAX_TABLE_SIZE      (1024 * 1024)
+
+/* cells per row of the heatmaps */
+#define HEATMAP_COLUMNS         64
+#define HEATMAP_CELL            12
+
+#pragma pack(push, 1)
+typedef struct {
+    uint8_t status;
+    uint8_t chsFirst[3];
+    uint8_t type;
+    uint8_t chsLast[3];
+    uint32_t lbaFirst;
+    uint32_t numSectors;
+} MbrEntryOnDisk;
+
+typedef struct {
+    char signature[8];
+    uint32_t revision;
+    uint32_t headerSize;
+    uint32_t headerCrc;
+    uint32_t reserved;
+    uint64_t currentLba;
+    uint64_t backupLba;
+    uint64_t firstUsableLba;
+    uint64_t lastUsableLba;
+    uint8_t diskGuid[16];
+    uint64_t entriesLba;
+    uint32_t numEntries;
+    uint32_t entrySize;
+    uint32_t entriesCrc;
+} GptHeaderOnDisk;
+
+typedef struct {
+    uint8_t typeGuid[16];
+    uint8_t uniqueGuid[16];
+    uint64_t firstLba;
+    uint64_t lastLba;
+    uint64_t attributes;
+    uint16_t name[36];
+} GptEntryOnDisk;
+#pragma pack(pop)
+
+static const struct {
+    const char *guid;
+    const char *name;
+} gptTypes[] = {
+    { "C12A7328-F81F-11D2-BA4B-00A0C93EC93B", "EFI System" },
+    { "21686148-6449-6E6F-744E-656564454649", "BIOS boot" },
+    { "0FC63DAF-8483-4772-8E79-3D69D8477DE4", "Linux filesystem" },
+    { "4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709", "Linux root (x86-64)" },
+    { "B921B045-1DF0-41C3-AF44-4C6F280D3FAE", "Linux root (ARM-64)" },
+    { "BC13C2FF-59E6-4262-A352-B275FD6F7172", "Linux extended boot" },
+    { "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F", "Linux swap" },
+    { "E6D6D379-F507-44C2-A23C-238F2A3DF928", "Linux LVM" },
+    { "A19D880F-05FC-4D3B-A006-743F0F84911E", "Linux RAID" },
+    { "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7", "Microsoft basic data" },
+    { "E3C9E316-0B5C-4DB8-817D-F92DF00215AE", "Microsoft reserved" },
+};
+
+static const struct {
+    uint8_t type;
+    const char *name;
+} mbrTypes[] = {
+    { 0x05, "Extended" },
+    { 0x07, "NTFS/exFAT" },
+    { 0x0b, "FAT32" },
+    { 0x0c, "FAT32 (LBA)" },
+    { 0x0f, "Extended (LBA)" },
+    { 0x82, "Linux swap" },
+    { 0x83, "Linux" },
+    { 0x85, "Linux extended" },
+    { 0x8e, "Linux LVM" },
+    { 0xef, "EFI System" },
+    { 0xfd, "Linux RAID" },
+};
+
+/* Keeps names safe to print in JSON and HTML without escaping. */
+static void
+copySafe(char *dst, size_t size, const char *src)
+{
+    size_t i;
+
+    for (i = 0; i + 1 < size && src[i] != '\0'; i++) {
+        char c = src[i];
+
+        dst[i] = (c >= ' ' && c <= '~' && !strchr("\"\\<>&'", c)) ? c : '_';
+    }
+    dst[i] = '\0';
+}
+
+static void
+formatGuid(char *buf, const uint8_t *g)
+{
+    /* the first three fields are little endian */
+    sprintf(buf, "%02X%02X%02X%02X-%02X%02X-%02X%02X-%02X%02X-%02X%02X%02X%02X%02X%02X",
+            g[3], g[2], g[1], g[0], g[5], g[4], g[7], g[6],
+            g[8], g[9], g[10], g[11], g[12], g[13], g[14], g[15]);
+}
+
+static bool
+addPartition(AnalyzeReport *report,
+             int number,
+             const char *type,
+             const char *name,
+             uint64_t start,
+             uint64_t length)
+{
+    AnalyzePartition *p;
+
+    if (report->numPartitions == ANALYZE_MAX_PARTITIONS) {
+        return false;
+    }
+    p = &report->partitions[report->numPartitions++];
+    memset(p, 0, sizeof *p);
+    p->number = number;
+    copySafe(p->type, sizeof p->type, type);
+    copySafe(p->name, sizeof p->name, name);
+    p->start = start;
+    p->length = length;
+    return true;
+}
+
+static bool
+readGpt(DiskInfo *di,
+        AnalyzeReport *report,
+        uint32_t lbaSize)
+{
+    GptHeaderOnDisk hdr;
+    uint8_t *table;
+    uint64_t tableSize;
+    uint32_t i;
+
+    if (di->vmt->pread(di, &hdr, sizeof hdr, lbaSize) != sizeof hdr ||
+        memcmp(hdr.signature, GPT_SIGNATURE, sizeof hdr.signature) != 0) {
+        return false;
+    }
+    tableSize = (uint64_t)le32toh(hdr.numEntries) * le32toh(hdr.entrySize);
+    if (le32toh(hdr.entrySize) < sizeof(GptEntryOnDisk) || tableSize > GPT_MAX_TABLE_SIZE ||
+        le64toh(hdr.entriesLba) * lbaSize + tableSize > report->capacity) {
+        return false;
+    }
+    table = malloc(tableSize ? tableSize : 1);
+    if (!table) {
+        return false;
+    }
+    if (di->vmt->pread(di, table, tableSize, le64toh(hdr.entriesLba) * lbaSize) != (ssize_t)tableSize) {
+        free(table);
+        return false;
+    }
+    report->partitionTable = "gpt";
+    for (i = 0; i < le32toh(hdr.numEntries); i++) {
+        GptEntryOnDisk *e = (GptEntryOnDisk *)(table + (uint64_t)i * le32toh(hdr.entrySize));
+        static const uint8_t unused[16];
+        char guid[40], name[37];
+        const char *type = guid;
+        size_t j;
+
+        if (memcmp(e->typeGuid, unused, sizeof unused) == 0 || le64toh(e->lastLba) < le64toh(e->firstLba)) {
+            continue;
+        }
+        formatGuid(guid, e->typeGuid);
+        for (j = 0; j < sizeof gptTypes / sizeof gptTypes[0]; j++) {
+            if (strcmp(guid, gptTypes[j].guid) == 0) {
+                type = gptTypes[j].name;
+            }
+        }
+        /* partition names are UTF-16, other characters than ASCII are replaced */
+        for (j = 0; j < 36 && e->name[j] != 0; j++) {
+            uint16_t c = le16toh(e->name[j]);
+
+            name[j] = c < 0x80 ? (char)c : '_';
+        }
+        name[j] = '\0';
+        if (!addPartition(report, i + 1, type, name, le64toh(e->firstLba) * lbaSize,
+                          (le64toh(e->lastLba) - le64toh(e->firstLba) + 1) * lbaSize)) {
+            break;
+        }
+    }
+    free(table);
+    return true;
+}
+
+static void
+readPartitions(DiskInfo *di,
+               AnalyzeReport *report)
+{
+    uint8_t mbr[512];
+    MbrEntryOnDisk entries[4];
+    int i;
+
+    report->partitionTable = "none";
+    if (report->capacity < 2 * sizeof mbr ||
+        di->vmt->pread(di, mbr, sizeof mbr, 0) != sizeof mbr ||
+        mbr[MBR_SIGNATURE_OFFSET] != 0x55 || mbr[MBR_SIGNATURE_OFFSET + 1] != 0xaa) {
+        return;
+    }
+    memcpy(entries, mbr + MBR_TABLE_OFFSET, sizeof entries);
+    for (i = 0; i < 4; i++) {
+        if (entries[i].type == MBR_TYPE_GPT) {
+            /* 512 byte sectors, or 4K sectors */
+            if (readGpt(di, report, 512) || readGpt(di, report, 4096)) {
+                return;
+            }
+            break;
+        }
+    }
+    report->partitionTable = "mbr";
+    for (i = 0; i < 4; i++) {
+        char type[8];
+        const char *typeName = type;
+        size_t j;
+
+        if (entries[i].type == 0 || entries[i].numSectors == 0) {
+            continue;
+        }
+        sprintf(type, "0x%02x", entries[i].type);
+        for (j = 0; j < sizeof mbrTypes / sizeof mbrTypes[0]; j++) {
+            if (mbrTypes[j].type == entries[i].type) {
+                typeName = mbrTypes[j].name;
+            }
+        }
+        addPartition(report, i + 1, typeName, "", (uint64_t)le32toh(entries[i].lbaFirst) * 512,
+                     (uint64_t)le32toh(entries[i].numSectors) * 512);
+    }
+}
+
+static AnalyzePartition *
+findPartition(AnalyzeReport *report,
+              uint64_t pos)
+{
+    int i;
+
+    for (i = 0; i < report->numPartitions; i++) {
+        AnalyzePartition *p = &report->partitions[i];
+
+        if (pos >= p->start && pos - p->start < p->length) {
+            return p;
+        }
+    }
+    return &report->unpartitioned;
+}
+
+/*
+ * Analyzes a sparse disk opened with Sparse_Open.  The disk is split in
+ * ANALYZE_NUM_REGIONS regions, at least one grain each.
+ */
+bool
+Analyze_Disk(DiskInfo *di,
+             AnalyzeReport *report)
+{
+    uint32_t *sizes;
+    uint64_t numGrains, i;
+    uint32_t grainSize;
+
+    memset(report, 0, sizeof *report);
+    report->capacity = di->vmt->getCapacity(di);
+    sizes = Sparse_GetGrainSizes(di, &grainSize, &numGrains);
+    if (!sizes) {
+        return false;
+    }
+    report->grainSize = grainSize;
+    report->regionSize = CEILING(CEILING(report->capacity, ANALYZE_NUM_REGIONS), grainSize) * grainSize;
+    if (report->regionSize == 0) {
+        report->regionSize = grainSize;
+    }
+    report->numRegions = CEILING(report->capacity, report->regionSize);
+    report->regions = calloc(report->numRegions ? report->numRegions : 1, sizeof *report->regions);
+    if (!report->regions) {
+        free(sizes);
+        errno = ENOMEM;
+        return false;
+    }
+    for (i = 0; i < report->numRegions; i++) {
+        report->regions[i].start = i * report->regionSize;
+    }
+
+    readPartitions(di, report);
+    strcpy(report->unpartitioned.type, "unpartitioned");
+
+    for (i = 0; i < numGrains; i++) {
+        uint64_t start = i * grainSize;
+        uint64_t length = report->capacity - start < grainSize ? report->capacity - start : grainSize;
+        AnalyzeRegion *region = &report->regions[start / report->regionSize];
+        AnalyzePartition *p;
+
+        if (sizes[i] == 0) {
+            continue;
+        }
+        p = findPartition(report, start);
+        region->allocatedBytes += length;
+        region->storedBytes += sizes[i];
+        p->allocatedBytes += length;
+        p->storedBytes += sizes[i];
+        report->allocatedBytes += length;
+        report->storedBytes += sizes[i];
+    }
+    free(sizes);
+    return true;
+}
+
+void
+Analyze_Free(AnalyzeReport *report)
+{
+    free(report->regions);
+    report->regions = NULL;
+}
+
+static void
+printPartitionJSON(FILE *f,
+                   const AnalyzePartition *p,
+                   bool withLocation)
+{
+    fprintf(f, "{ ");
+    if (withLocation) {
+        fprintf(f, "\"number\": %d, \"type\": \"%s\", \"name\": \"%s\", \"start\": %llu, \"length\": %llu, ",
+                p->number, p->type, p->name, (unsigned long long)p->start, (unsigned long long)p->length);
+    }
+    fprintf(f, "\"allocatedBytes\": %llu, \"storedBytes\": %llu }",
+            (unsigned long long)p->allocatedBytes, (unsigned long long)p->storedBytes);
+}
+
+void
+Analyze_PrintJSON(FILE *f,
+                  const AnalyzeReport *report)
+{
+    uint64_t i;
+    int j;
+
+    fprintf(f, "{ \"capacity\": %llu, \"grainSize\": %u, \"regionSize\": %llu, "
+            "\"allocatedBytes\": %llu, \"storedBytes\": %llu, \"partitionTable\": \"%s\", \"partitions\": [",
+            (unsigned long long)report->capacity, report->grainSize, (unsigned long long)report->regionSize,
+            (unsigned long long)report->allocatedBytes, (unsigned long long)report->storedBytes,
+            report->partitionTable);
+    for (j = 0; j < report->numPartitions; j++) {
+        fprintf(f, "%s", j ? ", " : "");
+        printPartitionJSON(f, &report->partitions[j], true);
+    }
+    fprintf(f, "], \"unpartitioned\": ");
+    printPartitionJSON(f, &report->unpartitioned, false);
+    fprintf(f, ", \"regions\": [");
+    for (i = 0; i < report->numRegions; i++) {
+        fprintf(f, "%s{ \"start\": %llu, \"allocatedBytes\": %llu, \"storedBytes\": %llu }", i ? ", " : "",
+                (unsigned long long)report->regions[i].start, (unsigned long long)report->regions[i].allocatedBytes,
+                (unsigned long long)report->regions[i].storedBytes);
+    }
+    fprintf(f, "] }\n");
+}
+
+/* Formats a byte count for people, at most 16 characters. */
+static const char *
+formatSize(char *buf,
+           uint64_t bytes)
+{
+    static const char *const units[] = { "bytes", "KB", "MB", "GB", "TB" };
+    double value = bytes;
+    int unit = 0;
+
+    while (value >= 1024 && unit < 4) {
+        value /= 1024;
+        unit++;
+    }
+    if (unit == 0) {
+        sprintf(buf, "%llu bytes", (unsigned long long)bytes);
+    } else {
+        sprintf(buf, "%.1f %s", value, units[unit]);
+    }
+    return buf;
+}
+
+static double
+ratio(uint64_t allocatedBytes,
+      uint64_t storedBytes)
+{
+    return storedBytes ? (double)allocatedBytes / storedBytes : 0;
+}
+
+/*
+ * Compression ratio from red (incompressible) to green (8:1 or better),
+ * on a log scale.  Regions without data are grey.
+ */
+static void
+ratioColor(char *buf,
+           const AnalyzeRegion *region)
+{
+    double r = ratio(region->allocatedBytes, region->storedBytes);
+    double hue;
+
+    if (region->storedBytes == 0) {
+        strcpy(buf, "#e8e8e8");
+        return;
+    }
+    hue = r <= 1 ? 0 : log2(r) / 3 * 120;
+    sprintf(buf, "hsl(%.0f,75%%,50%%)", hue > 120 ? 120 : hue);
+}
+
+/* Share of the stored bytes, from white to dark blue. */
+static void
+sizeColor(char *buf,
+          const AnalyzeRegion *region,
+          uint64_t maxStored)
+{
+    double share = maxStored ? (double)region->storedBytes / maxStored : 0;
+
+    sprintf(buf, "hsl(220,80%%,%.0f%%)", 97 - share * 67);
+}
+
+static void
+printHeatmap(FILE *f,
+             const AnalyzeReport *report,
+             bool bySize)
+{
+    uint64_t rows = CEILING(report->numRegions, HEATMAP_COLUMNS);
+    uint64_t maxStored = 0;
+    uint64_t i;
+
+    for (i = 0; i < report->numRegions; i++) {
+        if (report->regions[i].storedBytes > maxStored) {
+            maxStored = report->regions[i].storedBytes;
+        }
+    }
+    fprintf(f, "<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"%d\" height=\"%llu\">\n",
+            HEATMAP_COLUMNS * HEATMAP_CELL, (unsigned long long)(rows * HEATMAP_CELL));
+    for (i = 0; i < report->numRegions; i++) {
+        const AnalyzeRegion *region = &report->regions[i];
+        char color[32], start[16], data[16], stored[16];
+
+        if (bySize) {
+            sizeColor(color, region, maxStored);
+        } else {
+            ratioColor(color, region);
+        }
+        fprintf(f, "<rect x=\"%llu\" y=\"%llu\" width=\"%d\" height=\"%d\" fill=\"%s\">"
+                "<title>at %s: %s of data, %s stored, ratio %.2f</title></rect>\n",
+                (unsigned long long)(i % HEATMAP_COLUMNS * HEATMAP_CELL),
+                (unsigned long long)(i / HEATMAP_COLUMNS * HEATMAP_CELL), HEATMAP_CELL - 1, HEATMAP_CELL - 1, color,
+                formatSize(start, region->start), formatSize(data, region->allocatedBytes),
+                formatSize(stored, region->storedBytes), ratio(region->allocatedBytes, region->storedBytes));
+    }
+    fprintf(f, "</svg>\n");
+}
+
+static void
+printPartitionRow(FILE *f,
+                  const AnalyzeReport *report,
+                  const AnalyzePartition *p,
+                  bool withLocation)
+{
+    char buf[2][16];
+
+    if (withLocation) {
+        fprintf(f, "<tr><td>%d</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td>", p->number, p->type, p->name,
+                formatSize(buf[0], p->start), formatSize(buf[1], p->length));
+    } else {
+        fprintf(f, "<tr><td></td><td>%s</td><td></td><td></td><td></td>", p->type);
+    }
+    fprintf(f, "<td>%s</td><td>%s</td><td>%.1f%%</td><td>%.2f</td></tr>\n",
+            formatSize(buf[0], p->allocatedBytes), formatSize(buf[1], p->storedBytes),
+            report->storedBytes ? 100.0 * p->storedBytes / report->storedBytes : 0,
+            ratio(p->allocatedBytes, p->storedBytes));
+}
+
+/* A standalone page with the two heatmaps and the partition table. */
+void
+Analyze_PrintHTML(FILE *f,
+                  const AnalyzeReport *report,
+                  const char *title)
+{
+    char safeTitle[256];
+    char buf[4][16];
+    int j;
+
+    copySafe(safeTitle, sizeof safeTitle, title);
+    fprintf(f, "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>%s</title>\n"
+            "<style>body { font-family: sans-serif; } td, th { padding: 2px 8px; text-align: right; }</style>\n"
+            "</head><body>\n<h1>%s</h1>\n", safeTitle, safeTitle);
+    fprintf(f, "<p>Capacity %s, %s of data stored in %s, ratio %.2f. "
+            "Each cell is %s of the disk, left to right and top to bottom.</p>\n",
+            formatSize(buf[0], report->capacity), formatSize(buf[1], report->allocatedBytes),
+            formatSize(buf[2], report->storedBytes), ratio(report->allocatedBytes, report->storedBytes),
+            formatSize(buf[3], report->regionSize));
+    fprintf(f, "<h2>Compression ratio</h2>\n<p>Red is incompressible, green is 8:1 or better, grey has no data.</p>\n");
+    printHeatmap(f, report, false);
+    fprintf(f, "<h2>Stored bytes</h2>\n<p>Darker cells take more space in the file.</p>\n");
+    printHeatmap(f, report, true);
+    fprintf(f, "<h2>Partitions (%s)</h2>\n<table>\n<tr><th>#</th><th>Type</th><th>Name</th><th>Start</th>"
+            "<th>Size</th><th>Data</th><th>Stored</th><th>Share</th><th>Ratio</th></tr>\n",
+            report->partitionTable);
+    for (j = 0; j < report->numPartitions; j++) {
+        printPartitionRow(f, report, &report->partitions[j], true);
+    }
+    printPartitionRow(f, report, &report->unpartitioned, false);
+    fprintf(f, "</table>\n</body></html>\n");
+}
@@ -0,0 +1,61 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _ANALYZE_H_
+#define _ANALYZE_H_
+
+#include "diskinfo.h"
+
+#include <stdio.h>
+
+#define ANALYZE_MAX_PARTITIONS  128
+#define ANALYZE_NUM_REGIONS     1024
+
+typedef struct {
+    uint64_t start;             /* bytes */
+    uint64_t allocatedBytes;    /* disk bytes in allocated grains */
+    uint64_t storedBytes;       /* bytes these grains take in the file */
+} AnalyzeRegion;
+
+typedef struct {
+    int number;
+    char type[40];
+    char name[40];
+    uint64_t start;             /* bytes */
+    uint64_t length;
+    uint64_t allocatedBytes;
+    uint64_t storedBytes;
+} AnalyzePartition;
+
+typedef struct {
+    uint64_t capacity;
+    uint32_t grainSize;
+    uint64_t regionSize;
+    uint64_t allocatedBytes;
+    uint64_t storedBytes;
+    const char *partitionTable; /* "gpt", "mbr" or "none" */
+    int numPartitions;
+    AnalyzePartition partitions[ANALYZE_MAX_PARTITIONS];
+    AnalyzePartition unpartitioned;
+    uint64_t numRegions;
+    AnalyzeRegion *regions;
+} AnalyzeReport;
+
+bool Analyze_Disk(DiskInfo *di, AnalyzeReport *report);
+void Analyze_PrintJSON(FILE *f, const AnalyzeReport *report);
+void Analyze_PrintHTML(FILE *f, const AnalyzeReport *report, const char *title);
+void Analyze_Free(AnalyzeReport *report);
+
+#endif /* _ANALYZE_H_ */
@@ -0,0 +1,486 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#define _GNU_SOURCE
+
+#include "convert.h"
+#include "ratelimit.h"
+#include "vmware_vmdk.h"
+
+#include <ctype.h>
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <zlib.h>
+
+/* toolsVersion in metadata -
+   default is 2^31-1 (unknown) */
+char *toolsVersion = "2147483647";
+
+// Forward declaration for sparse disk structure
+typedef struct {
+    DiskInfo hdr;
+    bool hasFooter;
+    SparseExtentHeader diskHdr;
+    // We don't need the full structure, just the header
+} SparseDiskInfo;
+
+static int
+copyData(DiskInfo *dst,
+         off_t dstOffset,
+         DiskInfo *src,
+         off_t srcOffset,
+         uint64_t length)
+{
+    char buf[65536];
+
+    while (length > 0) {
+        size_t readLen;
+
+        readLen = sizeof buf;
+        if (length < readLen) {
+            readLen = length;
+            length = 0;
+        } else {
+            length -= readLen;
+        }
+        RateLimit_Consume(RATE_LIMIT_READ, readLen);
+        if (src->vmt->pread(src, buf, readLen, srcOffset) != (ssize_t)readLen) {
+            return -1;
+        }
+        if (dst->vmt->pwrite(dst, buf, readLen, dstOffset) != (ssize_t)readLen) {
+            return -1;
+        }
+        srcOffset += readLen;
+        dstOffset += readLen;
+    }
+    return 0;
+}
+
+/* Copies src to dst and closes dst.  dst is aborted if the copy fails. */
+bool
+Convert_CopyDisk(DiskInfo *src,
+                 DiskInfo *dst,
+                 int numThreads)
+{
+    if (dst->vmt->copyDisk) {
+        ssize_t ret;
+
+        ret = dst->vmt->copyDisk(src, dst, numThreads);
+        if (ret < 0) {
+            goto failAll;
+        }
+    } else {
+        off_t end = 0;
+        off_t pos;
+
+        while (src->vmt->nextData(src, &pos, &end) == 0) {
+            if (copyData(dst, pos, src, pos, end - pos)) {
+                goto failAll;
+            }
+        }
+        if (errno != ENXIO) {
+            goto failAll;
+        }
+    }
+    if (dst->vmt->close(dst)) {
+        return false;
+    }
+    return true;
+
+failAll:
+    dst->vmt->abort(dst);
+    return false;
+}
+
+/* Opens the source disk. Formats identified by a magic number are tried
+   first, anything else is treated as a raw image. */
+DiskInfo *
+Convert_OpenSource(const char *fileName,
+                   bool *isSparse)
+{
+    DiskInfo *di;
+
+    *isSparse = false;
+    di = Sparse_Open(fileName);
+    if (di != NULL) {
+        *isSparse = true;
+        return di;
+    }
+    di = Qcow2_Open(fileName);
+    if (di != NULL || errno != EINVAL) {
+        return di;
+    }
+    di = Vhd_Open(fileName);
+    if (di != NULL || errno != EINVAL) {
+        return di;
+    }
+    return Flat_Open(fileName);
+}
+
+static bool
+hasSuffix(const char *text, const char *suffix)
+{
+    size_t len = strlen(text);
+    size_t suffixLen = strlen(suffix);
+
+    return len >= suffixLen && strcmp(text + len - suffixLen, suffix) == 0;
+}
+
+/* Parses the --format argument. */
+TargetFormat
+Convert_ParseFormat(const char *name)
+{
+    if (strcmp(name, "streamOptimized") == 0 || strcmp(name, "vmdk") == 0) {
+        return TARGET_STREAM_OPTIMIZED;
+    }
+    if (strcmp(name, "monolithicSparse") == 0) {
+        return TARGET_MONOLITHIC_SPARSE;
+    }
+    if (strcmp(name, "qcow2") == 0) {
+        return TARGET_QCOW2;
+    }
+    if (strcmp(name, "raw") == 0) {
+        return TARGET_RAW;
+    }
+    return TARGET_DEFAULT;
+}
+
+/* Without --format the target format is picked by file extension. */
+TargetFormat
+Convert_GetFormat(const char *fileName)
+{
+    if (hasSuffix(fileName, ".vmdk")) {
+        return TARGET_STREAM_OPTIMIZED;
+    }
+    if (hasSuffix(fileName, ".qcow2")) {
+        return TARGET_QCOW2;
+    }
+    return TARGET_RAW;
+}
+
+/* Applies the options that are set after creating a streamOptimized disk. */
+static DiskInfo *
+setupStreamOptimized(DiskInfo *di,
+                     off_t capacity,
+                     const ConvertOptions *opts)
+{
+    if (!di) {
+        return NULL;
+    }
+    if (opts->grainCache) {
+        StreamOptimized_SetGrainCache(di, opts->grainCache);
+    }
+    if (opts->doContentDigest && !StreamOptimized_SetContentDigest(di, capacity)) {
+        int err = errno;
+
+        di->vmt->abort(di);
+        errno = err;
+        return NULL;
+    }
+    return di;
+}
+
+DiskInfo *
+Convert_CreateTarget(const char *src,
+                     const char *filename,
+                     TargetFormat targetFormat,
+                     off_t capacity,
+                     const ConvertOptions *opts)
+{
+    if (opts->offset != 0) {
+        if ((targetFormat != TARGET_DEFAULT && targetFormat != TARGET_STREAM_OPTIMIZED) ||
+            opts->checkpointInterval > 0 || opts->doResume) {
+            fprintf(stderr, "--offset is only supported for streamOptimized disks, without --checkpoint and --resume\n");
+            errno = EINVAL;
+            return NULL;
+        }
+        return setupStreamOptimized(StreamOptimized_CreateAt(filename, opts->offset, capacity, opts->compressionLevel,
+                                                             opts->doReorder, opts->sectorSize),
+                                    capacity, opts);
+    }
+    if (targetFormat == TARGET_DEFAULT) {
+        targetFormat = Convert_GetFormat(filename);
+    }
+    if ((opts->checkpointInterval > 0 || opts->doResume) && targetFormat != TARGET_STREAM_OPTIMIZED) {
+        fprintf(stderr, "--checkpoint and --resume are only supported for streamOptimized disks\n");
+        errno = EINVAL;
+        return NULL;
+    }
+    switch (targetFormat) {
+    case TARGET_STREAM_OPTIMIZED: {
+        DiskInfo *di = StreamOptimized_CreateCheckpointed(filename, capacity, opts->compressionLevel, opts->doReorder,
+                                                          opts->sectorSize, src, opts->checkpointInterval,
+                                                          opts->doResume);
+
+        return setupStreamOptimized(di, capacity, opts);
+    }
+    case TARGET_MONOLITHIC_SPARSE:
+        return MonolithicSparse_Create(filename, capacity, opts->sectorSize);
+    case TARGET_QCOW2:
+        return Qcow2_Create(filename, capacity, !opts->doCompress ? -1 :
+                            opts->compressionLevel > Z_BEST_COMPRESSION ? Z_BEST_COMPRESSION : opts->compressionLevel);
+    default:
+        return Flat_Create(filename, capacity);
+    }
+}
+
+/* Return the unquoted value of key in the descriptor, or NULL */
+char *
+Convert_GetDescriptorValue(const char *descriptor,
+                           const char *key)
+{
+    size_t keyLen = strlen(key);
+    const char *line = descriptor;
+
+    while (line && *line) {
+        const char *p = line;
+
+        while (*p == ' ' || *p == '\t') p++;
+        if (strncmp(p, key, keyLen) == 0) {
+            p += keyLen;
+            while (*p == ' ' || *p == '\t') p++;
+            if (*p == '=') {
+                const char *end;
+
+                p++;
+                while (*p == ' ' || *p == '\t') p++;
+                if (*p == '"') {
+                    p++;
+                    end = strchr(p, '"');
+                } else {
+                    end = strchr(p, '\n');
+                }
+                return end ? strndup(p, end - p) : strdup(p);
+            }
+        }
+        line = strchr(line, '\n');
+        if (line) {
+            line++;
+        }
+    }
+    return NULL;
+}
+
+/* Parse the descriptor file and return a JSON string with the key-value pairs */
+static char *
+parseDescriptorFile(const char *descriptor)
+{
+    char *result = NULL;
+    char *line, *saveptr1 = NULL;
+    char *descriptor_copy = NULL;
+    size_t result_size = 0;
+    size_t result_capacity = 1024; // Initial capacity
+    bool first_entry = true;
+
+    if (!descriptor) {
+        return NULL;
+    }
+
+    // Allocate memory for the result
+    result = malloc(result_capacity);
+    if (!result) {
+        return NULL;
+    }
+
+    // Initialize the result string with opening brace
+    strcpy(result, "{}");
+    result_size = 2;
+
+    // Make a copy of the descriptor to avoid modifying the original
+    descriptor_copy = strdup(descriptor);
+    if (!descriptor_copy) {
+        free(result);
+        return NULL;
+    }
+
+    // Parse each line of the descriptor
+    line = strtok_r(descriptor_copy, "\n", &saveptr1);
+    while (line != NULL) {
+        // Skip comments and empty lines
+        if (line[0] != '#' && strlen(line) > 0) {
+            char *key = NULL;
+            char *value = NULL;
+
+            // Find the equals sign
+            char *equals = strchr(line, '=');
+            if (equals) {
+                // Split the line into key and value
+                *equals = '\0';
+                key = line;
+                value = equals + 1;
+
+                // Trim whitespace from key and value
+                while (*key && isspace(*key)) key++;
+                while (*value && isspace(*value)) value++;
+
+                // Remove trailing whitespace from key
+                char *end = key + strlen(key) - 1;
+                while (end > key && isspace(*end)) {
+                    *end = '\0';
+                    end--;
+                }
+
+                // Remove trailing whitespace from value
+                end = value + strlen(value) - 1;
+                while (end > value && isspace(*end)) {
+                    *end = '\0';
+                    end--;
+                }
+
+                // Remove quotes from value if present
+                if (*value == '"' && value[strlen(value) - 1] == '"') {
+                    value[strlen(value) - 1] = '\0';
+                    value++;
+                }
+
+                // Add the key-value pair to the result
+                if (strlen(key) > 0) {
+                    // Calculate the required space for this entry
+                    size_t entry_size = strlen(key) + strlen(value) + 10; // 10 for quotes, colon, comma, etc.
+
+                    // Ensure we have enough space
+                    if (result_size + entry_size > result_capacity) {
+                        result_capacity *= 2;
+                        char *new_result = realloc(result, result_capacity);
+                        if (!new_result) {
+                            free(result);
+                            free(descriptor_copy);
+                            return NULL;
+                        }
+                        result = new_result;
+                    }
+
+                    // Insert before the closing brace
+                    result[result_size - 1] = '\0'; // Remove closing brace
+
+                    // Add comma if not the first entry
+                    if (!first_entry) {
+                        strcat(result, ", ");
+                        result_size += 2;
+                    } else {
+                        first_entry = false;
+                    }
+
+                    // Add the key-value pair
+                    strcat(result, "\"");
+                    strcat(result, key);
+                    strcat(result, "\": \"");
+                    strcat(result, value);
+                    strcat(result, "\"");
+                    strcat(result, "}");
+
+                    // Update result_size
+                    result_size = strlen(result);
+                }
+            }
+        }
+
+        // Get the next line
+        line = strtok_r(NULL, "\n", &saveptr1);
+    }
+
+    free(descriptor_copy);
+    return result;
+}
+
+/*
+ * Returns the information shown by vmdk-convert -i as a JSON string, to be
+ * freed by the caller, or NULL on error.
+ */
+char *
+Convert_Info(DiskInfo *di,
+             bool isSparse,
+             bool detailed)
+{
+    char *result = NULL;
+    size_t resultSize;
+    off_t capacity = di->vmt->getCapacity(di);
+    off_t end = 0;
+    off_t pos;
+    off_t usedSpace = 0;
+    FILE *f = open_memstream(&result, &resultSize);
+
+    if (f == NULL) {
+        return NULL;
+    }
+    while (di->vmt->nextData(di, &pos, &end) == 0) {
+        usedSpace += end - pos;
+    }
+    fprintf(f, "{ \"capacity\": %llu, \"used\": %llu",
+            (unsigned long long)capacity, (unsigned long long)usedSpace);
+
+    if (detailed) {
+        if (isSparse) {
+            // Cast to SparseDiskInfo to access the header
+            SparseDiskInfo *sdi = (SparseDiskInfo *)di;
+            fprintf(f, ", \"sparseHeader\": {");
+            fprintf(f, "\"version\": %u, ", sdi->diskHdr.version);
+            fprintf(f, "\"flags\": %u, ", sdi->diskHdr.flags);
+            fprintf(f, "\"flagsDecoded\": {");
+            fprintf(f, "\"validNewlineDetector\": %s, ", (sdi->diskHdr.flags & SPARSEFLAG_VALID_NEWLINE_DETECTOR) ? "true" : "false");
+            fprintf(f, "\"useRedundant\": %s, ", (sdi->diskHdr.flags & SPARSEFLAG_USE_REDUNDANT) ? "true" : "false");
+            fprintf(f, "\"compressed\": %s, ", (sdi->diskHdr.flags & SPARSEFLAG_COMPRESSED) ? "true" : "false");
+            fprintf(f, "\"embeddedLBA\": %s", (sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA) ? "true" : "false");
+            fprintf(f, "}, ");
+            fprintf(f, "\"numGTEsPerGT\": %u, ", sdi->diskHdr.numGTEsPerGT);
+            fprintf(f, "\"compressAlgorithm\": %u, ", sdi->diskHdr.compressAlgorithm);
+            fprintf(f, "\"compressAlgorithmName\": \"%s\", ",
+                    sdi->diskHdr.compressAlgorithm == SPARSE_COMPRESSALGORITHM_NONE ? "none" :
+                    sdi->diskHdr.compressAlgorithm == SPARSE_COMPRESSALGORITHM_DEFLATE ? "deflate" : "unknown");
+            fprintf(f, "\"uncleanShutdown\": %u, ", sdi->diskHdr.uncleanShutdown);
+            fprintf(f, "\"grainSize\": %llu, ", (unsigned long long)sdi->diskHdr.grainSize);
+            fprintf(f, "\"grainSizeBytes\": %llu, ", (unsigned long long)(sdi->diskHdr.grainSize * 512));
+            fprintf(f, "\"descriptorOffset\": %llu, ", (unsigned long long)sdi->diskHdr.descriptorOffset);
+            fprintf(f, "\"descriptorSize\": %llu, ", (unsigned long long)sdi->diskHdr.descriptorSize);
+            fprintf(f, "\"rgdOffset\": %llu, ", (unsigned long long)sdi->diskHdr.rgdOffset);
+            fprintf(f, "\"gdOffset\": %llu, ", (unsigned long long)sdi->diskHdr.gdOffset);
+            fprintf(f, "\"overHead\": %llu", (unsigned long long)sdi->diskHdr.overHead);
+            if (di->vmt->checkGrainOrder) {
+                fprintf(f, ", \"grainsOrdered\": %s", di->vmt->checkGrainOrder(di) ? "true" : "false");
+            }
+            fprintf(f, ", \"hasFooter\": %s", sdi->hasFooter ? "true" : "false");
+            fprintf(f, "}");
+        } else {
+            fprintf(f, ", \"error\": \"detailed information only available for sparse VMDK files\"");
+        }
+    }
+
+    // Add parsed descriptor file if available
+    if (detailed && isSparse && di->vmt->getDescriptor) {
+        char *descriptor = di->vmt->getDescriptor(di);
+        if (descriptor) {
+            char *contentDigest = Convert_GetDescriptorValue(descriptor, "ddb.contentDigest");
+            char *parsed_descriptor = parseDescriptorFile(descriptor);
+
+            if (contentDigest) {
+                fprintf(f, ", \"contentDigest\": \"%s\"", contentDigest);
+                free(contentDigest);
+            }
+            if (parsed_descriptor) {
+                fprintf(f, ", \"descriptorFile\": %s", parsed_descriptor);
+                free(parsed_descriptor);
+            }
+        }
+    }
+
+    fprintf(f, " }");
+    if (fclose(f) != 0) {
+        free(result);
+        return NULL;
+    }
+    return result;
+}
@@ -0,0 +1,52 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _CONVERT_H_
+#define _CONVERT_H_
+
+#include "diskinfo.h"
+#include "graincache.h"
+
+typedef enum {
+    TARGET_DEFAULT,
+    TARGET_STREAM_OPTIMIZED,
+    TARGET_MONOLITHIC_SPARSE,
+    TARGET_QCOW2,
+    TARGET_RAW
+} TargetFormat;
+
+/* Options applying to every destination disk */
+typedef struct {
+    int compressionLevel;
+    bool doReorder;
+    int sectorSize;
+    bool doCompress;
+    uint64_t checkpointInterval;
+    bool doResume;
+    bool doContentDigest;   /* record ddb.contentDigest in streamOptimized disks */
+    GrainCache *grainCache;
+    off_t offset;           /* write a streamOptimized disk into an existing file at offset */
+} ConvertOptions;
+
+DiskInfo *Convert_OpenSource(const char *fileName, bool *isSparse);
+TargetFormat Convert_ParseFormat(const char *name);
+TargetFormat Convert_GetFormat(const char *fileName);
+DiskInfo *Convert_CreateTarget(const char *src, const char *filename, TargetFormat targetFormat, off_t capacity,
+                               const ConvertOptions *opts);
+bool Convert_CopyDisk(DiskInfo *src, DiskInfo *dst, int numThreads);
+char *Convert_GetDescriptorValue(const char *descriptor, const char *key);
+char *Convert_Info(DiskInfo *di, bool isSparse, bool detailed);
+
+#endif /* _CONVERT_H_ */
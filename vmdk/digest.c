@@ -0,0 +1,249 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#include "digest.h"
+#include "sha256.h"
+
+#include <errno.h>
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+
+typedef uint8_t Hash[SHA256_DIGEST_SIZE];
+
+struct ContentDigest {
+    pthread_mutex_t mutex;
+    uint64_t capacity;
+    uint64_t numLeaves;
+    uint64_t numNodes;
+    uint64_t nodesDone;
+    Hash *nodes;
+    Hash **leaves;        /* leaf hashes of nodes in progress, NULL otherwise */
+    uint32_t *leafCount;  /* leaves added per node */
+    Hash zeroLeaf;
+};
+
+static void
+hashBuffer(const void *data,
+           size_t len,
+           uint8_t *out)
+{
+    Sha256Context ctx;
+
+    Sha256_Init(&ctx);
+    Sha256_Update(&ctx, data, len);
+    Sha256_Final(&ctx, out);
+}
+
+static bool
+isZeroLeaf(const void *data,
+           size_t len)
+{
+    const uint64_t *p = data;
+    size_t i;
+
+    if (len != CONTENT_DIGEST_LEAF_SIZE) {
+        return false;
+    }
+    for (i = 0; i < len / sizeof *p; i++) {
+        if (p[i] != 0) {
+            return false;
+        }
+    }
+    return true;
+}
+
+static uint32_t
+leavesInNode(const ContentDigest *cd,
+             uint64_t node)
+{
+    uint64_t first = node * CONTENT_DIGEST_FANOUT;
+
+    if (cd->numLeaves - first < CONTENT_DIGEST_FANOUT) {
+        return cd->numLeaves - first;
+    }
+    return CONTENT_DIGEST_FANOUT;
+}
+
+ContentDigest *
+ContentDigest_Create(uint64_t capacity)
+{
+    ContentDigest *cd;
+    void *zero;
+
+    cd = calloc(1, sizeof *cd);
+    if (!cd) {
+        return NULL;
+    }
+    cd->capacity = capacity;
+    cd->numLeaves = (capacity + CONTENT_DIGEST_LEAF_SIZE - 1) / CONTENT_DIGEST_LEAF_SIZE;
+    cd->numNodes = (cd->numLeaves + CONTENT_DIGEST_FANOUT - 1) / CONTENT_DIGEST_FANOUT;
+    cd->nodes = calloc(cd->numNodes ? cd->numNodes : 1, sizeof *cd->nodes);
+    cd->leaves = calloc(cd->numNodes ? cd->numNodes : 1, sizeof *cd->leaves);
+    cd->leafCount = calloc(cd->numNodes ? cd->numNodes : 1, sizeof *cd->leafCount);
+    zero = calloc(1, CONTENT_DIGEST_LEAF_SIZE);
+    if (!cd->nodes || !cd->leaves || !cd->leafCount || !zero ||
+        pthread_mutex_init(&cd->mutex, NULL) != 0) {
+        free(zero);
+        free(cd->leafCount);
+        free(cd->leaves);
+        free(cd->nodes);
+        free(cd);
+        return NULL;
+    }
+    hashBuffer(zero, CONTENT_DIGEST_LEAF_SIZE, cd->zeroLeaf);
+    free(zero);
+    return cd;
+}
+
+static bool
+addLeaf(ContentDigest *cd,
+        uint64_t leaf,
+        const uint8_t *hash)
+{
+    uint64_t node = leaf / CONTENT_DIGEST_FANOUT;
+    bool success = true;
+
+    pthread_mutex_lock(&cd->mutex);
+    if (cd->leafCount[node] == leavesInNode(cd, node)) {
+        /* node already complete, a leaf was added twice */
+        success = false;
+        goto out;
+    }
+    if (!cd->leaves[node]) {
+        cd->leaves[node] = malloc(CONTENT_DIGEST_FANOUT * sizeof(Hash));
+        if (!cd->leaves[node]) {
+            success = false;
+            goto out;
+        }
+    }
+    memcpy(cd->leaves[node][leaf % CONTENT_DIGEST_FANOUT], hash, sizeof(Hash));
+    if (++cd->leafCount[node] == leavesInNode(cd, node)) {
+        hashBuffer(cd->leaves[node], cd->leafCount[node] * sizeof(Hash), cd->nodes[node]);
+        free(cd->leaves[node]);
+        cd->leaves[node] = NULL;
+        cd->nodesDone++;
+    }
+out:
+    pthread_mutex_unlock(&cd->mutex);
+    return success;
+}
+
+/*
+ * Adds the content at pos.  pos must be leaf aligned and len a multiple
+ * of the leaf size, except for the last leaf of the disk.
+ */
+bool
+ContentDigest_Update(ContentDigest *cd,
+                     off_t pos,
+                     const void *data,
+                     size_t len)
+{
+    const uint8_t *p = data;
+
+    if (pos % CONTENT_DIGEST_LEAF_SIZE != 0 || (uint64_t)pos + len > cd->capacity) {
+        errno = EINVAL;
+        return false;
+    }
+    while (len > 0) {
+        size_t leafLen = len < CONTENT_DIGEST_LEAF_SIZE ? len : CONTENT_DIGEST_LEAF_SIZE;
+        Hash hash;
+
+        if (leafLen < CONTENT_DIGEST_LEAF_SIZE && (uint64_t)pos + leafLen != cd->capacity) {
+            errno = EINVAL;
+            return false;
+        }
+        if (isZeroLeaf(p, leafLen)) {
+            memcpy(hash, cd->zeroLeaf, sizeof hash);
+        } else {
+            hashBuffer(p, leafLen, hash);
+        }
+        if (!addLeaf(cd, pos / CONTENT_DIGEST_LEAF_SIZE, hash)) {
+            return false;
+        }
+        p += leafLen;
+        pos += leafLen;
+        len -= leafLen;
+    }
+    return true;
+}
+
+/*
+ * Adds the SHA-256 hash of one leaf of len bytes at pos, for callers that
+ * hashed the content already.
+ */
+bool
+ContentDigest_AddLeaf(ContentDigest *cd,
+                      off_t pos,
+                      size_t len,
+                      const uint8_t *hash)
+{
+    if (pos % CONTENT_DIGEST_LEAF_SIZE != 0 || len > CONTENT_DIGEST_LEAF_SIZE ||
+        (uint64_t)pos + len > cd->capacity ||
+        (len < CONTENT_DIGEST_LEAF_SIZE && (uint64_t)pos + len != cd->capacity)) {
+        errno = EINVAL;
+        return false;
+    }
+    return addLeaf(cd, pos / CONTENT_DIGEST_LEAF_SIZE, hash);
+}
+
+/*
+ * Stores the root as CONTENT_DIGEST_PREFIX followed by hex digits in str,
+ * which must hold CONTENT_DIGEST_STRING_SIZE bytes.  Fails if not all of
+ * the content has been added.
+ */
+bool
+ContentDigest_Final(ContentDigest *cd,
+                    char *str)
+{
+    Sha256Context ctx;
+    uint8_t capacity[8];
+    Hash root;
+    char hex[2 * SHA256_DIGEST_SIZE + 1];
+    int i;
+
+    if (cd->nodesDone != cd->numNodes) {
+        return false;
+    }
+    for (i = 0; i < 8; i++) {
+        capacity[i] = cd->capacity >> (8 * i);
+    }
+    Sha256_Init(&ctx);
+    Sha256_Update(&ctx, capacity, sizeof capacity);
+    Sha256_Update(&ctx, cd->nodes, cd->numNodes * sizeof(Hash));
+    Sha256_Final(&ctx, root);
+    Sha256_ToHex(root, hex);
+    strcpy(str, CONTENT_DIGEST_PREFIX);
+    strcat(str, hex);
+    return true;
+}
+
+void
+ContentDigest_Free(ContentDigest *cd)
+{
+    uint64_t i;
+
+    if (!cd) {
+        return;
+    }
+    for (i = 0; i < cd->numNodes; i++) {
+        free(cd->leaves[i]);
+    }
+    pthread_mutex_destroy(&cd->mutex);
+    free(cd->leafCount);
+    free(cd->leaves);
+    free(cd->nodes);
+    free(cd);
+}
@@ -0,0 +1,45 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _DIGEST_H_
+#define _DIGEST_H_
+
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <sys/types.h>
+
+/*
+ * Digest of the logical content of a disk, independent of the container
+ * format and of how the content is stored.  The content is split into
+ * 64 KB leaves, leaf hashes are combined per 512 leaves into node hashes,
+ * and the root is the SHA-256 of the capacity and all node hashes.
+ * Leaves can be added in any order and from several threads.
+ */
+
+#define CONTENT_DIGEST_LEAF_SIZE    65536
+#define CONTENT_DIGEST_FANOUT       512
+#define CONTENT_DIGEST_PREFIX       "sha256-tree:"
+#define CONTENT_DIGEST_STRING_SIZE  (sizeof CONTENT_DIGEST_PREFIX + 64)
+
+typedef struct ContentDigest ContentDigest;
+
+ContentDigest *ContentDigest_Create(uint64_t capacity);
+bool ContentDigest_Update(ContentDigest *cd, off_t pos, const void *data, size_t len);
+bool ContentDigest_AddLeaf(ContentDigest *cd, off_t pos, size_t len, const uint8_t *hash);
+bool ContentDigest_Final(ContentDigest *cd, char *str);
+void ContentDigest_Free(ContentDigest *cd);
+
+#endif /* _DIGEST_H_ */
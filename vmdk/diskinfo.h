@@ -43,6 +43,59 @@ extern char *toolsVersion; /* toolsVersion in metadata */
 DiskInfo *Flat_Open(const char *fileName);
 DiskInfo *Flat_Create(const char *fileName, off_t capacity);
 DiskInfo *Sparse_Open(const char *fileName);
+DiskInfo *Qcow2_Open(const char *fileName);
+DiskInfo *Vhd_Open(const char *fileName);
+DiskInfo *Qcow2_Create(const char *fileName, off_t capacity, int compressionLevel);
+DiskInfo *MonolithicSparse_Create(const char *fileName, off_t capacity, int sectorSize);
 DiskInfo *StreamOptimized_Create(const char *fileName, off_t capacity, int compressionLevel, bool doReorder, int sectorSize);
+DiskInfo *StreamOptimized_CreateCheckpointed(const char *fileName, off_t capacity, int compressionLevel, bool doReorder,
+                                             int sectorSize, const char *srcFileName, uint64_t checkpointInterval,
+                                             bool resume);
+DiskInfo *StreamOptimized_CreateAt(const char *fileName, off_t offset, off_t capacity, int compressionLevel,
+                                   bool doReorder, int sectorSize);
+struct GrainCache;
+void StreamOptimized_SetGrainCache(DiskInfo *self, struct GrainCache *cache);
+bool StreamOptimized_SetContentDigest(DiskInfo *self, off_t capacity);
+int StreamOptimized_CopyDisks(DiskInfo **srcs, DiskInfo **dsts, int numDisks, int numThreads, bool *results);
+
+#define VERIFY_MAX_ERRORS   32
+
+typedef struct {
+    uint64_t grains;            /* grain table entries */
+    uint64_t allocatedGrains;
+    uint64_t zeroGrains;        /* grains marked as zero in the grain table */
+    bool hasFooter;
+    bool hasEOS;
+    bool grainsOrdered;
+    char contentDigest[80];     /* empty if not computed */
+    uint64_t numErrors;
+    char errors[VERIFY_MAX_ERRORS][128];  /* the first VERIFY_MAX_ERRORS errors */
+} VerifyReport;
+
+bool Sparse_Verify(DiskInfo *self, int numThreads, bool computeDigest, VerifyReport *report);
+
+typedef struct {
+    uint64_t start;             /* bytes */
+    uint64_t length;
+    uint64_t sizeA;             /* bytes taken by the grains in each file */
+    uint64_t sizeB;
+} DiffExtent;
+
+typedef struct {
+    uint64_t grainSize;         /* bytes */
+    uint64_t grains;
+    uint64_t sameByTable;       /* not allocated in either disk */
+    uint64_t sameByPayload;     /* identical data in the files */
+    uint64_t sameByContent;     /* equal after decompression */
+    uint64_t changedGrains;
+    uint64_t changedBytes;
+    uint64_t sizeA;             /* bytes taken by all grains in each file */
+    uint64_t sizeB;
+    uint64_t numExtents;
+    DiffExtent *extents;        /* changed ranges, to be freed by the caller */
+} DiffReport;
+
+bool Sparse_Diff(DiskInfo *a, DiskInfo *b, int numThreads, DiffReport *report);
+uint32_t *Sparse_GetGrainSizes(DiskInfo *self, uint32_t *grainSize, uint64_t *numGrains);
 
 #endif /* _DISKINFO_H_ */
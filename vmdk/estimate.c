@@ -0,0 +1,451 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+
+#define _GNU_SOURCE
+
+#include "estimate.h"
+#include "ultra.h"
+#include "vmware_vmdk.h"
+
+#include <errno.h>
+#include <math.h>
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/sysinfo.h>
+#include <time.h>
+
+#include <zlib.h>
+
+#define GRAIN_SECTORS   128
+#define GRAIN_SIZE      (GRAIN_SECTORS * VMDK_SECTOR_SIZE)
+#define GTES_PER_GT     512
+#define Z_95            1.96
+
+#define CEILING(x, y) (((x) + (y) - 1) / (y))
+#define VMDK_SECTOR_SIZE    512ULL
+
+/* A run of populated grains, [start, end) in grain numbers. */
+typedef struct {
+    uint64_t start;
+    uint64_t end;
+} GrainRange;
+
+typedef struct {
+    pthread_mutex_t mutex;
+    DiskInfo *src;
+    off_t capacity;
+    int compressionLevel;
+    uint64_t *samples;      /* grain numbers to compress */
+    uint64_t numSamples;
+    uint64_t next;
+    double *bytes;          /* bytes each sampled grain takes in the output */
+    double *seconds;        /* CPU time to compress each sampled grain */
+    bool failed;
+} EstimateContext;
+
+/*
+ * Collects the grains touched by the data extents of src.  Extents of
+ * formats with a finer granularity than a grain may share grains, so
+ * adjacent runs are merged.
+ */
+static GrainRange *
+getPopulatedGrains(DiskInfo *src,
+                   size_t *numRanges,
+                   uint64_t *numGrains)
+{
+    off_t capacity = src->vmt->getCapacity(src);
+    GrainRange *ranges = NULL;
+    size_t count = 0, allocated = 0;
+    off_t pos = 0, end = 0;
+
+    *numGrains = 0;
+    while (true) {
+        uint64_t start, stop;
+
+        if (src->vmt->nextData) {
+            if (src->vmt->nextData(src, &pos, &end) != 0) {
+                break;
+            }
+        } else if (end == 0 && capacity > 0) {
+            pos = 0;
+            end = capacity;
+        } else {
+            break;
+        }
+        start = pos / GRAIN_SIZE;
+        stop = CEILING((uint64_t)end, GRAIN_SIZE);
+        if (count > 0 && start <= ranges[count - 1].end) {
+            if (stop > ranges[count - 1].end) {
+                *numGrains += stop - ranges[count - 1].end;
+                ranges[count - 1].end = stop;
+            }
+            continue;
+        }
+        if (count == allocated) {
+            GrainRange *tmp;
+
+            allocated = allocated ? 2 * allocated : 64;
+            tmp = realloc(ranges, allocated * sizeof *ranges);
+            if (!tmp) {
+                free(ranges);
+                return NULL;
+            }
+            ranges = tmp;
+        }
+        ranges[count].start = start;
+        ranges[count].end = stop;
+        *numGrains += stop - start;
+        count++;
+    }
+    if (!ranges) {
+        ranges = malloc(sizeof *ranges);
+    }
+    *numRanges = count;
+    return ranges;
+}
+
+/*
+ * Picks one grain at random from each of numSamples equally sized strata
+ * of the populated grains, so the sample covers the whole disk.
+ */
+static bool
+pickSamples(const GrainRange *ranges,
+            uint64_t numGrains,
+            uint64_t *samples,
+            uint64_t numSamples)
+{
+    const GrainRange *range = ranges;
+    uint64_t rangeBase = 0;
+    uint64_t i;
+
+    for (i = 0; i < numSamples; i++) {
+        uint64_t first = i * numGrains / numSamples;
+        uint64_t next = (i + 1) * numGrains / numSamples;
+        uint64_t idx = first + (uint64_t)(drand48() * (next - first));
+
+        if (idx >= next) {
+            idx = next - 1;
+        }
+        while (idx >= rangeBase + (range->end - range->start)) {
+            rangeBase += range->end - range->start;
+            range++;
+        }
+        samples[i] = range->start + (idx - rangeBase);
+    }
+    return true;
+}
+
+static double
+threadSeconds(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static bool
+isZeroed(const uint8_t *data,
+         size_t len)
+{
+    const uint64_t *data64 = (const uint64_t *)data;
+
+    len = len >> 3;
+    while (len--) {
+        if (*data64++ != 0) {
+            return false;
+        }
+    }
+    return true;
+}
+
+/* Compresses sampled grains the same way the streamOptimized writer does. */
+static void *
+sampleThread(void *arg)
+{
+    EstimateContext *ctx = arg;
+    z_stream zstream = {0};
+    UltraCompressor *uc = NULL;
+    uint8_t *buf = calloc(1, GRAIN_SIZE);
+    uint8_t *out = NULL;
+    size_t outSize = 0;
+
+    if (!buf || deflateInit(&zstream, ctx->compressionLevel > Z_BEST_COMPRESSION ?
+                                      Z_BEST_COMPRESSION : ctx->compressionLevel) != Z_OK) {
+        goto fail;
+    }
+    outSize = deflateBound(&zstream, GRAIN_SIZE);
+    out = malloc(outSize);
+    if (!out) {
+        goto fail;
+    }
+    if (ctx->compressionLevel == COMPRESSION_LEVEL_ULTRA) {
+        uc = Ultra_Create();
+        if (!uc) {
+            goto fail;
+        }
+    }
+
+    while (true) {
+        uint64_t i;
+        off_t pos;
+        size_t len = GRAIN_SIZE;
+        size_t cmpSize;
+        double start;
+
+        pthread_mutex_lock(&ctx->mutex);
+        i = ctx->next++;
+        pthread_mutex_unlock(&ctx->mutex);
+        if (i >= ctx->numSamples) {
+            break;
+        }
+        pos = ctx->samples[i] * GRAIN_SIZE;
+        if (ctx->capacity - pos < (off_t)len) {
+            len = ctx->capacity - pos;
+            memset(buf + len, 0, GRAIN_SIZE - len);
+        }
+        if (ctx->src->vmt->pread(ctx->src, buf, len, pos) != (ssize_t)len) {
+            goto fail;
+        }
+
+        start = threadSeconds();
+        if (isZeroed(buf, GRAIN_SIZE)) {
+            /* zero grains are not written */
+            ctx->bytes[i] = 0;
+        } else {
+            if (deflateReset(&zstream) != Z_OK) {
+                goto fail;
+            }
+            zstream.next_in = buf;
+            zstream.avail_in = len;
+            zstream.next_out = out;
+            zstream.avail_out = outSize;
+            if (deflate(&zstream, Z_FINISH) != Z_STREAM_END) {
+                goto fail;
+            }
+            cmpSize = zstream.total_out;
+            if (uc) {
+                size_t ultraSize = Ultra_Compress(uc, buf, len, out, cmpSize - 1);
+
+                if (ultraSize != 0) {
+                    cmpSize = ultraSize;
+                }
+            }
+            ctx->bytes[i] = CEILING(sizeof(SparseGrainLBAHeaderOnDisk) + cmpSize,
+                                    VMDK_SECTOR_SIZE) * VMDK_SECTOR_SIZE;
+        }
+        ctx->seconds[i] = threadSeconds() - start;
+    }
+    Ultra_Free(uc);
+    deflateEnd(&zstream);
+    free(out);
+    free(buf);
+    return NULL;
+
+fail:
+    pthread_mutex_lock(&ctx->mutex);
+    ctx->failed = true;
+    ctx->next = ctx->numSamples;
+    pthread_mutex_unlock(&ctx->mutex);
+    Ultra_Free(uc);
+    deflateEnd(&zstream);
+    free(out);
+    free(buf);
+    return NULL;
+}
+
+/*
+ * Estimates the total of a value over numGrains grains from the sample,
+ * with the confidence interval of a simple random sample drawn without
+ * replacement.  Stratified sampling is at least as precise, so the
+ * interval is conservative.
+ */
+static Estimate
+estimateTotal(const double *values,
+              uint64_t n,
+              uint64_t numGrains)
+{
+    Estimate e = { 0, 0, 0 };
+    double mean = 0, var = 0, se;
+    uint64_t i;
+
+    if (n == 0) {
+        return e;
+    }
+    for (i = 0; i < n; i++) {
+        mean += values[i];
+    }
+    mean /= n;
+    for (i = 0; i < n && n > 1; i++) {
+        var += (values[i] - mean) * (values[i] - mean);
+    }
+    if (n > 1) {
+        var /= n - 1;
+    }
+    se = numGrains * sqrt(var / n) * sqrt(1.0 - (double)n / numGrains);
+    e.value = mean * numGrains;
+    e.low = e.value - Z_95 * se;
+    e.high = e.value + Z_95 * se;
+    if (e.low < 0) {
+        e.low = 0;
+    }
+    return e;
+}
+
+/* Bytes of the streamOptimized file that do not depend on the content. */
+static uint64_t
+metadataBytes(uint64_t capacity)
+{
+    uint64_t GTEs = CEILING(capacity, GRAIN_SIZE);
+    uint64_t GTs = CEILING(GTEs, GTES_PER_GT);
+    uint64_t GDsectors = CEILING(GTs * sizeof(uint32_t), VMDK_SECTOR_SIZE);
+    uint64_t GTsectors = CEILING(GTES_PER_GT * sizeof(uint32_t), VMDK_SECTOR_SIZE);
+
+    /* header, descriptor, grain directory and tables, end of stream marker */
+    return (1 + 20 + GDsectors + GTs * GTsectors + 1) * VMDK_SECTOR_SIZE;
+}
+
+static void
+addThreadCount(EstimateReport *report,
+               int threads)
+{
+    int i;
+
+    for (i = 0; i < report->numThreadCounts; i++) {
+        if (report->threadCounts[i] == threads) {
+            return;
+        }
+        if (report->threadCounts[i] > threads) {
+            break;
+        }
+    }
+    if (report->numThreadCounts == ESTIMATE_MAX_THREAD_COUNTS) {
+        return;
+    }
+    memmove(&report->threadCounts[i + 1], &report->threadCounts[i],
+            (report->numThreadCounts - i) * sizeof report->threadCounts[0]);
+    report->threadCounts[i] = threads;
+    report->numThreadCounts++;
+}
+
+/*
+ * Estimates the size of src converted to streamOptimized at
+ * compressionLevel by compressing numSamples of its populated grains on
+ * numThreads threads.  The conversion time is projected from the CPU
+ * time per grain, assuming compression is CPU bound and scales up to
+ * the number of CPUs.
+ */
+bool
+Estimate_StreamOptimized(DiskInfo *src,
+                         int compressionLevel,
+                         int numThreads,
+                         int numSamples,
+                         EstimateReport *report)
+{
+    EstimateContext ctx;
+    GrainRange *ranges;
+    size_t numRanges;
+    uint64_t numGrains, populated = 0;
+    pthread_t threads[numThreads];
+    int threadsCreated = 0;
+    int nprocs = get_nprocs();
+    Estimate compressed, cpu;
+    bool success = false;
+    int i;
+
+    memset(report, 0, sizeof *report);
+    memset(&ctx, 0, sizeof ctx);
+    report->capacity = src->vmt->getCapacity(src);
+
+    ranges = getPopulatedGrains(src, &numRanges, &numGrains);
+    if (!ranges) {
+        return false;
+    }
+    if (pthread_mutex_init(&ctx.mutex, NULL) != 0) {
+        free(ranges);
+        return false;
+    }
+    ctx.src = src;
+    ctx.capacity = report->capacity;
+    ctx.compressionLevel = compressionLevel;
+    ctx.numSamples = numGrains < (uint64_t)numSamples ? numGrains : (uint64_t)numSamples;
+    ctx.samples = malloc((ctx.numSamples + 1) * sizeof *ctx.samples);
+    ctx.bytes = malloc((ctx.numSamples + 1) * sizeof *ctx.bytes);
+    ctx.seconds = malloc((ctx.numSamples + 1) * sizeof *ctx.seconds);
+    if (!ctx.samples || !ctx.bytes || !ctx.seconds ||
+        !pickSamples(ranges, numGrains, ctx.samples, ctx.numSamples)) {
+        goto out;
+    }
+
+    for (i = 0; i < numThreads; i++) {
+        if (pthread_create(&threads[i], NULL, sampleThread, &ctx) != 0) {
+            break;
+        }
+        threadsCreated++;
+    }
+    for (i = 0; i < threadsCreated; i++) {
+        pthread_join(threads[i], NULL);
+    }
+    if (threadsCreated == 0 || ctx.failed) {
+        errno = EIO;
+        goto out;
+    }
+
+    report->populatedGrains = numGrains;
+    report->sampledGrains = ctx.numSamples;
+    compressed = estimateTotal(ctx.bytes, ctx.numSamples, numGrains);
+    report->size.value = metadataBytes(report->capacity) + compressed.value;
+    report->size.low = metadataBytes(report->capacity) + compressed.low;
+    report->size.high = metadataBytes(report->capacity) + compressed.high;
+
+    for (i = 0; i < (int)numRanges; i++) {
+        populated += (ranges[i].end - ranges[i].start) * GRAIN_SIZE;
+    }
+    if (populated > report->capacity) {
+        /* the last grain may be partial */
+        populated = report->capacity;
+    }
+    if (compressed.value > 0) {
+        report->ratio.value = populated / compressed.value;
+        report->ratio.low = populated / compressed.high;
+        report->ratio.high = compressed.low > 0 ? populated / compressed.low : INFINITY;
+    }
+
+    cpu = estimateTotal(ctx.seconds, ctx.numSamples, numGrains);
+    for (i = 1; i <= (numThreads > nprocs ? numThreads : nprocs); i *= 2) {
+        addThreadCount(report, i);
+    }
+    addThreadCount(report, numThreads);
+    addThreadCount(report, nprocs);
+    for (i = 0; i < report->numThreadCounts; i++) {
+        int parallel = report->threadCounts[i] < nprocs ? report->threadCounts[i] : nprocs;
+
+        report->seconds[i].value = cpu.value / parallel;
+        report->seconds[i].low = cpu.low / parallel;
+        report->seconds[i].high = cpu.high / parallel;
+    }
+    success = true;
+
+out:
+    pthread_mutex_destroy(&ctx.mutex);
+    free(ctx.seconds);
+    free(ctx.bytes);
+    free(ctx.samples);
+    free(ranges);
+    return success;
+}
@@ -0,0 +1,44 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _ESTIMATE_H_
+#define _ESTIMATE_H_
+
+#include "diskinfo.h"
+
+#define ESTIMATE_MAX_THREAD_COUNTS  16
+
+/* A value estimated from a sample, with its 95% confidence interval. */
+typedef struct {
+    double value;
+    double low;
+    double high;
+} Estimate;
+
+typedef struct {
+    uint64_t capacity;
+    uint64_t populatedGrains;   /* grains touched by data extents */
+    uint64_t sampledGrains;
+    Estimate size;              /* streamOptimized file size in bytes */
+    Estimate ratio;             /* populated bytes / compressed grain bytes */
+    int numThreadCounts;
+    int threadCounts[ESTIMATE_MAX_THREAD_COUNTS];
+    Estimate seconds[ESTIMATE_MAX_THREAD_COUNTS];   /* conversion wall time per thread count */
+} EstimateReport;
+
+bool Estimate_StreamOptimized(DiskInfo *src, int compressionLevel, int numThreads, int numSamples,
+                              EstimateReport *report);
+
+#endif /* _ESTIMATE_H_ */
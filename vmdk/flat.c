@@ -16,6 +16,7 @@
 #define _GNU_SOURCE
 
 #include "diskinfo.h"
+#include "ratelimit.h"
 
 #include <sys/stat.h>
 #include <stdlib.h>
@@ -63,6 +64,7 @@ FlatPwrite(DiskInfo *self,
     /*
          * Should we do some zero detection here to generate sparse file?
          */
+    RateLimit_Consume(RATE_LIMIT_WRITE, len);
     return pwrite(fdi->fd, buf, len, pos);
 }
 
@@ -0,0 +1,382 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+
+/*
+ * Each entry is a file <dir>/<xx>/<hash>-<level>-<len>, where xx are the
+ * first two hex digits of the hash, holding a small header and the
+ * compressed grain.  Entries are written to a temporary file and renamed,
+ * so concurrent conversions sharing the cache never see partial entries.
+ * The modification time of an entry is updated on every hit.
+ *
+ * <dir>/size holds the total size of the entries, updated under a lock
+ * when a conversion that stored grains closes the cache.  Only when the
+ * total exceeds the budget are the entries listed, and the least recently
+ * used ones removed until the cache is below EVICT_TARGET of its budget,
+ * so the next conversions do not have to list them again right away.
+ */
+
+#define _GNU_SOURCE
+
+#include "graincache.h"
+
+#include <ctype.h>
+#include <dirent.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <stdbool.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/file.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include <zlib.h>
+
+#define GRAIN_CACHE_MAGIC   "VGC1"
+#define GRAIN_CACHE_INDEX   "size"
+#define EVICT_TARGET        0.9     /* fraction of the budget left after evicting */
+
+#pragma pack(push, 1)
+typedef struct {
+    char magic[4];
+    uint32_t dataLen;
+    uint32_t crc;       /* CRC-32 of the compressed data */
+} GrainCacheEntryHeader;
+#pragma pack(pop)
+
+struct GrainCache {
+    pthread_mutex_t mutex;
+    char *dir;
+    uint64_t budget;
+    uint64_t hits;
+    uint64_t misses;
+    uint64_t stored;
+    uint64_t storedBytes;   /* disk space of the entries stored by this run */
+};
+
+/*
+ * Space used by an entry.  Not st_blocks, which includes blocks the file
+ * system preallocates for a file that was just written.
+ */
+#define ENTRY_SIZE(sb)      (((sb).st_size + (sb).st_blksize - 1) / (sb).st_blksize * (sb).st_blksize)
+
+typedef struct {
+    char *path;
+    off_t size;
+    struct timespec mtime;
+} CacheEntry;
+
+GrainCache *
+GrainCache_Open(const char *dir,
+                uint64_t budget)
+{
+    GrainCache *gc;
+
+    if (mkdir(dir, 0777) != 0 && errno != EEXIST) {
+        fprintf(stderr, "Cannot create grain cache %s: %s\n", dir, strerror(errno));
+        return NULL;
+    }
+    gc = calloc(1, sizeof *gc);
+    if (!gc) {
+        return NULL;
+    }
+    gc->dir = strdup(dir);
+    if (!gc->dir || pthread_mutex_init(&gc->mutex, NULL) != 0) {
+        free(gc->dir);
+        free(gc);
+        return NULL;
+    }
+    gc->budget = budget;
+    return gc;
+}
+
+static char *
+entryPath(const GrainCache *gc,
+          const uint8_t hash[SHA256_DIGEST_SIZE],
+          int level,
+          size_t len,
+          bool subdirOnly)
+{
+    char hex[2 * SHA256_DIGEST_SIZE + 1];
+    char *path;
+    int ret;
+
+    Sha256_ToHex(hash, hex);
+    if (subdirOnly) {
+        ret = asprintf(&path, "%s/%.2s", gc->dir, hex);
+    } else {
+        ret = asprintf(&path, "%s/%.2s/%s-%d-%zu", gc->dir, hex, hex, level, len);
+    }
+    return ret == -1 ? NULL : path;
+}
+
+/*
+ * Copies the compressed grain for the given uncompressed content to out.
+ * Returns its length, or 0 if it is not cached.
+ */
+size_t
+GrainCache_Get(GrainCache *gc,
+               const uint8_t hash[SHA256_DIGEST_SIZE],
+               int level,
+               size_t len,
+               void *out,
+               size_t outSize)
+{
+    GrainCacheEntryHeader hdr;
+    char *path = entryPath(gc, hash, level, len, false);
+    size_t dataLen = 0;
+    int fd;
+
+    if (!path) {
+        goto out;
+    }
+    fd = open(path, O_RDONLY);
+    if (fd == -1) {
+        goto out;
+    }
+    if (pread(fd, &hdr, sizeof hdr, 0) == sizeof hdr &&
+        memcmp(hdr.magic, GRAIN_CACHE_MAGIC, sizeof hdr.magic) == 0 &&
+        hdr.dataLen > 0 && hdr.dataLen <= outSize &&
+        pread(fd, out, hdr.dataLen, sizeof hdr) == (ssize_t)hdr.dataLen &&
+        crc32(0, out, hdr.dataLen) == hdr.crc) {
+        dataLen = hdr.dataLen;
+        /* mark as recently used */
+        futimens(fd, NULL);
+    } else {
+        /* damaged, it will be replaced */
+        unlink(path);
+    }
+    close(fd);
+
+out:
+    free(path);
+    pthread_mutex_lock(&gc->mutex);
+    if (dataLen) {
+        gc->hits++;
+    } else {
+        gc->misses++;
+    }
+    pthread_mutex_unlock(&gc->mutex);
+    return dataLen;
+}
+
+/* Stores a compressed grain.  Failures only mean the grain is not cached. */
+void
+GrainCache_Put(GrainCache *gc,
+               const uint8_t hash[SHA256_DIGEST_SIZE],
+               int level,
+               size_t len,
+               const void *data,
+               size_t dataLen)
+{
+    GrainCacheEntryHeader hdr;
+    struct stat sb;
+    char *subdir = entryPath(gc, hash, level, len, true);
+    char *path = entryPath(gc, hash, level, len, false);
+    char *tmpPath = NULL;
+    int fd;
+
+    if (!subdir || !path || asprintf(&tmpPath, "%s.%d.XXXXXX", path, (int)getpid()) == -1) {
+        tmpPath = NULL;
+        goto out;
+    }
+    if (mkdir(subdir, 0777) != 0 && errno != EEXIST) {
+        goto out;
+    }
+    fd = mkstemp(tmpPath);
+    if (fd == -1) {
+        goto out;
+    }
+    memcpy(hdr.magic, GRAIN_CACHE_MAGIC, sizeof hdr.magic);
+    hdr.dataLen = dataLen;
+    hdr.crc = crc32(0, data, dataLen);
+    if (pwrite(fd, &hdr, sizeof hdr, 0) != sizeof hdr ||
+        pwrite(fd, data, dataLen, sizeof hdr) != (ssize_t)dataLen ||
+        fchmod(fd, 0644) != 0 ||
+        fstat(fd, &sb) != 0) {
+        close(fd);
+        unlink(tmpPath);
+        goto out;
+    }
+    if (close(fd) != 0 ||
+        rename(tmpPath, path) != 0) {
+        unlink(tmpPath);
+        goto out;
+    }
+    pthread_mutex_lock(&gc->mutex);
+    gc->stored++;
+    gc->storedBytes += ENTRY_SIZE(sb);
+    pthread_mutex_unlock(&gc->mutex);
+
+out:
+    free(tmpPath);
+    free(path);
+    free(subdir);
+}
+
+static int
+compareMtime(const void *a,
+             const void *b)
+{
+    const CacheEntry *ea = a, *eb = b;
+
+    if (ea->mtime.tv_sec != eb->mtime.tv_sec) {
+        return ea->mtime.tv_sec < eb->mtime.tv_sec ? -1 : 1;
+    }
+    if (ea->mtime.tv_nsec != eb->mtime.tv_nsec) {
+        return ea->mtime.tv_nsec < eb->mtime.tv_nsec ? -1 : 1;
+    }
+    return 0;
+}
+
+/*
+ * Removes the least recently used entries until the cache is below target.
+ * Returns the size of the remaining entries.
+ */
+static uint64_t
+evictEntries(GrainCache *gc,
+             uint64_t target)
+{
+    CacheEntry *entries = NULL;
+    size_t numEntries = 0, allocated = 0, i;
+    uint64_t total = 0;
+    DIR *top, *sub;
+    struct dirent *de, *se;
+
+    top = opendir(gc->dir);
+    if (!top) {
+        return 0;
+    }
+    while ((de = readdir(top)) != NULL) {
+        char *subdir;
+
+        /* only the <xx> directories, not ".." */
+        if (strlen(de->d_name) != 2 || !isxdigit((unsigned char)de->d_name[0]) ||
+            !isxdigit((unsigned char)de->d_name[1]) ||
+            asprintf(&subdir, "%s/%s", gc->dir, de->d_name) == -1) {
+            continue;
+        }
+        sub = opendir(subdir);
+        while (sub && (se = readdir(sub)) != NULL) {
+            struct stat sb;
+            char *path;
+
+            if (se->d_name[0] == '.' || asprintf(&path, "%s/%s", subdir, se->d_name) == -1) {
+                continue;
+            }
+            if (stat(path, &sb) != 0 || !S_ISREG(sb.st_mode)) {
+                free(path);
+                continue;
+            }
+            if (numEntries == allocated) {
+                CacheEntry *tmp;
+
+                allocated = allocated ? 2 * allocated : 1024;
+                tmp = realloc(entries, allocated * sizeof *entries);
+                if (!tmp) {
+                    free(path);
+                    break;
+                }
+                entries = tmp;
+            }
+            entries[numEntries].path = path;
+            entries[numEntries].size = ENTRY_SIZE(sb);
+            entries[numEntries].mtime = sb.st_mtim;
+            total += entries[numEntries].size;
+            numEntries++;
+        }
+        if (sub) {
+            closedir(sub);
+        }
+        free(subdir);
+    }
+    closedir(top);
+
+    if (total > gc->budget) {
+        qsort(entries, numEntries, sizeof *entries, compareMtime);
+        for (i = 0; i < numEntries && total > target; i++) {
+            if (unlink(entries[i].path) == 0) {
+                total -= entries[i].size;
+            }
+        }
+    }
+    for (i = 0; i < numEntries; i++) {
+        free(entries[i].path);
+    }
+    free(entries);
+    return total;
+}
+
+/*
+ * Adds the entries stored by this run to the recorded size of the cache,
+ * and evicts entries if that is over the budget.  Without a recorded size
+ * the entries are listed once to find it.
+ */
+static void
+updateSize(GrainCache *gc)
+{
+    char *path;
+    char buf[32];
+    ssize_t len;
+    uint64_t total;
+    bool known;
+    int fd;
+
+    if (asprintf(&path, "%s/%s", gc->dir, GRAIN_CACHE_INDEX) == -1) {
+        return;
+    }
+    fd = open(path, O_RDWR | O_CREAT, 0644);
+    free(path);
+    if (fd == -1) {
+        return;
+    }
+    if (flock(fd, LOCK_EX) != 0) {
+        close(fd);
+        return;
+    }
+    len = pread(fd, buf, sizeof buf - 1, 0);
+    known = len > 0;
+    if (known) {
+        buf[len] = '\0';
+        total = strtoull(buf, NULL, 10) + gc->storedBytes;
+    }
+    if (!known || total > gc->budget) {
+        total = evictEntries(gc, (uint64_t)(gc->budget * EVICT_TARGET));
+    }
+    len = snprintf(buf, sizeof buf, "%llu\n", (unsigned long long)total);
+    if (ftruncate(fd, 0) == 0) {
+        (void)!pwrite(fd, buf, len, 0);
+    }
+    close(fd);
+}
+
+void
+GrainCache_Close(GrainCache *gc)
+{
+    if (!gc) {
+        return;
+    }
+    printf("Grain cache: %llu hits, %llu misses, %llu grains stored\n",
+           (unsigned long long)gc->hits, (unsigned long long)gc->misses, (unsigned long long)gc->stored);
+    if (gc->storedBytes > 0) {
+        updateSize(gc);
+    }
+    pthread_mutex_destroy(&gc->mutex);
+    free(gc->dir);
+    free(gc);
+}
@@ -0,0 +1,38 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _GRAINCACHE_H_
+#define _GRAINCACHE_H_
+
+#include <stddef.h>
+#include <stdint.h>
+
+#include "sha256.h"
+
+/*
+ * Persistent cache of compressed grains, shared by all conversions using
+ * the same directory.  Entries are keyed by the hash of the uncompressed
+ * grain, its length and the compression level.
+ */
+typedef struct GrainCache GrainCache;
+
+GrainCache *GrainCache_Open(const char *dir, uint64_t budget);
+size_t GrainCache_Get(GrainCache *gc, const uint8_t hash[SHA256_DIGEST_SIZE], int level, size_t len,
+                      void *out, size_t outSize);
+void GrainCache_Put(GrainCache *gc, const uint8_t hash[SHA256_DIGEST_SIZE], int level, size_t len,
+                    const void *data, size_t dataLen);
+void GrainCache_Close(GrainCache *gc);
+
+#endif /* _GRAINCACHE_H_ */
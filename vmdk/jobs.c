@@ -0,0 +1,295 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+/*
+ * Reads a batch job file, a JSON array of objects like
+ *
+ *   [ { "src": "disk1.img", "dst": "disk1.vmdk" },
+ *     { "src": "disk2.qcow2", "dst": "disk2.vmdk", "format": "streamOptimized" } ]
+ *
+ * Only what is needed for that is parsed: strings, objects and arrays.
+ */
+
+#define _GNU_SOURCE
+
+#include "jobs.h"
+
+#include <ctype.h>
+#include <errno.h>
+#include <stdbool.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+typedef struct {
+    const char *text;
+    size_t pos;
+    const char *fileName;
+} JobParser;
+
+static void
+skipSpace(JobParser *p)
+{
+    while (isspace((unsigned char)p->text[p->pos])) {
+        p->pos++;
+    }
+}
+
+static bool
+parseError(JobParser *p, const char *what)
+{
+    fprintf(stderr, "%s: %s at offset %zu\n", p->fileName, what, p->pos);
+    return false;
+}
+
+static bool
+expect(JobParser *p, char c)
+{
+    skipSpace(p);
+    if (p->text[p->pos] != c) {
+        char what[32];
+
+        snprintf(what, sizeof what, "expected '%c'", c);
+        return parseError(p, what);
+    }
+    p->pos++;
+    return true;
+}
+
+/* Parses a string, only ASCII \u escapes are supported. */
+static bool
+parseString(JobParser *p, char **out)
+{
+    size_t len = 0;
+    char *str;
+
+    if (!expect(p, '"')) {
+        return false;
+    }
+    str = malloc(strlen(p->text + p->pos) + 1);
+    if (!str) {
+        return parseError(p, "out of memory");
+    }
+    while (p->text[p->pos] != '"') {
+        char c = p->text[p->pos++];
+
+        if (c == '\0') {
+            free(str);
+            return parseError(p, "unterminated string");
+        }
+        if (c == '\\') {
+            c = p->text[p->pos++];
+            switch (c) {
+            case '"': case '\\': case '/':
+                break;
+            case 'b': c = '\b'; break;
+            case 'f': c = '\f'; break;
+            case 'n': c = '\n'; break;
+            case 'r': c = '\r'; break;
+            case 't': c = '\t'; break;
+            case 'u': {
+                unsigned int code;
+
+                if (sscanf(p->text + p->pos, "%4x", &code) != 1 || code == 0 || code > 0x7f) {
+                    free(str);
+                    return parseError(p, "unsupported \\u escape");
+                }
+                p->pos += 4;
+                c = code;
+                break;
+            }
+            default:
+                free(str);
+                return parseError(p, "invalid escape");
+            }
+        }
+        str[len++] = c;
+    }
+    p->pos++;
+    str[len] = '\0';
+    *out = str;
+    return true;
+}
+
+static bool
+parseJob(JobParser *p, ConvertJob *job)
+{
+    if (!expect(p, '{')) {
+        return false;
+    }
+    skipSpace(p);
+    if (p->text[p->pos] == '}') {
+        p->pos++;
+        return parseError(p, "empty job");
+    }
+    for (;;) {
+        char *key, *value;
+
+        if (!parseString(p, &key)) {
+            return false;
+        }
+        if (!expect(p, ':') || !parseString(p, &value)) {
+            free(key);
+            return false;
+        }
+        if (strcmp(key, "src") == 0) {
+            free(job->src);
+            job->src = value;
+        } else if (strcmp(key, "dst") == 0) {
+            free(job->dst);
+            job->dst = value;
+        } else if (strcmp(key, "format") == 0) {
+            free(job->format);
+            job->format = value;
+        } else {
+            fprintf(stderr, "%s: unknown key \"%s\" at offset %zu\n", p->fileName, key, p->pos);
+            free(key);
+            free(value);
+            return false;
+        }
+        free(key);
+        skipSpace(p);
+        if (p->text[p->pos] == ',') {
+            p->pos++;
+            continue;
+        }
+        if (!expect(p, '}')) {
+            return false;
+        }
+        break;
+    }
+    if (!job->src || !job->dst) {
+        return parseError(p, "job needs \"src\" and \"dst\"");
+    }
+    return true;
+}
+
+static char *
+readFile(const char *fileName)
+{
+    FILE *f = fopen(fileName, "r");
+    char *text = NULL;
+    size_t len = 0, size = 0;
+
+    if (!f) {
+        return NULL;
+    }
+    for (;;) {
+        size_t rd;
+
+        if (size - len < 4096) {
+            char *newText = realloc(text, size + 65536);
+
+            if (!newText) {
+                free(text);
+                fclose(f);
+                errno = ENOMEM;
+                return NULL;
+            }
+            text = newText;
+            size += 65536;
+        }
+        rd = fread(text + len, 1, size - len - 1, f);
+        len += rd;
+        if (rd == 0) {
+            break;
+        }
+    }
+    if (ferror(f)) {
+        free(text);
+        fclose(f);
+        errno = EIO;
+        return NULL;
+    }
+    fclose(f);
+    text[len] = '\0';
+    return text;
+}
+
+void
+Jobs_Free(ConvertJob *jobs,
+          int numJobs)
+{
+    int i;
+
+    for (i = 0; i < numJobs; i++) {
+        free(jobs[i].src);
+        free(jobs[i].dst);
+        free(jobs[i].format);
+    }
+    free(jobs);
+}
+
+/* Returns the number of jobs read from fileName, or -1 on error. */
+int
+Jobs_Load(const char *fileName,
+          ConvertJob **jobs)
+{
+    JobParser p = { .fileName = fileName };
+    ConvertJob *list = NULL;
+    int numJobs = 0;
+    char *text;
+
+    text = readFile(fileName);
+    if (!text) {
+        fprintf(stderr, "Cannot read job file %s: %s\n", fileName, strerror(errno));
+        return -1;
+    }
+    p.text = text;
+    if (!expect(&p, '[')) {
+        goto fail;
+    }
+    skipSpace(&p);
+    if (p.text[p.pos] == ']') {
+        p.pos++;
+    } else {
+        for (;;) {
+            ConvertJob *newList = realloc(list, (numJobs + 1) * sizeof *list);
+
+            if (!newList) {
+                parseError(&p, "out of memory");
+                goto fail;
+            }
+            list = newList;
+            memset(&list[numJobs], 0, sizeof *list);
+            numJobs++;
+            if (!parseJob(&p, &list[numJobs - 1])) {
+                goto fail;
+            }
+            skipSpace(&p);
+            if (p.text[p.pos] == ',') {
+                p.pos++;
+                continue;
+            }
+            if (!expect(&p, ']')) {
+                goto fail;
+            }
+            break;
+        }
+    }
+    skipSpace(&p);
+    if (p.text[p.pos] != '\0') {
+        parseError(&p, "trailing data");
+        goto fail;
+    }
+    free(text);
+    *jobs = list;
+    return numJobs;
+
+fail:
+    free(text);
+    Jobs_Free(list, numJobs);
+    return -1;
+}
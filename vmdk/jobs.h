@@ -0,0 +1,29 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _JOBS_H_
+#define _JOBS_H_
+
+/* One conversion of a batch. */
+typedef struct {
+    char *src;
+    char *dst;
+    char *format;   /* NULL to pick the format by the dst extension */
+} ConvertJob;
+
+int Jobs_Load(const char *fileName, ConvertJob **jobs);
+void Jobs_Free(ConvertJob *jobs, int numJobs);
+
+#endif /* _JOBS_H_ */
@@ -0,0 +1,285 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#define _GNU_SOURCE
+
+#include "libvmdk.h"
+#include "convert.h"
+#include "ultra.h"
+
+#include <sys/sysinfo.h>
+#include <sys/time.h>
+#include <errno.h>
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+#include <zlib.h>
+
+/*
+ * A source disk.  Conversions read it through hdr, which counts the bytes
+ * read for the progress callback and fails the reads once cancelled.
+ */
+struct VmdkDisk {
+    DiskInfo hdr;
+    DiskInfo *di;
+    bool isSparse;
+    char *fileName;
+    bool cancelled;
+    pthread_mutex_t progressMutex;
+    VmdkProgressFn progress;
+    void *progressData;
+    uint64_t done;
+    uint64_t reported;
+};
+
+static pthread_once_t initOnce = PTHREAD_ONCE_INIT;
+
+static void
+init(void)
+{
+    struct timeval tv;
+
+    gettimeofday(&tv, NULL);
+    srand48(tv.tv_sec ^ tv.tv_usec);
+}
+
+static VmdkDisk *
+getDisk(DiskInfo *self)
+{
+    return (VmdkDisk *)self;
+}
+
+static off_t
+VmdkGetCapacity(DiskInfo *self)
+{
+    DiskInfo *di = getDisk(self)->di;
+
+    return di->vmt->getCapacity(di);
+}
+
+static void
+reportProgress(VmdkDisk *disk,
+               uint64_t len,
+               bool final)
+{
+    uint64_t total = VmdkGetCapacity(&disk->hdr);
+
+    pthread_mutex_lock(&disk->progressMutex);
+    disk->done += len;
+    if (final) {
+        disk->done = total;
+    }
+    /* at most once per 0.1% */
+    if (disk->progress && disk->done != disk->reported &&
+        (final || disk->done - disk->reported >= total / 1000)) {
+        disk->reported = disk->done;
+        disk->progress(disk->done, total, disk->progressData);
+    }
+    pthread_mutex_unlock(&disk->progressMutex);
+}
+
+static ssize_t
+VmdkPread(DiskInfo *self,
+          void *buf,
+          size_t len,
+          off_t pos)
+{
+    VmdkDisk *disk = getDisk(self);
+    ssize_t ret;
+
+    if (__atomic_load_n(&disk->cancelled, __ATOMIC_RELAXED)) {
+        errno = ECANCELED;
+        return -1;
+    }
+    ret = disk->di->vmt->pread(disk->di, buf, len, pos);
+    if (ret > 0) {
+        reportProgress(disk, ret, false);
+    }
+    return ret;
+}
+
+static int
+VmdkNextData(DiskInfo *self,
+             off_t *pos,
+             off_t *end)
+{
+    DiskInfo *di = getDisk(self)->di;
+
+    return di->vmt->nextData(di, pos, end);
+}
+
+static DiskInfoVMT vmdkDiskVMT = {
+    .getCapacity = VmdkGetCapacity,
+    .pread = VmdkPread,
+    .pwrite = NULL,
+    .nextData = VmdkNextData,
+    .close = NULL,
+    .abort = NULL,
+    .copyDisk = NULL,
+    .checkGrainOrder = NULL
+};
+
+VmdkDisk *
+Vmdk_Open(const char *fileName)
+{
+    VmdkDisk *disk;
+
+    pthread_once(&initOnce, init);
+    disk = calloc(1, sizeof *disk);
+    if (disk == NULL) {
+        return NULL;
+    }
+    disk->hdr.vmt = &vmdkDiskVMT;
+    disk->fileName = strdup(fileName);
+    if (disk->fileName == NULL) {
+        free(disk);
+        return NULL;
+    }
+    disk->di = Convert_OpenSource(fileName, &disk->isSparse);
+    if (disk->di == NULL) {
+        free(disk->fileName);
+        free(disk);
+        return NULL;
+    }
+    pthread_mutex_init(&disk->progressMutex, NULL);
+    return disk;
+}
+
+uint64_t
+Vmdk_GetCapacity(VmdkDisk *disk)
+{
+    return VmdkGetCapacity(&disk->hdr);
+}
+
+char *
+Vmdk_Info(VmdkDisk *disk,
+          int detailed)
+{
+    return Convert_Info(disk->di, disk->isSparse, detailed);
+}
+
+static int
+convert(VmdkDisk *disk,
+        const char *fileName,
+        off_t offset,
+        TargetFormat targetFormat,
+        int compressionLevel,
+        int numThreads,
+        int sectorSize,
+        VmdkProgressFn progress,
+        void *data)
+{
+    ConvertOptions opts = { 0 };
+    DiskInfo *dst;
+
+    if (compressionLevel < 0 || compressionLevel > COMPRESSION_LEVEL_ULTRA || numThreads < 0 || sectorSize < 0) {
+        errno = EINVAL;
+        return -1;
+    }
+    opts.compressionLevel = compressionLevel ? compressionLevel : Z_BEST_COMPRESSION;
+    opts.doReorder = true;
+    opts.sectorSize = sectorSize;
+    opts.offset = offset;
+
+    pthread_mutex_lock(&disk->progressMutex);
+    disk->progress = progress;
+    disk->progressData = data;
+    disk->done = 0;
+    disk->reported = 0;
+    pthread_mutex_unlock(&disk->progressMutex);
+
+    dst = Convert_CreateTarget(disk->fileName, fileName, targetFormat, Vmdk_GetCapacity(disk), &opts);
+    if (dst == NULL) {
+        return -1;
+    }
+    if (!Convert_CopyDisk(&disk->hdr, dst, numThreads ? numThreads : get_nprocs())) {
+        int err = __atomic_load_n(&disk->cancelled, __ATOMIC_RELAXED) ? ECANCELED : errno ? errno : EIO;
+
+        if (offset != 0) {
+            truncate(fileName, offset);
+        } else {
+            unlink(fileName);
+        }
+        errno = err;
+        return -1;
+    }
+    /* holes of raw images are skipped */
+    reportProgress(disk, 0, true);
+    return 0;
+}
+
+int
+Vmdk_Convert(VmdkDisk *disk,
+             const char *fileName,
+             const char *format,
+             int compressionLevel,
+             int numThreads,
+             int sectorSize,
+             VmdkProgressFn progress,
+             void *data)
+{
+    TargetFormat targetFormat = TARGET_DEFAULT;
+
+    if (format) {
+        targetFormat = Convert_ParseFormat(format);
+        if (targetFormat == TARGET_DEFAULT) {
+            errno = EINVAL;
+            return -1;
+        }
+    }
+    return convert(disk, fileName, 0, targetFormat, compressionLevel, numThreads, sectorSize, progress, data);
+}
+
+int
+Vmdk_ConvertAt(VmdkDisk *disk,
+               const char *fileName,
+               uint64_t offset,
+               int compressionLevel,
+               int numThreads,
+               int sectorSize,
+               VmdkProgressFn progress,
+               void *data)
+{
+    if (offset == 0 || offset % 512 != 0) {
+        errno = EINVAL;
+        return -1;
+    }
+    return convert(disk, fileName, offset, TARGET_STREAM_OPTIMIZED, compressionLevel, numThreads, sectorSize,
+                   progress, data);
+}
+
+void
+Vmdk_Cancel(VmdkDisk *disk)
+{
+    __atomic_store_n(&disk->cancelled, true, __ATOMIC_RELAXED);
+}
+
+void
+Vmdk_Close(VmdkDisk *disk)
+{
+    if (disk == NULL) {
+        return;
+    }
+    disk->di->vmt->close(disk->di);
+    pthread_mutex_destroy(&disk->progressMutex);
+    free(disk->fileName);
+    free(disk);
+}
+
+void
+Vmdk_Free(void *ptr)
+{
+    free(ptr);
+}
@@ -0,0 +1,83 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+/*
+ * The stable interface of libvmdk.so.1, for programs that open, inspect and
+ * convert virtual disks without running vmdk-convert.  Functions returning
+ * int return 0 on success and -1 with errno set on failure.
+ */
+
+#ifndef _LIBVMDK_H_
+#define _LIBVMDK_H_
+
+#include <stdint.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+typedef struct VmdkDisk VmdkDisk;
+
+/*
+ * Called during a conversion with the bytes of the source read so far.
+ * Calls are serialized, but may come from any thread of the conversion.
+ */
+typedef void (*VmdkProgressFn)(uint64_t done, uint64_t total, void *data);
+
+/* Opens a sparse VMDK, qcow2, VHD or VHDX, or a raw image. */
+VmdkDisk *Vmdk_Open(const char *fileName);
+
+uint64_t Vmdk_GetCapacity(VmdkDisk *disk);
+
+/*
+ * Returns the output of vmdk-convert -i [--detailed] as a JSON string,
+ * to be freed with Vmdk_Free().
+ */
+char *Vmdk_Info(VmdkDisk *disk, int detailed);
+
+/*
+ * Converts disk to fileName.  format is one of streamOptimized,
+ * monolithicSparse, qcow2 or raw, or NULL to pick it by the file
+ * extension like vmdk-convert.  compressionLevel is 1-9, or 10 for --ultra.
+ * 0 selects the defaults of compressionLevel (9), numThreads (all CPUs)
+ * and sectorSize (none written).  A failed or cancelled conversion removes
+ * fileName.
+ */
+int Vmdk_Convert(VmdkDisk *disk, const char *fileName, const char *format, int compressionLevel, int numThreads,
+                 int sectorSize, VmdkProgressFn progress, void *data);
+
+/*
+ * Like Vmdk_Convert with format streamOptimized, but the disk is written
+ * into the existing file fileName at offset, a multiple of 512, for
+ * example as a member of a tar archive.  A failed or cancelled conversion
+ * truncates fileName to offset.
+ */
+int Vmdk_ConvertAt(VmdkDisk *disk, const char *fileName, uint64_t offset, int compressionLevel, int numThreads,
+                   int sectorSize, VmdkProgressFn progress, void *data);
+
+/*
+ * Makes the running and any later conversion of disk fail with ECANCELED.
+ * Can be called from any thread.
+ */
+void Vmdk_Cancel(VmdkDisk *disk);
+
+void Vmdk_Close(VmdkDisk *disk);
+void Vmdk_Free(void *ptr);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* _LIBVMDK_H_ */
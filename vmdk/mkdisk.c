@@ -15,7 +15,14 @@
 
 #define _GNU_SOURCE
 
+#include "analyze.h"
+#include "convert.h"
 #include "diskinfo.h"
+#include "estimate.h"
+#include "graincache.h"
+#include "jobs.h"
+#include "ratelimit.h"
+#include "ultra.h"
 #include "vmware_vmdk.h"
 
 #include <sys/sysinfo.h>
@@ -27,81 +34,110 @@
 #include <getopt.h>
 #include <zlib.h>
 #include <ctype.h>
+#include <math.h>
 
-/* toolsVersion in metadata -
-   default is 2^31-1 (unknown) */
-char *toolsVersion = "2147483647";
-
-// Forward declaration for sparse disk structure
-typedef struct {
-    DiskInfo hdr;
-    bool hasFooter;
-    SparseExtentHeader diskHdr;
-    // We don't need the full structure, just the header
-} SparseDiskInfo;
-
+/*
+ * Converts all jobs in one process.  Grains of all streamOptimized
+ * destinations are compressed by one shared pool of numThreads threads,
+ * other formats are converted one after the other afterwards.
+ */
 static int
-copyData(DiskInfo *dst,
-         off_t dstOffset,
-         DiskInfo *src,
-         off_t srcOffset,
-         uint64_t length)
+convertBatch(ConvertJob *jobs,
+             int numJobs,
+             TargetFormat defaultFormat,
+             const ConvertOptions *opts,
+             int numThreads)
 {
-    char buf[65536];
-
-    while (length > 0) {
-        size_t readLen;
+    DiskInfo **srcs = calloc(numJobs, sizeof *srcs);
+    DiskInfo **dsts = calloc(numJobs, sizeof *dsts);
+    DiskInfo **poolSrcs = calloc(numJobs, sizeof *poolSrcs);
+    DiskInfo **poolDsts = calloc(numJobs, sizeof *poolDsts);
+    bool *poolResults = calloc(numJobs, sizeof *poolResults);
+    bool *inPool = calloc(numJobs, sizeof *inPool);
+    bool *results = calloc(numJobs, sizeof *results);
+    int numPool = 0;
+    int failed = 0;
+    int i;
+
+    if (!srcs || !dsts || !poolSrcs || !poolDsts || !poolResults || !inPool || !results) {
+        fprintf(stderr, "Out of memory\n");
+        exit(1);
+    }
 
-        readLen = sizeof buf;
-        if (length < readLen) {
-            readLen = length;
-            length = 0;
-        } else {
-            length -= readLen;
+    printf("Starting to convert %d disks using compression level %d%s and %d threads\n", numJobs, opts->compressionLevel,
+           opts->compressionLevel == COMPRESSION_LEVEL_ULTRA ? " (ultra)" : "", numThreads);
+    for (i = 0; i < numJobs; i++) {
+        TargetFormat targetFormat = defaultFormat;
+        bool isSparse;
+
+        if (jobs[i].format) {
+            targetFormat = Convert_ParseFormat(jobs[i].format);
+            if (targetFormat == TARGET_DEFAULT) {
+                fprintf(stderr, "invalid format for %s: %s\n", jobs[i].dst, jobs[i].format);
+                continue;
+            }
         }
-        if (src->vmt->pread(src, buf, readLen, srcOffset) != (ssize_t)readLen) {
-            return -1;
+        if (targetFormat == TARGET_DEFAULT) {
+            targetFormat = Convert_GetFormat(jobs[i].dst);
         }
-        if (dst->vmt->pwrite(dst, buf, readLen, dstOffset) != (ssize_t)readLen) {
-            return -1;
+        srcs[i] = Convert_OpenSource(jobs[i].src, &isSparse);
+        if (srcs[i] == NULL) {
+            fprintf(stderr, "Cannot open source disk %s: %s\n", jobs[i].src, strerror(errno));
+            continue;
         }
-        srcOffset += readLen;
-        dstOffset += readLen;
-    }
-    return 0;
-}
-
-static bool
-copyDisk(DiskInfo *src, DiskInfo *dst, int numThreads)
-{
-    if (dst->vmt->copyDisk) {
-        ssize_t ret;
-
-        ret = dst->vmt->copyDisk(src, dst, numThreads);
-        if (ret < 0) {
-            return false;
+        dsts[i] = Convert_CreateTarget(jobs[i].src, jobs[i].dst, targetFormat,
+                                   srcs[i]->vmt->getCapacity(srcs[i]), opts);
+        if (dsts[i] == NULL) {
+            fprintf(stderr, "Cannot open target disk %s: %s\n", jobs[i].dst, strerror(errno));
+            continue;
         }
-    } else {
-        off_t end = 0;
-        off_t pos;
+        if (targetFormat == TARGET_STREAM_OPTIMIZED) {
+            inPool[i] = true;
+            poolSrcs[numPool] = srcs[i];
+            poolDsts[numPool] = dsts[i];
+            numPool++;
+        }
+    }
 
-        while (src->vmt->nextData(src, &pos, &end) == 0) {
-            if (copyData(dst, pos, src, pos, end - pos)) {
-                goto failAll;
+    if (numPool > 0) {
+        StreamOptimized_CopyDisks(poolSrcs, poolDsts, numPool, numThreads, poolResults);
+    }
+    numPool = 0;
+    for (i = 0; i < numJobs; i++) {
+        if (dsts[i] == NULL) {
+            results[i] = false;
+        } else if (inPool[i]) {
+            if (poolResults[numPool]) {
+                results[i] = dsts[i]->vmt->close(dsts[i]) == 0;
+            } else {
+                dsts[i]->vmt->abort(dsts[i]);
+                results[i] = false;
             }
+            numPool++;
+        } else {
+            results[i] = Convert_CopyDisk(srcs[i], dsts[i], numThreads);
         }
-        if (errno != ENXIO) {
-            goto failAll;
+        if (srcs[i]) {
+            srcs[i]->vmt->close(srcs[i]);
         }
     }
-    if (dst->vmt->close(dst)) {
-        return false;
+
+    for (i = 0; i < numJobs; i++) {
+        printf("%s: %s -> %s\n", results[i] ? "Success" : "Failure", jobs[i].src, jobs[i].dst);
+        failed += !results[i];
+    }
+    if (failed) {
+        fprintf(stderr, "Failure! %d of %d disks failed\n", failed, numJobs);
     }
-    return true;
 
-failAll:
-    dst->vmt->abort(dst);
-    return false;
+    free(srcs);
+    free(dsts);
+    free(poolSrcs);
+    free(poolDsts);
+    free(poolResults);
+    free(inPool);
+    free(results);
+    return failed ? 1 : 0;
 }
 
 /* Displays the usage message. */
@@ -111,13 +147,39 @@ printUsage(char *cmd, int compressionLevel, int numThreads, int sectorSize)
     printf("Usage:\n");
     printf("%s -i [--detailed] src.vmdk: displays information for specified virtual disk\n", cmd);
     printf("%s --get-descriptor src.vmdk: prints the descriptor file content to stdout\n", cmd);
-    printf("%s [-c compressionlevel] [-n threads] [-t toolsVersion] [--noreorder] [-s size] src.vmdk dst.vmdk: converts source disk to destination disk with given tools version\n\n", cmd);
+    printf("%s --estimate [-c compressionlevel] [-n threads] [--samples n] src.vmdk: estimates size and time of a conversion to streamOptimized from a sample of grains\n", cmd);
+    printf("%s --analyze [--heatmap prefix] src.vmdk: attributes the file size of a sparse VMDK to disk regions and partitions, as JSON\n", cmd);
+    printf("%s --diff [-n threads] a.vmdk b.vmdk: lists the ranges where the content of two sparse VMDKs differs, as JSON\n", cmd);
+    printf("%s --verify [-n threads] [--digest digest] src.vmdk: checks all grains of a sparse VMDK and prints a JSON report\n", cmd);
+    printf("%s [-c compressionlevel] [-n threads] [-t toolsVersion] [--noreorder] [-s size] [--format fmt] [--compress] [--checkpoint MB] [--resume] [--content-digest] src.vmdk dst.vmdk: converts source disk to destination disk with given tools version\n", cmd);
+    printf("%s [options] --batch src1 dst1 [src2 dst2 ...]: converts several disks sharing one pool of threads\n", cmd);
+    printf("%s [options] --job-file jobs.json: same, jobs are read from a JSON array of {\"src\": ..., \"dst\": ..., \"format\": ...}\n", cmd);
+    printf("Source disks can be VMDK, qcow2, VHD, VHDX or raw images.\n");
+    printf("The destination is a streamOptimized VMDK for .vmdk, qcow2 for .qcow2 and a raw image otherwise.\n\n");
     printf("-c <level> sets the compression level. Valid values are 1 (fastest) to 9 (best). Only when writing to VMDK. Current is %d.\n", compressionLevel);
     printf("-n <threads> sets the number of threads used for compression level. Only when writing to VMDK. Current is %d.\n", numThreads);
     printf("-s, --sector-size <size> sets the sector size which will be written to the descriptor file unless it is 0. Current is %d.\n", sectorSize);
+    printf("--format <fmt> sets the destination format regardless of the file extension: streamOptimized, monolithicSparse, qcow2 or raw\n");
+    printf("--ultra compresses each grain with several encoders and keeps the smallest result, much slower than -c 9\n");
+    printf("--compress writes compressed clusters with the -c level (only for qcow2, default: uncompressed)\n");
+    printf("--grain-cache <dir> reuses compressed grains from earlier conversions stored in dir (only for streamOptimized)\n");
+    printf("--grain-cache-size <MB> sets the size of the grain cache, least recently used grains are removed (default: 4096)\n");
+    printf("--read-limit <MB/s> limits the bandwidth used to read the source and temporary files\n");
+    printf("--write-limit <MB/s> limits the bandwidth used to write the destination\n");
+    printf("--cpu-share <percent> limits the CPU time used for compression, in percent of one CPU\n");
+    printf("--limit-file <file> reads limits from file, lines read-limit=<MB/s>, write-limit=<MB/s>, cpu-share=<percent>,\n"
+           "    read again on SIGHUP or when the file changes, 0 removes a limit\n");
+    printf("--heatmap <prefix> writes the analysis to prefix.json and a heatmap to prefix.html, with --analyze or for the converted VMDK\n");
+    printf("--checkpoint <MB> records progress in dst.vmdk.checkpoint every <MB> megabytes of the source (only for streamOptimized)\n");
+    printf("--resume continues an interrupted conversion from dst.vmdk.checkpoint\n");
+    printf("--content-digest records a digest of the disk content as ddb.contentDigest (only for streamOptimized)\n");
     printf("--detailed shows detailed sparse extent header information (only with -i)\n");
     printf("--get-descriptor prints the descriptor file content to stdout\n");
+    printf("--samples <n> sets the number of grains compressed by --estimate (default: 1000)\n");
+    printf("--digest <digest> checks the content against digest (only with --verify, default: the digest in the descriptor)\n");
     printf("--noreorder disables grain reordering after compression (default: reordering enabled)\n");
+    printf("--offset <bytes> writes the streamOptimized disk into the existing file dst at offset, a multiple of 512,\n"
+           "    for example as a member of a tar archive\n");
 
     return 1;
 }
@@ -143,126 +205,205 @@ isNumber(const char *text)
     return true;
 }
 
-/* Parse the descriptor file and return a JSON string with the key-value pairs */
-static char *
-parseDescriptorFile(const char *descriptor)
+/*
+ * Checks a sparse VMDK and prints the result as JSON.  The content digest
+ * is checked against expectedDigest, or the one recorded in the
+ * descriptor if that is NULL.  Returns the exit status.
+ */
+static int
+verifyDisk(DiskInfo *di,
+           int numThreads,
+           const char *expectedDigest)
 {
-    char *result = NULL;
-    char *line, *saveptr1 = NULL;
-    char *descriptor_copy = NULL;
-    size_t result_size = 0;
-    size_t result_capacity = 1024; // Initial capacity
-    bool first_entry = true;
-
-    if (!descriptor) {
-        return NULL;
-    }
-
-    // Allocate memory for the result
-    result = malloc(result_capacity);
-    if (!result) {
-        return NULL;
-    }
-
-    // Initialize the result string with opening brace
-    strcpy(result, "{}");
-    result_size = 2;
-
-    // Make a copy of the descriptor to avoid modifying the original
-    descriptor_copy = strdup(descriptor);
-    if (!descriptor_copy) {
-        free(result);
-        return NULL;
-    }
-
-    // Parse each line of the descriptor
-    line = strtok_r(descriptor_copy, "\n", &saveptr1);
-    while (line != NULL) {
-        // Skip comments and empty lines
-        if (line[0] != '#' && strlen(line) > 0) {
-            char *key = NULL;
-            char *value = NULL;
-
-            // Find the equals sign
-            char *equals = strchr(line, '=');
-            if (equals) {
-                // Split the line into key and value
-                *equals = '\0';
-                key = line;
-                value = equals + 1;
-
-                // Trim whitespace from key and value
-                while (*key && isspace(*key)) key++;
-                while (*value && isspace(*value)) value++;
-
-                // Remove trailing whitespace from key
-                char *end = key + strlen(key) - 1;
-                while (end > key && isspace(*end)) {
-                    *end = '\0';
-                    end--;
-                }
+    VerifyReport report;
+    char *recordedDigest = NULL;
+    bool digestMatch = true;
+    uint64_t i;
+
+    if (!expectedDigest && di->vmt->getDescriptor && di->vmt->getDescriptor(di)) {
+        recordedDigest = Convert_GetDescriptorValue(di->vmt->getDescriptor(di), "ddb.contentDigest");
+        expectedDigest = recordedDigest;
+    }
+    if (!Sparse_Verify(di, numThreads, expectedDigest != NULL, &report)) {
+        fprintf(stderr, "Failed to verify disk: %s\n", strerror(errno));
+        free(recordedDigest);
+        return 1;
+    }
 
-                // Remove trailing whitespace from value
-                end = value + strlen(value) - 1;
-                while (end > value && isspace(*end)) {
-                    *end = '\0';
-                    end--;
-                }
+    printf("{ \"capacity\": %llu, \"grains\": %llu, \"allocatedGrains\": %llu, \"zeroGrains\": %llu",
+           (unsigned long long)di->vmt->getCapacity(di), (unsigned long long)report.grains,
+           (unsigned long long)report.allocatedGrains, (unsigned long long)report.zeroGrains);
+    printf(", \"hasFooter\": %s, \"hasEOS\": %s, \"grainsOrdered\": %s",
+           report.hasFooter ? "true" : "false", report.hasEOS ? "true" : "false",
+           report.grainsOrdered ? "true" : "false");
+    if (expectedDigest) {
+        digestMatch = strcmp(expectedDigest, report.contentDigest) == 0;
+        printf(", \"contentDigest\": { \"expected\": \"%s\", \"computed\": \"%s\", \"match\": %s }",
+               expectedDigest, report.contentDigest, digestMatch ? "true" : "false");
+    }
+    printf(", \"numErrors\": %llu, \"errors\": [", (unsigned long long)report.numErrors);
+    for (i = 0; i < report.numErrors && i < VERIFY_MAX_ERRORS; i++) {
+        printf("%s\"%s\"", i ? ", " : "", report.errors[i]);
+    }
+    printf("], \"valid\": %s }\n", report.numErrors == 0 && digestMatch ? "true" : "false");
 
-                // Remove quotes from value if present
-                if (*value == '"' && value[strlen(value) - 1] == '"') {
-                    value[strlen(value) - 1] = '\0';
-                    value++;
-                }
+    free(recordedDigest);
+    return report.numErrors == 0 && digestMatch ? 0 : 1;
+}
 
-                // Add the key-value pair to the result
-                if (strlen(key) > 0) {
-                    // Calculate the required space for this entry
-                    size_t entry_size = strlen(key) + strlen(value) + 10; // 10 for quotes, colon, comma, etc.
-
-                    // Ensure we have enough space
-                    if (result_size + entry_size > result_capacity) {
-                        result_capacity *= 2;
-                        char *new_result = realloc(result, result_capacity);
-                        if (!new_result) {
-                            free(result);
-                            free(descriptor_copy);
-                            return NULL;
-                        }
-                        result = new_result;
-                    }
+static bool
+hasSuffix(const char *text, const char *suffix)
+{
+    size_t len = strlen(text);
+    size_t suffixLen = strlen(suffix);
 
-                    // Insert before the closing brace
-                    result[result_size - 1] = '\0'; // Remove closing brace
+    return len >= suffixLen && strcmp(text + len - suffixLen, suffix) == 0;
+}
 
-                    // Add comma if not the first entry
-                    if (!first_entry) {
-                        strcat(result, ", ");
-                        result_size += 2;
-                    } else {
-                        first_entry = false;
-                    }
+static bool
+writeAnalysis(const char *fileName,
+              const AnalyzeReport *report,
+              const char *diskName)
+{
+    FILE *f = fopen(fileName, "w");
+    char title[256];
 
-                    // Add the key-value pair
-                    strcat(result, "\"");
-                    strcat(result, key);
-                    strcat(result, "\": \"");
-                    strcat(result, value);
-                    strcat(result, "\"");
-                    strcat(result, "}");
+    if (f != NULL) {
+        if (hasSuffix(fileName, ".html")) {
+            snprintf(title, sizeof title, "Compression heatmap of %s", diskName);
+            Analyze_PrintHTML(f, report, title);
+        } else {
+            Analyze_PrintJSON(f, report);
+        }
+        if (fclose(f) == 0) {
+            return true;
+        }
+    }
+    fprintf(stderr, "Cannot write %s: %s\n", fileName, strerror(errno));
+    return false;
+}
 
-                    // Update result_size
-                    result_size = strlen(result);
-                }
-            }
+/*
+ * Attributes the file size of a sparse disk to regions and partitions.
+ * The report is printed as JSON if toStdout is set, and written to
+ * <heatmap>.json and <heatmap>.html if heatmap is not NULL.
+ */
+static int
+analyzeDisk(DiskInfo *di,
+            const char *name,
+            bool toStdout,
+            const char *heatmap)
+{
+    AnalyzeReport report;
+    bool success = true;
+
+    if (!Analyze_Disk(di, &report)) {
+        fprintf(stderr, "Failed to analyze disk: %s\n", strerror(errno));
+        return 1;
+    }
+    if (toStdout) {
+        Analyze_PrintJSON(stdout, &report);
+    }
+    if (heatmap) {
+        size_t len = strlen(heatmap) + sizeof ".html";
+        char *fileName = malloc(len);
+
+        if (!fileName) {
+            success = false;
+        } else {
+            snprintf(fileName, len, "%s.json", heatmap);
+            success = writeAnalysis(fileName, &report, name);
+            snprintf(fileName, len, "%s.html", heatmap);
+            success = success && writeAnalysis(fileName, &report, name);
+            free(fileName);
         }
+    }
+    Analyze_Free(&report);
+    return success ? 0 : 1;
+}
 
-        // Get the next line
-        line = strtok_r(NULL, "\n", &saveptr1);
+/*
+ * Compares two sparse disks and prints the changed ranges as JSON.
+ * Returns 0 if the content is the same.
+ */
+static int
+diffDisks(DiskInfo *a,
+          DiskInfo *b,
+          int numThreads)
+{
+    DiffReport report;
+    uint64_t i;
+
+    if (!Sparse_Diff(a, b, numThreads, &report)) {
+        if (errno == EINVAL) {
+            fprintf(stderr, "Cannot compare disks with different grain sizes\n");
+        } else {
+            fprintf(stderr, "Failed to compare disks: %s\n", strerror(errno));
+        }
+        return 1;
     }
 
-    free(descriptor_copy);
-    return result;
+    printf("{ \"capacity\": [%llu, %llu], \"grainSize\": %llu, \"grains\": %llu",
+           (unsigned long long)a->vmt->getCapacity(a), (unsigned long long)b->vmt->getCapacity(b),
+           (unsigned long long)report.grainSize, (unsigned long long)report.grains);
+    printf(", \"sameByTable\": %llu, \"sameByPayload\": %llu, \"sameByContent\": %llu",
+           (unsigned long long)report.sameByTable, (unsigned long long)report.sameByPayload,
+           (unsigned long long)report.sameByContent);
+    printf(", \"changedGrains\": %llu, \"changedBytes\": %llu, \"size\": [%llu, %llu], \"extents\": [",
+           (unsigned long long)report.changedGrains, (unsigned long long)report.changedBytes,
+           (unsigned long long)report.sizeA, (unsigned long long)report.sizeB);
+    for (i = 0; i < report.numExtents; i++) {
+        printf("%s{ \"start\": %llu, \"length\": %llu, \"size\": [%llu, %llu] }", i ? ", " : "",
+               (unsigned long long)report.extents[i].start, (unsigned long long)report.extents[i].length,
+               (unsigned long long)report.extents[i].sizeA, (unsigned long long)report.extents[i].sizeB);
+    }
+    printf("], \"identical\": %s }\n", report.changedGrains == 0 ? "true" : "false");
+
+    free(report.extents);
+    return report.changedGrains == 0 ? 0 : 1;
+}
+
+static void
+printEstimate(const char *name,
+              const Estimate *e,
+              int decimals)
+{
+    printf("\"%s\": { \"value\": %.*f, \"low\": %.*f, \"high\": ", name, decimals, e->value, decimals, e->low);
+    if (isinf(e->high)) {
+        printf("null }");
+    } else {
+        printf("%.*f }", decimals, e->high);
+    }
+}
+
+/* Estimates the streamOptimized conversion of di and prints it as JSON. */
+static int
+estimateDisk(DiskInfo *di,
+             int compressionLevel,
+             int numThreads,
+             int numSamples)
+{
+    EstimateReport report;
+    int i;
+
+    if (!Estimate_StreamOptimized(di, compressionLevel, numThreads, numSamples, &report)) {
+        fprintf(stderr, "Failed to estimate compression: %s\n", strerror(errno));
+        return 1;
+    }
+    printf("{ \"capacity\": %llu, \"populatedGrains\": %llu, \"sampledGrains\": %llu, "
+           "\"compressionLevel\": %d, \"confidence\": 0.95, ",
+           (unsigned long long)report.capacity, (unsigned long long)report.populatedGrains,
+           (unsigned long long)report.sampledGrains, compressionLevel);
+    printEstimate("projectedSize", &report.size, 0);
+    printf(", ");
+    printEstimate("compressionRatio", &report.ratio, 2);
+    printf(", \"wallTime\": [");
+    for (i = 0; i < report.numThreadCounts; i++) {
+        printf("%s{ \"threads\": %d, \"seconds\": %.2f, \"low\": %.2f, \"high\": %.2f }", i ? ", " : "",
+               report.threadCounts[i], report.seconds[i].value, report.seconds[i].low, report.seconds[i].high);
+    }
+    printf("] }\n");
+    return 0;
 }
 
 int
@@ -278,17 +419,59 @@ main(int argc,
     bool doConvert = false;
     bool doReorder = true;  // Default to true for backward compatibility
     bool doGetDescriptor = false;
+    bool doCompress = false;
+    bool doResume = false;
+    bool doContentDigest = false;
+    bool doBatch = false;
+    bool doVerify = false;
+    bool doDiff = false;
+    bool doAnalyze = false;
+    const char *heatmap = NULL;
+    bool doEstimate = false;
+    bool doUltra = false;
+    const char *grainCacheDir = NULL;
+    const char *limitFile = NULL;
+    uint64_t grainCacheSize = 4096ULL * 1024 * 1024;
+    int numSamples = 1000;
+    const char *expectedDigest = NULL;
+    const char *jobFile = NULL;
+    uint64_t checkpointInterval = 0;
+    off_t targetOffset = 0;
+    TargetFormat targetFormat = TARGET_DEFAULT;
+    ConvertOptions opts;
     int compressionLevel = Z_BEST_COMPRESSION;
     int numThreads = get_nprocs();
     int sectorSize = 0;
     const char *env;
 
     static struct option long_options[] = {
+        {"analyze", no_argument, 0, 'A'},
+        {"batch", no_argument, 0, 'b'},
+        {"checkpoint", required_argument, 0, 'k'},
+        {"compress", no_argument, 0, 'z'},
+        {"content-digest", no_argument, 0, 'C'},
+        {"cpu-share", required_argument, 0, 'P'},
         {"detailed", no_argument, 0, 'd'},
+        {"diff", no_argument, 0, 'F'},
+        {"digest", required_argument, 0, 'D'},
+        {"estimate", no_argument, 0, 'E'},
+        {"format", required_argument, 0, 'f'},
         {"get-descriptor", no_argument, 0, 'g'},
+        {"grain-cache", required_argument, 0, 'G'},
+        {"grain-cache-size", required_argument, 0, 'M'},
+        {"heatmap", required_argument, 0, 'H'},
         {"help", no_argument, 0, 'h'},
+        {"job-file", required_argument, 0, 'j'},
+        {"limit-file", required_argument, 0, 'L'},
         {"noreorder", no_argument, 0, 'r'},
+        {"offset", required_argument, 0, 'o'},
+        {"read-limit", required_argument, 0, 'I'},
+        {"resume", no_argument, 0, 'R'},
+        {"samples", required_argument, 0, 'S'},
         {"sector-size", required_argument, 0, 's'},
+        {"ultra", no_argument, 0, 'U'},
+        {"verify", no_argument, 0, 'V'},
+        {"write-limit", required_argument, 0, 'O'},
         {0, 0, 0, 0}
     };
 
@@ -313,6 +496,12 @@ main(int argc,
 
     while ((opt = getopt_long(argc, argv, "c:hin:s:t:", long_options, NULL)) != -1) {
         switch (opt) {
+        case 'b':
+            doBatch = true;
+            break;
+        case 'j':
+            jobFile = optarg;
+            break;
         case 'c':
             if (!isNumber(optarg)){
                 fprintf(stderr, "invalid compression level: %s\n", optarg);
@@ -326,6 +515,30 @@ main(int argc,
         case 'd':
             doDetailed = true;
             break;
+        case 'E':
+            doEstimate = true;
+            break;
+        case 'S':
+            if (!isNumber(optarg) || atoi(optarg) <= 0) {
+                fprintf(stderr, "invalid number of samples: %s\n", optarg);
+                exit(1);
+            }
+            numSamples = atoi(optarg);
+            break;
+        case 'D':
+            if (strpbrk(optarg, "\"\\") != NULL) {
+                fprintf(stderr, "invalid digest: %s\n", optarg);
+                exit(1);
+            }
+            expectedDigest = optarg;
+            break;
+        case 'f':
+            targetFormat = Convert_ParseFormat(optarg);
+            if (targetFormat == TARGET_DEFAULT) {
+                fprintf(stderr, "invalid format: %s\n", optarg);
+                exit(1);
+            }
+            break;
         case 'g':
             doGetDescriptor = true;
             break;
@@ -336,9 +549,29 @@ main(int argc,
             }
             numThreads = atoi(optarg);
             break;
+        case 'k':
+            if (!isNumber(optarg) || atoll(optarg) <= 0) {
+                fprintf(stderr, "invalid checkpoint interval: %s\n", optarg);
+                exit(1);
+            }
+            checkpointInterval = (uint64_t)atoll(optarg) * 1024 * 1024;
+            break;
         case 'r':
             doReorder = false;
             break;
+        case 'o':
+            if (!isNumber(optarg) || atoll(optarg) <= 0 || atoll(optarg) % 512 != 0) {
+                fprintf(stderr, "invalid offset: %s\n", optarg);
+                exit(1);
+            }
+            targetOffset = atoll(optarg);
+            break;
+        case 'R':
+            doResume = true;
+            break;
+        case 'C':
+            doContentDigest = true;
+            break;
         case 's':
             if (!isNumber(optarg)) {
                 fprintf(stderr, "invalid sector-size value: %s\n", optarg);
@@ -346,6 +579,52 @@ main(int argc,
             }
             sectorSize = atoi(optarg);
             break;
+        case 'I':
+        case 'O':
+            if (!isNumber(optarg) || atoll(optarg) <= 0) {
+                fprintf(stderr, "invalid rate limit: %s\n", optarg);
+                exit(1);
+            }
+            RateLimit_Set(opt == 'I' ? RATE_LIMIT_READ : RATE_LIMIT_WRITE, atoll(optarg) * 1024.0 * 1024.0);
+            break;
+        case 'P':
+            if (!isNumber(optarg) || atoi(optarg) <= 0) {
+                fprintf(stderr, "invalid CPU share: %s\n", optarg);
+                exit(1);
+            }
+            RateLimit_Set(RATE_LIMIT_CPU, atoi(optarg) / 100.0);
+            break;
+        case 'L':
+            limitFile = optarg;
+            break;
+        case 'G':
+            grainCacheDir = optarg;
+            break;
+        case 'M':
+            if (!isNumber(optarg) || atoll(optarg) <= 0) {
+                fprintf(stderr, "invalid grain cache size: %s\n", optarg);
+                exit(1);
+            }
+            grainCacheSize = (uint64_t)atoll(optarg) * 1024 * 1024;
+            break;
+        case 'U':
+            doUltra = true;
+            break;
+        case 'V':
+            doVerify = true;
+            break;
+        case 'F':
+            doDiff = true;
+            break;
+        case 'A':
+            doAnalyze = true;
+            break;
+        case 'H':
+            heatmap = optarg;
+            break;
+        case 'z':
+            doCompress = true;
+            break;
         case 't':
             doConvert = true;
             toolsVersion = optarg;
@@ -370,6 +649,9 @@ main(int argc,
         fprintf(stderr, "compression level must be >= 0 and <= 9: %d\n", compressionLevel);
         exit(1);
     }
+    if (doUltra) {
+        compressionLevel = COMPRESSION_LEVEL_ULTRA;
+    }
 
     if ((doInfo && doConvert) || (doInfo && doGetDescriptor) || (doConvert && doGetDescriptor)) {
         fprintf(stderr, "Error: -i, --get-descriptor and -t options are mutually exclusive\n");
@@ -382,23 +664,168 @@ main(int argc,
         exit(1);
     }
 
+    if (doVerify && (doInfo || doConvert || doGetDescriptor || doBatch || jobFile)) {
+        fprintf(stderr, "Error: --verify cannot be combined with -i, -t, --get-descriptor, --batch or --job-file\n");
+        exit(1);
+    }
+
+    if (doEstimate && (doVerify || doInfo || doConvert || doGetDescriptor || doBatch || jobFile)) {
+        fprintf(stderr, "Error: --estimate cannot be combined with --verify, -i, -t, --get-descriptor, --batch or --job-file\n");
+        exit(1);
+    }
+
+    if (doDiff && (doEstimate || doVerify || doInfo || doConvert || doGetDescriptor || doBatch || jobFile)) {
+        fprintf(stderr, "Error: --diff cannot be combined with --estimate, --verify, -i, -t, --get-descriptor, --batch or --job-file\n");
+        exit(1);
+    }
+
+    if (doAnalyze && (doDiff || doEstimate || doVerify || doInfo || doConvert || doGetDescriptor || doBatch || jobFile)) {
+        fprintf(stderr, "Error: --analyze cannot be combined with --diff, --estimate, --verify, -i, -t, --get-descriptor, --batch or --job-file\n");
+        exit(1);
+    }
+
+    if (heatmap && (doDiff || doEstimate || doVerify || doInfo || doGetDescriptor || doBatch || jobFile)) {
+        fprintf(stderr, "Error: --heatmap can only be used with --analyze or when converting one disk\n");
+        exit(1);
+    }
+
+    if (targetOffset != 0 && (doBatch || jobFile || heatmap || doInfo || doGetDescriptor || doVerify || doEstimate ||
+                             doDiff || doAnalyze)) {
+        fprintf(stderr, "Error: --offset can only be used when converting one disk, without --heatmap\n");
+        exit(1);
+    }
+
+    if (expectedDigest && !doVerify) {
+        fprintf(stderr, "--digest can only be used with --verify\n");
+        exit(1);
+    }
+
+    opts.compressionLevel = compressionLevel;
+    opts.doReorder = doReorder;
+    opts.sectorSize = sectorSize;
+    opts.doCompress = doCompress;
+    opts.checkpointInterval = checkpointInterval;
+    opts.doResume = doResume;
+    opts.doContentDigest = doContentDigest;
+    opts.offset = targetOffset;
+    /* read after the options, so the file overrides them */
+    if (limitFile && !RateLimit_SetControlFile(limitFile)) {
+        exit(1);
+    }
+
+    opts.grainCache = NULL;
+    if (grainCacheDir && !doInfo && !doGetDescriptor && !doVerify && !doEstimate && !doDiff && !doAnalyze) {
+        opts.grainCache = GrainCache_Open(grainCacheDir, grainCacheSize);
+        if (!opts.grainCache) {
+            exit(1);
+        }
+    }
+
+    if (doBatch || jobFile) {
+        ConvertJob *jobs = NULL;
+        int numJobs = 0;
+        int ret;
+
+        if (doInfo || doGetDescriptor || (doBatch && jobFile)) {
+            fprintf(stderr, "Error: --batch and --job-file cannot be combined with -i, --get-descriptor or each other\n");
+            exit(1);
+        }
+        if (jobFile) {
+            if (optind < argc) {
+                fprintf(stderr, "Error: no disks can be given with --job-file\n");
+                exit(1);
+            }
+            numJobs = Jobs_Load(jobFile, &jobs);
+            if (numJobs < 0) {
+                exit(1);
+            }
+        } else {
+            int i;
+
+            if ((argc - optind) % 2 != 0) {
+                fprintf(stderr, "Error: --batch needs pairs of source and destination disks\n");
+                exit(1);
+            }
+            numJobs = (argc - optind) / 2;
+            jobs = calloc(numJobs ? numJobs : 1, sizeof *jobs);
+            if (!jobs) {
+                exit(1);
+            }
+            for (i = 0; i < numJobs; i++) {
+                jobs[i].src = strdup(argv[optind + 2 * i]);
+                jobs[i].dst = strdup(argv[optind + 2 * i + 1]);
+            }
+        }
+        if (numJobs == 0) {
+            fprintf(stderr, "Error: no disks to convert\n");
+            exit(1);
+        }
+        ret = convertBatch(jobs, numJobs, targetFormat, &opts, numThreads);
+        Jobs_Free(jobs, numJobs);
+        GrainCache_Close(opts.grainCache);
+        return ret;
+    }
+
     if (optind >= argc) {
         src = "src.vmdk";
     } else {
         src = argv[optind++];
     }
-    bool isSparse = false;
-    di = Sparse_Open(src);
-    if (di != NULL) {
-        isSparse = true;
-    } else {
-        di = Flat_Open(src);
-    }
+    bool isSparse;
+    di = Convert_OpenSource(src, &isSparse);
     if (di == NULL) {
         fprintf(stderr, "Cannot open source disk %s: %s\n", src, strerror(errno));
         exit(1);
     } else {
-        if (doGetDescriptor) {
+        if (doEstimate) {
+            int ret = estimateDisk(di, compressionLevel, numThreads, numSamples);
+
+            di->vmt->close(di);
+            return ret;
+        } else if (doVerify) {
+            int ret;
+
+            if (!isSparse) {
+                fprintf(stderr, "Error: --verify only works with sparse VMDK files\n");
+                exit(1);
+            }
+            ret = verifyDisk(di, numThreads, expectedDigest);
+            di->vmt->close(di);
+            return ret;
+        } else if (doAnalyze) {
+            int ret;
+
+            if (!isSparse) {
+                fprintf(stderr, "Error: --analyze only works with sparse VMDK files, use --heatmap when converting\n");
+                exit(1);
+            }
+            ret = analyzeDisk(di, src, true, heatmap);
+            di->vmt->close(di);
+            return ret;
+        } else if (doDiff) {
+            const char *other = optind < argc ? argv[optind] : NULL;
+            DiskInfo *di2;
+            bool isSparse2;
+            int ret;
+
+            if (!other) {
+                fprintf(stderr, "Error: --diff needs two disks\n");
+                exit(1);
+            }
+            di2 = Convert_OpenSource(other, &isSparse2);
+            if (di2 == NULL) {
+                fprintf(stderr, "Cannot open disk %s: %s\n", other, strerror(errno));
+                exit(1);
+            }
+            if (!isSparse || !isSparse2) {
+                fprintf(stderr, "Error: --diff only works with sparse VMDK files\n");
+                exit(1);
+            }
+            ret = diffDisks(di, di2, numThreads);
+            di2->vmt->close(di2);
+            di->vmt->close(di);
+            return ret;
+        } else if (doGetDescriptor) {
             // Handle --get-descriptor option
             if (isSparse && di->vmt->getDescriptor) {
                 char *descriptor = di->vmt->getDescriptor(di);
@@ -413,65 +840,14 @@ main(int argc,
                 exit(1);
             }
         } else if (doInfo) {
-            off_t capacity = di->vmt->getCapacity(di);
-            off_t end = 0;
-            off_t pos;
-            off_t usedSpace = 0;
-            while (di->vmt->nextData(di, &pos, &end) == 0) {
-                usedSpace += end - pos;
-            }
-            printf("{ \"capacity\": %llu, \"used\": %llu",
-                    (unsigned long long)capacity, (unsigned long long)usedSpace);
-
-            if (doDetailed) {
-                if (isSparse) {
-                    // Cast to SparseDiskInfo to access the header
-                    SparseDiskInfo *sdi = (SparseDiskInfo *)di;
-                    printf(", \"sparseHeader\": {");
-                    printf("\"version\": %u, ", sdi->diskHdr.version);
-                    printf("\"flags\": %u, ", sdi->diskHdr.flags);
-                    printf("\"flagsDecoded\": {");
-                    printf("\"validNewlineDetector\": %s, ", (sdi->diskHdr.flags & SPARSEFLAG_VALID_NEWLINE_DETECTOR) ? "true" : "false");
-                    printf("\"useRedundant\": %s, ", (sdi->diskHdr.flags & SPARSEFLAG_USE_REDUNDANT) ? "true" : "false");
-                    printf("\"compressed\": %s, ", (sdi->diskHdr.flags & SPARSEFLAG_COMPRESSED) ? "true" : "false");
-                    printf("\"embeddedLBA\": %s", (sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA) ? "true" : "false");
-                    printf("}, ");
-                    printf("\"numGTEsPerGT\": %u, ", sdi->diskHdr.numGTEsPerGT);
-                    printf("\"compressAlgorithm\": %u, ", sdi->diskHdr.compressAlgorithm);
-                    printf("\"compressAlgorithmName\": \"%s\", ",
-                           sdi->diskHdr.compressAlgorithm == SPARSE_COMPRESSALGORITHM_NONE ? "none" :
-                           sdi->diskHdr.compressAlgorithm == SPARSE_COMPRESSALGORITHM_DEFLATE ? "deflate" : "unknown");
-                    printf("\"uncleanShutdown\": %u, ", sdi->diskHdr.uncleanShutdown);
-                    printf("\"grainSize\": %llu, ", (unsigned long long)sdi->diskHdr.grainSize);
-                    printf("\"grainSizeBytes\": %llu, ", (unsigned long long)(sdi->diskHdr.grainSize * 512));
-                    printf("\"descriptorOffset\": %llu, ", (unsigned long long)sdi->diskHdr.descriptorOffset);
-                    printf("\"descriptorSize\": %llu, ", (unsigned long long)sdi->diskHdr.descriptorSize);
-                    printf("\"rgdOffset\": %llu, ", (unsigned long long)sdi->diskHdr.rgdOffset);
-                    printf("\"gdOffset\": %llu, ", (unsigned long long)sdi->diskHdr.gdOffset);
-                    printf("\"overHead\": %llu", (unsigned long long)sdi->diskHdr.overHead);
-                    if (di->vmt->checkGrainOrder) {
-                        printf(", \"grainsOrdered\": %s", di->vmt->checkGrainOrder(di) ? "true" : "false");
-                    }
-                    printf(", \"hasFooter\": %s", sdi->hasFooter ? "true" : "false");
-                    printf("}");
-                } else {
-                    printf(", \"error\": \"detailed information only available for sparse VMDK files\"");
-                }
-            }
+            char *info = Convert_Info(di, isSparse, doDetailed);
 
-            // Add parsed descriptor file if available
-            if (doDetailed && isSparse && di->vmt->getDescriptor) {
-                char *descriptor = di->vmt->getDescriptor(di);
-                if (descriptor) {
-                    char *parsed_descriptor = parseDescriptorFile(descriptor);
-                    if (parsed_descriptor) {
-                        printf(", \"descriptorFile\": %s", parsed_descriptor);
-                        free(parsed_descriptor);
-                    }
-                }
+            if (!info) {
+                fprintf(stderr, "Cannot get disk information: %s\n", strerror(errno));
+                exit(1);
             }
-
-            printf(" }\n");
+            printf("%s\n", info);
+            free(info);
         } else {
             const char *filename;
             DiskInfo *tgt;
@@ -482,20 +858,35 @@ main(int argc,
             } else {
                 filename = argv[optind++];
             }
-            capacity = di->vmt->getCapacity(di);
+            if (heatmap) {
+                TargetFormat fmt = targetFormat == TARGET_DEFAULT ? Convert_GetFormat(filename) : targetFormat;
 
-            if (strcmp(&(filename[strlen(filename) - 5]), ".vmdk") == 0)
-                tgt = StreamOptimized_Create(filename, capacity, compressionLevel, doReorder, sectorSize);
-            else
-                tgt = Flat_Create(filename, capacity);
+                if (fmt != TARGET_STREAM_OPTIMIZED && fmt != TARGET_MONOLITHIC_SPARSE) {
+                    fprintf(stderr, "Error: --heatmap only works when converting to a sparse VMDK\n");
+                    exit(1);
+                }
+            }
+            capacity = di->vmt->getCapacity(di);
+            tgt = Convert_CreateTarget(src, filename, targetFormat, capacity, &opts);
 
             if (tgt == NULL) {
                 fprintf(stderr, "Cannot open target disk %s: %s\n", filename, strerror(errno));
                 di->vmt->close(di);
                 exit(1);
             } else {
-                printf("Starting to convert %s to %s using compression level %d and %d threads\n", src, filename, compressionLevel, numThreads);
-                if (copyDisk(di, tgt, numThreads)) {
+                printf("Starting to convert %s to %s using compression level %d%s and %d threads\n", src, filename, compressionLevel,
+                       compressionLevel == COMPRESSION_LEVEL_ULTRA ? " (ultra)" : "", numThreads);
+                if (Convert_CopyDisk(di, tgt, numThreads)) {
+                    GrainCache_Close(opts.grainCache);
+                    if (heatmap) {
+                        DiskInfo *out = Sparse_Open(filename);
+
+                        if (out == NULL || analyzeDisk(out, filename, false, heatmap) != 0) {
+                            fprintf(stderr, "Cannot analyze %s\n", filename);
+                            exit(1);
+                        }
+                        out->vmt->close(out);
+                    }
                     printf("Success\n");
                 } else {
                     fprintf(stderr, "Failure!\n");
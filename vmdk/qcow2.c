@@ -0,0 +1,1012 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#define _GNU_SOURCE
+
+#include "diskinfo.h"
+#include "ratelimit.h"
+
+#include <endian.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <stddef.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/stat.h>
+
+#include <zlib.h>
+
+#define CEILING(x, y) (((x) + (y) - 1) / (y))
+
+#define QCOW2_MAGIC                     0x514649fbU /* 'Q' 'F' 'I' 0xfb */
+
+#define QCOW2_INCOMPAT_DIRTY            (1ULL << 0)
+#define QCOW2_INCOMPAT_CORRUPT          (1ULL << 1)
+#define QCOW2_INCOMPAT_DATA_FILE        (1ULL << 2)
+#define QCOW2_INCOMPAT_COMPRESSION      (1ULL << 3)
+#define QCOW2_INCOMPAT_EXTL2            (1ULL << 4)
+#define QCOW2_INCOMPAT_KNOWN            (QCOW2_INCOMPAT_DIRTY | QCOW2_INCOMPAT_CORRUPT | \
+                                         QCOW2_INCOMPAT_DATA_FILE | QCOW2_INCOMPAT_COMPRESSION | \
+                                         QCOW2_INCOMPAT_EXTL2)
+
+#define QCOW2_OFLAG_COPIED              (1ULL << 63)
+#define QCOW2_OFLAG_COMPRESSED          (1ULL << 62)
+#define QCOW2_OFLAG_ZERO                (1ULL << 0)
+#define QCOW2_OFFSET_MASK               0x00fffffffffffe00ULL
+
+#define QCOW2_COMPRESSION_ZLIB          0
+
+#pragma pack(push, 1)
+typedef struct {
+    uint32_t magic;
+    uint32_t version;
+    uint64_t backingFileOffset;
+    uint32_t backingFileSize;
+    uint32_t clusterBits;
+    uint64_t size;
+    uint32_t cryptMethod;
+    uint32_t l1Size;
+    uint64_t l1TableOffset;
+    uint64_t refcountTableOffset;
+    uint32_t refcountTableClusters;
+    uint32_t nbSnapshots;
+    uint64_t snapshotsOffset;
+    /* version 3 only */
+    uint64_t incompatibleFeatures;
+    uint64_t compatibleFeatures;
+    uint64_t autoclearFeatures;
+    uint32_t refcountOrder;
+    uint32_t headerLength;
+    uint8_t compressionType;
+} Qcow2HeaderOnDisk;
+#pragma pack(pop)
+
+#define QCOW2_V2_HEADER_LENGTH          72
+#define QCOW2_V3_HEADER_LENGTH          104
+
+/* Cluster size and refcount width of images we create, same as qemu-img. */
+#define QCOW2_CREATE_CLUSTER_BITS       16
+#define QCOW2_CREATE_REFCOUNT_ORDER     4
+
+/* The last compressed cluster inflated by one reading thread */
+typedef struct Qcow2ClusterCache {
+    struct Qcow2ClusterCache *next;
+    uint64_t cluster;           /* UINT64_MAX if none */
+    uint8_t *cmpBuf;
+    uint8_t *clusterBuf;
+} Qcow2ClusterCache;
+
+typedef struct {
+    DiskInfo hdr;
+    int fd;
+    uint64_t capacity;
+    uint32_t clusterBits;
+    uint64_t clusterSize;
+    uint64_t clusters;
+    uint64_t *l2;       /* L2 entries of all clusters, host endian */
+    /*
+     * A compressed cluster is read in parts by several grains of the same
+     * thread, so each thread keeps the last cluster it inflated. The caches
+     * of all threads are listed to free them on close.
+     */
+    pthread_key_t cacheKey;
+    pthread_mutex_t cacheMutex; /* protects caches */
+    Qcow2ClusterCache *caches;
+} Qcow2DiskInfo;
+
+static inline Qcow2DiskInfo *
+getQDI(DiskInfo *self)
+{
+    return (Qcow2DiskInfo *)self;
+}
+
+static off_t
+Qcow2GetCapacity(DiskInfo *self)
+{
+    Qcow2DiskInfo *qdi = getQDI(self);
+
+    return qdi->capacity;
+}
+
+static bool
+isDataCluster(uint64_t entry)
+{
+    if (entry & QCOW2_OFLAG_COMPRESSED) {
+        return true;
+    }
+    if (entry & QCOW2_OFLAG_ZERO) {
+        return false;
+    }
+    return (entry & QCOW2_OFFSET_MASK) != 0;
+}
+
+static int
+readCompressedCluster(Qcow2DiskInfo *qdi,
+                      uint64_t entry,
+                      uint8_t *cmpBuf,
+                      uint8_t *clusterBuf)
+{
+    uint32_t x = 62 - (qdi->clusterBits - 8);
+    uint64_t offset = entry & ((1ULL << x) - 1);
+    uint64_t sectors = ((entry >> x) & ((1ULL << (qdi->clusterBits - 8)) - 1)) + 1;
+    size_t cmpSize = sectors * 512 - (offset & 511);
+    z_stream zstream = {0};
+    ssize_t rd;
+    int ret;
+
+    /* The last compressed cluster may end before the sector count claims. */
+    rd = pread(qdi->fd, cmpBuf, cmpSize, offset);
+    if (rd <= 0) {
+        fprintf(stderr, "Failed to read compressed cluster at %llu\n", (unsigned long long)offset);
+        return -1;
+    }
+    /* qcow2 stores raw deflate data with a 4KB window. */
+    if (inflateInit2(&zstream, -12) != Z_OK) {
+        return -1;
+    }
+    zstream.next_in = cmpBuf;
+    zstream.avail_in = rd;
+    zstream.next_out = clusterBuf;
+    zstream.avail_out = qdi->clusterSize;
+    ret = inflate(&zstream, Z_FINISH);
+    inflateEnd(&zstream);
+    if (ret != Z_STREAM_END && !(ret == Z_BUF_ERROR && zstream.avail_out == 0)) {
+        fprintf(stderr, "Failed to inflate compressed cluster at %llu\n", (unsigned long long)offset);
+        return -1;
+    }
+    if (zstream.avail_out != 0) {
+        fprintf(stderr, "Short compressed cluster at %llu\n", (unsigned long long)offset);
+        return -1;
+    }
+    return 0;
+}
+
+static Qcow2ClusterCache *
+getClusterCache(Qcow2DiskInfo *qdi)
+{
+    Qcow2ClusterCache *cache = pthread_getspecific(qdi->cacheKey);
+
+    if (cache) {
+        return cache;
+    }
+    cache = calloc(1, sizeof *cache);
+    if (!cache) {
+        return NULL;
+    }
+    cache->cluster = UINT64_MAX;
+    if (pthread_setspecific(qdi->cacheKey, cache) != 0) {
+        free(cache);
+        return NULL;
+    }
+    pthread_mutex_lock(&qdi->cacheMutex);
+    cache->next = qdi->caches;
+    qdi->caches = cache;
+    pthread_mutex_unlock(&qdi->cacheMutex);
+    return cache;
+}
+
+static ssize_t
+Qcow2Pread(DiskInfo *self,
+           void *buf,
+           size_t len,
+           off_t pos)
+{
+    Qcow2DiskInfo *qdi = getQDI(self);
+    uint8_t *buf8 = buf;
+
+    if ((uint64_t)pos >= qdi->capacity) {
+        return 0;
+    }
+    if (len > qdi->capacity - pos) {
+        len = qdi->capacity - pos;
+    }
+
+    while (len > 0) {
+        uint64_t clusterNr = pos >> qdi->clusterBits;
+        uint64_t skip = pos & (qdi->clusterSize - 1);
+        uint64_t entry = qdi->l2[clusterNr];
+        size_t readLen = qdi->clusterSize - skip;
+
+        if (len < readLen) {
+            readLen = len;
+        }
+        if (!isDataCluster(entry)) {
+            memset(buf8, 0, readLen);
+        } else if (entry & QCOW2_OFLAG_COMPRESSED) {
+            Qcow2ClusterCache *cache = getClusterCache(qdi);
+
+            if (!cache) {
+                return -1;
+            }
+            if (cache->cluster != clusterNr) {
+                if (!cache->cmpBuf) {
+                    cache->cmpBuf = malloc(2 * qdi->clusterSize);
+                }
+                if (!cache->clusterBuf) {
+                    cache->clusterBuf = malloc(qdi->clusterSize);
+                }
+                if (!cache->cmpBuf || !cache->clusterBuf ||
+                    readCompressedCluster(qdi, entry, cache->cmpBuf, cache->clusterBuf)) {
+                    cache->cluster = UINT64_MAX;
+                    return -1;
+                }
+                cache->cluster = clusterNr;
+            }
+            memcpy(buf8, cache->clusterBuf + skip, readLen);
+        } else {
+            uint64_t hostOffset = (entry & QCOW2_OFFSET_MASK) + skip;
+
+            if (pread(qdi->fd, buf8, readLen, hostOffset) != (ssize_t)readLen) {
+                fprintf(stderr, "Failed to read cluster at %llu\n", (unsigned long long)hostOffset);
+                return -1;
+            }
+        }
+        buf8 += readLen;
+        pos += readLen;
+        len -= readLen;
+    }
+    return buf8 - (uint8_t *)buf;
+}
+
+static int
+Qcow2NextData(DiskInfo *self,
+              off_t *pos,
+              off_t *end)
+{
+    Qcow2DiskInfo *qdi = getQDI(self);
+    uint64_t clusterNr = (uint64_t)*end >> qdi->clusterBits;
+    uint64_t skip = *end & (qdi->clusterSize - 1);
+
+    while (clusterNr < qdi->clusters && !isDataCluster(qdi->l2[clusterNr])) {
+        clusterNr++;
+        skip = 0;
+    }
+    if (clusterNr >= qdi->clusters) {
+        errno = ENXIO;
+        return -1;
+    }
+    *pos = (clusterNr << qdi->clusterBits) | skip;
+    while (clusterNr < qdi->clusters && isDataCluster(qdi->l2[clusterNr])) {
+        clusterNr++;
+    }
+    if (clusterNr >= qdi->clusters) {
+        *end = qdi->capacity;
+    } else {
+        *end = clusterNr << qdi->clusterBits;
+    }
+    return 0;
+}
+
+static int
+Qcow2Close(DiskInfo *self)
+{
+    Qcow2DiskInfo *qdi = getQDI(self);
+    int fd = qdi->fd;
+
+    free(qdi->l2);
+    while (qdi->caches) {
+        Qcow2ClusterCache *cache = qdi->caches;
+
+        qdi->caches = cache->next;
+        free(cache->cmpBuf);
+        free(cache->clusterBuf);
+        free(cache);
+    }
+    pthread_key_delete(qdi->cacheKey);
+    pthread_mutex_destroy(&qdi->cacheMutex);
+    free(qdi);
+    return close(fd);
+}
+
+static DiskInfoVMT qcow2DiskInfoVMT = {
+    .getCapacity = Qcow2GetCapacity,
+    .pread = Qcow2Pread,
+    .pwrite = NULL,
+    .nextData = Qcow2NextData,
+    .close = Qcow2Close,
+    .abort = Qcow2Close,
+    .copyDisk = NULL,
+    .checkGrainOrder = NULL
+};
+
+static bool
+checkQcow2Header(const Qcow2HeaderOnDisk *hdr, uint64_t fileSize)
+{
+    uint32_t version = be32toh(hdr->version);
+    uint32_t clusterBits = be32toh(hdr->clusterBits);
+
+    if (version != 2 && version != 3) {
+        fprintf(stderr, "Unsupported qcow2 version %u\n", version);
+        errno = ENOTSUP;
+        return false;
+    }
+    if (clusterBits < 9 || clusterBits > 21) {
+        fprintf(stderr, "Invalid qcow2 cluster size 2^%u\n", clusterBits);
+        errno = EBADMSG;
+        return false;
+    }
+    if (be64toh(hdr->backingFileOffset) != 0) {
+        fprintf(stderr, "qcow2 images with a backing file are not supported\n");
+        errno = ENOTSUP;
+        return false;
+    }
+    if (be32toh(hdr->cryptMethod) != 0) {
+        fprintf(stderr, "Encrypted qcow2 images are not supported\n");
+        errno = ENOTSUP;
+        return false;
+    }
+    if (be64toh(hdr->l1TableOffset) & ((1ULL << clusterBits) - 1) ||
+        be64toh(hdr->l1TableOffset) + be32toh(hdr->l1Size) * sizeof(uint64_t) > fileSize) {
+        fprintf(stderr, "Invalid qcow2 L1 table\n");
+        errno = EBADMSG;
+        return false;
+    }
+    if (version >= 3) {
+        uint64_t incompat = be64toh(hdr->incompatibleFeatures);
+
+        if (incompat & ~QCOW2_INCOMPAT_KNOWN) {
+            fprintf(stderr, "Unknown qcow2 incompatible features 0x%llx\n", (unsigned long long)incompat);
+            errno = ENOTSUP;
+            return false;
+        }
+        if (incompat & QCOW2_INCOMPAT_CORRUPT) {
+            fprintf(stderr, "qcow2 image is marked corrupt\n");
+            errno = EBADMSG;
+            return false;
+        }
+        if (incompat & QCOW2_INCOMPAT_DATA_FILE) {
+            fprintf(stderr, "qcow2 images with an external data file are not supported\n");
+            errno = ENOTSUP;
+            return false;
+        }
+        if (incompat & QCOW2_INCOMPAT_EXTL2) {
+            fprintf(stderr, "qcow2 images with extended L2 entries are not supported\n");
+            errno = ENOTSUP;
+            return false;
+        }
+        if (incompat & QCOW2_INCOMPAT_COMPRESSION) {
+            if (be32toh(hdr->headerLength) <= offsetof(Qcow2HeaderOnDisk, compressionType) ||
+                hdr->compressionType != QCOW2_COMPRESSION_ZLIB) {
+                fprintf(stderr, "Only zlib compressed qcow2 images are supported\n");
+                errno = ENOTSUP;
+                return false;
+            }
+        }
+    }
+    return true;
+}
+
+/* Loads the L1 table and all L2 tables it references into qdi->l2. */
+static bool
+loadL2Tables(Qcow2DiskInfo *qdi, const Qcow2HeaderOnDisk *hdr)
+{
+    uint32_t l1Size = be32toh(hdr->l1Size);
+    uint64_t l2Entries = qdi->clusterSize / sizeof(uint64_t);
+    uint64_t l1Used = CEILING(qdi->clusters, l2Entries);
+    uint64_t *l1;
+    uint64_t i;
+    bool success = false;
+
+    if (l1Size < l1Used) {
+        fprintf(stderr, "qcow2 L1 table too small for disk size\n");
+        errno = EBADMSG;
+        return false;
+    }
+    l1 = malloc(l1Size * sizeof(uint64_t));
+    qdi->l2 = calloc(l1Used * l2Entries, sizeof(uint64_t));
+    if (!l1 || !qdi->l2) {
+        goto out;
+    }
+    if (pread(qdi->fd, l1, l1Size * sizeof(uint64_t), be64toh(hdr->l1TableOffset)) != (ssize_t)(l1Size * sizeof(uint64_t))) {
+        fprintf(stderr, "Failed to read qcow2 L1 table\n");
+        goto out;
+    }
+    for (i = 0; i < l1Used; i++) {
+        uint64_t l2Offset = be64toh(l1[i]) & QCOW2_OFFSET_MASK;
+        uint64_t *l2 = qdi->l2 + i * l2Entries;
+        uint64_t j;
+
+        if (l2Offset == 0) {
+            continue;
+        }
+        if (pread(qdi->fd, l2, qdi->clusterSize, l2Offset) != (ssize_t)qdi->clusterSize) {
+            fprintf(stderr, "Failed to read qcow2 L2 table at %llu\n", (unsigned long long)l2Offset);
+            goto out;
+        }
+        for (j = 0; j < l2Entries; j++) {
+            l2[j] = be64toh(l2[j]);
+        }
+    }
+    success = true;
+
+out:
+    free(l1);
+    if (!success) {
+        free(qdi->l2);
+        qdi->l2 = NULL;
+        if (errno == 0) {
+            errno = EIO;
+        }
+    }
+    return success;
+}
+
+DiskInfo *
+Qcow2_Open(const char *fileName)
+{
+    Qcow2HeaderOnDisk onDisk = {0};
+    Qcow2DiskInfo *qdi;
+    struct stat stb;
+    ssize_t rd;
+    int fd;
+
+    fd = open(fileName, O_RDONLY);
+    if (fd == -1) {
+        return NULL;
+    }
+    rd = pread(fd, &onDisk, sizeof onDisk, 0);
+    if (rd < QCOW2_V2_HEADER_LENGTH || be32toh(onDisk.magic) != QCOW2_MAGIC) {
+        errno = EINVAL;
+        goto errClose;
+    }
+    if (fstat(fd, &stb)) {
+        goto errClose;
+    }
+    if (!checkQcow2Header(&onDisk, stb.st_size)) {
+        goto errClose;
+    }
+    qdi = malloc(sizeof *qdi);
+    if (!qdi) {
+        goto errClose;
+    }
+    memset(qdi, 0, sizeof *qdi);
+    qdi->hdr.vmt = &qcow2DiskInfoVMT;
+    qdi->fd = fd;
+    qdi->capacity = be64toh(onDisk.size);
+    qdi->clusterBits = be32toh(onDisk.clusterBits);
+    qdi->clusterSize = 1ULL << qdi->clusterBits;
+    qdi->clusters = CEILING(qdi->capacity, qdi->clusterSize);
+    errno = 0;
+    if (!loadL2Tables(qdi, &onDisk)) {
+        free(qdi);
+        goto errClose;
+    }
+    if ((errno = pthread_key_create(&qdi->cacheKey, NULL)) != 0) {
+        free(qdi->l2);
+        free(qdi);
+        goto errClose;
+    }
+    pthread_mutex_init(&qdi->cacheMutex, NULL);
+    return &qdi->hdr;
+
+errClose:
+    {
+        int err = errno;
+
+        close(fd);
+        errno = err;
+    }
+    return NULL;
+}
+
+typedef struct {
+    DiskInfo hdr;
+    int fd;
+    uint64_t capacity;
+    uint32_t clusterBits;
+    uint64_t clusterSize;
+    uint64_t clusters;
+    uint64_t *l2;       /* L2 entries of all clusters, host endian */
+    uint64_t curOffset; /* next free byte in the file */
+    int compressionLevel; /* -1 writes uncompressed clusters */
+} Qcow2WriterInfo;
+
+static inline Qcow2WriterInfo *
+getQWI(DiskInfo *self)
+{
+    return (Qcow2WriterInfo *)self;
+}
+
+static bool
+safePwrite(int fd,
+           const void *buf,
+           size_t len,
+           off_t pos)
+{
+    RateLimit_Consume(RATE_LIMIT_WRITE, len);
+    ssize_t written = pwrite(fd, buf, len, pos);
+
+    if (written == -1) {
+        fprintf(stderr, "Write failed: %s (fd=%d)\n", strerror(errno), fd);
+        return false;
+    }
+    if ((size_t)written != len) {
+        fprintf(stderr, "Short write. Disk full? (fd=%d)\n", fd);
+        return false;
+    }
+    return true;
+}
+
+static bool
+isZeroed(const void *data,
+         size_t len)
+{
+    const uint64_t *data64 = data;
+    len = len >> 3;
+
+    while (len--) {
+        if (*data64++ != 0) {
+            return false;
+        }
+    }
+    return true;
+}
+
+static uint64_t
+alignCluster(const Qcow2WriterInfo *qwi, uint64_t offset)
+{
+    return (offset + qwi->clusterSize - 1) & ~(qwi->clusterSize - 1);
+}
+
+/* Adds one reference to every host cluster in [offset, offset + len). */
+static void
+addRefs(const Qcow2WriterInfo *qwi,
+        uint16_t *refcounts,
+        uint64_t offset,
+        uint64_t len)
+{
+    uint64_t first = offset >> qwi->clusterBits;
+    uint64_t last = (offset + len - 1) >> qwi->clusterBits;
+
+    while (first <= last) {
+        refcounts[first++]++;
+    }
+}
+
+/*
+ * Writes L2 tables, the L1 table, the refcount structures and finally
+ * the header behind the data clusters.  The refcount table has to
+ * account for its own clusters, so its size is found by iterating.
+ */
+static bool
+writeQcow2Metadata(Qcow2WriterInfo *qwi)
+{
+    uint64_t l2Entries = qwi->clusterSize / sizeof(uint64_t);
+    uint64_t l1Size = CEILING(qwi->clusters, l2Entries);
+    uint64_t refcountsPerBlock = qwi->clusterSize * 8 >> QCOW2_CREATE_REFCOUNT_ORDER;
+    uint64_t l1Offset, refcountBlocksOffset, refcountTableOffset;
+    uint64_t refcountBlocks = 0, refcountTableClusters = 0;
+    uint64_t hostClusters, offset, i;
+    uint64_t *l1 = NULL;
+    uint64_t *table = NULL;
+    uint16_t *refcounts = NULL;
+    uint8_t *buf = NULL;
+    Qcow2HeaderOnDisk onDisk;
+    bool success = false;
+
+    l1 = calloc(l1Size ? l1Size : 1, sizeof(uint64_t));
+    buf = malloc(qwi->clusterSize);
+    if (!l1 || !buf) {
+        goto out;
+    }
+
+    /* L2 tables, only for ranges that have data */
+    offset = alignCluster(qwi, qwi->curOffset);
+    for (i = 0; i < l1Size; i++) {
+        uint64_t *l2 = (uint64_t *)buf;
+        bool used = false;
+        uint64_t j;
+
+        for (j = 0; j < l2Entries; j++) {
+            uint64_t nr = i * l2Entries + j;
+            uint64_t entry = nr < qwi->clusters ? qwi->l2[nr] : 0;
+
+            used |= entry != 0;
+            l2[j] = htobe64(entry);
+        }
+        if (!used) {
+            continue;
+        }
+        if (!safePwrite(qwi->fd, buf, qwi->clusterSize, offset)) {
+            goto out;
+        }
+        l1[i] = htobe64(offset | QCOW2_OFLAG_COPIED);
+        offset += qwi->clusterSize;
+    }
+
+    l1Offset = offset;
+    if (!safePwrite(qwi->fd, l1, l1Size * sizeof(uint64_t), l1Offset)) {
+        goto out;
+    }
+    offset = alignCluster(qwi, l1Offset + l1Size * sizeof(uint64_t));
+
+    refcountBlocksOffset = offset;
+    for (;;) {
+        uint64_t total = (offset >> qwi->clusterBits) + refcountBlocks + refcountTableClusters;
+        uint64_t blocks = CEILING(total, refcountsPerBlock);
+        uint64_t tableClusters = CEILING(blocks * sizeof(uint64_t), qwi->clusterSize);
+
+        if (blocks == refcountBlocks && tableClusters == refcountTableClusters) {
+            hostClusters = total;
+            break;
+        }
+        refcountBlocks = blocks;
+        refcountTableClusters = tableClusters;
+    }
+    refcountTableOffset = refcountBlocksOffset + refcountBlocks * qwi->clusterSize;
+
+    refcounts = calloc(refcountBlocks * refcountsPerBlock, sizeof(uint16_t));
+    table = calloc(refcountTableClusters * qwi->clusterSize, 1);
+    if (!refcounts || !table) {
+        goto out;
+    }
+    addRefs(qwi, refcounts, 0, qwi->clusterSize);
+    for (i = 0; i < qwi->clusters; i++) {
+        uint64_t entry = qwi->l2[i];
+
+        if (entry & QCOW2_OFLAG_COMPRESSED) {
+            uint32_t x = 62 - (qwi->clusterBits - 8);
+            uint64_t sectors = ((entry >> x) & ((1ULL << (qwi->clusterBits - 8)) - 1)) + 1;
+            uint64_t cmpOffset = entry & ((1ULL << x) - 1);
+
+            addRefs(qwi, refcounts, cmpOffset, sectors * 512 - (cmpOffset & 511));
+        } else if (entry != 0) {
+            addRefs(qwi, refcounts, entry & QCOW2_OFFSET_MASK, qwi->clusterSize);
+        }
+    }
+    for (i = 0; i < l1Size; i++) {
+        if (l1[i] != 0) {
+            addRefs(qwi, refcounts, be64toh(l1[i]) & QCOW2_OFFSET_MASK, qwi->clusterSize);
+        }
+    }
+    addRefs(qwi, refcounts, l1Offset, l1Size * sizeof(uint64_t));
+    addRefs(qwi, refcounts, refcountBlocksOffset,
+            (refcountBlocks + refcountTableClusters) * qwi->clusterSize);
+
+    for (i = 0; i < refcountBlocks; i++) {
+        uint16_t *block = refcounts + i * refcountsPerBlock;
+        uint64_t j;
+
+        for (j = 0; j < refcountsPerBlock; j++) {
+            block[j] = htobe16(block[j]);
+        }
+        if (!safePwrite(qwi->fd, block, qwi->clusterSize, refcountBlocksOffset + i * qwi->clusterSize)) {
+            goto out;
+        }
+        table[i] = htobe64(refcountBlocksOffset + i * qwi->clusterSize);
+    }
+    if (!safePwrite(qwi->fd, table, refcountTableClusters * qwi->clusterSize, refcountTableOffset)) {
+        goto out;
+    }
+    if (fsync(qwi->fd) != 0) {
+        goto out;
+    }
+
+    /* The header goes last, until then the file is not a valid image. */
+    memset(buf, 0, qwi->clusterSize);
+    memset(&onDisk, 0, sizeof onDisk);
+    onDisk.magic = htobe32(QCOW2_MAGIC);
+    onDisk.version = htobe32(3);
+    onDisk.clusterBits = htobe32(qwi->clusterBits);
+    onDisk.size = htobe64(qwi->capacity);
+    onDisk.l1Size = htobe32(l1Size);
+    onDisk.l1TableOffset = htobe64(l1Offset);
+    onDisk.refcountTableOffset = htobe64(refcountTableOffset);
+    onDisk.refcountTableClusters = htobe32(refcountTableClusters);
+    onDisk.refcountOrder = htobe32(QCOW2_CREATE_REFCOUNT_ORDER);
+    onDisk.headerLength = htobe32(QCOW2_V3_HEADER_LENGTH);
+    /* followed by an empty header extension list */
+    memcpy(buf, &onDisk, QCOW2_V3_HEADER_LENGTH);
+    if (!safePwrite(qwi->fd, buf, qwi->clusterSize, 0)) {
+        goto out;
+    }
+    if (ftruncate(qwi->fd, hostClusters << qwi->clusterBits) != 0 || fsync(qwi->fd) != 0) {
+        goto out;
+    }
+    success = true;
+
+out:
+    free(l1);
+    free(buf);
+    free(refcounts);
+    free(table);
+    return success;
+}
+
+static int
+Qcow2WriterFinalize(Qcow2WriterInfo *qwi)
+{
+    int ret = close(qwi->fd);
+
+    free(qwi->l2);
+    free(qwi);
+    return ret;
+}
+
+static int
+Qcow2WriterAbort(DiskInfo *self)
+{
+    Qcow2WriterInfo *qwi = getQWI(self);
+
+    return Qcow2WriterFinalize(qwi);
+}
+
+static int
+Qcow2WriterClose(DiskInfo *self)
+{
+    Qcow2WriterInfo *qwi = getQWI(self);
+
+    if (!writeQcow2Metadata(qwi)) {
+        fprintf(stderr, "Failed to write qcow2 metadata\n");
+        Qcow2WriterAbort(self);
+        return -1;
+    }
+    return Qcow2WriterFinalize(qwi);
+}
+
+typedef enum {
+    CT_STATE_FAILED = -1,
+    CT_STATE_RUNNING = 0,
+    CT_STATE_DONE = 1
+} ClusterThreadState;
+
+typedef struct {
+    pthread_mutex_t readPosMutex;
+    pthread_mutex_t writeMutex;
+
+    Qcow2WriterInfo *qwi;
+    DiskInfo *src;
+    off_t readPos;
+    off_t dataEnd;      /* end of the source data range containing readPos */
+
+    ClusterThreadState state;
+} ClusterThreadContext;
+
+/*
+ * Claims the next cluster containing source data.  Holes reported by the
+ * source are skipped without reading them.  Returns false when done.
+ */
+static bool
+nextCluster(ClusterThreadContext *ctCtx, uint64_t *clusterNr)
+{
+    Qcow2WriterInfo *qwi = ctCtx->qwi;
+    bool found = false;
+
+    pthread_mutex_lock(&ctCtx->readPosMutex);
+    if (ctCtx->state == CT_STATE_RUNNING) {
+        if (ctCtx->readPos >= ctCtx->dataEnd) {
+            off_t pos, end = ctCtx->readPos;
+
+            if (ctCtx->src->vmt->nextData(ctCtx->src, &pos, &end) == 0) {
+                ctCtx->readPos = pos & ~(qwi->clusterSize - 1);
+                ctCtx->dataEnd = end;
+            } else if (errno == ENXIO) {
+                ctCtx->readPos = qwi->capacity;
+                ctCtx->state = CT_STATE_DONE;
+            } else {
+                ctCtx->state = CT_STATE_FAILED;
+            }
+        }
+        if (ctCtx->state == CT_STATE_RUNNING) {
+            *clusterNr = ctCtx->readPos >> qwi->clusterBits;
+            ctCtx->readPos += qwi->clusterSize;
+            found = true;
+        }
+    }
+    pthread_mutex_unlock(&ctCtx->readPosMutex);
+    return found;
+}
+
+static void
+*writeClusterThread(void *arg)
+{
+    ClusterThreadContext *ctCtx = (ClusterThreadContext *)arg;
+    Qcow2WriterInfo *qwi = ctCtx->qwi;
+    z_stream zstream = {0};
+    uint8_t *buf = malloc(qwi->clusterSize);
+    uint8_t *cmpBuf = malloc(qwi->clusterSize);
+    bool zstreamInit = false;
+    uint64_t clusterNr;
+
+    if (!buf || !cmpBuf) {
+        goto fail;
+    }
+    if (qwi->compressionLevel >= 0) {
+        /* qcow2 stores raw deflate data with a 4KB window. */
+        if (deflateInit2(&zstream, qwi->compressionLevel, Z_DEFLATED, -12, 9, Z_DEFAULT_STRATEGY) != Z_OK) {
+            goto fail;
+        }
+        zstreamInit = true;
+    }
+
+    while (nextCluster(ctCtx, &clusterNr)) {
+        uint64_t pos = clusterNr << qwi->clusterBits;
+        size_t readLen = qwi->clusterSize;
+        const uint8_t *data = buf;
+        size_t dataLen = qwi->clusterSize;
+        uint64_t offset;
+
+        if (qwi->capacity - pos < readLen) {
+            readLen = qwi->capacity - pos;
+            memset(buf + readLen, 0, qwi->clusterSize - readLen);
+        }
+        RateLimit_Consume(RATE_LIMIT_READ, readLen);
+        if (ctCtx->src->vmt->pread(ctCtx->src, buf, readLen, pos) != (ssize_t)readLen) {
+            goto fail;
+        }
+        if (isZeroed(buf, qwi->clusterSize)) {
+            continue;
+        }
+        if (zstreamInit) {
+            uint64_t cpuStart = RateLimit_CpuStart();
+
+            if (deflateReset(&zstream) != Z_OK) {
+                goto fail;
+            }
+            zstream.next_in = buf;
+            zstream.avail_in = qwi->clusterSize;
+            zstream.next_out = cmpBuf;
+            zstream.avail_out = qwi->clusterSize;
+            /* Clusters which do not shrink are stored uncompressed. */
+            if (deflate(&zstream, Z_FINISH) == Z_STREAM_END) {
+                data = cmpBuf;
+                dataLen = qwi->clusterSize - zstream.avail_out;
+            }
+            RateLimit_CpuEnd(cpuStart);
+        }
+
+        pthread_mutex_lock(&ctCtx->writeMutex);
+        if (data == cmpBuf) {
+            uint32_t x = 62 - (qwi->clusterBits - 8);
+            uint64_t sectors;
+
+            offset = qwi->curOffset;
+            qwi->curOffset += dataLen;
+            sectors = (offset + dataLen - 1) / 512 - offset / 512 + 1;
+            qwi->l2[clusterNr] = QCOW2_OFLAG_COMPRESSED | ((sectors - 1) << x) | offset;
+        } else {
+            offset = alignCluster(qwi, qwi->curOffset);
+            qwi->curOffset = offset + qwi->clusterSize;
+            qwi->l2[clusterNr] = offset | QCOW2_OFLAG_COPIED;
+        }
+        pthread_mutex_unlock(&ctCtx->writeMutex);
+
+        if (!safePwrite(qwi->fd, data, dataLen, offset)) {
+            goto fail;
+        }
+    }
+
+    if (zstreamInit) {
+        deflateEnd(&zstream);
+    }
+    free(buf);
+    free(cmpBuf);
+    return arg;
+
+fail:
+    pthread_mutex_lock(&ctCtx->readPosMutex);
+    ctCtx->state = CT_STATE_FAILED;
+    pthread_mutex_unlock(&ctCtx->readPosMutex);
+    if (zstreamInit) {
+        deflateEnd(&zstream);
+    }
+    free(buf);
+    free(cmpBuf);
+    return arg;
+}
+
+static ssize_t
+Qcow2WriterCopyDisk(DiskInfo *src,
+                    DiskInfo *self,
+                    int numThreads)
+{
+    Qcow2WriterInfo *qwi = getQWI(self);
+    ClusterThreadContext ctCtx = {0};
+    pthread_t threads[numThreads];
+    int i, ret;
+    int threadsCreated = 0;
+
+    if ((ret = pthread_mutex_init(&ctCtx.readPosMutex, NULL)) != 0) {
+        fprintf(stderr, "Failed to initialize readPosMutex: %s\n", strerror(ret));
+        return -1;
+    }
+    if ((ret = pthread_mutex_init(&ctCtx.writeMutex, NULL)) != 0) {
+        fprintf(stderr, "Failed to initialize writeMutex: %s\n", strerror(ret));
+        pthread_mutex_destroy(&ctCtx.readPosMutex);
+        return -1;
+    }
+    ctCtx.qwi = qwi;
+    ctCtx.src = src;
+    ctCtx.state = CT_STATE_RUNNING;
+
+    for (i = 0; i < numThreads; i++) {
+        ret = pthread_create(&threads[i], NULL, writeClusterThread, (void *)&ctCtx);
+        if (ret != 0) {
+            fprintf(stderr, "Failed to create thread %d: %s\n", i, strerror(ret));
+            pthread_mutex_lock(&ctCtx.readPosMutex);
+            ctCtx.state = CT_STATE_FAILED;
+            pthread_mutex_unlock(&ctCtx.readPosMutex);
+            break;
+        }
+        threadsCreated++;
+    }
+    for (i = 0; i < threadsCreated; i++) {
+        pthread_join(threads[i], NULL);
+    }
+
+    pthread_mutex_destroy(&ctCtx.writeMutex);
+    pthread_mutex_destroy(&ctCtx.readPosMutex);
+
+    if (threadsCreated != numThreads || ctCtx.state != CT_STATE_DONE) {
+        return -1;
+    }
+    return qwi->capacity;
+}
+
+static DiskInfoVMT qcow2WriterVMT = {
+    .getCapacity = NULL,
+    .pread = NULL,
+    .pwrite = NULL,
+    .nextData = NULL,
+    .close = Qcow2WriterClose,
+    .abort = Qcow2WriterAbort,
+    .copyDisk = Qcow2WriterCopyDisk,
+    .checkGrainOrder = NULL
+};
+
+/*
+ * Creates a qcow2 v3 image.  Data clusters are written in the order the
+ * worker threads finish them, all metadata is appended at close.  With a
+ * compressionLevel < 0 clusters are stored uncompressed.
+ */
+DiskInfo *
+Qcow2_Create(const char *fileName,
+             off_t capacity,
+             int compressionLevel)
+{
+    Qcow2WriterInfo *qwi;
+
+    qwi = malloc(sizeof *qwi);
+    if (!qwi) {
+        goto fail;
+    }
+    memset(qwi, 0, sizeof *qwi);
+    qwi->hdr.vmt = &qcow2WriterVMT;
+    qwi->capacity = capacity;
+    qwi->clusterBits = QCOW2_CREATE_CLUSTER_BITS;
+    qwi->clusterSize = 1ULL << qwi->clusterBits;
+    qwi->clusters = CEILING(qwi->capacity, qwi->clusterSize);
+    qwi->compressionLevel = compressionLevel;
+    /* cluster 0 is reserved for the header */
+    qwi->curOffset = qwi->clusterSize;
+    qwi->l2 = calloc(qwi->clusters ? qwi->clusters : 1, sizeof(uint64_t));
+    if (!qwi->l2) {
+        goto failQWI;
+    }
+    qwi->fd = open(fileName, O_RDWR | O_CREAT | O_TRUNC, 0666);
+    if (qwi->fd == -1) {
+        goto failL2;
+    }
+    return &qwi->hdr;
+
+failL2:
+    free(qwi->l2);
+failQWI:
+    free(qwi);
+fail:
+    return NULL;
+}
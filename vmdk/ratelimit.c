@@ -0,0 +1,308 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+/*
+ * Token buckets for read and write bandwidth and for the CPU time spent
+ * compressing.  A caller takes what it needs from the bucket, possibly
+ * taking it into debt, and then sleeps until the debt is paid off.  With
+ * several threads the later ones see the debt of the earlier ones and
+ * sleep longer, so the total stays within the rate.
+ *
+ * The limits can be changed while a conversion runs through a control
+ * file, which is read again on SIGHUP or when its modification time
+ * changes.
+ */
+
+#include "ratelimit.h"
+
+#include <errno.h>
+#include <pthread.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <time.h>
+
+/* allowed burst, in seconds at the configured rate */
+#define RATE_LIMIT_BURST            0.1
+
+/* how often the control file is checked for changes, in seconds */
+#define RATE_LIMIT_CHECK_INTERVAL   1.0
+
+typedef struct {
+    double rate;        /* 0 means unlimited */
+    double tokens;
+    double last;
+} TokenBucket;
+
+static const char *const limitNames[RATE_LIMIT_NUM] = { "read-limit", "write-limit", "cpu-share" };
+
+/* control file values are in MB/s and percent of one CPU */
+static const double limitUnits[RATE_LIMIT_NUM] = { 1024.0 * 1024.0, 1024.0 * 1024.0, 0.01 };
+
+static pthread_mutex_t rateMutex = PTHREAD_MUTEX_INITIALIZER;
+static TokenBucket buckets[RATE_LIMIT_NUM];
+static bool rateEnabled;
+static char *controlFile;
+static struct timespec controlMtime;
+static double lastCheck;
+static volatile sig_atomic_t reloadRequested;
+
+static double
+now(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void
+setRate(RateLimitKind kind, double rate)
+{
+    buckets[kind].rate = rate > 0 ? rate : 0;
+    buckets[kind].tokens = 0;
+    buckets[kind].last = now();
+}
+
+void
+RateLimit_Set(RateLimitKind kind, double rate)
+{
+    pthread_mutex_lock(&rateMutex);
+    setRate(kind, rate);
+    if (rate > 0) {
+        rateEnabled = true;
+    }
+    pthread_mutex_unlock(&rateMutex);
+}
+
+static void
+printLimits(void)
+{
+    int kind;
+
+    printf("Rate limits:");
+    for (kind = 0; kind < RATE_LIMIT_NUM; kind++) {
+        if (buckets[kind].rate > 0) {
+            printf(" %s %g", limitNames[kind], buckets[kind].rate / limitUnits[kind]);
+        } else {
+            printf(" %s unlimited", limitNames[kind]);
+        }
+    }
+    printf("\n");
+    fflush(stdout);
+}
+
+/*
+ * Reads lines "<name>=<value>" with the names of the command line options.
+ * Limits not mentioned keep their value, 0 removes a limit.  Nothing is
+ * changed if the file cannot be parsed.
+ */
+static bool
+readControlFile(void)
+{
+    double rates[RATE_LIMIT_NUM];
+    bool seen[RATE_LIMIT_NUM] = { false };
+    char line[256];
+    int lineNr = 0;
+    int kind;
+    FILE *f;
+
+    f = fopen(controlFile, "r");
+    if (f == NULL) {
+        fprintf(stderr, "Cannot open rate limit file %s: %s\n", controlFile, strerror(errno));
+        return false;
+    }
+    while (fgets(line, sizeof line, f) != NULL) {
+        char *p = line + strspn(line, " \t");
+        char *value, *end;
+        double v;
+
+        lineNr++;
+        if (*p == '#' || *p == '\n' || *p == '\0') {
+            continue;
+        }
+        value = strchr(p, '=');
+        if (value == NULL) {
+            goto invalid;
+        }
+        *value++ = '\0';
+        p[strcspn(p, " \t")] = '\0';
+        for (kind = 0; kind < RATE_LIMIT_NUM; kind++) {
+            if (strcmp(p, limitNames[kind]) == 0) {
+                break;
+            }
+        }
+        errno = 0;
+        v = strtod(value, &end);
+        if (kind == RATE_LIMIT_NUM || end == value || errno != 0 || v < 0 ||
+            end[strspn(end, " \t\n")] != '\0') {
+            goto invalid;
+        }
+        rates[kind] = v * limitUnits[kind];
+        seen[kind] = true;
+    }
+    fclose(f);
+
+    for (kind = 0; kind < RATE_LIMIT_NUM; kind++) {
+        if (seen[kind]) {
+            setRate(kind, rates[kind]);
+        }
+    }
+    return true;
+
+invalid:
+    fprintf(stderr, "Invalid line %d in rate limit file %s\n", lineNr, controlFile);
+    fclose(f);
+    return false;
+}
+
+/* called with rateMutex held */
+static void
+checkControlFile(double t)
+{
+    struct stat sb;
+
+    if (!reloadRequested && t - lastCheck < RATE_LIMIT_CHECK_INTERVAL) {
+        return;
+    }
+    lastCheck = t;
+    if (stat(controlFile, &sb) != 0) {
+        return;
+    }
+    if (reloadRequested ||
+        sb.st_mtim.tv_sec != controlMtime.tv_sec || sb.st_mtim.tv_nsec != controlMtime.tv_nsec) {
+        reloadRequested = 0;
+        controlMtime = sb.st_mtim;
+        if (readControlFile()) {
+            printLimits();
+        }
+    }
+}
+
+static void
+reloadHandler(int sig)
+{
+    (void)sig;
+    reloadRequested = 1;
+}
+
+bool
+RateLimit_SetControlFile(const char *path)
+{
+    struct sigaction sa;
+    struct stat sb;
+    bool success;
+
+    pthread_mutex_lock(&rateMutex);
+    free(controlFile);
+    controlFile = strdup(path);
+    if (controlFile == NULL) {
+        pthread_mutex_unlock(&rateMutex);
+        return false;
+    }
+    if (stat(controlFile, &sb) == 0) {
+        controlMtime = sb.st_mtim;
+    }
+    lastCheck = now();
+    success = readControlFile();
+    rateEnabled = true;
+    pthread_mutex_unlock(&rateMutex);
+    if (!success) {
+        return false;
+    }
+
+    memset(&sa, 0, sizeof sa);
+    sa.sa_handler = reloadHandler;
+    sa.sa_flags = SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    return sigaction(SIGHUP, &sa, NULL) == 0;
+}
+
+static void
+sleepFor(double seconds)
+{
+    struct timespec ts;
+
+    ts.tv_sec = (time_t)seconds;
+    ts.tv_nsec = (long)((seconds - ts.tv_sec) * 1e9);
+    while (nanosleep(&ts, &ts) != 0 && errno == EINTR) {
+    }
+}
+
+void
+RateLimit_Consume(RateLimitKind kind, double amount)
+{
+    TokenBucket *b = &buckets[kind];
+    double wait = 0;
+    double t;
+
+    if (!rateEnabled) {
+        return;
+    }
+
+    pthread_mutex_lock(&rateMutex);
+    t = now();
+    if (controlFile) {
+        checkControlFile(t);
+    }
+    if (b->rate > 0) {
+        b->tokens += (t - b->last) * b->rate;
+        if (b->tokens > b->rate * RATE_LIMIT_BURST) {
+            b->tokens = b->rate * RATE_LIMIT_BURST;
+        }
+        b->last = t;
+        b->tokens -= amount;
+        if (b->tokens < 0) {
+            wait = -b->tokens / b->rate;
+        }
+    }
+    pthread_mutex_unlock(&rateMutex);
+
+    if (wait > 0) {
+        sleepFor(wait);
+    }
+}
+
+/*
+ * The CPU time of the calling thread in nanoseconds, to be passed to
+ * RateLimit_CpuEnd() once the work to be accounted for is done.
+ */
+uint64_t
+RateLimit_CpuStart(void)
+{
+    struct timespec ts;
+
+    if (!rateEnabled) {
+        return 0;
+    }
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+void
+RateLimit_CpuEnd(uint64_t start)
+{
+    uint64_t end;
+
+    if (!rateEnabled) {
+        return;
+    }
+    end = RateLimit_CpuStart();
+    if (end > start) {
+        RateLimit_Consume(RATE_LIMIT_CPU, (end - start) / 1e9);
+    }
+}
@@ -0,0 +1,35 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _RATELIMIT_H_
+#define _RATELIMIT_H_
+
+#include <stdbool.h>
+#include <stdint.h>
+
+typedef enum {
+    RATE_LIMIT_READ,    /* bytes read per second */
+    RATE_LIMIT_WRITE,   /* bytes written per second */
+    RATE_LIMIT_CPU,     /* CPU seconds spent compressing per second */
+    RATE_LIMIT_NUM
+} RateLimitKind;
+
+void RateLimit_Set(RateLimitKind kind, double rate);
+bool RateLimit_SetControlFile(const char *path);
+void RateLimit_Consume(RateLimitKind kind, double amount);
+uint64_t RateLimit_CpuStart(void);
+void RateLimit_CpuEnd(uint64_t start);
+
+#endif /* _RATELIMIT_H_ */
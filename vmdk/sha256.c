@@ -0,0 +1,148 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+/* SHA-256 as specified in FIPS 180-4. */
+
+#include "sha256.h"
+
+#include <string.h>
+
+static const uint32_t k[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+};
+
+#define ROTR(x, n)  (((x) >> (n)) | ((x) << (32 - (n))))
+
+static void
+sha256Block(uint32_t state[8], const uint8_t *block)
+{
+    uint32_t w[64];
+    uint32_t a, b, c, d, e, f, g, h;
+    int i;
+
+    for (i = 0; i < 16; i++) {
+        w[i] = (uint32_t)block[4 * i] << 24 | (uint32_t)block[4 * i + 1] << 16 |
+               (uint32_t)block[4 * i + 2] << 8 | block[4 * i + 3];
+    }
+    for (i = 16; i < 64; i++) {
+        uint32_t s0 = ROTR(w[i - 15], 7) ^ ROTR(w[i - 15], 18) ^ (w[i - 15] >> 3);
+        uint32_t s1 = ROTR(w[i - 2], 17) ^ ROTR(w[i - 2], 19) ^ (w[i - 2] >> 10);
+
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+
+    a = state[0]; b = state[1]; c = state[2]; d = state[3];
+    e = state[4]; f = state[5]; g = state[6]; h = state[7];
+    for (i = 0; i < 64; i++) {
+        uint32_t s1 = ROTR(e, 6) ^ ROTR(e, 11) ^ ROTR(e, 25);
+        uint32_t ch = (e & f) ^ (~e & g);
+        uint32_t t1 = h + s1 + ch + k[i] + w[i];
+        uint32_t s0 = ROTR(a, 2) ^ ROTR(a, 13) ^ ROTR(a, 22);
+        uint32_t maj = (a & b) ^ (a & c) ^ (b & c);
+        uint32_t t2 = s0 + maj;
+
+        h = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+    state[0] += a; state[1] += b; state[2] += c; state[3] += d;
+    state[4] += e; state[5] += f; state[6] += g; state[7] += h;
+}
+
+void
+Sha256_Init(Sha256Context *ctx)
+{
+    static const uint32_t init[8] = {
+        0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+    };
+
+    memcpy(ctx->state, init, sizeof init);
+    ctx->length = 0;
+    ctx->bufferLen = 0;
+}
+
+void
+Sha256_Update(Sha256Context *ctx,
+              const void *data,
+              size_t len)
+{
+    const uint8_t *p = data;
+
+    ctx->length += len;
+    if (ctx->bufferLen > 0) {
+        size_t n = sizeof ctx->buffer - ctx->bufferLen;
+
+        if (n > len) {
+            n = len;
+        }
+        memcpy(ctx->buffer + ctx->bufferLen, p, n);
+        ctx->bufferLen += n;
+        p += n;
+        len -= n;
+        if (ctx->bufferLen < sizeof ctx->buffer) {
+            return;
+        }
+        sha256Block(ctx->state, ctx->buffer);
+        ctx->bufferLen = 0;
+    }
+    while (len >= sizeof ctx->buffer) {
+        sha256Block(ctx->state, p);
+        p += sizeof ctx->buffer;
+        len -= sizeof ctx->buffer;
+    }
+    memcpy(ctx->buffer, p, len);
+    ctx->bufferLen = len;
+}
+
+void
+Sha256_Final(Sha256Context *ctx,
+             uint8_t digest[SHA256_DIGEST_SIZE])
+{
+    uint64_t bits = ctx->length * 8;
+    uint8_t pad[72] = { 0x80 };
+    size_t padLen = (ctx->bufferLen < 56 ? 56 : 120) - ctx->bufferLen;
+    int i;
+
+    for (i = 0; i < 8; i++) {
+        pad[padLen + i] = bits >> (56 - 8 * i);
+    }
+    Sha256_Update(ctx, pad, padLen + 8);
+    for (i = 0; i < 8; i++) {
+        digest[4 * i] = ctx->state[i] >> 24;
+        digest[4 * i + 1] = ctx->state[i] >> 16;
+        digest[4 * i + 2] = ctx->state[i] >> 8;
+        digest[4 * i + 3] = ctx->state[i];
+    }
+}
+
+void
+Sha256_ToHex(const uint8_t digest[SHA256_DIGEST_SIZE],
+             char hex[2 * SHA256_DIGEST_SIZE + 1])
+{
+    static const char digits[] = "0123456789abcdef";
+    int i;
+
+    for (i = 0; i < SHA256_DIGEST_SIZE; i++) {
+        hex[2 * i] = digits[digest[i] >> 4];
+        hex[2 * i + 1] = digits[digest[i] & 15];
+    }
+    hex[2 * SHA256_DIGEST_SIZE] = '\0';
+}
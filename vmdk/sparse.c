@@ -17,10 +17,15 @@
 
 #include "vmware_vmdk.h"
 #include "diskinfo.h"
+#include "digest.h"
+#include "graincache.h"
+#include "ratelimit.h"
+#include "ultra.h"
 
 #include <errno.h>
 #include <fcntl.h>
 #include <pthread.h>
+#include <stdarg.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
@@ -60,15 +65,30 @@ typedef struct GrainInfo {
     uint32_t bufferValidEnd;
 } GrainInfo;
 
+typedef struct {
+    char *fileName;         /* NULL if checkpoints are disabled */
+    uint64_t interval;      /* source bytes between checkpoints */
+    off_t next;             /* source position of the next checkpoint */
+    off_t resumePos;        /* source position to start converting at */
+    uint64_t srcSize;
+    uint64_t srcMtimeSec;
+    uint64_t srcMtimeNsec;
+} CheckpointInfo;
+
 typedef struct SparseVmdkWriter {
     SparseGTInfo gtInfo;
     uint32_t curSP;
     GrainInfo currentGrain;
     int fd;
+    off_t offset;           /* position of the disk in fd, if it is embedded in another file */
     char *fileName;
     int compressionLevel;
     bool doReorder;
+    bool orderedCommit;     /* grains are written in LBA order, so they never need reordering */
     uint32_t sectorSize; /* we can only know for sure when writing, therefore it's here */
+    CheckpointInfo checkpoint;
+    ContentDigest *digest;  /* digest of the source content, complete after copyDisk, NULL if not wanted */
+    GrainCache *grainCache; /* optional, not owned */
 } SparseVmdkWriter;
 
 typedef struct StreamOptimizedDiskInfo {
@@ -222,9 +242,11 @@ setSparseExtentHeader(SparseExtentHeaderOnDisk *dst,
 
 static char *
 makeDiskDescriptorFile(const char *fileName,
+                       const char *createType,
                        uint64_t capacity,
                        uint32_t sectorSize,
-                       uint32_t cid)
+                       uint32_t cid,
+                       const char *contentDigest)
 {
     static const char ddfTemplate[] =
 "# Disk DescriptorFile\n"
@@ -232,7 +254,7 @@ makeDiskDescriptorFile(const char *fileName,
 "encoding=\"UTF-8\"\n"
 "CID=%08x\n"
 "parentCID=ffffffff\n"
-"createType=\"streamOptimized\"\n"
+"createType=\"%s\"\n"
 "\n"
 "# Extent description\n"
 "RW %llu SPARSE \"%s\"\n"
@@ -246,12 +268,14 @@ makeDiskDescriptorFile(const char *fileName,
 "ddb.geometry.heads = \"255\"\n" /* 255/63 is good for anything bigger than 4GB. */
 "ddb.geometry.sectors = \"63\"\n"
 "%s"
+"%s"
 "ddb.adapterType = \"lsilogic\"\n"
 "ddb.toolsInstallType = \"4\"\n" /* unmanaged (open-vm-tools) */
 "ddb.toolsVersion = \"%s\""; /* open-vm-tools version */
 
     unsigned int cylinders;
     char *secEntries = NULL;
+    char *digestEntry = NULL;
     char *ret = NULL;
 
     if (capacity > 65535 * 255 * 63) {
@@ -265,12 +289,20 @@ makeDiskDescriptorFile(const char *fileName,
             return NULL;
     }
 
-    if (asprintf(&ret, ddfTemplate, cid, (long long int)capacity, fileName, (uint32_t)mrand48(), (uint32_t)mrand48(), (uint32_t)mrand48(), cid, cylinders, secEntries ? secEntries : "", toolsVersion) == -1) {
-        return NULL;
+    if (contentDigest) {
+        if (asprintf(&digestEntry, "ddb.contentDigest = \"%s\"\n", contentDigest) == -1) {
+            free(secEntries);
+            return NULL;
+        }
+    }
+
+    if (asprintf(&ret, ddfTemplate, cid, createType, (long long int)capacity, fileName, (uint32_t)mrand48(), (uint32_t)mrand48(), (uint32_t)mrand48(), cid, cylinders, secEntries ? secEntries : "", digestEntry ? digestEntry : "", toolsVersion) == -1) {
+        ret = NULL;
     }
 
     if (secEntries)
         free(secEntries);
+    free(digestEntry);
 
     return ret;
 }
@@ -340,6 +372,7 @@ safePwrite(int fd,
 #ifdef DEBUG
     printf("DEBUG: Writing to fd %d at pos %lld, len %zu\n", fd, (long long)pos, len);
 #endif
+    RateLimit_Consume(RATE_LIMIT_WRITE, len);
     ssize_t written = pwrite(fd, buf, len, pos);
 
     if (written == -1) {
@@ -362,6 +395,7 @@ safePread(int fd,
 #ifdef DEBUG
     printf("DEBUG: Reading from fd %d at pos %lld, len %zu\n", fd, (long long)pos, len);
 #endif
+    RateLimit_Consume(RATE_LIMIT_READ, len);
     ssize_t rd = pread(fd, buf, len, pos);
 
     if (rd == -1) {
@@ -475,7 +509,7 @@ writeGrain(StreamOptimizedDiskInfo *sodi, GrainInfo *grain, uint32_t sp)
         memset(grain->zstream.next_out, 0, rem);
         dataLen += rem;
     }
-    if (!safePwrite(sodi->writer.fd, grainHdr, dataLen, sp * VMDK_SECTOR_SIZE)) {
+    if (!safePwrite(sodi->writer.fd, grainHdr, dataLen, sodi->writer.offset + sp * VMDK_SECTOR_SIZE)) {
         return -1;
     }
 
@@ -627,7 +661,9 @@ initGrain(StreamOptimizedDiskInfo *sodi, GrainInfo *grain)
     grain->zstream.zalloc = NULL;
     grain->zstream.zfree = NULL;
     grain->zstream.opaque = &sodi->writer;
-    if (deflateInit(&grain->zstream, sodi->writer.compressionLevel) != Z_OK) {
+    /* ultra compression starts from level 9, see deflateGrains */
+    if (deflateInit(&grain->zstream, sodi->writer.compressionLevel > Z_BEST_COMPRESSION ?
+                                     Z_BEST_COMPRESSION : sodi->writer.compressionLevel) != Z_OK) {
         goto failGrainBuffer;
     }
     maxOutSize = deflateBound(&grain->zstream, sodi->diskHdr.grainSize * VMDK_SECTOR_SIZE) + sizeof(SparseGrainLBAHeaderOnDisk);
@@ -657,33 +693,321 @@ typedef struct {
     pthread_mutex_t readPosMutex;
     pthread_mutex_t writeSPMutex;
     pthread_mutex_t stateMutex;
+    /* serializes writing checkpoints, outside of readPosMutex */
+    pthread_mutex_t checkpointMutex;
+    off_t checkpointWritten;
+    /* with orderedCommit, grains get their place in the order they were read */
+    pthread_cond_t commitCond;
+    off_t commitPos;        /* source position of the next grain to commit, under writeSPMutex */
 
     StreamOptimizedDiskInfo *sodi;
     DiskInfo *src;
     off_t readPos;
 
+    /*
+     * source position each thread is compressing, -1 if idle or only
+     * hashing content that was converted before a resume
+     */
+    off_t *busyPos;
+    int numSlots;
+
     GrainThreadState state;
+
+    /* ultra compression results compared to level 9, under stateMutex */
+    uint64_t ultraGrains;
+    uint64_t ultraImproved;
+    uint64_t level9Bytes;
+    uint64_t ultraBytes;
+    uint64_t ultraMaxSaved;
 } GrainThreadContext;
 
+#define CHECKPOINT_MAGIC    "VMDKCKPT"
+#define CHECKPOINT_VERSION  1
+
+#pragma pack(push, 1)
+typedef struct {
+    char magic[8];
+    __le32 version;
+    __le32 grainSize;
+    __le64 capacity;
+    __le64 srcSize;
+    __le64 srcMtimeSec;
+    __le64 srcMtimeNsec;
+    __le64 interval;
+    __le64 readPos;
+    __le32 curSP;
+    __le32 numGTEs;
+    /* followed by numGTEs grain table entries and a CRC-32 of everything */
+} CheckpointHeaderOnDisk;
+#pragma pack(pop)
+
+/*
+ * A checkpoint taken under readPosMutex, written after it is released so
+ * the other threads do not wait for the sync.
+ */
+typedef struct {
+    off_t watermark;
+    uint8_t *buf;
+    size_t len;
+} Checkpoint;
+
+/*
+ * Takes the state needed to resume the conversion at the source position
+ * watermark: all grains before it are written, the grains after it are
+ * converted again.  The grain table entries before the watermark do not
+ * change any more.
+ */
+static bool
+takeCheckpoint(StreamOptimizedDiskInfo *sodi,
+               off_t watermark,
+               uint32_t curSP,
+               Checkpoint *out)
+{
+    CheckpointInfo *ckpt = &sodi->writer.checkpoint;
+    uint64_t numGTEs = watermark / (sodi->diskHdr.grainSize * VMDK_SECTOR_SIZE);
+    size_t len = sizeof(CheckpointHeaderOnDisk) + numGTEs * sizeof(uint32_t);
+    CheckpointHeaderOnDisk *onDisk;
+    uint8_t *buf;
+    __le32 crc;
+
+    buf = malloc(len + sizeof crc);
+    if (!buf) {
+        return false;
+    }
+    onDisk = (CheckpointHeaderOnDisk *)buf;
+    memset(onDisk, 0, sizeof *onDisk);
+    memcpy(onDisk->magic, CHECKPOINT_MAGIC, sizeof onDisk->magic);
+    onDisk->version = __cpu_to_le32(CHECKPOINT_VERSION);
+    onDisk->grainSize = __cpu_to_le32(sodi->diskHdr.grainSize);
+    onDisk->capacity = __cpu_to_le64(sodi->diskHdr.capacity);
+    onDisk->srcSize = __cpu_to_le64(ckpt->srcSize);
+    onDisk->srcMtimeSec = __cpu_to_le64(ckpt->srcMtimeSec);
+    onDisk->srcMtimeNsec = __cpu_to_le64(ckpt->srcMtimeNsec);
+    onDisk->interval = __cpu_to_le64(ckpt->interval);
+    onDisk->readPos = __cpu_to_le64(watermark);
+    onDisk->curSP = __cpu_to_le32(curSP);
+    onDisk->numGTEs = __cpu_to_le32(numGTEs);
+    memcpy(buf + sizeof *onDisk, sodi->writer.gtInfo.gt, numGTEs * sizeof(uint32_t));
+    crc = __cpu_to_le32(crc32(0, buf, len));
+    memcpy(buf + len, &crc, sizeof crc);
+
+    out->watermark = watermark;
+    out->buf = buf;
+    out->len = len + sizeof crc;
+    return true;
+}
+
+/*
+ * Persists a checkpoint taken with takeCheckpoint().  Data is synced
+ * before the sidecar is atomically replaced, so the sidecar never refers
+ * to unwritten grains.  Frees the checkpoint.
+ */
+static bool
+writeCheckpoint(GrainThreadContext *gtCtx,
+                Checkpoint *cp)
+{
+    StreamOptimizedDiskInfo *sodi = gtCtx->sodi;
+    CheckpointInfo *ckpt = &sodi->writer.checkpoint;
+    char *tmpName = NULL;
+    int fd = -1;
+    bool success = false;
+
+    pthread_mutex_lock(&gtCtx->checkpointMutex);
+    /* a later checkpoint was written by another thread meanwhile */
+    if (cp->watermark <= gtCtx->checkpointWritten) {
+        success = true;
+        goto out;
+    }
+    if (asprintf(&tmpName, "%s.tmp", ckpt->fileName) == -1) {
+        tmpName = NULL;
+        goto out;
+    }
+    if (fsync(sodi->writer.fd) != 0) {
+        fprintf(stderr, "Failed to sync %s: %s\n", sodi->writer.fileName, strerror(errno));
+        goto out;
+    }
+    fd = open(tmpName, O_WRONLY | O_CREAT | O_TRUNC, 0666);
+    if (fd == -1) {
+        fprintf(stderr, "Failed to create %s: %s\n", tmpName, strerror(errno));
+        goto out;
+    }
+    if (!safePwrite(fd, cp->buf, cp->len, 0) || fsync(fd) != 0) {
+        goto out;
+    }
+    if (rename(tmpName, ckpt->fileName) != 0) {
+        fprintf(stderr, "Failed to rename %s: %s\n", tmpName, strerror(errno));
+        goto out;
+    }
+    gtCtx->checkpointWritten = cp->watermark;
+    success = true;
+
+out:
+    pthread_mutex_unlock(&gtCtx->checkpointMutex);
+    if (fd != -1) {
+        close(fd);
+    }
+    if (!success && tmpName) {
+        unlink(tmpName);
+    }
+    free(tmpName);
+    free(cp->buf);
+    cp->buf = NULL;
+    return success;
+}
+
+/*
+ * Called with readPosMutex held, before gtCtx->readPos is advanced.  Sets
+ * cp->buf if a checkpoint is due, to be written with writeCheckpoint()
+ * once readPosMutex is released.
+ */
+static bool
+maybeCheckpoint(GrainThreadContext *gtCtx,
+                Checkpoint *cp)
+{
+    StreamOptimizedDiskInfo *sodi = gtCtx->sodi;
+    CheckpointInfo *ckpt = &sodi->writer.checkpoint;
+    off_t watermark = gtCtx->readPos;
+    uint32_t curSP;
+    int i;
+
+    cp->buf = NULL;
+    if (!ckpt->fileName || gtCtx->readPos < ckpt->next) {
+        return true;
+    }
+    for (i = 0; i < gtCtx->numSlots; i++) {
+        if (gtCtx->busyPos[i] != -1 && gtCtx->busyPos[i] < watermark) {
+            watermark = gtCtx->busyPos[i];
+        }
+    }
+    pthread_mutex_lock(&gtCtx->writeSPMutex);
+    curSP = sodi->writer.curSP;
+    pthread_mutex_unlock(&gtCtx->writeSPMutex);
+
+    if (!takeCheckpoint(sodi, watermark, curSP, cp)) {
+        return false;
+    }
+    while (ckpt->next <= gtCtx->readPos) {
+        ckpt->next += ckpt->interval;
+    }
+    return true;
+}
+
+/*
+ * Tries to compress the grain smaller than level 9 did, replacing the
+ * deflated data in the grain if that succeeds.
+ */
 static void
-*deflateGrainThread(void *arg)
+ultraDeflateGrain(GrainThreadContext *gtCtx,
+                  GrainInfo *grain,
+                  UltraCompressor *uc,
+                  uint8_t *ultraBuf)
+{
+    uint8_t *data = grain->zlibBuffer.data + sizeof(SparseGrainLBAHeaderOnDisk);
+    size_t level9Len = grain->zstream.next_out - data;
+    size_t ultraLen;
+    uint64_t level9Bytes, ultraBytes;
+
+    ultraLen = Ultra_Compress(uc, grain->buffer, grain->bufferValidEnd, ultraBuf, level9Len - 1);
+    level9Bytes = CEILING(sizeof(SparseGrainLBAHeaderOnDisk) + level9Len, VMDK_SECTOR_SIZE) * VMDK_SECTOR_SIZE;
+    ultraBytes = level9Bytes;
+    if (ultraLen != 0) {
+        memcpy(data, ultraBuf, ultraLen);
+        grain->zstream.next_out = data + ultraLen;
+        ultraBytes = CEILING(sizeof(SparseGrainLBAHeaderOnDisk) + ultraLen, VMDK_SECTOR_SIZE) * VMDK_SECTOR_SIZE;
+    }
+
+    pthread_mutex_lock(&gtCtx->stateMutex);
+    gtCtx->ultraGrains++;
+    gtCtx->level9Bytes += level9Bytes;
+    gtCtx->ultraBytes += ultraBytes;
+    if (ultraBytes < level9Bytes) {
+        gtCtx->ultraImproved++;
+        if (level9Bytes - ultraBytes > gtCtx->ultraMaxSaved) {
+            gtCtx->ultraMaxSaved = level9Bytes - ultraBytes;
+        }
+    }
+    pthread_mutex_unlock(&gtCtx->stateMutex);
+}
+
+static bool
+hasFailed(GrainThreadContext *gtCtx)
+{
+    bool failed;
+
+    pthread_mutex_lock(&gtCtx->stateMutex);
+    failed = gtCtx->state == GT_STATE_FAILED;
+    pthread_mutex_unlock(&gtCtx->stateMutex);
+    return failed;
+}
+
+/*
+ * Reserves sectors for the grain read at readPos and returns its position
+ * in sp.  With orderedCommit, waits until all grains before it have been
+ * committed, zero grains and grains converted before a resume included,
+ * so the grains are written in LBA order without reordering them later.
+ */
+static bool
+commitGrain(GrainThreadContext *gtCtx,
+            off_t readPos,
+            size_t readLen,
+            uint32_t sectors,
+            uint32_t *sp)
+{
+    StreamOptimizedDiskInfo *sodi = gtCtx->sodi;
+
+    pthread_mutex_lock(&gtCtx->writeSPMutex);
+    if (sodi->writer.orderedCommit) {
+        while (gtCtx->commitPos != readPos) {
+            if (hasFailed(gtCtx)) {
+                pthread_mutex_unlock(&gtCtx->writeSPMutex);
+                return false;
+            }
+            pthread_cond_wait(&gtCtx->commitCond, &gtCtx->writeSPMutex);
+        }
+        gtCtx->commitPos = readPos + readLen;
+        pthread_cond_broadcast(&gtCtx->commitCond);
+    }
+    *sp = sodi->writer.curSP;
+    sodi->writer.curSP += sectors;
+    pthread_mutex_unlock(&gtCtx->writeSPMutex);
+    return true;
+}
+
+/*
+ * Compresses grains of one disk until all of them have been claimed.
+ * slot is the index of the calling thread in the pool.
+ */
+static void
+deflateGrains(GrainThreadContext *gtCtx, int slot)
 {
-    GrainThreadContext *gtCtx = (GrainThreadContext *)arg;
     GrainInfo grain = {0};
     StreamOptimizedDiskInfo *sodi = gtCtx->sodi;
     SparseExtentHeader *hdr = &sodi->diskHdr;
     off_t capacity = gtCtx->src->vmt->getCapacity(gtCtx->src);
+    UltraCompressor *uc = NULL;
+    uint8_t *ultraBuf = NULL;
 
     if (initGrain(sodi, &grain) == false) {
         goto fail;
     }
+    if (sodi->writer.compressionLevel == COMPRESSION_LEVEL_ULTRA) {
+        uc = Ultra_Create();
+        ultraBuf = malloc(grain.zlibBufferSize);
+        if (!uc || !ultraBuf) {
+            goto fail;
+        }
+    }
 
     while (true) {
         off_t readPos;
         size_t readLen;
         off_t remaining;
+        uint8_t hash[SHA256_DIGEST_SIZE];
+        bool zeroed, useCache;
+        Checkpoint checkpoint = {0};
 
         pthread_mutex_lock(&gtCtx->readPosMutex);
+        gtCtx->busyPos[slot] = -1;
         readPos = gtCtx->readPos;
 
         // Check if another thread has failed - exit early to avoid wasted work
@@ -704,6 +1028,11 @@ static void
             break;
         }
 
+        if (!maybeCheckpoint(gtCtx, &checkpoint)) {
+            pthread_mutex_unlock(&gtCtx->readPosMutex);
+            goto fail;
+        }
+
         // Calculate how much this thread should read
         remaining = capacity - readPos;
         readLen = hdr->grainSize * VMDK_SECTOR_SIZE;
@@ -717,21 +1046,78 @@ static void
         /* Advance global position before reading and unlock,
            so other threads get updated pos in the mean time */
         gtCtx->readPos += readLen;
+        if (readPos >= sodi->writer.checkpoint.resumePos) {
+            gtCtx->busyPos[slot] = readPos;
+        }
 
         pthread_mutex_unlock(&gtCtx->readPosMutex);
 
+        if (checkpoint.buf && !writeCheckpoint(gtCtx, &checkpoint)) {
+            goto fail;
+        }
+
         // Read data from source
+        RateLimit_Consume(RATE_LIMIT_READ, readLen);
         if (gtCtx->src->vmt->pread(gtCtx->src, grain.buffer, readLen, readPos) != (ssize_t)readLen) {
             goto fail;
         }
         grain.bufferValidEnd = readLen;
+        zeroed = isZeroed(grain.buffer, readLen);
 
-        // Process non-zero data
-        if (!isZeroed(grain.buffer, readLen)) {
+        // The grain hash is the cache key and a leaf of the digest
+        useCache = sodi->writer.grainCache && !zeroed && readPos >= sodi->writer.checkpoint.resumePos;
+        if (useCache) {
+            Sha256Context sha;
+
+            Sha256_Init(&sha);
+            Sha256_Update(&sha, grain.buffer, readLen);
+            Sha256_Final(&sha, hash);
+        }
+        if (sodi->writer.digest &&
+            !(useCache && readLen <= CONTENT_DIGEST_LEAF_SIZE ?
+              ContentDigest_AddLeaf(sodi->writer.digest, readPos, readLen, hash) :
+              ContentDigest_Update(sodi->writer.digest, readPos, grain.buffer, readLen))) {
+            fprintf(stderr, "Failed to update content digest: %s\n", strerror(errno));
+            goto fail;
+        }
+
+        // Already converted before resuming, only needed for the digest
+        if (readPos < sodi->writer.checkpoint.resumePos) {
             uint32_t sp;
-            if (deflateGrain(&grain) < 0) {
+
+            if (sodi->writer.orderedCommit && !commitGrain(gtCtx, readPos, readLen, 0, &sp)) {
                 goto fail;
             }
+            continue;
+        }
+
+        // Process non-zero data
+        if (!zeroed) {
+            uint8_t *data = grain.zlibBuffer.data + sizeof(SparseGrainLBAHeaderOnDisk);
+            size_t cachedLen = 0;
+            uint32_t sp;
+
+            if (useCache) {
+                cachedLen = GrainCache_Get(sodi->writer.grainCache, hash, sodi->writer.compressionLevel, readLen,
+                                           data, grain.zlibBufferSize - sizeof(SparseGrainLBAHeaderOnDisk));
+            }
+            if (cachedLen > 0) {
+                grain.zstream.next_out = data + cachedLen;
+            } else {
+                uint64_t cpuStart = RateLimit_CpuStart();
+
+                if (deflateGrain(&grain) < 0) {
+                    goto fail;
+                }
+                if (uc) {
+                    ultraDeflateGrain(gtCtx, &grain, uc, ultraBuf);
+                }
+                RateLimit_CpuEnd(cpuStart);
+                if (useCache) {
+                    GrainCache_Put(sodi->writer.grainCache, hash, sodi->writer.compressionLevel, readLen,
+                                   data, grain.zstream.next_out - data);
+                }
+            }
             ssize_t dataLen = grain.zstream.next_out - grain.zlibBuffer.data;
             uint32_t rem = dataLen & (VMDK_SECTOR_SIZE - 1);
             if (rem != 0) {
@@ -739,39 +1125,168 @@ static void
                 dataLen += rem;
             }
 
-            pthread_mutex_lock(&gtCtx->writeSPMutex);
-            sp = sodi->writer.curSP;
-            sodi->writer.curSP += dataLen / VMDK_SECTOR_SIZE;
-            pthread_mutex_unlock(&gtCtx->writeSPMutex);
-
+            if (!commitGrain(gtCtx, readPos, readLen, dataLen / VMDK_SECTOR_SIZE, &sp)) {
+                goto fail;
+            }
             if((dataLen = writeGrain(sodi, &grain, sp)) < 0) {
                 goto fail;
             }
+        } else if (sodi->writer.orderedCommit) {
+            uint32_t sp;
+
+            if (!commitGrain(gtCtx, readPos, readLen, 0, &sp)) {
+                goto fail;
+            }
         }
     }
 
+    Ultra_Free(uc);
+    free(ultraBuf);
     freeGrain(&grain);
-    return arg;
+    return;
 
 fail:
     pthread_mutex_lock(&gtCtx->stateMutex);
     gtCtx->state = GT_STATE_FAILED;
     pthread_mutex_unlock(&gtCtx->stateMutex);
+    /* threads waiting for this grain to be committed give up */
+    pthread_mutex_lock(&gtCtx->writeSPMutex);
+    pthread_cond_broadcast(&gtCtx->commitCond);
+    pthread_mutex_unlock(&gtCtx->writeSPMutex);
+    Ultra_Free(uc);
+    free(ultraBuf);
     freeGrain(&grain);
+}
+
+typedef struct {
+    GrainThreadContext *gtCtxs;
+    int numDisks;
+    int slot;
+} GrainThreadArg;
+
+/*
+ * Worker of the shared pool.  All threads work on the first disk until
+ * its last grain has been claimed, then move on to the next one, so the
+ * tail of one disk overlaps with the start of the next.
+ */
+static void
+*deflateGrainThread(void *arg)
+{
+    GrainThreadArg *gtArg = (GrainThreadArg *)arg;
+    int i;
+
+    for (i = 0; i < gtArg->numDisks; i++) {
+        deflateGrains(&gtArg->gtCtxs[i], gtArg->slot);
+    }
     return arg;
 }
 
+/*
+ * Loads the sidecar of an interrupted conversion and checks that it
+ * belongs to this source and destination.  The grain headers of all
+ * committed grains are checked against the grain table.
+ */
+static bool
+loadCheckpoint(StreamOptimizedDiskInfo *sodi)
+{
+    CheckpointInfo *ckpt = &sodi->writer.checkpoint;
+    CheckpointHeaderOnDisk onDisk;
+    uint8_t *buf = NULL;
+    uint64_t grainBytes = sodi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint64_t numGTEs, i;
+    uint32_t curSP;
+    size_t len;
+    __le32 crc;
+    struct stat sb;
+    bool success = false;
+    int fd;
+
+    fd = open(ckpt->fileName, O_RDONLY);
+    if (fd == -1) {
+        fprintf(stderr, "Cannot open checkpoint %s: %s\n", ckpt->fileName, strerror(errno));
+        return false;
+    }
+    if (fstat(fd, &sb) != 0 || !safePread(fd, &onDisk, sizeof onDisk, 0)) {
+        goto invalid;
+    }
+    numGTEs = __le32_to_cpu(onDisk.numGTEs);
+    len = sizeof onDisk + numGTEs * sizeof(uint32_t);
+    if (memcmp(onDisk.magic, CHECKPOINT_MAGIC, sizeof onDisk.magic) != 0 ||
+        __le32_to_cpu(onDisk.version) != CHECKPOINT_VERSION ||
+        (uint64_t)sb.st_size != len + sizeof crc) {
+        goto invalid;
+    }
+    buf = malloc(len);
+    if (!buf || !safePread(fd, buf, len, 0) || !safePread(fd, &crc, sizeof crc, len) ||
+        __le32_to_cpu(crc) != crc32(0, buf, len)) {
+        goto invalid;
+    }
+    if (__le32_to_cpu(onDisk.grainSize) != sodi->diskHdr.grainSize ||
+        __le64_to_cpu(onDisk.capacity) != sodi->diskHdr.capacity ||
+        numGTEs > sodi->writer.gtInfo.GTEs ||
+        __le64_to_cpu(onDisk.readPos) != numGTEs * grainBytes) {
+        fprintf(stderr, "Checkpoint %s does not match the destination disk\n", ckpt->fileName);
+        goto out;
+    }
+    if (__le64_to_cpu(onDisk.srcSize) != ckpt->srcSize ||
+        __le64_to_cpu(onDisk.srcMtimeSec) != ckpt->srcMtimeSec ||
+        __le64_to_cpu(onDisk.srcMtimeNsec) != ckpt->srcMtimeNsec) {
+        fprintf(stderr, "Source disk has changed since checkpoint %s was written\n", ckpt->fileName);
+        goto out;
+    }
+
+    curSP = __le32_to_cpu(onDisk.curSP);
+    memcpy(sodi->writer.gtInfo.gt, buf + sizeof onDisk, numGTEs * sizeof(uint32_t));
+    for (i = 0; i < numGTEs; i++) {
+        uint32_t sect = __le32_to_cpu(sodi->writer.gtInfo.gt[i]);
+        SparseGrainLBAHeaderOnDisk grainHdr;
+
+        if (sect == 0) {
+            continue;
+        }
+        if (sect < sodi->diskHdr.overHead || sect >= curSP ||
+            !safePread(sodi->writer.fd, &grainHdr, sizeof grainHdr, sodi->writer.offset + sect * VMDK_SECTOR_SIZE) ||
+            __le64_to_cpu(grainHdr.lba) != i * sodi->diskHdr.grainSize ||
+            sect * VMDK_SECTOR_SIZE + sizeof grainHdr + __le32_to_cpu(grainHdr.cmpSize) > curSP * VMDK_SECTOR_SIZE) {
+            fprintf(stderr, "Grain %llu in %s does not match checkpoint %s\n",
+                    (unsigned long long)i, sodi->writer.fileName, ckpt->fileName);
+            goto out;
+        }
+    }
+
+    sodi->writer.curSP = curSP;
+    ckpt->resumePos = numGTEs * grainBytes;
+    if (ckpt->interval == 0) {
+        ckpt->interval = __le64_to_cpu(onDisk.interval);
+    }
+    ckpt->next = ckpt->resumePos + ckpt->interval;
+    printf("Resuming conversion at %llu MB\n", (unsigned long long)(ckpt->resumePos >> 20));
+    success = true;
+    goto out;
+
+invalid:
+    fprintf(stderr, "Invalid checkpoint %s\n", ckpt->fileName);
+out:
+    free(buf);
+    close(fd);
+    if (!success) {
+        errno = EINVAL;
+    }
+    return success;
+}
+
 /* Add helper functions before reorderGrains */
 static bool
-writeGrainTables(int fd, const SparseExtentHeader *hdr, const SparseGTInfo *gtInfo)
+writeGrainTables(int fd, off_t offset, SectorType gdOffset, const SparseGTInfo *gtInfo)
 {
     return safePwrite(fd, gtInfo->gd,
                      (gtInfo->GDsectors + gtInfo->GTsectors * gtInfo->GTs) * VMDK_SECTOR_SIZE,
-                     hdr->gdOffset * VMDK_SECTOR_SIZE);
+                     offset + gdOffset * VMDK_SECTOR_SIZE);
 }
 
 static bool
-writeDescriptor(int fd, const SparseExtentHeader *hdr, uint32_t sectorSize)
+writeDescriptor(int fd, off_t offset, const SparseExtentHeader *hdr, const char *extentName,
+                const char *createType, uint32_t sectorSize, const char *contentDigest)
 {
     uint32_t cid;
     char *descFile;
@@ -781,25 +1296,26 @@ writeDescriptor(int fd, const SparseExtentHeader *hdr, uint32_t sectorSize)
         cid = mrand48();
     } while (cid == 0xFFFFFFFFU || cid == 0xFFFFFFFEU);
 
-    descFile = makeDiskDescriptorFile("disk", hdr->capacity, sectorSize, cid);
+    descFile = makeDiskDescriptorFile(extentName, createType, hdr->capacity, sectorSize, cid, contentDigest);
     if (!descFile) {
         fprintf(stderr, "Failed to create descriptor file\n");
         return false;
     }
 
-    success = (pwrite(fd, descFile, strlen(descFile), hdr->descriptorOffset * VMDK_SECTOR_SIZE) == (ssize_t)strlen(descFile));
+    success = (pwrite(fd, descFile, strlen(descFile), offset + hdr->descriptorOffset * VMDK_SECTOR_SIZE) ==
+               (ssize_t)strlen(descFile));
     free(descFile);
     return success;
 }
 
 static bool
-writeHeaders(int fd, const SparseExtentHeader *hdr)
+writeHeaders(int fd, off_t offset, const SparseExtentHeader *hdr)
 {
     SparseExtentHeaderOnDisk onDisk;
 
     /* Write header with unclean flag */
     setSparseExtentHeader(&onDisk, hdr, true);
-    if (pwrite(fd, &onDisk, sizeof onDisk, 0) != sizeof onDisk) {
+    if (pwrite(fd, &onDisk, sizeof onDisk, offset) != sizeof onDisk) {
         fprintf(stderr, "Failed to write temporary header\n");
         return false;
     }
@@ -810,7 +1326,7 @@ writeHeaders(int fd, const SparseExtentHeader *hdr)
 
     /* Write final header */
     setSparseExtentHeader(&onDisk, hdr, false);
-    if (pwrite(fd, &onDisk, sizeof onDisk, 0) != sizeof onDisk) {
+    if (pwrite(fd, &onDisk, sizeof onDisk, offset) != sizeof onDisk) {
         fprintf(stderr, "Failed to write final header\n");
         return false;
     }
@@ -825,7 +1341,7 @@ writeHeaders(int fd, const SparseExtentHeader *hdr)
 static bool
 rewriteGrains(StreamOptimizedDiskInfo *sodi,
               SparseGTInfo *srcGT, SparseGTInfo *dstGT,
-              int srcFd, int dstFd)
+              int srcFd, off_t srcOffset, int dstFd)
 {
     uint8_t *readBuf = NULL;
     size_t readBufSize;
@@ -860,7 +1376,7 @@ rewriteGrains(StreamOptimizedDiskInfo *sodi,
 #endif
 
         /* Read grain header first to get compressed size */
-        if (!safePread(srcFd, readBuf, VMDK_SECTOR_SIZE, oldSector * VMDK_SECTOR_SIZE)) {
+        if (!safePread(srcFd, readBuf, VMDK_SECTOR_SIZE, srcOffset + oldSector * VMDK_SECTOR_SIZE)) {
             fprintf(stderr, "Failed to read grain header for grain %llu\n", (unsigned long long)grainNr);
             goto cleanup;
         }
@@ -893,7 +1409,8 @@ rewriteGrains(StreamOptimizedDiskInfo *sodi,
         size_t remainingLength = 0;
         if (cmpSize + hdrlen > VMDK_SECTOR_SIZE) {
             remainingLength = (cmpSize + hdrlen - VMDK_SECTOR_SIZE + VMDK_SECTOR_SIZE - 1) & ~(VMDK_SECTOR_SIZE - 1);
-            if (!safePread(srcFd, readBuf + VMDK_SECTOR_SIZE, remainingLength, (oldSector + 1) * VMDK_SECTOR_SIZE)) {
+            if (!safePread(srcFd, readBuf + VMDK_SECTOR_SIZE, remainingLength,
+                           srcOffset + (oldSector + 1) * VMDK_SECTOR_SIZE)) {
                 fprintf(stderr, "Failed to read remaining data for grain %llu\n", (unsigned long long)grainNr);
                 goto cleanup;
             }
@@ -926,6 +1443,29 @@ cleanup:
     return success;
 }
 
+/* Copies the sectors [start, end) of srcFd to dstFd at dstOffset. */
+static bool
+copyGrains(int srcFd, int dstFd, off_t dstOffset, SectorType start, SectorType end)
+{
+    size_t bufSize = 1024 * 1024;
+    uint8_t *buf = malloc(bufSize);
+    off_t pos = (off_t)start * VMDK_SECTOR_SIZE;
+    off_t endPos = (off_t)end * VMDK_SECTOR_SIZE;
+    bool success = true;
+
+    if (!buf) {
+        return false;
+    }
+    while (success && pos < endPos) {
+        size_t len = endPos - pos < (off_t)bufSize ? (size_t)(endPos - pos) : bufSize;
+
+        success = safePread(srcFd, buf, len, pos) && safePwrite(dstFd, buf, len, dstOffset + pos);
+        pos += len;
+    }
+    free(buf);
+    return success;
+}
+
 static bool
 reorderGrains(StreamOptimizedDiskInfo *sodi)
 {
@@ -990,7 +1530,7 @@ reorderGrains(StreamOptimizedDiskInfo *sodi)
     printf("DEBUG: Found %u valid grains to reorder\n", validGrains);
 #endif
 
-    if (!rewriteGrains(sodi, &sodi->writer.gtInfo, &tempGTInfo, sodi->writer.fd, tempFd)) {
+    if (!rewriteGrains(sodi, &sodi->writer.gtInfo, &tempGTInfo, sodi->writer.fd, sodi->writer.offset, tempFd)) {
         fprintf(stderr, "Rewriting grains failed\n");
         goto cleanup;
     }
@@ -1005,6 +1545,21 @@ reorderGrains(StreamOptimizedDiskInfo *sodi)
     printf("DEBUG: Closing files (temp fd=%d, orig fd=%d)\n", tempFd, sodi->writer.fd);
 #endif
 
+    /* An embedded disk cannot be replaced, the grains are copied back */
+    if (sodi->writer.offset != 0) {
+        if (!copyGrains(tempFd, sodi->writer.fd, sodi->writer.offset,
+                        sodi->diskHdr.overHead, sodi->writer.curSP)) {
+            fprintf(stderr, "Failed to copy reordered grains\n");
+            goto cleanup;
+        }
+        close(tempFd);
+        tempFd = -1;
+        unlink(tempFileName);
+        memcpy(sodi->writer.gtInfo.gt, tempGTInfo.gt, sodi->writer.gtInfo.GTEs * sizeof(uint32_t));
+        success = true;
+        goto cleanup;
+    }
+
     /* Close files */
     if (close(tempFd) != 0) {
         fprintf(stderr, "Failed to close temporary file\n");
@@ -1062,54 +1617,128 @@ cleanup:
     return success;
 }
 
-static ssize_t
-StreamOptimizedCopyDisk(DiskInfo *src,
-                        DiskInfo *self,
-                        int numThreads)
+static void
+destroyGrainThreadContext(GrainThreadContext *gtCtx)
 {
-    StreamOptimizedDiskInfo *sodi = getSODI(self);
-    GrainThreadContext gtCtx = {0};
-    pthread_t threads[numThreads];
-    int i, ret;
-    int threadsCreated = 0;
-    ssize_t result = -1;
-    bool readPosMutexInit = false;
-    bool writeSPMutexInit = false;
-    bool stateMutexInit = false;
+    free(gtCtx->busyPos);
+    pthread_cond_destroy(&gtCtx->commitCond);
+    pthread_mutex_destroy(&gtCtx->checkpointMutex);
+    pthread_mutex_destroy(&gtCtx->stateMutex);
+    pthread_mutex_destroy(&gtCtx->writeSPMutex);
+    pthread_mutex_destroy(&gtCtx->readPosMutex);
+}
+
+static bool
+initGrainThreadContext(GrainThreadContext *gtCtx,
+                       DiskInfo *src,
+                       StreamOptimizedDiskInfo *sodi,
+                       int numThreads)
+{
+    int ret, i;
 
-    // Initialize mutexes with error checking
-    if ((ret = pthread_mutex_init(&gtCtx.readPosMutex, NULL)) != 0) {
+    memset(gtCtx, 0, sizeof *gtCtx);
+    if ((ret = pthread_mutex_init(&gtCtx->readPosMutex, NULL)) != 0) {
         fprintf(stderr, "Failed to initialize readPosMutex: %s\n", strerror(ret));
-        goto cleanup;
+        return false;
     }
-    readPosMutexInit = true;
-
-    if ((ret = pthread_mutex_init(&gtCtx.writeSPMutex, NULL)) != 0) {
+    if ((ret = pthread_mutex_init(&gtCtx->writeSPMutex, NULL)) != 0) {
         fprintf(stderr, "Failed to initialize writeSPMutex: %s\n", strerror(ret));
-        goto cleanup;
+        pthread_mutex_destroy(&gtCtx->readPosMutex);
+        return false;
     }
-    writeSPMutexInit = true;
-
-    if ((ret = pthread_mutex_init(&gtCtx.stateMutex, NULL)) != 0) {
+    if ((ret = pthread_mutex_init(&gtCtx->stateMutex, NULL)) != 0) {
         fprintf(stderr, "Failed to initialize stateMutex: %s\n", strerror(ret));
-        goto cleanup;
+        pthread_mutex_destroy(&gtCtx->writeSPMutex);
+        pthread_mutex_destroy(&gtCtx->readPosMutex);
+        return false;
+    }
+    if ((ret = pthread_mutex_init(&gtCtx->checkpointMutex, NULL)) != 0) {
+        fprintf(stderr, "Failed to initialize checkpointMutex: %s\n", strerror(ret));
+        pthread_mutex_destroy(&gtCtx->stateMutex);
+        pthread_mutex_destroy(&gtCtx->writeSPMutex);
+        pthread_mutex_destroy(&gtCtx->readPosMutex);
+        return false;
     }
-    stateMutexInit = true;
+    if ((ret = pthread_cond_init(&gtCtx->commitCond, NULL)) != 0) {
+        fprintf(stderr, "Failed to initialize commitCond: %s\n", strerror(ret));
+        pthread_mutex_destroy(&gtCtx->checkpointMutex);
+        pthread_mutex_destroy(&gtCtx->stateMutex);
+        pthread_mutex_destroy(&gtCtx->writeSPMutex);
+        pthread_mutex_destroy(&gtCtx->readPosMutex);
+        return false;
+    }
+    gtCtx->busyPos = malloc(numThreads * sizeof *gtCtx->busyPos);
+    if (!gtCtx->busyPos) {
+        destroyGrainThreadContext(gtCtx);
+        return false;
+    }
+    for (i = 0; i < numThreads; i++) {
+        gtCtx->busyPos[i] = -1;
+    }
+    gtCtx->numSlots = numThreads;
+    gtCtx->checkpointWritten = -1;
+    gtCtx->sodi = sodi;
+    gtCtx->src = src;
+    /* With a digest, content converted before a resume is hashed again. */
+    gtCtx->readPos = sodi->writer.digest ? 0 : sodi->writer.checkpoint.resumePos;
+    gtCtx->commitPos = gtCtx->readPos;
+    gtCtx->state = GT_STATE_RUNNING;
+    return true;
+}
+
+/*
+ * Converts several disks with one pool of numThreads compression
+ * threads.  The destinations must have been created with
+ * StreamOptimized_Create.  results[i] tells whether disk i was converted,
+ * the destinations still have to be closed (or aborted) by the caller.
+ * Returns the number of disks that failed.
+ */
+int
+StreamOptimized_CopyDisks(DiskInfo **srcs,
+                          DiskInfo **dsts,
+                          int numDisks,
+                          int numThreads,
+                          bool *results)
+{
+    GrainThreadContext *gtCtxs;
+    GrainThreadArg *gtArgs;
+    pthread_t threads[numThreads];
+    int i, ret;
+    int ctxsInitialized = 0;
+    int threadsCreated = 0;
+    int failed = numDisks;
 
-    gtCtx.sodi = sodi;
-    gtCtx.src = src;
-    gtCtx.readPos = 0;
-    gtCtx.state = GT_STATE_RUNNING;
+    for (i = 0; i < numDisks; i++) {
+        results[i] = false;
+    }
+    gtCtxs = calloc(numDisks, sizeof *gtCtxs);
+    gtArgs = calloc(numThreads, sizeof *gtArgs);
+    if (!gtCtxs || !gtArgs) {
+        goto cleanup;
+    }
+    for (i = 0; i < numDisks; i++) {
+        if (!initGrainThreadContext(&gtCtxs[i], srcs[i], getSODI(dsts[i]), numThreads)) {
+            goto cleanup;
+        }
+        ctxsInitialized++;
+    }
 
     // Create threads with error checking
     for (i = 0; i < numThreads; i++) {
-        ret = pthread_create(&threads[i], NULL, deflateGrainThread, (void *)&gtCtx);
+        gtArgs[i].gtCtxs = gtCtxs;
+        gtArgs[i].numDisks = numDisks;
+        gtArgs[i].slot = i;
+        ret = pthread_create(&threads[i], NULL, deflateGrainThread, (void *)&gtArgs[i]);
         if (ret != 0) {
+            int j;
+
             fprintf(stderr, "Failed to create thread %d: %s\n", i, strerror(ret));
             // Set state to failed to signal existing threads to exit
-            pthread_mutex_lock(&gtCtx.stateMutex);
-            gtCtx.state = GT_STATE_FAILED;
-            pthread_mutex_unlock(&gtCtx.stateMutex);
+            for (j = 0; j < numDisks; j++) {
+                pthread_mutex_lock(&gtCtxs[j].stateMutex);
+                gtCtxs[j].state = GT_STATE_FAILED;
+                pthread_mutex_unlock(&gtCtxs[j].stateMutex);
+            }
             break;
         }
         threadsCreated++;
@@ -1125,23 +1754,44 @@ StreamOptimizedCopyDisk(DiskInfo *src,
     }
 
     // Determine result
-    if (threadsCreated == numThreads && gtCtx.state == GT_STATE_DONE) {
-        result = gtCtx.readPos;
+    if (threadsCreated == numThreads) {
+        failed = 0;
+        for (i = 0; i < numDisks; i++) {
+            results[i] = gtCtxs[i].state == GT_STATE_DONE;
+            failed += !results[i];
+            if (results[i] && gtCtxs[i].ultraGrains > 0) {
+                GrainThreadContext *gtCtx = &gtCtxs[i];
+
+                printf("Ultra compression: %llu of %llu grains smaller than with level 9, "
+                       "%llu instead of %llu bytes (%.2f%% saved), at most %llu bytes saved in a grain\n",
+                       (unsigned long long)gtCtx->ultraImproved, (unsigned long long)gtCtx->ultraGrains,
+                       (unsigned long long)gtCtx->ultraBytes, (unsigned long long)gtCtx->level9Bytes,
+                       100.0 * (gtCtx->level9Bytes - gtCtx->ultraBytes) / gtCtx->level9Bytes,
+                       (unsigned long long)gtCtx->ultraMaxSaved);
+            }
+        }
     }
 
 cleanup:
-    // Destroy mutexes in reverse order of initialization
-    if (stateMutexInit) {
-        pthread_mutex_destroy(&gtCtx.stateMutex);
-    }
-    if (writeSPMutexInit) {
-        pthread_mutex_destroy(&gtCtx.writeSPMutex);
-    }
-    if (readPosMutexInit) {
-        pthread_mutex_destroy(&gtCtx.readPosMutex);
+    for (i = 0; i < ctxsInitialized; i++) {
+        destroyGrainThreadContext(&gtCtxs[i]);
     }
+    free(gtCtxs);
+    free(gtArgs);
+    return failed;
+}
+
+static ssize_t
+StreamOptimizedCopyDisk(DiskInfo *src,
+                        DiskInfo *self,
+                        int numThreads)
+{
+    bool result;
 
-    return result;
+    if (StreamOptimized_CopyDisks(&src, &self, 1, numThreads, &result) != 0) {
+        return -1;
+    }
+    return src->vmt->getCapacity(src);
 }
 
 static bool
@@ -1154,7 +1804,7 @@ writeSpecial(SparseVmdkWriter *writer,
     memset(writer->currentGrain.zlibBuffer.data, 0, VMDK_SECTOR_SIZE);
     specialHdr->lba = __cpu_to_le64(length);
     specialHdr->type = __cpu_to_le32(marker);
-    return safePwrite(writer->fd, specialHdr, VMDK_SECTOR_SIZE, writer->curSP * VMDK_SECTOR_SIZE);
+    return safePwrite(writer->fd, specialHdr, VMDK_SECTOR_SIZE, writer->offset + writer->curSP * VMDK_SECTOR_SIZE);
 }
 
 static bool
@@ -1174,6 +1824,8 @@ StreamOptimizedFinalize(StreamOptimizedDiskInfo *sodi)
     free(sodi->writer.currentGrain.buffer);
     free(sodi->writer.currentGrain.zlibBuffer.data);
     free(sodi->writer.fileName);
+    free(sodi->writer.checkpoint.fileName);
+    ContentDigest_Free(sodi->writer.digest);
     free(sodi);
     return ret;
 }
@@ -1190,10 +1842,15 @@ static int
 StreamOptimizedClose(DiskInfo *self)
 {
     StreamOptimizedDiskInfo *sodi = getSODI(self);
+    char contentDigest[CONTENT_DIGEST_STRING_SIZE];
+    bool hasDigest;
 
     if (flushGrain(sodi))
         goto failAll;
 
+    /* Only complete if the disk was written by copyDisk. */
+    hasDigest = sodi->writer.digest && ContentDigest_Final(sodi->writer.digest, contentDigest);
+
         // Reorder grains if needed and requested
     if (sodi->writer.doReorder && !areStreamOptimizedGrainsOrdered(sodi)) {
         printf("reordering grains\n");
@@ -1206,21 +1863,32 @@ StreamOptimizedClose(DiskInfo *self)
         fprintf(stderr, "Failed to write EOS marker\n");
         goto failAll;
     }
-    if (!writeGrainTables(sodi->writer.fd, &sodi->diskHdr, &sodi->writer.gtInfo)) {
+    /* A resumed conversion may end before the stream it continued. */
+    if (ftruncate(sodi->writer.fd, sodi->writer.offset + (sodi->writer.curSP + 1) * VMDK_SECTOR_SIZE) != 0) {
+        fprintf(stderr, "Failed to truncate %s: %s\n", sodi->writer.fileName, strerror(errno));
+        goto failAll;
+    }
+    if (!writeGrainTables(sodi->writer.fd, sodi->writer.offset, sodi->diskHdr.gdOffset, &sodi->writer.gtInfo)) {
         fprintf(stderr, "Failed to write grain tables\n");
         goto failAll;
     }
-    if (!writeDescriptor(sodi->writer.fd, &sodi->diskHdr, sodi->writer.sectorSize)) {
+    if (!writeDescriptor(sodi->writer.fd, sodi->writer.offset, &sodi->diskHdr, "disk", "streamOptimized",
+                         sodi->writer.sectorSize,
+                         hasDigest ? contentDigest : NULL)) {
         fprintf(stderr, "Failed to write descriptor\n");
         goto failAll;
     }
-    if (!writeHeaders(sodi->writer.fd, &sodi->diskHdr)) {
+    if (!writeHeaders(sodi->writer.fd, sodi->writer.offset, &sodi->diskHdr)) {
         fprintf(stderr, "Failed to write headers\n");
         goto failAll;
     }
     if (fsync(sodi->writer.fd) != 0) {
         goto failAll;
     }
+    /* The disk is complete, nothing to resume any more. */
+    if (sodi->writer.checkpoint.fileName) {
+        unlink(sodi->writer.checkpoint.fileName);
+    }
     return StreamOptimizedFinalize(sodi);
 
 failAll:
@@ -1239,18 +1907,89 @@ static DiskInfoVMT streamOptimizedVMT = {
     .checkGrainOrder = NULL
 };
 
+/*
+ * Makes the compression threads look up grains in cache before
+ * compressing them, and store the ones they compressed.
+ */
+void
+StreamOptimized_SetGrainCache(DiskInfo *self,
+                              GrainCache *cache)
+{
+    getSODI(self)->writer.grainCache = cache;
+}
+
+/*
+ * Records a digest of the content in the descriptor.  Only takes effect
+ * for disks written by copyDisk, a resumed conversion reads the already
+ * converted part of the source again to hash it.
+ */
+bool
+StreamOptimized_SetContentDigest(DiskInfo *self,
+                                 off_t capacity)
+{
+    StreamOptimizedDiskInfo *sodi = getSODI(self);
+
+    if (!sodi->writer.digest) {
+        sodi->writer.digest = ContentDigest_Create(capacity);
+    }
+    return sodi->writer.digest != NULL;
+}
+
+static DiskInfo *
+createStreamOptimized(const char *fileName, off_t offset, off_t capacity, int compressionLevel, bool doReorder,
+                      int sectorSize, const char *srcFileName, uint64_t checkpointInterval, bool resume);
+
 DiskInfo *
 StreamOptimized_Create(const char *fileName, off_t capacity, int compressionLevel, bool doReorder, int sectorSize)
 {
-    StreamOptimizedDiskInfo *sodi;
+    return createStreamOptimized(fileName, 0, capacity, compressionLevel, doReorder, sectorSize, NULL, 0, false);
+}
 
-    sodi = malloc(sizeof *sodi);
-    if (!sodi) {
-        goto fail;
-    }
-    memset(sodi, 0, sizeof *sodi);
-    sodi->writer.fileName = strdup(fileName);
-    if (!sodi->writer.fileName) {
+/*
+ * Like StreamOptimized_Create, but every checkpointInterval bytes of the
+ * source the committed part of the conversion is recorded in
+ * fileName.checkpoint.  With resume the conversion of srcFileName is
+ * continued from an existing checkpoint instead of starting over.
+ */
+DiskInfo *
+StreamOptimized_CreateCheckpointed(const char *fileName, off_t capacity, int compressionLevel, bool doReorder,
+                                   int sectorSize, const char *srcFileName, uint64_t checkpointInterval,
+                                   bool resume)
+{
+    return createStreamOptimized(fileName, 0, capacity, compressionLevel, doReorder, sectorSize, srcFileName,
+                                 checkpointInterval, resume);
+}
+
+/*
+ * Like StreamOptimized_Create, but the disk is written into the existing
+ * file fileName, starting at offset, for example as a member of a tar
+ * archive.  Nothing is written before offset and the file is not
+ * truncated.
+ */
+DiskInfo *
+StreamOptimized_CreateAt(const char *fileName, off_t offset, off_t capacity, int compressionLevel, bool doReorder,
+                         int sectorSize)
+{
+    if (offset < 0 || offset % VMDK_SECTOR_SIZE != 0) {
+        errno = EINVAL;
+        return NULL;
+    }
+    return createStreamOptimized(fileName, offset, capacity, compressionLevel, doReorder, sectorSize, NULL, 0, false);
+}
+
+static DiskInfo *
+createStreamOptimized(const char *fileName, off_t offset, off_t capacity, int compressionLevel, bool doReorder,
+                      int sectorSize, const char *srcFileName, uint64_t checkpointInterval, bool resume)
+{
+    StreamOptimizedDiskInfo *sodi;
+
+    sodi = malloc(sizeof *sodi);
+    if (!sodi) {
+        goto fail;
+    }
+    memset(sodi, 0, sizeof *sodi);
+    sodi->writer.fileName = strdup(fileName);
+    if (!sodi->writer.fileName) {
         goto failSODI;
     }
     sodi->hdr.vmt = &streamOptimizedVMT;
@@ -1264,12 +2003,32 @@ StreamOptimized_Create(const char *fileName, off_t capacity, int compressionLeve
     if (!getGDGT(&sodi->writer.gtInfo, &sodi->diskHdr)) {
         goto failFileName;
     }
-    sodi->writer.fd = open(fileName, O_RDWR | O_CREAT | O_TRUNC, 0666);
+    if (checkpointInterval > 0 || resume) {
+        CheckpointInfo *ckpt = &sodi->writer.checkpoint;
+        struct stat sb;
+
+        if (!srcFileName || stat(srcFileName, &sb) != 0) {
+            goto failGDGT;
+        }
+        ckpt->srcSize = sb.st_size;
+        ckpt->srcMtimeSec = sb.st_mtim.tv_sec;
+        ckpt->srcMtimeNsec = sb.st_mtim.tv_nsec;
+        ckpt->interval = checkpointInterval;
+        ckpt->next = checkpointInterval;
+        if (asprintf(&ckpt->fileName, "%s.checkpoint", fileName) == -1) {
+            ckpt->fileName = NULL;
+            goto failGDGT;
+        }
+    }
+    sodi->writer.fd = open(fileName, resume || offset != 0 ? O_RDWR : O_RDWR | O_CREAT | O_TRUNC, 0666);
     if (sodi->writer.fd == -1) {
-        goto failGDGT;
+        goto failCheckpoint;
     }
+    sodi->writer.offset = offset;
     sodi->writer.compressionLevel = compressionLevel;
     sodi->writer.doReorder = doReorder;
+    /* inside another file, reordering would copy all grains to a temporary file and back */
+    sodi->writer.orderedCommit = doReorder && offset != 0;
     sodi->writer.sectorSize = sectorSize;
 
     sodi->diskHdr.descriptorOffset = sodi->diskHdr.overHead;
@@ -1282,14 +2041,28 @@ StreamOptimized_Create(const char *fileName, off_t capacity, int compressionLeve
     initGrain(sodi, &sodi->writer.currentGrain);
 
     sodi->writer.curSP = sodi->diskHdr.overHead;
-    if (lseek(sodi->writer.fd, sodi->writer.curSP * VMDK_SECTOR_SIZE, SEEK_SET) == -1) {
+    if (resume && !loadCheckpoint(sodi)) {
+        goto failAll;
+    }
+    if (lseek(sodi->writer.fd, offset + sodi->writer.curSP * VMDK_SECTOR_SIZE, SEEK_SET) == -1) {
         goto failAll;
     }
     return &sodi->hdr;
 
 failAll:
+    {
+        int err = errno;
+
+        close(sodi->writer.fd);
+        errno = err;
+    }
+    deflateEnd(&sodi->writer.currentGrain.zstream);
+    free(sodi->writer.currentGrain.buffer);
     free(sodi->writer.currentGrain.zlibBuffer.data);
+failCheckpoint:
+    free(sodi->writer.checkpoint.fileName);
 failGDGT:
+    ContentDigest_Free(sodi->writer.digest);
     free(sodi->writer.gtInfo.gd);
 failFileName:
     free(sodi->writer.fileName);
@@ -1299,6 +2072,206 @@ fail:
     return NULL;
 }
 
+typedef struct MonolithicSparseDiskInfo {
+    DiskInfo hdr;
+    SparseExtentHeader diskHdr;
+    SparseGTInfo gtInfo;
+    int fd;
+    char *fileName;
+    uint32_t curSP;
+    uint32_t sectorSize;
+} MonolithicSparseDiskInfo;
+
+static MonolithicSparseDiskInfo *
+getMSDI(DiskInfo *self)
+{
+    return (MonolithicSparseDiskInfo *)self;
+}
+
+/*
+ * Grains are allocated on first write, in the order they are written.
+ * Unallocated grains read as zeros, so writing zeros to them is skipped.
+ * The file is extended by the writes, parts of a grain that are never
+ * written stay holes.
+ */
+static ssize_t
+MonolithicSparsePwrite(DiskInfo *self,
+                       const void *buf,
+                       size_t length,
+                       off_t pos)
+{
+    MonolithicSparseDiskInfo *msdi = getMSDI(self);
+    const uint8_t *buf8 = buf;
+    uint64_t grainBytes = msdi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint64_t grainNr = pos / grainBytes;
+    uint32_t updateStart = pos & (grainBytes - 1);
+
+    while (length > 0) {
+        uint32_t updateLen = grainBytes - updateStart;
+        uint32_t sect;
+
+        if (grainNr >= msdi->gtInfo.GTEs) {
+            fprintf(stderr, "Grain number %llu exceeds maximum grain table entries %llu\n",
+                    (unsigned long long)grainNr,
+                    (unsigned long long)msdi->gtInfo.GTEs);
+            return -1;
+        }
+        if (length < updateLen) {
+            updateLen = length;
+        }
+        sect = __le32_to_cpu(msdi->gtInfo.gt[grainNr]);
+        if (sect == 0 && !((updateLen & 7) == 0 && isZeroed(buf8, updateLen))) {
+            sect = msdi->curSP;
+            msdi->curSP += msdi->diskHdr.grainSize;
+            msdi->gtInfo.gt[grainNr] = __cpu_to_le32(sect);
+        }
+        if (sect != 0 &&
+            !safePwrite(msdi->fd, buf8, updateLen, sect * VMDK_SECTOR_SIZE + updateStart)) {
+            return -1;
+        }
+        buf8 += updateLen;
+        length -= updateLen;
+        grainNr++;
+        updateStart = 0;
+    }
+    return buf8 - (const uint8_t *)buf;
+}
+
+static int
+MonolithicSparseFinalize(MonolithicSparseDiskInfo *msdi)
+{
+    int ret;
+
+    ret = close(msdi->fd);
+    free(msdi->gtInfo.gd);
+    free(msdi->fileName);
+    free(msdi);
+    return ret;
+}
+
+static int
+MonolithicSparseAbort(DiskInfo *self)
+{
+    return MonolithicSparseFinalize(getMSDI(self));
+}
+
+static int
+MonolithicSparseClose(DiskInfo *self)
+{
+    MonolithicSparseDiskInfo *msdi = getMSDI(self);
+    SparseGTInfo *gtInfo = &msdi->gtInfo;
+    const char *extentName;
+
+    /* The last grain may have been written partially. */
+    if (ftruncate(msdi->fd, msdi->curSP * VMDK_SECTOR_SIZE) != 0) {
+        goto failAll;
+    }
+
+    /* Same GTs twice, with the GD pointing to the respective copy */
+    prefillGD(gtInfo, msdi->diskHdr.rgdOffset + gtInfo->GDsectors);
+    if (!writeGrainTables(msdi->fd, 0, msdi->diskHdr.rgdOffset, gtInfo)) {
+        fprintf(stderr, "Failed to write redundant grain tables\n");
+        goto failAll;
+    }
+    prefillGD(gtInfo, msdi->diskHdr.gdOffset + gtInfo->GDsectors);
+    if (!writeGrainTables(msdi->fd, 0, msdi->diskHdr.gdOffset, gtInfo)) {
+        fprintf(stderr, "Failed to write grain tables\n");
+        goto failAll;
+    }
+
+    /* A monolithic extent refers to its own file. */
+    extentName = strrchr(msdi->fileName, '/');
+    extentName = extentName ? extentName + 1 : msdi->fileName;
+    if (!writeDescriptor(msdi->fd, 0, &msdi->diskHdr, extentName, "monolithicSparse", msdi->sectorSize, NULL)) {
+        fprintf(stderr, "Failed to write descriptor\n");
+        goto failAll;
+    }
+    if (!writeHeaders(msdi->fd, 0, &msdi->diskHdr)) {
+        fprintf(stderr, "Failed to write headers\n");
+        goto failAll;
+    }
+    return MonolithicSparseFinalize(msdi);
+
+failAll:
+    MonolithicSparseAbort(self);
+    return -1;
+}
+
+static DiskInfoVMT monolithicSparseVMT = {
+    .getCapacity = NULL,
+    .pread = NULL,
+    .pwrite = MonolithicSparsePwrite,
+    .nextData = NULL,
+    .close = MonolithicSparseClose,
+    .abort = MonolithicSparseAbort,
+    .copyDisk = NULL,
+    .checkGrainOrder = NULL
+};
+
+/*
+ * Creates a hosted monolithicSparse disk with uncompressed grains and
+ * redundant grain tables, as written by Workstation.
+ */
+DiskInfo *
+MonolithicSparse_Create(const char *fileName, off_t capacity, int sectorSize)
+{
+    MonolithicSparseDiskInfo *msdi;
+    SectorType overHead;
+
+    msdi = malloc(sizeof *msdi);
+    if (!msdi) {
+        goto fail;
+    }
+    memset(msdi, 0, sizeof *msdi);
+    msdi->fileName = strdup(fileName);
+    if (!msdi->fileName) {
+        goto failMSDI;
+    }
+    msdi->hdr.vmt = &monolithicSparseVMT;
+    msdi->diskHdr.version = 1;
+    msdi->diskHdr.flags = SPARSEFLAG_VALID_NEWLINE_DETECTOR | SPARSEFLAG_USE_REDUNDANT;
+    msdi->diskHdr.numGTEsPerGT = 512;
+    msdi->diskHdr.compressAlgorithm = SPARSE_COMPRESSALGORITHM_NONE;
+    msdi->diskHdr.grainSize = 128;
+    msdi->diskHdr.capacity = CEILING(capacity, VMDK_SECTOR_SIZE);
+    if (!getGDGT(&msdi->gtInfo, &msdi->diskHdr)) {
+        goto failFileName;
+    }
+    msdi->sectorSize = sectorSize;
+
+    overHead = 1;
+    msdi->diskHdr.descriptorOffset = overHead;
+    msdi->diskHdr.descriptorSize = 20;
+    overHead += msdi->diskHdr.descriptorSize;
+    msdi->diskHdr.rgdOffset = overHead;
+    overHead = prefillGD(&msdi->gtInfo, overHead + msdi->gtInfo.GDsectors);
+    msdi->diskHdr.gdOffset = overHead;
+    overHead = prefillGD(&msdi->gtInfo, overHead + msdi->gtInfo.GDsectors);
+    msdi->diskHdr.overHead = CEILING(overHead, msdi->diskHdr.grainSize) * msdi->diskHdr.grainSize;
+    msdi->curSP = msdi->diskHdr.overHead;
+    /* Grain locations are 32 bit sector numbers. */
+    if (msdi->diskHdr.overHead + msdi->gtInfo.GTEs * msdi->diskHdr.grainSize > UINT32_MAX) {
+        fprintf(stderr, "Disk too big for monolithicSparse format\n");
+        errno = EFBIG;
+        goto failGDGT;
+    }
+
+    msdi->fd = open(fileName, O_RDWR | O_CREAT | O_TRUNC, 0666);
+    if (msdi->fd == -1) {
+        goto failGDGT;
+    }
+    return &msdi->hdr;
+
+failGDGT:
+    free(msdi->gtInfo.gd);
+failFileName:
+    free(msdi->fileName);
+failMSDI:
+    free(msdi);
+fail:
+    return NULL;
+}
+
 typedef struct {
     off_t pos;
     uint8_t *buf;
@@ -1746,3 +2719,717 @@ fail:
 }
 
 
+
+#define VERIFY_CHUNK_SIZE   (4 * 1024 * 1024)
+
+typedef struct {
+    pthread_mutex_t mutex;
+    SparseDiskInfo *sdi;
+    VerifyReport *report;
+    ContentDigest *digest;
+    uint64_t fileSectors;
+    uint64_t nextGrain;
+    uint64_t grainsPerChunk;
+    uint8_t *grainSectors;  /* sectors occupied by each grain, 0 if not allocated */
+    bool failed;
+} VerifyContext;
+
+static void
+verifyError(VerifyContext *ctx,
+            const char *fmt,
+            ...)
+{
+    VerifyReport *report = ctx->report;
+    va_list ap;
+
+    pthread_mutex_lock(&ctx->mutex);
+    if (report->numErrors < VERIFY_MAX_ERRORS) {
+        va_start(ap, fmt);
+        vsnprintf(report->errors[report->numErrors], sizeof report->errors[0], fmt, ap);
+        va_end(ap);
+    }
+    report->numErrors++;
+    pthread_mutex_unlock(&ctx->mutex);
+}
+
+/*
+ * Checks one allocated grain and stores its content in buf.  Returns the
+ * number of sectors the grain occupies in the file, 0 if it is invalid.
+ */
+static uint32_t
+verifyGrain(VerifyContext *ctx,
+            z_stream *zstream,
+            uint8_t *readBuf,
+            uint64_t grainNr,
+            uint32_t sect,
+            uint8_t *buf,
+            uint32_t grainSize)
+{
+    SparseDiskInfo *sdi = ctx->sdi;
+    uint32_t grainBytes = sdi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint32_t hdrlen, cmpSize, sectors;
+
+    if (sect < sdi->diskHdr.overHead) {
+        verifyError(ctx, "grain %llu at sector %u overlaps metadata", (unsigned long long)grainNr, sect);
+        return 0;
+    }
+    if (!(sdi->diskHdr.flags & SPARSEFLAG_COMPRESSED)) {
+        sectors = sdi->diskHdr.grainSize;
+        if (sect + (uint64_t)sectors > ctx->fileSectors) {
+            verifyError(ctx, "grain %llu at sector %u is beyond the end of the file", (unsigned long long)grainNr, sect);
+            return 0;
+        }
+        if (buf && pread(sdi->fd, buf, grainSize, sect * VMDK_SECTOR_SIZE) != (ssize_t)grainSize) {
+            verifyError(ctx, "grain %llu: cannot read", (unsigned long long)grainNr);
+            return 0;
+        }
+        return sectors;
+    }
+
+    if (sect >= ctx->fileSectors ||
+        pread(sdi->fd, readBuf, VMDK_SECTOR_SIZE, sect * VMDK_SECTOR_SIZE) != VMDK_SECTOR_SIZE) {
+        verifyError(ctx, "grain %llu at sector %u is beyond the end of the file", (unsigned long long)grainNr, sect);
+        return 0;
+    }
+    if (sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA) {
+        SparseGrainLBAHeaderOnDisk *hdr = (SparseGrainLBAHeaderOnDisk *)readBuf;
+
+        if (__le64_to_cpu(hdr->lba) != grainNr * sdi->diskHdr.grainSize) {
+            verifyError(ctx, "grain %llu at sector %u has LBA %llu instead of %llu", (unsigned long long)grainNr,
+                        sect, (unsigned long long)__le64_to_cpu(hdr->lba),
+                        (unsigned long long)(grainNr * sdi->diskHdr.grainSize));
+            return 0;
+        }
+        cmpSize = __le32_to_cpu(hdr->cmpSize);
+        hdrlen = sizeof *hdr;
+    } else {
+        cmpSize = __le32_to_cpu(*(__le32 *)readBuf);
+        hdrlen = 4;
+    }
+    if (cmpSize == 0 || cmpSize > grainBytes + VMDK_SECTOR_SIZE - hdrlen) {
+        verifyError(ctx, "grain %llu at sector %u has invalid cmpSize %u", (unsigned long long)grainNr, sect, cmpSize);
+        return 0;
+    }
+    sectors = CEILING(hdrlen + cmpSize, VMDK_SECTOR_SIZE);
+    if (sect + (uint64_t)sectors > ctx->fileSectors) {
+        verifyError(ctx, "grain %llu at sector %u with cmpSize %u is beyond the end of the file",
+                    (unsigned long long)grainNr, sect, cmpSize);
+        return 0;
+    }
+    if (sectors > 1 &&
+        pread(sdi->fd, readBuf + VMDK_SECTOR_SIZE, (sectors - 1) * VMDK_SECTOR_SIZE,
+              (sect + 1) * VMDK_SECTOR_SIZE) != (ssize_t)((sectors - 1) * VMDK_SECTOR_SIZE)) {
+        verifyError(ctx, "grain %llu: cannot read", (unsigned long long)grainNr);
+        return 0;
+    }
+    if (inflateReset(zstream) != Z_OK) {
+        verifyError(ctx, "grain %llu: cannot reset decompressor", (unsigned long long)grainNr);
+        return 0;
+    }
+    zstream->next_in = readBuf + hdrlen;
+    zstream->avail_in = cmpSize;
+    zstream->next_out = buf;
+    zstream->avail_out = grainBytes;
+    if (inflate(zstream, Z_FINISH) != Z_STREAM_END) {
+        verifyError(ctx, "grain %llu at sector %u does not decompress", (unsigned long long)grainNr, sect);
+        return 0;
+    }
+    if (grainBytes - zstream->avail_out < grainSize) {
+        verifyError(ctx, "grain %llu at sector %u decompresses to %u bytes instead of %u", (unsigned long long)grainNr,
+                    sect, grainBytes - zstream->avail_out, grainSize);
+        return 0;
+    }
+    return sectors;
+}
+
+static void *
+verifyGrainsThread(void *arg)
+{
+    VerifyContext *ctx = arg;
+    SparseDiskInfo *sdi = ctx->sdi;
+    uint32_t grainBytes = sdi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    z_stream zstream = {0};
+    uint8_t *readBuf = malloc(grainBytes + 2 * VMDK_SECTOR_SIZE);
+    uint8_t *chunk = malloc(ctx->grainsPerChunk * grainBytes);
+
+    if (!readBuf || !chunk || inflateInit(&zstream) != Z_OK) {
+        pthread_mutex_lock(&ctx->mutex);
+        ctx->failed = true;
+        pthread_mutex_unlock(&ctx->mutex);
+        goto out;
+    }
+
+    while (true) {
+        uint64_t first, grainNr, end;
+        uint8_t *p = chunk;
+
+        pthread_mutex_lock(&ctx->mutex);
+        first = ctx->nextGrain;
+        ctx->nextGrain += ctx->grainsPerChunk;
+        pthread_mutex_unlock(&ctx->mutex);
+        if (first > sdi->gtInfo.lastGrainNr) {
+            break;
+        }
+        end = first + ctx->grainsPerChunk;
+        if (end > sdi->gtInfo.lastGrainNr + 1) {
+            end = sdi->gtInfo.lastGrainNr + 1;
+        }
+
+        for (grainNr = first; grainNr < end; grainNr++) {
+            uint32_t sect = __le32_to_cpu(sdi->gtInfo.gt[grainNr]);
+            uint32_t grainSize = grainNr == sdi->gtInfo.lastGrainNr ? sdi->gtInfo.lastGrainSize : grainBytes;
+
+            if (sect <= 1) {
+                memset(p, 0, grainSize);
+            } else {
+                ctx->grainSectors[grainNr] = verifyGrain(ctx, &zstream, readBuf, grainNr, sect, p, grainSize);
+                if (ctx->grainSectors[grainNr] == 0) {
+                    /* keep going to report all errors, but the digest is meaningless now */
+                    memset(p, 0, grainSize);
+                }
+            }
+            p += grainSize;
+        }
+        if (ctx->digest &&
+            !ContentDigest_Update(ctx->digest, first * grainBytes, chunk, p - chunk)) {
+            pthread_mutex_lock(&ctx->mutex);
+            ctx->failed = true;
+            pthread_mutex_unlock(&ctx->mutex);
+            break;
+        }
+    }
+
+out:
+    inflateEnd(&zstream);
+    free(chunk);
+    free(readBuf);
+    return NULL;
+}
+
+/* Checks the end of stream marker, and that the footer matches the header. */
+static void
+verifyMarkers(VerifyContext *ctx)
+{
+    SparseDiskInfo *sdi = ctx->sdi;
+    VerifyReport *report = ctx->report;
+    SparseMetaDataMarkerOnDisk marker;
+    SparseExtentHeaderOnDisk onDisk;
+    SparseExtentHeader hdr;
+
+    if (!(sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA)) {
+        return;
+    }
+    report->hasEOS = ctx->fileSectors > 0 &&
+                     pread(sdi->fd, &marker, sizeof marker, (ctx->fileSectors - 1) * VMDK_SECTOR_SIZE) == sizeof marker &&
+                     marker.numSectors == 0 && marker.size == 0 && __le32_to_cpu(marker.type) == GRAIN_MARKER_EOS;
+    if (!report->hasEOS) {
+        verifyError(ctx, "end of stream marker missing");
+    }
+    if (!sdi->hasFooter) {
+        return;
+    }
+    if (pread(sdi->fd, &onDisk, sizeof onDisk, 0) != sizeof onDisk ||
+        !checkSparseExtentHeader(&onDisk) || !getSparseExtentHeader(&hdr, &onDisk)) {
+        verifyError(ctx, "invalid header");
+        return;
+    }
+    if (hdr.gdOffset != SPARSE_GD_AT_END && hdr.gdOffset != sdi->diskHdr.gdOffset) {
+        verifyError(ctx, "grain directory in header and footer differ");
+    }
+    if (hdr.capacity != sdi->diskHdr.capacity || hdr.grainSize != sdi->diskHdr.grainSize) {
+        verifyError(ctx, "geometry in header and footer differ");
+    }
+}
+
+/*
+ * Walks the grain table of a sparse disk opened with Sparse_Open and
+ * checks every allocated grain, decompressing them on numThreads
+ * threads.  With computeDigest the content digest of the disk is
+ * computed on the way.  Returns false if the check itself could not be
+ * done, problems found in the disk are listed in the report.
+ */
+bool
+Sparse_Verify(DiskInfo *self,
+              int numThreads,
+              bool computeDigest,
+              VerifyReport *report)
+{
+    SparseDiskInfo *sdi = getSDI(self);
+    VerifyContext ctx;
+    pthread_t threads[numThreads];
+    uint32_t grainBytes = sdi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint64_t i, prevEnd = 0;
+    struct stat sb;
+    int threadsCreated = 0;
+    bool success = false;
+
+    memset(report, 0, sizeof *report);
+    memset(&ctx, 0, sizeof ctx);
+    if (fstat(sdi->fd, &sb) != 0 || pthread_mutex_init(&ctx.mutex, NULL) != 0) {
+        return false;
+    }
+    ctx.sdi = sdi;
+    ctx.report = report;
+    ctx.fileSectors = sb.st_size / VMDK_SECTOR_SIZE;
+    ctx.grainsPerChunk = VERIFY_CHUNK_SIZE / grainBytes;
+    ctx.grainSectors = calloc(sdi->gtInfo.GTEs ? sdi->gtInfo.GTEs : 1, 1);
+    if (!ctx.grainSectors) {
+        goto out;
+    }
+    if (computeDigest) {
+        ctx.digest = ContentDigest_Create(sdi->diskHdr.capacity * VMDK_SECTOR_SIZE);
+        if (!ctx.digest) {
+            goto out;
+        }
+    }
+
+    report->grains = sdi->gtInfo.GTEs;
+    report->hasFooter = sdi->hasFooter;
+    report->grainsOrdered = areSparseGrainsOrdered(sdi);
+
+    for (i = 0; i < (uint64_t)numThreads; i++) {
+        if (pthread_create(&threads[i], NULL, verifyGrainsThread, &ctx) != 0) {
+            ctx.failed = true;
+            break;
+        }
+        threadsCreated++;
+    }
+    for (i = 0; i < (uint64_t)threadsCreated; i++) {
+        pthread_join(threads[i], NULL);
+    }
+    if (ctx.failed || threadsCreated == 0) {
+        goto out;
+    }
+
+    verifyMarkers(&ctx);
+
+    /* In stream order, no grain may start before the previous one ends. */
+    for (i = 0; i < sdi->gtInfo.GTEs; i++) {
+        uint32_t sect = __le32_to_cpu(sdi->gtInfo.gt[i]);
+
+        if (sect == 1) {
+            report->zeroGrains++;
+        } else if (sect > 1) {
+            report->allocatedGrains++;
+            if (report->grainsOrdered && ctx.grainSectors[i] != 0) {
+                if (sect < prevEnd) {
+                    verifyError(&ctx, "grain %llu at sector %u overlaps the previous grain", (unsigned long long)i, sect);
+                }
+                prevEnd = sect + ctx.grainSectors[i];
+            }
+        }
+    }
+    if (!report->grainsOrdered && (sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA)) {
+        verifyError(&ctx, "grains are not in ascending order");
+    }
+    if (ctx.digest && !ContentDigest_Final(ctx.digest, report->contentDigest)) {
+        goto out;
+    }
+    success = true;
+
+out:
+    ContentDigest_Free(ctx.digest);
+    free(ctx.grainSectors);
+    pthread_mutex_destroy(&ctx.mutex);
+    return success;
+}
+
+typedef enum {
+    DIFF_SAME_TABLE,
+    DIFF_SAME_PAYLOAD,
+    DIFF_SAME_CONTENT,
+    DIFF_CHANGED
+} DiffResult;
+
+typedef struct {
+    pthread_mutex_t mutex;
+    SparseDiskInfo *sdi[2];
+    uint64_t grains;
+    uint64_t nextGrain;
+    uint64_t grainsPerChunk;
+    uint8_t *results;       /* DiffResult of each grain */
+    uint32_t *used[2];      /* bytes taken by each grain in each file */
+    bool failed;
+} DiffContext;
+
+/*
+ * Reads the data of an allocated grain as stored in the file, compressed
+ * or not.  Returns the length of the data, 0 on error.
+ */
+static uint32_t
+readGrainPayload(SparseDiskInfo *sdi,
+                 uint64_t grainNr,
+                 uint32_t sect,
+                 uint8_t *readBuf,
+                 uint8_t **payload,
+                 uint32_t *used)
+{
+    uint32_t grainBytes = sdi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint32_t hdrlen, cmpSize, sectors;
+
+    if (!(sdi->diskHdr.flags & SPARSEFLAG_COMPRESSED)) {
+        if (pread(sdi->fd, readBuf, grainBytes, sect * VMDK_SECTOR_SIZE) != (ssize_t)grainBytes) {
+            return 0;
+        }
+        *payload = readBuf;
+        *used = grainBytes;
+        return grainBytes;
+    }
+
+    if (pread(sdi->fd, readBuf, VMDK_SECTOR_SIZE, sect * VMDK_SECTOR_SIZE) != VMDK_SECTOR_SIZE) {
+        return 0;
+    }
+    if (sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA) {
+        SparseGrainLBAHeaderOnDisk *hdr = (SparseGrainLBAHeaderOnDisk *)readBuf;
+
+        if (__le64_to_cpu(hdr->lba) != grainNr * sdi->diskHdr.grainSize) {
+            return 0;
+        }
+        cmpSize = __le32_to_cpu(hdr->cmpSize);
+        hdrlen = sizeof *hdr;
+    } else {
+        cmpSize = __le32_to_cpu(*(__le32 *)readBuf);
+        hdrlen = 4;
+    }
+    if (cmpSize == 0 || cmpSize > grainBytes + VMDK_SECTOR_SIZE - hdrlen) {
+        return 0;
+    }
+    sectors = CEILING(hdrlen + cmpSize, VMDK_SECTOR_SIZE);
+    if (sectors > 1 &&
+        pread(sdi->fd, readBuf + VMDK_SECTOR_SIZE, (sectors - 1) * VMDK_SECTOR_SIZE,
+              (sect + 1) * VMDK_SECTOR_SIZE) != (ssize_t)((sectors - 1) * VMDK_SECTOR_SIZE)) {
+        return 0;
+    }
+    *payload = readBuf + hdrlen;
+    *used = sectors * VMDK_SECTOR_SIZE;
+    return cmpSize;
+}
+
+/* Stores the content of a grain as stored in the file in buf, grainBytes long. */
+static bool
+decodeGrainPayload(SparseDiskInfo *sdi,
+                   z_stream *zstream,
+                   uint8_t *payload,
+                   uint32_t len,
+                   uint8_t *buf,
+                   uint32_t grainBytes)
+{
+    if (!(sdi->diskHdr.flags & SPARSEFLAG_COMPRESSED)) {
+        memcpy(buf, payload, grainBytes);
+        return true;
+    }
+    if (inflateReset(zstream) != Z_OK) {
+        return false;
+    }
+    zstream->next_in = payload;
+    zstream->avail_in = len;
+    zstream->next_out = buf;
+    zstream->avail_out = grainBytes;
+    if (inflate(zstream, Z_FINISH) != Z_STREAM_END) {
+        return false;
+    }
+    /* the last grain may be short, the rest of it reads as zeros */
+    memset(zstream->next_out, 0, zstream->avail_out);
+    return true;
+}
+
+static uint32_t
+diffGrainSector(SparseDiskInfo *sdi,
+                uint64_t grainNr)
+{
+    if (grainNr > sdi->gtInfo.lastGrainNr || grainNr >= sdi->gtInfo.GTEs ||
+        (grainNr == sdi->gtInfo.lastGrainNr && sdi->gtInfo.lastGrainSize == 0)) {
+        return 0;
+    }
+    return __le32_to_cpu(sdi->gtInfo.gt[grainNr]);
+}
+
+/*
+ * Compares one grain, from the cheapest to the most expensive check: the
+ * grain tables, then the data in the files, and only then the content
+ * after decompression.
+ */
+static bool
+diffGrain(DiffContext *ctx,
+          uint64_t grainNr,
+          z_stream *zstreams,
+          uint8_t **readBufs,
+          uint8_t **contents)
+{
+    uint32_t grainBytes = ctx->sdi[0]->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint8_t *payload[2] = { NULL, NULL };
+    uint32_t len[2] = { 0, 0 };
+    int i;
+
+    for (i = 0; i < 2; i++) {
+        uint32_t sect = diffGrainSector(ctx->sdi[i], grainNr);
+
+        ctx->used[i][grainNr] = 0;
+        if (sect > 1) {
+            len[i] = readGrainPayload(ctx->sdi[i], grainNr, sect, readBufs[i], &payload[i], &ctx->used[i][grainNr]);
+            if (len[i] == 0) {
+                fprintf(stderr, "Cannot read grain %llu of the %s disk\n", (unsigned long long)grainNr,
+                        i ? "second" : "first");
+                return false;
+            }
+        }
+    }
+
+    if (!payload[0] && !payload[1]) {
+        ctx->results[grainNr] = DIFF_SAME_TABLE;
+        return true;
+    }
+    if (payload[0] && payload[1] && len[0] == len[1] &&
+        (ctx->sdi[0]->diskHdr.flags & SPARSEFLAG_COMPRESSED) == (ctx->sdi[1]->diskHdr.flags & SPARSEFLAG_COMPRESSED) &&
+        memcmp(payload[0], payload[1], len[0]) == 0) {
+        ctx->results[grainNr] = DIFF_SAME_PAYLOAD;
+        return true;
+    }
+
+    for (i = 0; i < 2; i++) {
+        if (!payload[i]) {
+            memset(contents[i], 0, grainBytes);
+        } else if (!decodeGrainPayload(ctx->sdi[i], &zstreams[i], payload[i], len[i], contents[i], grainBytes)) {
+            fprintf(stderr, "Cannot decompress grain %llu of the %s disk\n", (unsigned long long)grainNr,
+                    i ? "second" : "first");
+            return false;
+        }
+    }
+    ctx->results[grainNr] = memcmp(contents[0], contents[1], grainBytes) == 0 ? DIFF_SAME_CONTENT : DIFF_CHANGED;
+    return true;
+}
+
+static void *
+diffGrainsThread(void *arg)
+{
+    DiffContext *ctx = arg;
+    uint32_t grainBytes = ctx->sdi[0]->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    z_stream zstreams[2] = {{0}, {0}};
+    uint8_t *readBufs[2], *contents[2];
+    bool zstreamsInit = false;
+    int i;
+
+    for (i = 0; i < 2; i++) {
+        readBufs[i] = malloc(grainBytes + 2 * VMDK_SECTOR_SIZE);
+        contents[i] = malloc(grainBytes);
+    }
+    if (!readBufs[0] || !readBufs[1] || !contents[0] || !contents[1]) {
+        goto fail;
+    }
+    if (inflateInit(&zstreams[0]) != Z_OK) {
+        goto fail;
+    }
+    if (inflateInit(&zstreams[1]) != Z_OK) {
+        inflateEnd(&zstreams[0]);
+        goto fail;
+    }
+    zstreamsInit = true;
+
+    while (true) {
+        uint64_t first, grainNr, end;
+
+        pthread_mutex_lock(&ctx->mutex);
+        first = ctx->nextGrain;
+        ctx->nextGrain += ctx->grainsPerChunk;
+        if (ctx->failed) {
+            first = ctx->grains;
+        }
+        pthread_mutex_unlock(&ctx->mutex);
+        if (first >= ctx->grains) {
+            break;
+        }
+        end = first + ctx->grainsPerChunk;
+        if (end > ctx->grains) {
+            end = ctx->grains;
+        }
+        for (grainNr = first; grainNr < end; grainNr++) {
+            if (!diffGrain(ctx, grainNr, zstreams, readBufs, contents)) {
+                goto fail;
+            }
+        }
+    }
+    goto out;
+
+fail:
+    pthread_mutex_lock(&ctx->mutex);
+    ctx->failed = true;
+    pthread_mutex_unlock(&ctx->mutex);
+out:
+    if (zstreamsInit) {
+        inflateEnd(&zstreams[0]);
+        inflateEnd(&zstreams[1]);
+    }
+    for (i = 0; i < 2; i++) {
+        free(readBufs[i]);
+        free(contents[i]);
+    }
+    return NULL;
+}
+
+/*
+ * Compares two sparse disks opened with Sparse_Open grain by grain on
+ * numThreads threads and lists the changed ranges.  A disk smaller than
+ * the other one reads as zeros past its end.  Both disks must have the
+ * same grain size.
+ */
+bool
+Sparse_Diff(DiskInfo *a,
+            DiskInfo *b,
+            int numThreads,
+            DiffReport *report)
+{
+    DiffContext ctx;
+    pthread_t threads[numThreads];
+    uint64_t grainBytes, capacity, i;
+    int threadsCreated = 0;
+    bool success = false;
+
+    memset(report, 0, sizeof *report);
+    memset(&ctx, 0, sizeof ctx);
+    ctx.sdi[0] = getSDI(a);
+    ctx.sdi[1] = getSDI(b);
+    if (ctx.sdi[0]->diskHdr.grainSize != ctx.sdi[1]->diskHdr.grainSize) {
+        errno = EINVAL;
+        return false;
+    }
+    if (pthread_mutex_init(&ctx.mutex, NULL) != 0) {
+        return false;
+    }
+
+    grainBytes = ctx.sdi[0]->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    capacity = ctx.sdi[0]->diskHdr.capacity;
+    if (ctx.sdi[1]->diskHdr.capacity > capacity) {
+        capacity = ctx.sdi[1]->diskHdr.capacity;
+    }
+    capacity *= VMDK_SECTOR_SIZE;
+    ctx.grains = CEILING(capacity, grainBytes);
+    ctx.grainsPerChunk = VERIFY_CHUNK_SIZE / grainBytes;
+    ctx.results = malloc(ctx.grains ? ctx.grains : 1);
+    ctx.used[0] = malloc((ctx.grains ? ctx.grains : 1) * sizeof(uint32_t));
+    ctx.used[1] = malloc((ctx.grains ? ctx.grains : 1) * sizeof(uint32_t));
+    if (!ctx.results || !ctx.used[0] || !ctx.used[1]) {
+        goto out;
+    }
+
+    for (i = 0; i < (uint64_t)numThreads; i++) {
+        if (pthread_create(&threads[i], NULL, diffGrainsThread, &ctx) != 0) {
+            ctx.failed = true;
+            break;
+        }
+        threadsCreated++;
+    }
+    for (i = 0; i < (uint64_t)threadsCreated; i++) {
+        pthread_join(threads[i], NULL);
+    }
+    if (ctx.failed || threadsCreated == 0) {
+        errno = EIO;
+        goto out;
+    }
+
+    report->grainSize = grainBytes;
+    report->grains = ctx.grains;
+    for (i = 0; i < ctx.grains; i++) {
+        uint64_t start = i * grainBytes;
+        uint64_t length = capacity - start < grainBytes ? capacity - start : grainBytes;
+
+        report->sizeA += ctx.used[0][i];
+        report->sizeB += ctx.used[1][i];
+        switch (ctx.results[i]) {
+        case DIFF_SAME_TABLE:
+            report->sameByTable++;
+            continue;
+        case DIFF_SAME_PAYLOAD:
+            report->sameByPayload++;
+            continue;
+        case DIFF_SAME_CONTENT:
+            report->sameByContent++;
+            continue;
+        case DIFF_CHANGED:
+            break;
+        }
+        report->changedGrains++;
+        report->changedBytes += length;
+        if (report->numExtents == 0 ||
+            report->extents[report->numExtents - 1].start + report->extents[report->numExtents - 1].length != start) {
+            DiffExtent *extents = realloc(report->extents, (report->numExtents + 1) * sizeof *extents);
+
+            if (!extents) {
+                goto out;
+            }
+            report->extents = extents;
+            memset(&extents[report->numExtents], 0, sizeof *extents);
+            extents[report->numExtents].start = start;
+            report->numExtents++;
+        }
+        report->extents[report->numExtents - 1].length += length;
+        report->extents[report->numExtents - 1].sizeA += ctx.used[0][i];
+        report->extents[report->numExtents - 1].sizeB += ctx.used[1][i];
+    }
+    success = true;
+
+out:
+    if (!success) {
+        free(report->extents);
+        report->extents = NULL;
+        report->numExtents = 0;
+    }
+    free(ctx.results);
+    free(ctx.used[0]);
+    free(ctx.used[1]);
+    pthread_mutex_destroy(&ctx.mutex);
+    return success;
+}
+
+/*
+ * Returns the number of bytes each grain of a sparse disk opened with
+ * Sparse_Open takes in the file, 0 for grains that are not allocated.
+ * The array is to be freed by the caller.  grainSize is set to the grain
+ * size in bytes.
+ */
+uint32_t *
+Sparse_GetGrainSizes(DiskInfo *self,
+                     uint32_t *grainSize,
+                     uint64_t *numGrains)
+{
+    SparseDiskInfo *sdi = getSDI(self);
+    uint32_t grainBytes = sdi->diskHdr.grainSize * VMDK_SECTOR_SIZE;
+    uint64_t n = CEILING(sdi->diskHdr.capacity, sdi->diskHdr.grainSize);
+    uint8_t sector[VMDK_SECTOR_SIZE];
+    uint32_t *sizes;
+    uint64_t i;
+
+    if (n > sdi->gtInfo.GTEs) {
+        n = sdi->gtInfo.GTEs;
+    }
+    sizes = calloc(n ? n : 1, sizeof *sizes);
+    if (!sizes) {
+        return NULL;
+    }
+    for (i = 0; i < n; i++) {
+        uint32_t sect = __le32_to_cpu(sdi->gtInfo.gt[i]);
+        uint32_t hdrlen, cmpSize;
+
+        if (sect <= 1) {
+            continue;
+        }
+        if (!(sdi->diskHdr.flags & SPARSEFLAG_COMPRESSED)) {
+            sizes[i] = grainBytes;
+            continue;
+        }
+        if (!safePread(sdi->fd, sector, VMDK_SECTOR_SIZE, sect * VMDK_SECTOR_SIZE)) {
+            free(sizes);
+            return NULL;
+        }
+        if (sdi->diskHdr.flags & SPARSEFLAG_EMBEDDED_LBA) {
+            cmpSize = __le32_to_cpu(((SparseGrainLBAHeaderOnDisk *)sector)->cmpSize);
+            hdrlen = sizeof(SparseGrainLBAHeaderOnDisk);
+        } else {
+            cmpSize = __le32_to_cpu(*(__le32 *)sector);
+            hdrlen = 4;
+        }
+        sizes[i] = CEILING(hdrlen + cmpSize, VMDK_SECTOR_SIZE) * VMDK_SECTOR_SIZE;
+    }
+    *grainSize = grainBytes;
+    *numGrains = n;
+    return sizes;
+}
@@ -0,0 +1,156 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+
+/*
+ * Ultra compression spends much more CPU time for a smaller output: every
+ * grain is compressed with several encoder settings and the smallest
+ * result is kept.  All of them produce standard zlib streams, so the
+ * output is read by any inflate implementation.  Built with
+ * HAVE_LIBDEFLATE, libdeflate's exhaustive level 12 is tried as well.
+ */
+
+#include "ultra.h"
+
+#include <stdlib.h>
+#include <string.h>
+
+#include <zlib.h>
+#ifdef HAVE_LIBDEFLATE
+#include <libdeflate.h>
+#endif
+
+typedef struct {
+    int memLevel;
+    int strategy;
+} ZlibVariant;
+
+/* level 9 with the defaults (memLevel 8) is what -c 9 uses already */
+static const ZlibVariant zlibVariants[] = {
+    { 9, Z_DEFAULT_STRATEGY },
+    { 8, Z_FILTERED },
+    { 9, Z_FILTERED },
+    { 9, Z_RLE },
+};
+
+#define NUM_ZLIB_VARIANTS (sizeof zlibVariants / sizeof zlibVariants[0])
+
+struct UltraCompressor {
+    z_stream zstreams[NUM_ZLIB_VARIANTS];
+#ifdef HAVE_LIBDEFLATE
+    struct libdeflate_compressor *compressor;
+#endif
+};
+
+UltraCompressor *
+Ultra_Create(void)
+{
+    UltraCompressor *uc;
+    size_t i;
+
+    uc = calloc(1, sizeof *uc);
+    if (!uc) {
+        return NULL;
+    }
+    for (i = 0; i < NUM_ZLIB_VARIANTS; i++) {
+        if (deflateInit2(&uc->zstreams[i], Z_BEST_COMPRESSION, Z_DEFLATED, MAX_WBITS,
+                         zlibVariants[i].memLevel, zlibVariants[i].strategy) != Z_OK) {
+            while (i-- > 0) {
+                deflateEnd(&uc->zstreams[i]);
+            }
+            free(uc);
+            return NULL;
+        }
+    }
+#ifdef HAVE_LIBDEFLATE
+    uc->compressor = libdeflate_alloc_compressor(12);
+    if (!uc->compressor) {
+        for (i = 0; i < NUM_ZLIB_VARIANTS; i++) {
+            deflateEnd(&uc->zstreams[i]);
+        }
+        free(uc);
+        return NULL;
+    }
+#endif
+    return uc;
+}
+
+/*
+ * Compresses len bytes from in to out in zlib format, trying all encoder
+ * settings.  Returns the length of the smallest result, or 0 if none fits
+ * in outSize bytes.  Thread safe as long as each thread has its own uc.
+ */
+size_t
+Ultra_Compress(UltraCompressor *uc,
+               const void *in,
+               size_t len,
+               void *out,
+               size_t outSize)
+{
+    Bytef *tmp;
+    size_t best = 0;
+    size_t i;
+
+    tmp = malloc(outSize);
+    if (!tmp) {
+        return 0;
+    }
+    for (i = 0; i < NUM_ZLIB_VARIANTS; i++) {
+        z_stream *zstream = &uc->zstreams[i];
+
+        if (deflateReset(zstream) != Z_OK) {
+            continue;
+        }
+        zstream->next_in = (Bytef *)in;
+        zstream->avail_in = len;
+        zstream->next_out = tmp;
+        zstream->avail_out = best ? best - 1 : outSize;
+        if (deflate(zstream, Z_FINISH) != Z_STREAM_END) {
+            /* larger than the best so far */
+            continue;
+        }
+        best = zstream->total_out;
+        memcpy(out, tmp, best);
+    }
+#ifdef HAVE_LIBDEFLATE
+    {
+        size_t n = libdeflate_zlib_compress(uc->compressor, in, len, tmp, best ? best - 1 : outSize);
+
+        if (n != 0) {
+            best = n;
+            memcpy(out, tmp, best);
+        }
+    }
+#endif
+    free(tmp);
+    return best;
+}
+
+void
+Ultra_Free(UltraCompressor *uc)
+{
+    size_t i;
+
+    if (!uc) {
+        return;
+    }
+    for (i = 0; i < NUM_ZLIB_VARIANTS; i++) {
+        deflateEnd(&uc->zstreams[i]);
+    }
+#ifdef HAVE_LIBDEFLATE
+    libdeflate_free_compressor(uc->compressor);
+#endif
+    free(uc);
+}
@@ -0,0 +1,30 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#ifndef _ULTRA_H_
+#define _ULTRA_H_
+
+#include <stddef.h>
+
+/* compression level selecting ultra compression, on top of zlib's 1 to 9 */
+#define COMPRESSION_LEVEL_ULTRA 10
+
+typedef struct UltraCompressor UltraCompressor;
+
+UltraCompressor *Ultra_Create(void);
+size_t Ultra_Compress(UltraCompressor *uc, const void *in, size_t len, void *out, size_t outSize);
+void Ultra_Free(UltraCompressor *uc);
+
+#endif /* _ULTRA_H_ */
@@ -0,0 +1,778 @@
+/* *******************************************************************************
+ * Copyright (c) 2014-2023 VMware, Inc.  All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the “License”); you may not
+ * use this file except in compliance with the License.  You may obtain a copy of
+ * the License at:
+ *
+ *            http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software distributed
+ * under the License is distributed on an “AS IS” BASIS, without warranties or
+ * conditions of any kind, EITHER EXPRESS OR IMPLIED.  See the License for the
+ * specific language governing permissions and limitations under the License.
+ * *********************************************************************************/
+
+#define _GNU_SOURCE
+
+#include "diskinfo.h"
+
+#include <endian.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/stat.h>
+
+#define CEILING(x, y) (((x) + (y) - 1) / (y))
+
+#define VHD_SECTOR_SIZE                 512ULL
+
+#define VHD_DISK_TYPE_FIXED             2
+#define VHD_DISK_TYPE_DYNAMIC           3
+#define VHD_DISK_TYPE_DIFFERENCING      4
+#define VHD_BAT_UNUSED                  0xFFFFFFFFU
+
+#pragma pack(push, 1)
+typedef struct {
+    char cookie[8];             /* "conectix" */
+    uint32_t features;
+    uint32_t formatVersion;
+    uint64_t dataOffset;
+    uint32_t timeStamp;
+    char creatorApplication[4];
+    uint32_t creatorVersion;
+    uint32_t creatorHostOS;
+    uint64_t originalSize;
+    uint64_t currentSize;
+    uint32_t diskGeometry;
+    uint32_t diskType;
+    uint32_t checksum;
+    uint8_t uniqueId[16];
+    uint8_t savedState;
+    uint8_t reserved[427];
+} VhdFooterOnDisk;
+
+typedef struct {
+    char cookie[8];             /* "cxsparse" */
+    uint64_t dataOffset;
+    uint64_t tableOffset;
+    uint32_t headerVersion;
+    uint32_t maxTableEntries;
+    uint32_t blockSize;
+    uint32_t checksum;
+    uint8_t parentUniqueId[16];
+    uint32_t parentTimeStamp;
+    uint32_t reserved1;
+    uint8_t parentUnicodeName[512];
+    uint8_t parentLocatorEntries[8][24];
+    uint8_t reserved2[256];
+} VhdDynamicHeaderOnDisk;
+#pragma pack(pop)
+
+#define VHDX_FILE_SIGNATURE             "vhdxfile"
+#define VHDX_HEADER_SIGNATURE           "head"
+#define VHDX_REGION_SIGNATURE           "regi"
+#define VHDX_METADATA_SIGNATURE         "metadata"
+
+#define VHDX_HEADER1_OFFSET             (64 * 1024)
+#define VHDX_HEADER2_OFFSET             (128 * 1024)
+#define VHDX_HEADER_SIZE                (4 * 1024)
+#define VHDX_REGION1_OFFSET             (192 * 1024)
+#define VHDX_REGION2_OFFSET             (256 * 1024)
+#define VHDX_REGION_SIZE                (64 * 1024)
+#define VHDX_METADATA_TABLE_SIZE        (64 * 1024)
+
+#define VHDX_BAT_STATE_MASK             7
+#define VHDX_BAT_FULLY_PRESENT          6
+#define VHDX_BAT_PARTIALLY_PRESENT      7
+#define VHDX_BAT_OFFSET_MASK            0xFFFFFFFFFFF00000ULL
+
+#define VHDX_FILE_HAS_PARENT            (1 << 1)
+
+#pragma pack(push, 1)
+typedef struct {
+    char signature[4];
+    uint32_t checksum;
+    uint64_t sequenceNumber;
+    uint8_t fileWriteGuid[16];
+    uint8_t dataWriteGuid[16];
+    uint8_t logGuid[16];
+    uint16_t logVersion;
+    uint16_t version;
+    uint32_t logLength;
+    uint64_t logOffset;
+} VhdxHeaderOnDisk;
+
+typedef struct {
+    char signature[4];
+    uint32_t checksum;
+    uint32_t entryCount;
+    uint32_t reserved;
+} VhdxRegionTableHeaderOnDisk;
+
+typedef struct {
+    uint8_t guid[16];
+    uint64_t fileOffset;
+    uint32_t length;
+    uint32_t required;
+} VhdxRegionTableEntryOnDisk;
+
+typedef struct {
+    char signature[8];
+    uint16_t reserved;
+    uint16_t entryCount;
+    uint32_t reserved2[5];
+} VhdxMetadataTableHeaderOnDisk;
+
+typedef struct {
+    uint8_t itemId[16];
+    uint32_t offset;
+    uint32_t length;
+    uint32_t flags;
+    uint32_t reserved;
+} VhdxMetadataTableEntryOnDisk;
+#pragma pack(pop)
+
+/* GUIDs in their on-disk (mixed endian) byte order */
+static const uint8_t vhdxBatGuid[16] = {
+    0x66, 0x77, 0xc2, 0x2d, 0x23, 0xf6, 0x00, 0x42,
+    0x9d, 0x64, 0x11, 0x5e, 0x9b, 0xfd, 0x4a, 0x08
+};
+static const uint8_t vhdxMetadataGuid[16] = {
+    0x06, 0xa2, 0x7c, 0x8b, 0x90, 0x47, 0x9a, 0x4b,
+    0xb8, 0xfe, 0x57, 0x5f, 0x05, 0x0f, 0x88, 0x6e
+};
+static const uint8_t vhdxFileParametersGuid[16] = {
+    0x37, 0x67, 0xa1, 0xca, 0x36, 0xfa, 0x43, 0x4d,
+    0xb3, 0xb6, 0x33, 0xf0, 0xaa, 0x44, 0xe7, 0x6b
+};
+static const uint8_t vhdxVirtualDiskSizeGuid[16] = {
+    0x24, 0x42, 0xa5, 0x2f, 0x1b, 0xcd, 0x76, 0x48,
+    0xb2, 0x11, 0x5d, 0xbe, 0xd8, 0x3b, 0xf4, 0xb8
+};
+static const uint8_t vhdxLogicalSectorSizeGuid[16] = {
+    0x1d, 0xbf, 0x41, 0x81, 0x6f, 0xa9, 0x09, 0x47,
+    0xba, 0x47, 0xf2, 0x33, 0xa8, 0xfa, 0xab, 0x5f
+};
+
+typedef enum {
+    VHD_FIXED,
+    VHD_DYNAMIC,
+    VHDX
+} VhdType;
+
+typedef struct {
+    DiskInfo hdr;
+    int fd;
+    VhdType type;
+    uint64_t capacity;
+    uint32_t blockSize;
+    uint32_t bitmapSize;    /* VHD dynamic only: size of the sector bitmap preceding each block */
+    uint64_t blocks;
+    uint64_t *blockOffset;  /* file offset of each block's data, 0 if not present */
+} VhdDiskInfo;
+
+static inline VhdDiskInfo *
+getVDI(DiskInfo *self)
+{
+    return (VhdDiskInfo *)self;
+}
+
+static off_t
+VhdGetCapacity(DiskInfo *self)
+{
+    VhdDiskInfo *vdi = getVDI(self);
+
+    return vdi->capacity;
+}
+
+/* VHD dynamic disks may mark sectors of an allocated block as not present. */
+static int
+applySectorBitmap(VhdDiskInfo *vdi,
+                  uint64_t blockNr,
+                  uint64_t skip,
+                  uint8_t *buf,
+                  size_t len)
+{
+    uint8_t bitmap[vdi->bitmapSize];
+    uint64_t sect;
+
+    if (pread(vdi->fd, bitmap, vdi->bitmapSize, vdi->blockOffset[blockNr] - vdi->bitmapSize) != (ssize_t)vdi->bitmapSize) {
+        fprintf(stderr, "Failed to read VHD sector bitmap of block %llu\n", (unsigned long long)blockNr);
+        return -1;
+    }
+    for (sect = skip / VHD_SECTOR_SIZE; sect * VHD_SECTOR_SIZE < skip + len; sect++) {
+        if (!(bitmap[sect / 8] & (0x80 >> (sect % 8)))) {
+            uint64_t start = sect * VHD_SECTOR_SIZE;
+            uint64_t end = start + VHD_SECTOR_SIZE;
+
+            if (start < skip) {
+                start = skip;
+            }
+            if (end > skip + len) {
+                end = skip + len;
+            }
+            memset(buf + (start - skip), 0, end - start);
+        }
+    }
+    return 0;
+}
+
+static ssize_t
+VhdPread(DiskInfo *self,
+         void *buf,
+         size_t len,
+         off_t pos)
+{
+    VhdDiskInfo *vdi = getVDI(self);
+    uint8_t *buf8 = buf;
+
+    if ((uint64_t)pos >= vdi->capacity) {
+        return 0;
+    }
+    if (len > vdi->capacity - pos) {
+        len = vdi->capacity - pos;
+    }
+    if (vdi->type == VHD_FIXED) {
+        return pread(vdi->fd, buf, len, pos);
+    }
+
+    while (len > 0) {
+        uint64_t blockNr = pos / vdi->blockSize;
+        uint64_t skip = pos % vdi->blockSize;
+        size_t readLen = vdi->blockSize - skip;
+
+        if (len < readLen) {
+            readLen = len;
+        }
+        if (vdi->blockOffset[blockNr] == 0) {
+            memset(buf8, 0, readLen);
+        } else {
+            if (pread(vdi->fd, buf8, readLen, vdi->blockOffset[blockNr] + skip) != (ssize_t)readLen) {
+                fprintf(stderr, "Failed to read block %llu\n", (unsigned long long)blockNr);
+                return -1;
+            }
+            if (vdi->type == VHD_DYNAMIC && applySectorBitmap(vdi, blockNr, skip, buf8, readLen)) {
+                return -1;
+            }
+        }
+        buf8 += readLen;
+        pos += readLen;
+        len -= readLen;
+    }
+    return buf8 - (uint8_t *)buf;
+}
+
+static int
+VhdNextData(DiskInfo *self,
+            off_t *pos,
+            off_t *end)
+{
+    VhdDiskInfo *vdi = getVDI(self);
+    uint64_t blockNr;
+    uint64_t skip;
+
+    if (vdi->type == VHD_FIXED) {
+        off_t dataOff = lseek(vdi->fd, *end, SEEK_DATA);
+        off_t holeOff;
+
+        if (dataOff == -1) {
+            if (errno == ENXIO) {
+                return -1;
+            }
+            dataOff = *end;
+            holeOff = vdi->capacity;
+        } else {
+            holeOff = lseek(vdi->fd, dataOff, SEEK_HOLE);
+            if (holeOff == -1 || (uint64_t)holeOff > vdi->capacity) {
+                holeOff = vdi->capacity;
+            }
+        }
+        if ((uint64_t)dataOff >= vdi->capacity) {
+            errno = ENXIO;
+            return -1;
+        }
+        *pos = dataOff;
+        *end = holeOff;
+        return 0;
+    }
+
+    blockNr = *end / vdi->blockSize;
+    skip = *end % vdi->blockSize;
+    while (blockNr < vdi->blocks && vdi->blockOffset[blockNr] == 0) {
+        blockNr++;
+        skip = 0;
+    }
+    if (blockNr >= vdi->blocks) {
+        errno = ENXIO;
+        return -1;
+    }
+    *pos = blockNr * vdi->blockSize + skip;
+    while (blockNr < vdi->blocks && vdi->blockOffset[blockNr] != 0) {
+        blockNr++;
+    }
+    if (blockNr * vdi->blockSize >= vdi->capacity) {
+        *end = vdi->capacity;
+    } else {
+        *end = blockNr * vdi->blockSize;
+    }
+    return 0;
+}
+
+static int
+VhdClose(DiskInfo *self)
+{
+    VhdDiskInfo *vdi = getVDI(self);
+    int fd = vdi->fd;
+
+    free(vdi->blockOffset);
+    free(vdi);
+    return close(fd);
+}
+
+static DiskInfoVMT vhdDiskInfoVMT = {
+    .getCapacity = VhdGetCapacity,
+    .pread = VhdPread,
+    .pwrite = NULL,
+    .nextData = VhdNextData,
+    .close = VhdClose,
+    .abort = VhdClose,
+    .copyDisk = NULL,
+    .checkGrainOrder = NULL
+};
+
+static uint32_t
+vhdChecksum(const void *data, size_t len, const uint32_t *checksumField)
+{
+    const uint8_t *p = data;
+    const uint8_t *skip = (const uint8_t *)checksumField;
+    uint32_t sum = 0;
+    size_t i;
+
+    for (i = 0; i < len; i++) {
+        if (p + i >= skip && p + i < skip + sizeof *checksumField) {
+            continue;
+        }
+        sum += p[i];
+    }
+    return ~sum;
+}
+
+static uint32_t
+crc32c(const void *data, size_t len)
+{
+    static uint32_t table[256];
+    const uint8_t *p = data;
+    uint32_t crc = 0xFFFFFFFFU;
+    size_t i;
+
+    if (table[1] == 0) {
+        for (i = 0; i < 256; i++) {
+            uint32_t c = i;
+            int k;
+
+            for (k = 0; k < 8; k++) {
+                c = c & 1 ? (c >> 1) ^ 0x82F63B78U : c >> 1;
+            }
+            table[i] = c;
+        }
+    }
+    for (i = 0; i < len; i++) {
+        crc = table[(crc ^ p[i]) & 0xFF] ^ (crc >> 8);
+    }
+    return ~crc;
+}
+
+/* Verifies a VHDX structure whose CRC-32C is computed with the checksum field zeroed. */
+static bool
+checkVhdxCrc(void *data, size_t len, uint32_t *checksumField)
+{
+    uint32_t expected = le32toh(*checksumField);
+    uint32_t actual;
+
+    *checksumField = 0;
+    actual = crc32c(data, len);
+    *checksumField = htole32(expected);
+    return actual == expected;
+}
+
+static bool
+isZeroGuid(const uint8_t *guid)
+{
+    int i;
+
+    for (i = 0; i < 16; i++) {
+        if (guid[i] != 0) {
+            return false;
+        }
+    }
+    return true;
+}
+
+static bool
+openVhdDynamic(VhdDiskInfo *vdi, const VhdFooterOnDisk *footer)
+{
+    VhdDynamicHeaderOnDisk dynHdr;
+    uint32_t *bat = NULL;
+    uint64_t tableOffset;
+    uint32_t entries;
+    uint64_t i;
+    bool success = false;
+
+    if (pread(vdi->fd, &dynHdr, sizeof dynHdr, be64toh(footer->dataOffset)) != sizeof dynHdr ||
+        memcmp(dynHdr.cookie, "cxsparse", 8) != 0) {
+        fprintf(stderr, "Invalid VHD dynamic disk header\n");
+        errno = EBADMSG;
+        return false;
+    }
+    if (vhdChecksum(&dynHdr, sizeof dynHdr, &dynHdr.checksum) != be32toh(dynHdr.checksum)) {
+        fprintf(stderr, "VHD dynamic disk header checksum mismatch\n");
+        errno = EBADMSG;
+        return false;
+    }
+    vdi->blockSize = be32toh(dynHdr.blockSize);
+    if (vdi->blockSize == 0 || vdi->blockSize % VHD_SECTOR_SIZE) {
+        fprintf(stderr, "Invalid VHD block size %u\n", vdi->blockSize);
+        errno = EBADMSG;
+        return false;
+    }
+    vdi->bitmapSize = CEILING(CEILING(vdi->blockSize / VHD_SECTOR_SIZE, 8), VHD_SECTOR_SIZE) * VHD_SECTOR_SIZE;
+    vdi->blocks = CEILING(vdi->capacity, vdi->blockSize);
+    entries = be32toh(dynHdr.maxTableEntries);
+    if (entries < vdi->blocks) {
+        fprintf(stderr, "VHD block allocation table too small for disk size\n");
+        errno = EBADMSG;
+        return false;
+    }
+    tableOffset = be64toh(dynHdr.tableOffset);
+
+    bat = malloc(vdi->blocks * sizeof *bat);
+    vdi->blockOffset = calloc(vdi->blocks, sizeof *vdi->blockOffset);
+    if (!bat || !vdi->blockOffset) {
+        goto out;
+    }
+    if (pread(vdi->fd, bat, vdi->blocks * sizeof *bat, tableOffset) != (ssize_t)(vdi->blocks * sizeof *bat)) {
+        fprintf(stderr, "Failed to read VHD block allocation table\n");
+        errno = EIO;
+        goto out;
+    }
+    for (i = 0; i < vdi->blocks; i++) {
+        uint32_t sect = be32toh(bat[i]);
+
+        if (sect != VHD_BAT_UNUSED) {
+            vdi->blockOffset[i] = sect * VHD_SECTOR_SIZE + vdi->bitmapSize;
+        }
+    }
+    success = true;
+
+out:
+    free(bat);
+    return success;
+}
+
+static bool
+openVhd(VhdDiskInfo *vdi, const VhdFooterOnDisk *footer, uint64_t fileSize)
+{
+    uint32_t diskType = be32toh(footer->diskType);
+
+    vdi->capacity = be64toh(footer->currentSize);
+    switch (diskType) {
+    case VHD_DISK_TYPE_FIXED:
+        vdi->type = VHD_FIXED;
+        if (vdi->capacity > fileSize - sizeof *footer) {
+            fprintf(stderr, "VHD file is smaller than its disk size\n");
+            errno = EBADMSG;
+            return false;
+        }
+        return true;
+    case VHD_DISK_TYPE_DYNAMIC:
+        vdi->type = VHD_DYNAMIC;
+        return openVhdDynamic(vdi, footer);
+    case VHD_DISK_TYPE_DIFFERENCING:
+        fprintf(stderr, "Differencing VHD images are not supported\n");
+        errno = ENOTSUP;
+        return false;
+    default:
+        fprintf(stderr, "Unknown VHD disk type %u\n", diskType);
+        errno = ENOTSUP;
+        return false;
+    }
+}
+
+/* Returns the current header: the valid one with the highest sequence number. */
+static bool
+readVhdxHeader(int fd, VhdxHeaderOnDisk *hdr)
+{
+    static const off_t offsets[] = { VHDX_HEADER1_OFFSET, VHDX_HEADER2_OFFSET };
+    uint8_t buf[VHDX_HEADER_SIZE];
+    bool found = false;
+    unsigned int i;
+
+    for (i = 0; i < sizeof offsets / sizeof offsets[0]; i++) {
+        VhdxHeaderOnDisk *cur = (VhdxHeaderOnDisk *)buf;
+
+        if (pread(fd, buf, sizeof buf, offsets[i]) != sizeof buf ||
+            memcmp(cur->signature, VHDX_HEADER_SIGNATURE, 4) != 0 ||
+            !checkVhdxCrc(buf, sizeof buf, &cur->checksum)) {
+            continue;
+        }
+        if (!found || le64toh(cur->sequenceNumber) > le64toh(hdr->sequenceNumber)) {
+            memcpy(hdr, cur, sizeof *hdr);
+            found = true;
+        }
+    }
+    return found;
+}
+
+static bool
+readVhdxRegions(int fd, uint64_t *batOffset, uint32_t *batLength, uint64_t *metadataOffset)
+{
+    static const off_t offsets[] = { VHDX_REGION1_OFFSET, VHDX_REGION2_OFFSET };
+    uint8_t *buf = malloc(VHDX_REGION_SIZE);
+    bool success = false;
+    unsigned int i;
+
+    if (!buf) {
+        return false;
+    }
+    for (i = 0; i < sizeof offsets / sizeof offsets[0] && !success; i++) {
+        VhdxRegionTableHeaderOnDisk *hdr = (VhdxRegionTableHeaderOnDisk *)buf;
+        VhdxRegionTableEntryOnDisk *entries = (VhdxRegionTableEntryOnDisk *)(hdr + 1);
+        uint32_t count;
+        uint32_t j;
+
+        if (pread(fd, buf, VHDX_REGION_SIZE, offsets[i]) != VHDX_REGION_SIZE ||
+            memcmp(hdr->signature, VHDX_REGION_SIGNATURE, 4) != 0 ||
+            !checkVhdxCrc(buf, VHDX_REGION_SIZE, &hdr->checksum)) {
+            continue;
+        }
+        count = le32toh(hdr->entryCount);
+        if (count > (VHDX_REGION_SIZE - sizeof *hdr) / sizeof *entries) {
+            continue;
+        }
+        *batOffset = 0;
+        *metadataOffset = 0;
+        for (j = 0; j < count; j++) {
+            if (memcmp(entries[j].guid, vhdxBatGuid, 16) == 0) {
+                *batOffset = le64toh(entries[j].fileOffset);
+                *batLength = le32toh(entries[j].length);
+            } else if (memcmp(entries[j].guid, vhdxMetadataGuid, 16) == 0) {
+                *metadataOffset = le64toh(entries[j].fileOffset);
+            } else if (le32toh(entries[j].required) & 1) {
+                fprintf(stderr, "VHDX image requires an unknown region\n");
+                errno = ENOTSUP;
+                free(buf);
+                return false;
+            }
+        }
+        success = *batOffset != 0 && *metadataOffset != 0;
+    }
+    free(buf);
+    if (!success) {
+        fprintf(stderr, "No valid VHDX region table found\n");
+        errno = EBADMSG;
+    }
+    return success;
+}
+
+static bool
+readVhdxMetadata(VhdDiskInfo *vdi, uint64_t metadataOffset, uint32_t *logicalSectorSize)
+{
+    uint8_t *buf = malloc(VHDX_METADATA_TABLE_SIZE);
+    VhdxMetadataTableHeaderOnDisk *hdr = (VhdxMetadataTableHeaderOnDisk *)buf;
+    VhdxMetadataTableEntryOnDisk *entries = (VhdxMetadataTableEntryOnDisk *)(hdr + 1);
+    uint32_t fileFlags = 0;
+    uint32_t count;
+    uint32_t i;
+    bool success = false;
+
+    if (!buf) {
+        return false;
+    }
+    if (pread(vdi->fd, buf, VHDX_METADATA_TABLE_SIZE, metadataOffset) != VHDX_METADATA_TABLE_SIZE ||
+        memcmp(hdr->signature, VHDX_METADATA_SIGNATURE, 8) != 0) {
+        fprintf(stderr, "Invalid VHDX metadata table\n");
+        errno = EBADMSG;
+        goto out;
+    }
+    count = le16toh(hdr->entryCount);
+    if (count > (VHDX_METADATA_TABLE_SIZE - sizeof *hdr) / sizeof *entries) {
+        fprintf(stderr, "Invalid VHDX metadata table\n");
+        errno = EBADMSG;
+        goto out;
+    }
+    vdi->blockSize = 0;
+    vdi->capacity = 0;
+    *logicalSectorSize = 0;
+    for (i = 0; i < count; i++) {
+        uint64_t itemOffset = metadataOffset + le32toh(entries[i].offset);
+        uint8_t item[8] = {0};
+
+        if (memcmp(entries[i].itemId, vhdxFileParametersGuid, 16) == 0 ||
+            memcmp(entries[i].itemId, vhdxVirtualDiskSizeGuid, 16) == 0 ||
+            memcmp(entries[i].itemId, vhdxLogicalSectorSizeGuid, 16) == 0) {
+            if (pread(vdi->fd, item, sizeof item, itemOffset) != sizeof item) {
+                errno = EIO;
+                goto out;
+            }
+        }
+        if (memcmp(entries[i].itemId, vhdxFileParametersGuid, 16) == 0) {
+            vdi->blockSize = le32toh(*(uint32_t *)item);
+            fileFlags = le32toh(*(uint32_t *)(item + 4));
+        } else if (memcmp(entries[i].itemId, vhdxVirtualDiskSizeGuid, 16) == 0) {
+            vdi->capacity = le64toh(*(uint64_t *)item);
+        } else if (memcmp(entries[i].itemId, vhdxLogicalSectorSizeGuid, 16) == 0) {
+            *logicalSectorSize = le32toh(*(uint32_t *)item);
+        }
+    }
+    if (fileFlags & VHDX_FILE_HAS_PARENT) {
+        fprintf(stderr, "Differencing VHDX images are not supported\n");
+        errno = ENOTSUP;
+        goto out;
+    }
+    if (vdi->blockSize == 0 || vdi->capacity == 0 ||
+        (*logicalSectorSize != 512 && *logicalSectorSize != 4096)) {
+        fprintf(stderr, "Missing or invalid VHDX metadata\n");
+        errno = EBADMSG;
+        goto out;
+    }
+    success = true;
+
+out:
+    free(buf);
+    return success;
+}
+
+static bool
+openVhdx(VhdDiskInfo *vdi)
+{
+    VhdxHeaderOnDisk hdr;
+    uint64_t batOffset = 0;
+    uint32_t batLength = 0;
+    uint64_t metadataOffset = 0;
+    uint32_t logicalSectorSize;
+    uint64_t chunkRatio;
+    uint64_t batEntries;
+    uint64_t *bat = NULL;
+    uint64_t i;
+    bool success = false;
+
+    vdi->type = VHDX;
+    if (!readVhdxHeader(vdi->fd, &hdr)) {
+        fprintf(stderr, "No valid VHDX header found\n");
+        errno = EBADMSG;
+        return false;
+    }
+    if (!isZeroGuid(hdr.logGuid)) {
+        fprintf(stderr, "VHDX image has a pending log, replaying it is not supported\n");
+        errno = ENOTSUP;
+        return false;
+    }
+    if (!readVhdxRegions(vdi->fd, &batOffset, &batLength, &metadataOffset)) {
+        return false;
+    }
+    if (!readVhdxMetadata(vdi, metadataOffset, &logicalSectorSize)) {
+        return false;
+    }
+
+    /* Every chunkRatio payload block entries are followed by one sector bitmap entry. */
+    chunkRatio = ((1ULL << 23) * logicalSectorSize) / vdi->blockSize;
+    vdi->blocks = CEILING(vdi->capacity, vdi->blockSize);
+    batEntries = vdi->blocks + (vdi->blocks - 1) / chunkRatio;
+    if (batEntries * sizeof *bat > batLength) {
+        fprintf(stderr, "VHDX block allocation table too small for disk size\n");
+        errno = EBADMSG;
+        return false;
+    }
+
+    bat = malloc(batEntries * sizeof *bat);
+    vdi->blockOffset = calloc(vdi->blocks, sizeof *vdi->blockOffset);
+    if (!bat || !vdi->blockOffset) {
+        goto out;
+    }
+    if (pread(vdi->fd, bat, batEntries * sizeof *bat, batOffset) != (ssize_t)(batEntries * sizeof *bat)) {
+        fprintf(stderr, "Failed to read VHDX block allocation table\n");
+        errno = EIO;
+        goto out;
+    }
+    for (i = 0; i < vdi->blocks; i++) {
+        uint64_t entry = le64toh(bat[i + i / chunkRatio]);
+
+        switch (entry & VHDX_BAT_STATE_MASK) {
+        case VHDX_BAT_FULLY_PRESENT:
+            vdi->blockOffset[i] = entry & VHDX_BAT_OFFSET_MASK;
+            break;
+        case VHDX_BAT_PARTIALLY_PRESENT:
+            fprintf(stderr, "Partially present VHDX blocks are not supported\n");
+            errno = ENOTSUP;
+            goto out;
+        default:
+            /* not present, undefined, zero or unmapped: reads as zeros */
+            break;
+        }
+    }
+    success = true;
+
+out:
+    free(bat);
+    return success;
+}
+
+DiskInfo *
+Vhd_Open(const char *fileName)
+{
+    VhdDiskInfo *vdi = NULL;
+    VhdFooterOnDisk footer;
+    char signature[8];
+    struct stat stb;
+    bool success;
+    int err;
+    int fd;
+
+    fd = open(fileName, O_RDONLY);
+    if (fd == -1) {
+        return NULL;
+    }
+    if (fstat(fd, &stb)) {
+        goto errClose;
+    }
+    vdi = malloc(sizeof *vdi);
+    if (!vdi) {
+        goto errClose;
+    }
+    memset(vdi, 0, sizeof *vdi);
+    vdi->hdr.vmt = &vhdDiskInfoVMT;
+    vdi->fd = fd;
+
+    if (pread(fd, signature, sizeof signature, 0) == sizeof signature &&
+        memcmp(signature, VHDX_FILE_SIGNATURE, 8) == 0) {
+        success = openVhdx(vdi);
+    } else if (stb.st_size >= (off_t)sizeof footer &&
+               pread(fd, &footer, sizeof footer, stb.st_size - sizeof footer) == sizeof footer &&
+               memcmp(footer.cookie, "conectix", 8) == 0) {
+        if (vhdChecksum(&footer, sizeof footer, &footer.checksum) != be32toh(footer.checksum)) {
+            fprintf(stderr, "VHD footer checksum mismatch\n");
+            errno = EBADMSG;
+            goto errFree;
+        }
+        success = openVhd(vdi, &footer, stb.st_size);
+    } else {
+        errno = EINVAL;
+        goto errFree;
+    }
+    if (!success) {
+        goto errFree;
+    }
+    return &vdi->hdr;
+
+errFree:
+    free(vdi->blockOffset);
+    free(vdi);
+errClose:
+    err = errno;
+    close(fd);
+    errno = err;
+    return NULL;
+}